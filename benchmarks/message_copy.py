@@ -0,0 +1,64 @@
+"""
+Benchmark copying messages.
+
+Compares :meth:`vumi.message.Message.copy` with the serialize-and-parse
+round trip it replaces, both for a plain copy and for the common dispatcher
+pattern of copying a message and then modifying its `helper_metadata`.
+"""
+
+import sys
+import timeit
+
+from vumi.message import TransportUserMessage
+
+
+def mk_msg():
+    return TransportUserMessage(
+        to_addr="+1234",
+        from_addr="+5678",
+        transport_name="dummy",
+        transport_type="sms",
+        content="Hello world!",
+        transport_metadata={"foo": {"bar": "baz"}},
+        helper_metadata={"tag": {"tag": ["pool", "tag"]}},
+    )
+
+
+def json_copy(msg):
+    return msg.from_json(msg.to_json())
+
+
+def cow_copy(msg):
+    return msg.copy()
+
+
+def json_copy_and_modify(msg):
+    msg_copy = json_copy(msg)
+    msg_copy['helper_metadata']['transport_name'] = 'foo'
+    msg_copy.set_routing_endpoint('bar')
+    return msg_copy
+
+
+def cow_copy_and_modify(msg):
+    msg_copy = cow_copy(msg)
+    msg_copy['helper_metadata']['transport_name'] = 'foo'
+    msg_copy.set_routing_endpoint('bar')
+    return msg_copy
+
+
+def run_bench(loops):
+    msg = mk_msg()
+    for func in [json_copy, cow_copy, json_copy_and_modify,
+                 cow_copy_and_modify]:
+        total = timeit.timeit(lambda: func(msg), number=loops)
+        print "%-22s %8.2f us per copy" % (
+            func.__name__, total / loops * 1e6)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args:
+        loops = int(args[0])
+    else:
+        loops = 10000
+    run_bench(loops)
@@ -0,0 +1,397 @@
+"""
+Benchmark the message pipeline.
+
+Each scenario handles one message at a time and reports throughput
+(messages per second), median and 99th percentile latency and the number
+of objects retained per message. The last figure counts container objects
+created minus those freed while the garbage collector is disabled, so it
+shows how much each message leaves behind (for example, in caches or
+reference cycles), not how much it allocates. Python 2 has no allocation
+counter.
+
+Scenarios:
+
+  encode_json, encode_fast_json, encode_msgpack
+    Encode and decode a TransportUserMessage with each message codec.
+  middleware
+    Pass a message through a MiddlewareStack of five middlewares, consuming
+    and then publishing.
+  router
+    Route an inbound message with SimpleDispatchRouter.
+  connector
+    Deliver a message to a ReceiveInboundConnector over the fake AMQP
+    broker from :mod:`vumi.tests.fake_amqp`.
+  pipeline
+    Send a message from a transport through a dispatcher to an application
+    and back again as a reply, all over the fake AMQP broker.
+
+Usage:
+
+  python benchmarks/pipeline.py [-n LOOPS] [-s SCENARIO ...] [--json FILE]
+  python benchmarks/pipeline.py --compare REV_A REV_B [-n LOOPS]
+
+The second form runs the benchmarks against two git revisions of vumi (this
+script is used for both) and prints the change for each measurement.
+Scenarios that don't work with a revision are reported as skipped.
+"""
+
+import gc
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, maybeDeferred, succeed)
+from twisted.internet.task import react
+
+
+SCENARIOS = []
+
+
+def scenario(func):
+    """Register a scenario.
+
+    A scenario is a function returning a Deferred that fires with a
+    `(handle_one, cleanup)` pair. `handle_one()` handles a single message
+    and may return a Deferred. `cleanup()` may also return a Deferred.
+    """
+    SCENARIOS.append(func)
+    return func
+
+
+def mk_msg(**kw):
+    from vumi.message import TransportUserMessage
+    fields = dict(
+        to_addr="+1234",
+        from_addr="+5678",
+        transport_name="bench_transport",
+        transport_type="sms",
+        content="Hello world!",
+        transport_metadata={"foo": {"bar": "baz"}},
+        helper_metadata={"tag": {"tag": ["pool", "tag"]}},
+    )
+    fields.update(kw)
+    return TransportUserMessage(**fields)
+
+
+def nothing():
+    pass
+
+
+def codec_scenario(codec_name):
+    def setup():
+        msg = mk_msg()
+        msg_class = type(msg)
+        try:
+            from vumi.message import get_message_codec
+        except ImportError:
+            # Older revisions only have JSON.
+            if codec_name != 'json':
+                raise
+
+            def handle_one():
+                return msg_class.from_json(msg.to_json())
+
+            return handle_one, nothing
+
+        codec = get_message_codec(codec_name)
+
+        def handle_one():
+            return msg_class.decode(msg.encode(codec), codec)
+
+        return handle_one, nothing
+
+    setup.__name__ = 'encode_%s' % (codec_name,)
+    return scenario(setup)
+
+
+encode_json = codec_scenario('json')
+encode_fast_json = codec_scenario('fast_json')
+encode_msgpack = codec_scenario('msgpack')
+
+
+@scenario
+def middleware():
+    from vumi.middleware.base import BaseMiddleware, MiddlewareStack
+    stack = MiddlewareStack([
+        BaseMiddleware('mw%d' % i, {}, None) for i in range(5)])
+    msg = mk_msg()
+
+    def handle_one():
+        d = stack.apply_consume('inbound', msg, 'bench')
+        d.addCallback(
+            lambda m: stack.apply_publish('outbound', m, 'bench'))
+        return d
+
+    return handle_one, nothing
+
+
+class BenchDispatcher(object):
+    transport_publisher = {'bench_transport': None}
+
+    def publish_inbound_message(self, name, msg):
+        pass
+
+    def publish_outbound_message(self, name, msg):
+        pass
+
+
+@scenario
+def router():
+    from vumi.dispatchers.base import SimpleDispatchRouter
+    router = SimpleDispatchRouter(BenchDispatcher(), {
+        'route_mappings': {'bench_transport': ['bench_app']},
+    })
+    msg = mk_msg()
+
+    def handle_one():
+        router.dispatch_inbound_message(msg)
+
+    return handle_one, nothing
+
+
+def get_worker(worker_class, config, broker):
+    from vumi.tests.helpers import WorkerHelper
+    return WorkerHelper.get_worker_raw(worker_class, config, broker)
+
+
+@scenario
+@inlineCallbacks
+def connector():
+    from vumi.worker import BaseWorker
+    from vumi.tests.fake_amqp import FakeAMQPBroker
+
+    class BenchWorker(BaseWorker):
+        def setup_connectors(self):
+            d = self.setup_ri_connector('bench')
+            d.addCallback(lambda conn: conn.set_inbound_handler(self.handle))
+            return d
+
+        def setup_worker(self):
+            self.pending = None
+
+        def teardown_worker(self):
+            pass
+
+        def handle(self, msg):
+            d, self.pending = self.pending, None
+            d.callback(msg)
+
+    broker = FakeAMQPBroker()
+    worker = get_worker(BenchWorker, {}, broker)
+    yield worker.startWorker()
+    worker.connectors['bench'].unpause()
+    data = mk_msg().to_json()
+
+    def handle_one():
+        worker.pending = Deferred()
+        broker.publish_raw('vumi', 'bench.inbound', data)
+        return worker.pending
+
+    returnValue((handle_one, worker.stopWorker))
+
+
+@scenario
+@inlineCallbacks
+def pipeline():
+    from vumi.application.base import ApplicationWorker
+    from vumi.dispatchers.base import BaseDispatchWorker
+    from vumi.transports.base import Transport
+    from vumi.tests.fake_amqp import FakeAMQPBroker
+
+    class BenchTransport(Transport):
+        def setup_transport(self):
+            self.pending = {}
+
+        def teardown_transport(self):
+            pass
+
+        def handle_outbound_message(self, msg):
+            self.pending.pop(msg['in_reply_to']).callback(msg)
+
+    class BenchApp(ApplicationWorker):
+        def consume_user_message(self, msg):
+            return self.reply_to(msg, msg['content'])
+
+    broker = FakeAMQPBroker()
+    app = get_worker(BenchApp, {'transport_name': 'bench_app'}, broker)
+    dispatcher = get_worker(BaseDispatchWorker, {
+        'transport_names': ['bench_transport'],
+        'exposed_names': ['bench_app'],
+        'router_class': 'vumi.dispatchers.base.SimpleDispatchRouter',
+        'route_mappings': {'bench_transport': ['bench_app']},
+    }, broker)
+    transport = get_worker(
+        BenchTransport, {'transport_name': 'bench_transport'}, broker)
+    workers = [app, dispatcher, transport]
+    for worker in workers:
+        yield worker.startWorker()
+
+    def handle_one():
+        msg = mk_msg()
+        d = transport.pending[msg['message_id']] = Deferred()
+        transport.connectors['bench_transport'].publish_inbound(msg)
+        return d
+
+    @inlineCallbacks
+    def cleanup():
+        for worker in reversed(workers):
+            yield worker.stopWorker()
+
+    returnValue((handle_one, cleanup))
+
+
+def percentile(sorted_values, fraction):
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+@inlineCallbacks
+def run_scenario(setup, loops):
+    """Run a scenario and return a dict of measurements."""
+    handle_one, cleanup = yield maybeDeferred(setup)
+    # Warm up caches and lazily created state.
+    for _ in range(min(loops, 100)):
+        yield handle_one()
+
+    latencies = []
+    gc.collect()
+    gc.disable()
+    objects_start = gc.get_count()[0]
+    start = time.time()
+    try:
+        for _ in range(loops):
+            started = time.time()
+            yield handle_one()
+            latencies.append(time.time() - started)
+        elapsed = time.time() - start
+        retained_objects = gc.get_count()[0] - objects_start
+    finally:
+        gc.enable()
+    yield cleanup()
+
+    latencies.sort()
+    returnValue({
+        'msgs_per_sec': loops / elapsed,
+        'p50_us': percentile(latencies, 0.5) * 1e6,
+        'p99_us': percentile(latencies, 0.99) * 1e6,
+        'retained_objects_per_msg': float(retained_objects) / loops,
+    })
+
+
+COLUMNS = [
+    ('msgs_per_sec', 'msgs/s', '%12.0f'),
+    ('p50_us', 'p50 us', '%10.1f'),
+    ('p99_us', 'p99 us', '%10.1f'),
+    ('retained_objects_per_msg', 'kept/msg', '%10.1f'),
+]
+
+
+def print_results(results):
+    print "%-18s" % ("scenario",) + "".join(
+        "%12s" % (title,) if i == 0 else "%10s" % (title,)
+        for i, (_, title, _) in enumerate(COLUMNS))
+    for name, result in results:
+        if result is None:
+            print "%-18s skipped" % (name,)
+            continue
+        print "%-18s" % (name,) + "".join(
+            fmt % (result[key],) for key, _, fmt in COLUMNS)
+
+
+@inlineCallbacks
+def run_benchmarks(scenario_names, loops):
+    results = []
+    for setup in SCENARIOS:
+        name = setup.__name__
+        if scenario_names and name not in scenario_names:
+            continue
+        try:
+            result = yield run_scenario(setup, loops)
+        except Exception as e:
+            print >> sys.stderr, "Scenario %s failed: %r" % (name, e)
+            result = None
+        results.append((name, result))
+    returnValue(results)
+
+
+def export_revision(rev, path):
+    """Extract the tree at a git revision into `path`."""
+    archive = subprocess.Popen(
+        ['git', 'archive', rev], stdout=subprocess.PIPE)
+    subprocess.check_call(['tar', '-x', '-C', path], stdin=archive.stdout)
+    archive.stdout.close()
+    if archive.wait() != 0:
+        raise RuntimeError("Could not export revision %r" % (rev,))
+
+
+def run_revision(rev, options):
+    tmpdir = tempfile.mkdtemp(prefix='vumi-bench-')
+    try:
+        export_revision(rev, tmpdir)
+        output = os.path.join(tmpdir, 'results.json')
+        args = [sys.executable, os.path.abspath(__file__),
+                '-n', str(options.loops), '--json', output]
+        for name in options.scenarios:
+            args.extend(['-s', name])
+        env = dict(os.environ, PYTHONPATH=tmpdir)
+        subprocess.check_call(args, env=env, cwd=tmpdir)
+        with open(output) as f:
+            return json.load(f)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def compare_revisions(rev_a, rev_b, options):
+    print "Running benchmarks for %s ..." % (rev_a,)
+    results_a = dict(run_revision(rev_a, options))
+    print "Running benchmarks for %s ..." % (rev_b,)
+    results_b = run_revision(rev_b, options)
+    print
+    print "Changes from %s to %s:" % (rev_a, rev_b)
+    print "%-18s" % ("scenario",) + "".join(
+        "%12s" % (title,) for _, title, _ in COLUMNS)
+    for name, result_b in results_b:
+        result_a = results_a.get(name)
+        if result_a is None or result_b is None:
+            print "%-18s skipped" % (name,)
+            continue
+        print "%-18s" % (name,) + "".join(
+            "%+11.1f%%" % ((result_b[key] / result_a[key] - 1) * 100
+                           if result_a[key] else 0,)
+            for key, _, _ in COLUMNS)
+
+
+def main(reactor, argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--loops", type="int", default=2000,
+                      help="Number of messages per scenario.")
+    parser.add_option("-s", "--scenario", dest="scenarios", action="append",
+                      default=[], help="Scenario to run (may be repeated).")
+    parser.add_option("--json", help="Write results to this file as JSON.")
+    parser.add_option("--compare", nargs=2, metavar="REV_A REV_B",
+                      help="Compare two git revisions.")
+    options, _ = parser.parse_args(argv)
+
+    if options.compare:
+        compare_revisions(options.compare[0], options.compare[1], options)
+        return succeed(None)
+
+    d = run_benchmarks(options.scenarios, options.loops)
+
+    def report(results):
+        print_results(results)
+        if options.json:
+            with open(options.json, 'w') as f:
+                json.dump(results, f)
+
+    return d.addCallback(report)
+
+
+if __name__ == "__main__":
+    react(main, [sys.argv[1:]])
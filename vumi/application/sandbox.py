@@ -1150,6 +1150,7 @@ class Sandbox(ApplicationWorker):
     """Sandbox application worker."""
 
     CONFIG_CLASS = SandboxConfig
+    CONFIG_CACHE_SIZE = 100
 
     KB, MB = 1024, 1024 * 1024
     DEFAULT_RLIMITS = {
@@ -1170,9 +1171,14 @@ class Sandbox(ApplicationWorker):
         self.resources.validate_config()
 
     def get_config(self, msg):
-        config = self.config.copy()
-        config['sandbox_id'] = self.sandbox_id_for_message(msg)
-        return succeed(self.CONFIG_CLASS(config))
+        sandbox_id = self.sandbox_id_for_message(msg)
+
+        def build():
+            config = self.config.copy()
+            config['sandbox_id'] = sandbox_id
+            return self.CONFIG_CLASS(config)
+
+        return succeed(self.config_cache.get(sandbox_id, build))
 
     def _convert_rlimits(self, rlimits_config):
         rlimits = dict((getattr(resource, key, key), value) for key, value in
@@ -33,32 +33,97 @@ class SessionManager(object):
         self.r_server = r_server
         self.r_prefix = prefix
 
-        self.gc = task.LoopingCall(lambda: self.active_sessions())
+        self.gc = task.LoopingCall(lambda: self.clear_expired_sessions())
         self.gc.start(gc_period)
 
     def stop(self):
         if self.gc.running:
             return self.gc.stop()
 
-    def active_sessions(self):
+    def active_sessions(self, page_size=100):
         """
-        Return a list of active user_ids and associated sessions. Loops over
-        known active_sessions, some of which might have auto expired.
-        Implements lazy garbage collection, for each entry it checks if
-        the user's session still exists, if not it is removed from the set.
+        Return a generator over active user_ids and associated sessions.
+
+        The user_ids come from a sorted set of sessions, scored by when they
+        were last saved, which is read ``page_size`` entries at a time. Each
+        page of sessions is loaded in one pipeline. Implements lazy garbage
+        collection: sessions that no longer exist, some of which might have
+        auto expired, are removed from the sorted set as they're found.
+        """
+        skey = self.r_key('session_index')
+        min_score, offset = '-inf', 0
+        while True:
+            index = self.r_server.zrangebyscore(
+                skey, min_score, '+inf', start=offset, num=page_size,
+                withscores=True)
+            pipe = self.r_server.pipeline()
+            for user_id, _score in index:
+                pipe.hgetall(self.r_key('session', user_id))
+            sessions = pipe.execute() if index else []
+
+            active = set()
+            pipe = self.r_server.pipeline()
+            for (user_id, _score), session in zip(index, sessions):
+                if session:
+                    active.add(user_id)
+                else:
+                    pipe.zrem(skey, user_id)
+            if len(active) < len(index):
+                pipe.execute()
+
+            for (user_id, _score), session in zip(index, sessions):
+                if user_id in active:
+                    yield user_id, session
+
+            if len(index) < page_size:
+                break
+            # Continue from the last score we saw, skipping the sessions at
+            # that score that are still in the sorted set.
+            last_score = index[-1][1]
+            if last_score != float(min_score):
+                offset = 0
+            offset += len([user_id for user_id, score in index
+                           if score == last_score and user_id in active])
+            min_score = repr(last_score)
+
+    def clear_expired_sessions(self, batch_size=100):
+        """
+        Remove expired sessions from the sorted set of sessions and return
+        how many were removed.
+
+        Only sessions last saved more than ``max_session_length`` ago are
+        checked, ``batch_size`` at a time.
         """
-        skey = self.r_key('active_sessions')
-        sessions_to_expire = []
-        for user_id in self.r_server.smembers(skey):
-            ukey = self.r_key('session', user_id)
-            if self.r_server.exists(ukey):
-                yield user_id, self.load_session(user_id)
-            else:
-                sessions_to_expire.append(user_id)
-
-        # clear empty ones
-        for user_ids in sessions_to_expire:
-            self.r_server.srem(skey, user_id)
+        if not self.max_session_length:
+            return 0
+        skey = self.r_key('session_index')
+        max_score = time.time() - self.max_session_length
+        removed = 0
+        offset = 0
+        while True:
+            user_ids = self.r_server.zrangebyscore(
+                skey, '-inf', max_score, start=offset, num=batch_size)
+            if not user_ids:
+                break
+            pipe = self.r_server.pipeline()
+            for user_id in user_ids:
+                pipe.exists(self.r_key('session', user_id))
+            exists = pipe.execute()
+
+            expired = [user_id for user_id, session_exists
+                       in zip(user_ids, exists) if not session_exists]
+            if expired:
+                pipe = self.r_server.pipeline()
+                for user_id in expired:
+                    pipe.zrem(skey, user_id)
+                pipe.execute()
+            removed += len(expired)
+            # Skip the sessions that still exist because their expiry has
+            # been extended.
+            offset += len(user_ids) - len(expired)
+            if len(user_ids) < batch_size:
+                break
+        return removed
 
     def r_key(self, *args):
         """
@@ -104,7 +169,10 @@ class SessionManager(object):
 
     def clear_session(self, user_id):
         ukey = self.r_key('session', user_id)
-        self.r_server.delete(ukey)
+        pipe = self.r_server.pipeline()
+        pipe.delete(ukey)
+        pipe.zrem(self.r_key('session_index'), user_id)
+        pipe.execute()
 
     def save_session(self, user_id, session):
         """
@@ -120,8 +188,10 @@ class SessionManager(object):
 
         """
         ukey = self.r_key('session', user_id)
-        for s_key, s_value in session.items():
-            self.r_server.hset(ukey, s_key, s_value)
-        skey = self.r_key('active_sessions')
-        self.r_server.sadd(skey, user_id)
+        skey = self.r_key('session_index')
+        pipe = self.r_server.pipeline()
+        if session:
+            pipe.hmset(ukey, session)
+        pipe.zadd(skey, **{user_id: time.time()})
+        pipe.execute()
         return session
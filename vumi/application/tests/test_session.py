@@ -55,3 +55,47 @@ class TestSessionManager(VumiTestCase):
     def test_lazy_clearing(self):
         self.sm.save_session('user_id', {})
         self.assertEqual(list(self.sm.active_sessions()), [])
+
+    def test_active_sessions_pages(self):
+        for i in range(5):
+            self.sm.save_session("u%d" % i, {"i": i})
+        # Sessions saved at the same time are paged through by offset.
+        skey = self.sm.r_key('session_index')
+        self.fake_redis.zadd(skey, u0=1, u1=2, u2=2, u3=2, u4=3)
+        sessions = list(self.sm.active_sessions(page_size=2))
+        self.assertEqual(
+            [(user_id, session["i"]) for user_id, session in sessions],
+            [("u0", "0"), ("u1", "1"), ("u2", "2"), ("u3", "3"),
+             ("u4", "4")])
+
+    def test_active_sessions_removes_expired_sessions(self):
+        for i in range(3):
+            self.sm.save_session("u%d" % i, {"i": i})
+        self.fake_redis.delete(self.sm.r_key('session', 'u1'))
+        self.assertEqual(
+            sorted(user_id for user_id, _ in self.sm.active_sessions()),
+            ["u0", "u2"])
+        self.assertEqual(
+            sorted(self.fake_redis.zrange(
+                self.sm.r_key('session_index'), 0, -1)),
+            ["u0", "u2"])
+
+    def test_clear_session(self):
+        self.sm.create_session("u1")
+        self.sm.clear_session("u1")
+        self.assertEqual(self.sm.load_session("u1"), {})
+        self.assertEqual(
+            self.fake_redis.zrange(self.sm.r_key('session_index'), 0, -1),
+            [])
+
+    def test_clear_expired_sessions(self):
+        self.sm.max_session_length = 60
+        for i in range(3):
+            self.sm.create_session("u%d" % i)
+        skey = self.sm.r_key('session_index')
+        old = time.time() - 120
+        self.fake_redis.zadd(skey, u0=old, u1=old)
+        self.fake_redis.delete(self.sm.r_key('session', 'u0'))
+        self.assertEqual(self.sm.clear_expired_sessions(batch_size=1), 1)
+        self.assertEqual(
+            sorted(self.fake_redis.zrange(skey, 0, -1)), ["u1", "u2"])
@@ -287,6 +287,38 @@ class Count(Metric):
         self.set(1.0)
 
 
+class Gauge(Metric):
+    """A metric that reads its value from a function when polled.
+
+    Useful for measuring something that already has a current value, such
+    as a queue length, without having to set it every time it changes.
+
+    :type func: f()
+    :param func:
+        Function returning the current value.
+
+    Examples:
+
+    >>> mm = MetricManager('vumi.worker0.')
+    >>> queue = []
+    >>> my_gauge = mm.register(Gauge('queue.length', lambda: len(queue)))
+    """
+
+    def __init__(self, name, func, aggregators=None):
+        super(Gauge, self).__init__(name, aggregators=aggregators)
+        self._func = func
+
+    def set_func(self, func):
+        """Change the function the gauge reads its value from."""
+        self._func = func
+
+    def poll(self):
+        """Called periodically by the :class:`MetricManager`."""
+        values = super(Gauge, self).poll()
+        values.append((int(time.time()), self._func()))
+        return values
+
+
 class TimerError(Exception):
     """Raised when an error occurs in a call to an EventTimer method."""
 
@@ -375,6 +375,15 @@ class TestCount(VumiTestCase, CheckValuesMixin):
         self.check_poll(metric, [1.0, 1.0])
 
 
+class TestGauge(VumiTestCase, CheckValuesMixin):
+    def test_poll(self):
+        values = [3, 5]
+        metric = metrics.Gauge("foo", values.pop)
+        self.check_poll(metric, [5])
+        metric.set(1.0)
+        self.check_poll(metric, [1.0, 3])
+
+
 class TestTimer(VumiTestCase, CheckValuesMixin):
 
     def patch_time(self, starting_value):
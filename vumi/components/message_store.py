@@ -222,6 +222,55 @@ class MessageStore(object):
 
         yield msg_record.save()
 
+    def add_outbound_messages(self, msgs, tag=None, batch_id=None,
+                              batch_ids=()):
+        """Add several outbound messages to the same batches.
+
+        This does the same as `add_outbound_message()` for each message, but
+        the messages are stored concurrently and the batch caches are updated
+        with one pipeline per batch.
+
+        :returns:
+            A list of `(message_record, failure)` pairs for the messages that
+            couldn't be stored.
+        """
+        return self._add_messages(
+            OutboundMessage, self.cache.add_outbound_messages, msgs, tag,
+            batch_id, batch_ids)
+
+    @Manager.calls_manager
+    def _add_messages(self, modelcls, add_to_cache, msgs, tag, batch_id,
+                      batch_ids):
+        msgs = list(msgs)
+        msgs_by_id = dict((msg['message_id'], msg) for msg in msgs)
+        msg_records = {}
+
+        def update_record(msg_record):
+            msg_record.msg = msgs_by_id[msg_record.key]
+            msg_records[msg_record.key] = msg_record
+
+        yield self.manager.load_all(modelcls, msgs_by_id.keys(), update_record)
+        for msg_id, msg in msgs_by_id.iteritems():
+            if msg_id not in msg_records:
+                msg_records[msg_id] = modelcls(self.manager, msg_id, msg=msg)
+
+        if batch_id is None and tag is not None:
+            tag_record = yield self.current_tags.load(tag)
+            if tag_record is not None:
+                batch_id = tag_record.current_batch.key
+
+        batch_ids = list(batch_ids)
+        if batch_id is not None:
+            batch_ids.append(batch_id)
+
+        for batch_id in batch_ids:
+            for msg_record in msg_records.itervalues():
+                msg_record.batches.add_key(batch_id)
+            yield add_to_cache(batch_id, msgs)
+
+        failures = yield self.manager.store_many(msg_records.values())
+        returnValue(failures)
+
     @Manager.calls_manager
     def get_outbound_message(self, msg_id):
         msg = yield self.outbound_messages.load(msg_id)
@@ -281,6 +330,22 @@ class MessageStore(object):
 
         yield msg_record.save()
 
+    def add_inbound_messages(self, msgs, tag=None, batch_id=None,
+                             batch_ids=()):
+        """Add several inbound messages to the same batches.
+
+        This does the same as `add_inbound_message()` for each message, but
+        the messages are stored concurrently and the batch caches are updated
+        with one pipeline per batch.
+
+        :returns:
+            A list of `(message_record, failure)` pairs for the messages that
+            couldn't be stored.
+        """
+        return self._add_messages(
+            InboundMessage, self.cache.add_inbound_messages, msgs, tag,
+            batch_id, batch_ids)
+
     @Manager.calls_manager
     def get_inbound_message(self, msg_id):
         msg = yield self.inbound_messages.load(msg_id)
@@ -302,6 +367,12 @@ class MessageStore(object):
     def batch_outbound_keys(self, batch_id):
         return self.outbound_messages.index_keys('batches', batch_id)
 
+    def batch_outbound_keys_page(self, batch_id, max_results=None,
+                                 continuation=None):
+        return self.outbound_messages.index_keys_page(
+            'batches', batch_id, max_results=max_results,
+            continuation=continuation)
+
     def batch_outbound_keys_matching(self, batch_id, query):
         mr = self.outbound_messages.index_match(query, 'batches', batch_id)
         return mr.get_keys()
@@ -309,6 +380,12 @@ class MessageStore(object):
     def batch_inbound_keys(self, batch_id):
         return self.inbound_messages.index_keys('batches', batch_id)
 
+    def batch_inbound_keys_page(self, batch_id, max_results=None,
+                                continuation=None):
+        return self.inbound_messages.index_keys_page(
+            'batches', batch_id, max_results=max_results,
+            continuation=continuation)
+
     def batch_inbound_keys_matching(self, batch_id, query):
         mr = self.inbound_messages.index_match(query, 'batches', batch_id)
         return mr.get_keys()
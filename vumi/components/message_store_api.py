@@ -110,9 +110,10 @@ class MatchResource(resource.Resource):
             for bunch in self._load_bunches_cb(keys):
                 # inbound & outbound messages have a `.msg` attribute which
                 # is the actual message stored, they share the same message_id
-                # as the key.
-                messages.extend([msg.msg.payload for msg in (yield bunch)
-                                    if msg.msg])
+                # as the key. We only serialise the payloads, so we don't need
+                # to build the messages.
+                payloads = [msg.get_raw_value('msg') for msg in (yield bunch)]
+                messages.extend([payload for payload in payloads if payload])
 
             # sort the results in the order that the keys specified
             messages.sort(key=lambda msg: keys.index(msg['message_id']))
@@ -230,6 +230,47 @@ class MessageStoreCache(object):
             batch_id, msg['message_id'], timestamp)
         yield self.add_to_addr(batch_id, msg['to_addr'], timestamp)
 
+    @Manager.calls_manager
+    def add_outbound_messages(self, batch_id, msgs):
+        """
+        Add several outbound messages to the cache for the given batch_id.
+
+        This has the same effect as calling `add_outbound_message()` for each
+        message, but the message keys and addresses are written in a single
+        pipeline.
+        """
+        if not msgs:
+            return
+        pipe = self.redis.pipeline()
+        pipe.exists(self.inbound_count_key(batch_id))
+        self._add_message_keys(
+            pipe, self.outbound_key(batch_id), self.to_addr_key(batch_id),
+            msgs, 'to_addr')
+        uses_counters, new_entries, _ = yield pipe.execute()
+
+        pipe = self.redis.pipeline()
+        if new_entries:
+            pipe.hincrby(self.status_key(batch_id), 'sent', new_entries)
+        if uses_counters:
+            pipe.incr(self.outbound_count_key(batch_id), len(msgs))
+        if new_entries or uses_counters:
+            yield pipe.execute()
+        if uses_counters:
+            yield self.truncate_outbound_message_keys(batch_id)
+
+    def _add_message_keys(self, pipe, key, addr_key, msgs, addr_field):
+        """
+        Queue a `zadd` of the message keys and one of the addresses of
+        `msgs` on `pipe`, each weighted by the message timestamp.
+        """
+        message_keys, addrs = {}, {}
+        for msg in msgs:
+            timestamp = self.get_timestamp(msg['timestamp'])
+            message_keys[msg['message_id'].encode('utf-8')] = timestamp
+            addrs[msg[addr_field].encode('utf-8')] = timestamp
+        pipe.zadd(key, **message_keys)
+        pipe.zadd(addr_key, **addrs)
+
     @Manager.calls_manager
     def add_outbound_message_key(self, batch_id, message_key, timestamp):
         """
@@ -294,6 +335,28 @@ class MessageStoreCache(object):
             batch_id, msg['message_id'], timestamp)
         yield self.add_from_addr(batch_id, msg['from_addr'], timestamp)
 
+    @Manager.calls_manager
+    def add_inbound_messages(self, batch_id, msgs):
+        """
+        Add several inbound messages to the cache for the given batch_id.
+
+        This has the same effect as calling `add_inbound_message()` for each
+        message, but the message keys and addresses are written in a single
+        pipeline.
+        """
+        if not msgs:
+            return
+        pipe = self.redis.pipeline()
+        pipe.exists(self.inbound_count_key(batch_id))
+        self._add_message_keys(
+            pipe, self.inbound_key(batch_id), self.from_addr_key(batch_id),
+            msgs, 'from_addr')
+        uses_counters, _, _ = yield pipe.execute()
+
+        if uses_counters:
+            yield self.redis.incr(self.inbound_count_key(batch_id), len(msgs))
+            yield self.truncate_inbound_message_keys(batch_id)
+
     @Manager.calls_manager
     def add_inbound_message_key(self, batch_id, message_key, timestamp):
         """
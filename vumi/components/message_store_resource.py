@@ -5,6 +5,7 @@ from twisted.internet.defer import DeferredList, inlineCallbacks
 from twisted.web.resource import NoResource, Resource
 from twisted.web.server import NOT_DONE_YET
 
+from vumi import log
 from vumi.components.message_store import MessageStore
 from vumi.config import (
     ConfigDict, ConfigText, ConfigServerEndpoint, ConfigInt,
@@ -49,24 +50,47 @@ class MessageStoreProxyResource(Resource):
         else:
             concurrency = self.default_concurrency
 
-        d = self.get_keys(self.message_store, self.batch_id)
-        d.addCallback(lambda keys: list(chunks(keys, chunk_size)))
-        d.addCallback(self.fetch_chunks, concurrency, request)
+        d = self.fetch_pages(chunk_size, concurrency, request)
+        d.addErrback(self.fetch_failed, request)
         return NOT_DONE_YET
 
+    @inlineCallbacks
+    def fetch_pages(self, chunk_size, concurrency, request):
+        # We fetch only as many keys as we can handle concurrently, so we
+        # don't need to hold all the keys for a large batch in memory.
+        page_size = chunk_size * concurrency
+        if not self.message_store.manager.supports_index_pages():
+            # The Riak transport can't page through index results, so we
+            # have to fetch all the keys at once.
+            keys = yield self.get_keys(self.message_store, self.batch_id)
+            for page in chunks(keys, page_size):
+                yield self.handle_chunks(
+                    list(chunks(page, chunk_size)), request)
+            request.finish()
+            return
+        continuation = None
+        while True:
+            keys, continuation = yield self.get_keys_page(
+                self.message_store, self.batch_id, page_size, continuation)
+            yield self.handle_chunks(list(chunks(keys, chunk_size)), request)
+            if continuation is None:
+                break
+        request.finish()
+
+    def fetch_failed(self, failure, request):
+        log.err(failure, "Error fetching messages for batch %r" % (
+            self.batch_id,))
+        request.finish()
+
     def get_keys(self, message_store, batch_id):
         raise NotImplementedError('To be implemented by sub-class.')
 
-    def get_message(self, message_store, message_id):
+    def get_keys_page(self, message_store, batch_id, max_results,
+                      continuation):
         raise NotImplementedError('To be implemented by sub-class.')
 
-    @inlineCallbacks
-    def fetch_chunks(self, chunked_keys, concurrency, request):
-        while chunked_keys:
-            block, chunked_keys = (
-                chunked_keys[:concurrency], chunked_keys[concurrency:])
-            yield self.handle_chunks(block, request)
-        request.finish()
+    def get_message(self, message_store, message_id):
+        raise NotImplementedError('To be implemented by sub-class.')
 
     def handle_chunks(self, chunks, request):
         return DeferredList([
@@ -91,6 +115,11 @@ class InboundResource(MessageStoreProxyResource):
     def get_keys(self, message_store, batch_id):
         return message_store.batch_inbound_keys(batch_id)
 
+    def get_keys_page(self, message_store, batch_id, max_results,
+                      continuation):
+        return message_store.batch_inbound_keys_page(
+            batch_id, max_results=max_results, continuation=continuation)
+
     def get_message(self, message_store, message_id):
         return message_store.get_inbound_message(message_id)
 
@@ -100,6 +129,11 @@ class OutboundResource(MessageStoreProxyResource):
     def get_keys(self, message_store, batch_id):
         return message_store.batch_outbound_keys(batch_id)
 
+    def get_keys_page(self, message_store, batch_id, max_results,
+                      continuation):
+        return message_store.batch_outbound_keys_page(
+            batch_id, max_results=max_results, continuation=continuation)
+
     def get_message(self, message_store, message_id):
         return message_store.get_outbound_message(message_id)
 
@@ -2,68 +2,601 @@
 
 """Session management utilities."""
 
+from collections import OrderedDict
+import math
 import time
+from uuid import uuid4
 
+from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi import log
+from vumi.errors import VumiError
+from vumi.persist.redis_base import RedisScript
+
+
+class SessionLeaseHeld(VumiError):
+    """Raised when changing a session another process holds the lease on.
+    """
+
+
+def _acquire_session_lease(redis, keys, args):
+    lease_key, session_key = keys
+    owner, ttl = args
+    acquired = 0
+    current_owner = redis.get(lease_key)
+    if current_owner is None or current_owner == owner:
+        redis.set(lease_key, owner)
+        redis.expire(lease_key, int(ttl))
+        acquired = 1
+    session = []
+    for field, value in redis.hgetall(session_key).items():
+        session.extend([field, value])
+    return [acquired, session]
+
+
+ACQUIRE_SESSION_LEASE_SCRIPT = RedisScript('session.acquire_lease', """
+local lease_key, session_key = KEYS[1], KEYS[2]
+local acquired = 0
+local current_owner = redis.call('GET', lease_key)
+if not current_owner or current_owner == ARGV[1] then
+    redis.call('SET', lease_key, ARGV[1])
+    redis.call('EXPIRE', lease_key, ARGV[2])
+    acquired = 1
+end
+return {acquired, redis.call('HGETALL', session_key)}
+""", _acquire_session_lease)
+
+
+def _release_session_leases(redis, keys, args):
+    [owner] = args
+    for lease_key in keys:
+        if redis.get(lease_key) == owner:
+            redis.delete(lease_key)
+
+
+RELEASE_SESSION_LEASES_SCRIPT = RedisScript('session.release_leases', """
+for _, lease_key in ipairs(KEYS) do
+    if redis.call('GET', lease_key) == ARGV[1] then
+        redis.call('DEL', lease_key)
+    end
+end
+""", _release_session_leases)
+
+
+def _flush_sessions(redis, keys, args):
+    index_key, leased_keys = keys[0], keys[1:]
+    owner, lease_ttl, max_length, score = args[:4]
+    args = args[4:]
+    lost = []
+    for lease_key, session_key in zip(leased_keys[::2], leased_keys[1::2]):
+        user_id, created, num_fields = args[:3]
+        end = 3 + 2 * int(num_fields)
+        fields = args[3:end]
+        args = args[end:]
+        if redis.get(lease_key) != owner:
+            lost.append(user_id)
+            continue
+        if created == '1':
+            redis.delete(session_key)
+        if fields:
+            redis.hmset(session_key, dict(zip(fields[::2], fields[1::2])))
+        redis.zadd(index_key, **{user_id: float(score)})
+        if created == '1' and int(max_length) > 0:
+            redis.expire(session_key, int(max_length))
+        redis.expire(lease_key, int(lease_ttl))
+    return lost
+
+
+FLUSH_SESSIONS_SCRIPT = RedisScript('session.flush', """
+local index_key = KEYS[1]
+local owner, lease_ttl = ARGV[1], ARGV[2]
+local max_length, score = tonumber(ARGV[3]), ARGV[4]
+local lost = {}
+local arg = 5
+for i = 2, #KEYS, 2 do
+    local lease_key, session_key = KEYS[i], KEYS[i + 1]
+    local user_id, created = ARGV[arg], ARGV[arg + 1]
+    local num_fields = tonumber(ARGV[arg + 2])
+    local fields = {}
+    for j = 1, 2 * num_fields do
+        fields[j] = ARGV[arg + 2 + j]
+    end
+    arg = arg + 3 + 2 * num_fields
+    if redis.call('GET', lease_key) ~= owner then
+        table.insert(lost, user_id)
+    else
+        if created == '1' then
+            redis.call('DEL', session_key)
+        end
+        if num_fields > 0 then
+            redis.call('HMSET', session_key, unpack(fields))
+        end
+        redis.call('ZADD', index_key, score, user_id)
+        if created == '1' and max_length > 0 then
+            redis.call('EXPIRE', session_key, max_length)
+        end
+        redis.call('EXPIRE', lease_key, lease_ttl)
+    end
+end
+return lost
+""", _flush_sessions)
+
+
+def _encode(value):
+    # Sessions are cached as Redis would return them.
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def encode_session(session):
+    return dict((_encode(k), _encode(v)) for k, v in session.iteritems())
+
+
+class SessionCache(object):
+    """In-process cache of the sessions a :class:`SessionManager` holds
+    leases for.
+
+    Each entry expires when the lease it was cached under runs out, and the
+    least recently used entries are discarded once there are more than
+    `max_size` of them. Every read returns a copy of the cached session.
+
+    :param int max_size:
+        The maximum number of sessions to keep.
+    :param clock:
+        An :class:`IReactorTime` provider.
+    """
+
+    def __init__(self, max_size, clock):
+        self.max_size = max_size
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id):
+        """Return a copy of the cached session for a user, or ``None``."""
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            session, expires_at = entry
+            if expires_at > self.clock.seconds():
+                self._entries[user_id] = entry
+                self.hits += 1
+                return dict(session)
+        self.misses += 1
+        return None
+
+    def put(self, user_id, session, expires_at):
+        """Cache a copy of a user's session until ``expires_at``."""
+        self._entries.pop(user_id, None)
+        self._entries[user_id] = (dict(session), expires_at)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def update(self, user_id, session):
+        """Replace a cached session, keeping its expiry time."""
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            self._entries[user_id] = (dict(session), entry[1])
+
+    def renew(self, user_id, expires_at):
+        """Extend the expiry time of a cached session."""
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            self._entries[user_id] = (entry[0], expires_at)
+
+    def invalidate(self, user_id):
+        """Discard the cached session for a user, if there is one."""
+        self._entries.pop(user_id, None)
+
+    def user_ids(self):
+        return list(self._entries)
+
+    def clear(self):
+        """Discard all cached sessions."""
+        self._entries.clear()
 
 
 class SessionManager(object):
     """A manager for sessions.
 
+    Each session is stored in a Redis hash. The user_ids of active sessions
+    are kept in a sorted set, scored by when each session was last saved, so
+    that they can be paged through without scanning the whole keyspace.
+    Index entries for expired sessions are cleared out by
+    :meth:`clear_expired_sessions`, which is started in the background when
+    a session is created or saved, at most once every ``gc_period`` seconds.
+
+    If ``cache_size`` is set, sessions are also cached in process. Before
+    caching a session, the manager takes a lease on it in Redis so that only
+    one process caches a given session at a time. The lease lasts for
+    ``cache_ttl`` seconds and is renewed whenever the cached session is
+    written back. While the lease is held, loading the session doesn't touch
+    Redis, and saving it only updates the cache. Changes are written back
+    to Redis by a single script ``flush_delay`` seconds later, which only
+    writes the sessions the manager still holds the lease on. Changes to a
+    session whose lease ran out and was taken by another process are
+    discarded. Redis stays the source of truth, so another process can take
+    over once the lease runs out or is released on :meth:`stop`.
+
+    Processes that can't get the lease read the session from Redis, but
+    creating, saving or clearing it raises :class:`SessionLeaseHeld`.
+    Sessions should therefore be routed to the same process wherever
+    possible.
+
     :param TxRedisManager redis:
         Redis manager object.
     :param int max_session_length:
         Time before a session expires. Default is None (never expire).
     :param float gc_period:
-        Deprecated and ignored.
+        Minimum number of seconds between clearing expired sessions from
+        the session index. Default is 60.
+    :param int cache_size:
+        The maximum number of sessions to cache. Default is None (no cache).
+    :param float cache_ttl:
+        Seconds to cache a session for and length of the lease on it.
+    :param float flush_delay:
+        Seconds to wait before writing changed sessions back to Redis.
     """
 
-    def __init__(self, redis, max_session_length=None, gc_period=None):
+    SESSION_INDEX_KEY = 'session_index'
+    SESSION_LEASE_KEY = 'session_lease'
+
+    DEFAULT_GC_PERIOD = 60
+    DEFAULT_CACHE_TTL = 30
+    DEFAULT_FLUSH_DELAY = 0.1
+
+    def __init__(self, redis, max_session_length=None, gc_period=None,
+                 cache_size=None, cache_ttl=None, flush_delay=None):
         self.max_session_length = max_session_length
         self.redis = redis
-        if gc_period is not None:
-            log.warning("SessionManager 'gc_period' parameter is deprecated.")
+        if gc_period is None:
+            gc_period = self.DEFAULT_GC_PERIOD
+        self.gc_period = gc_period
+        self.clock = self.get_clock()
+        self._next_gc = None
+        self._gc_d = None
+        self.cache = None
+        if cache_size:
+            self.cache = SessionCache(cache_size, self.clock)
+        self.lease_ttl = int(math.ceil(cache_ttl or self.DEFAULT_CACHE_TTL))
+        if flush_delay is None:
+            flush_delay = self.DEFAULT_FLUSH_DELAY
+        self.flush_delay = flush_delay
+        self.lease_owner = uuid4().hex
+        # Sessions changed in the cache but not yet written back, as
+        # (session, created) pairs. `created` is set if the session was
+        # created, rather than just saved, since the last flush.
+        self._unflushed = OrderedDict()
+        self._flush_call = None
+
+    def get_clock(self):
+        return reactor
 
     @inlineCallbacks
     def stop(self, stop_redis=True):
+        if self._gc_d is not None:
+            yield self._gc_d
+        if self.cache is not None:
+            yield self.flush()
+            yield self.release_leases()
         if stop_redis:
             yield self.redis._close()
 
     @classmethod
     def from_redis_config(cls, config, key_prefix=None,
-                          max_session_length=None, gc_period=None):
+                          max_session_length=None, gc_period=None,
+                          cache_size=None, cache_ttl=None, flush_delay=None):
         """Create a `SessionManager` instance using `TxRedisManager`.
         """
         from vumi.persist.txredis_manager import TxRedisManager
         d = TxRedisManager.from_config(config)
         if key_prefix is not None:
             d.addCallback(lambda m: m.sub_manager(key_prefix))
-        return d.addCallback(lambda m: cls(m, max_session_length, gc_period))
+        return d.addCallback(lambda m: cls(
+            m, max_session_length, gc_period, cache_size=cache_size,
+            cache_ttl=cache_ttl, flush_delay=flush_delay))
+
+    def session_key(self, user_id):
+        return "%s:%s" % ('session', user_id)
+
+    def lease_key(self, user_id):
+        return "%s:%s" % (self.SESSION_LEASE_KEY, user_id)
+
+    @inlineCallbacks
+    def acquire_lease(self, user_id):
+        """Take or renew the lease on a user's session and load it.
+
+        :returns:
+            A deferred that fires with an ``(acquired, session)`` pair.
+            ``acquired`` is ``False`` if another process holds the lease.
+        """
+        acquired, fields = yield self.redis.run_script(
+            ACQUIRE_SESSION_LEASE_SCRIPT,
+            [self.lease_key(user_id), self.session_key(user_id)],
+            [self.lease_owner, self.lease_ttl])
+        returnValue((bool(acquired), dict(zip(fields[::2], fields[1::2]))))
+
+    def release_leases(self):
+        """Release the leases on all the sessions in the cache and empty it.
+
+        Unflushed changes are discarded, so call :meth:`flush` first.
+        """
+        user_ids = set(self.cache.user_ids()) | set(self._unflushed)
+        self.cache.clear()
+        self._unflushed.clear()
+        return self._release_leases(user_ids)
+
+    def _release_leases(self, user_ids):
+        return self.redis.run_script(
+            RELEASE_SESSION_LEASES_SCRIPT,
+            [self.lease_key(user_id) for user_id in user_ids],
+            [self.lease_owner])
+
+    @inlineCallbacks
+    def _load_leased(self, user_id):
+        """Load a session from the cache, taking the lease on it if it isn't
+        cached.
+
+        :returns:
+            A deferred that fires with a ``(held, session)`` pair. ``held``
+            is ``False`` if another process holds the lease.
+        """
+        session = self.cache.get(user_id)
+        if session is not None:
+            returnValue((True, session))
+        if user_id in self._unflushed:
+            # Evicted from the cache (or its lease ran out) before it was
+            # written back. The flush checks that we still hold the lease.
+            yield self.flush()
+        acquired, session = yield self.acquire_lease(user_id)
+        if acquired:
+            self.cache.put(
+                user_id, session, self.clock.seconds() + self.lease_ttl)
+        returnValue((acquired, session))
+
+    @inlineCallbacks
+    def _hold_lease(self, user_id):
+        """Like :meth:`_load_leased`, but raise :class:`SessionLeaseHeld`
+        if another process holds the lease."""
+        held, session = yield self._load_leased(user_id)
+        if not held:
+            raise SessionLeaseHeld(
+                "Another process holds the lease on the session for %r." % (
+                    user_id,))
+        returnValue(session)
+
+    def _cache_changed(self, user_id, session, created=False):
+        """Update a cached session and schedule a flush."""
+        self.cache.update(user_id, session)
+        _, was_created = self._unflushed.pop(user_id, (None, False))
+        self._unflushed[user_id] = (dict(session), created or was_created)
+        if self._flush_call is None:
+            self._flush_call = self.clock.callLater(
+                self.flush_delay, self._scheduled_flush)
+
+    def _scheduled_flush(self):
+        self._flush_call = None
+        return self.flush().addErrback(
+            log.err, "Error writing sessions to Redis")
+
+    @inlineCallbacks
+    def flush(self):
+        """Write changes to cached sessions back to Redis and renew the
+        leases on them.
+
+        Sessions whose lease has been lost are dropped from the cache and
+        their changes are discarded. If the write fails, the changes are kept
+        for the next flush.
+        """
+        if self._flush_call is not None:
+            self._flush_call.cancel()
+            self._flush_call = None
+        unflushed, self._unflushed = self._unflushed, OrderedDict()
+        if not unflushed:
+            return
+
+        expires_at = self.clock.seconds() + self.lease_ttl
+        keys = [self.SESSION_INDEX_KEY]
+        args = [self.lease_owner, self.lease_ttl,
+                int(self.max_session_length or 0), repr(time.time())]
+        for user_id, (session, created) in unflushed.iteritems():
+            keys.extend([self.lease_key(user_id), self.session_key(user_id)])
+            args.extend([user_id, int(created), len(session)])
+            for field, value in session.iteritems():
+                args.extend([field, value])
+        try:
+            lost = yield self.redis.run_script(
+                FLUSH_SESSIONS_SCRIPT, keys, args)
+        except Exception:
+            # Changes made since take precedence over the ones we failed
+            # to write.
+            for user_id, (session, created) in unflushed.iteritems():
+                if user_id in self._unflushed:
+                    session, newer_created = self._unflushed[user_id]
+                    created = created or newer_created
+                self._unflushed[user_id] = (session, created)
+            if self._flush_call is None:
+                self._flush_call = self.clock.callLater(
+                    self.flush_delay, self._scheduled_flush)
+            raise
+        for user_id in lost:
+            log.warning(
+                "Lost the lease on the session for %r, discarding changes."
+                % (user_id,))
+            self.cache.invalidate(user_id)
+            self._unflushed.pop(user_id, None)
+        for user_id in unflushed:
+            if user_id not in lost:
+                self.cache.renew(user_id, expires_at)
 
     @inlineCallbacks
     def active_sessions(self):
         """Return a list of active user_ids and associated sessions.
 
-        Queries redis for keys starting with the session key prefix. This is
-        O(n) over the total number of keys in redis, but this is still pretty
-        quick even for millions of keys. Try not to hit this too often, though.
+        This loads every session in the session index, a page at a time.
+        Use :meth:`stream_active_sessions` to avoid holding them all in
+        memory at once.
         """
-        keys = yield self.redis.keys('session:*')
         sessions = []
-        for user_id in [key.split(':', 1)[1] for key in keys]:
-            sessions.append((user_id, (yield self.load_session(user_id))))
-
+        yield self.stream_active_sessions(sessions.extend)
         returnValue(sessions)
 
+    def _parse_continuation(self, continuation):
+        if continuation is None:
+            return '-inf', 0
+        score, offset = continuation.rsplit(':', 1)
+        return score, int(offset)
+
+    @inlineCallbacks
+    def active_sessions_page(self, max_results=100, continuation=None):
+        """Fetch a page of active user_ids and associated sessions.
+
+        Sessions are paged through in order of when they were last saved,
+        using the session index. Index entries for sessions that have expired
+        are removed as they're found, so a page may hold fewer than
+        ``max_results`` sessions. A session saved while the pages are being
+        fetched may be returned twice.
+
+        :returns:
+            A deferred that fires with a ``(sessions, continuation)`` pair,
+            where ``sessions`` is a list of ``(user_id, session)`` pairs.
+            Pass ``continuation`` back in to fetch the next page. It is
+            ``None`` on the last page.
+        """
+        min_score, offset = self._parse_continuation(continuation)
+        index = yield self.redis.zrangebyscore(
+            self.SESSION_INDEX_KEY, min_score, '+inf', start=offset,
+            num=max_results, withscores=True)
+        user_ids = [user_id for user_id, _score in index]
+        loaded = yield self.load_sessions(user_ids)
+
+        sessions = []
+        expired = []
+        for user_id, session in zip(user_ids, loaded):
+            if session:
+                sessions.append((user_id, session))
+            else:
+                expired.append(user_id)
+        if expired:
+            pipe = self.redis.pipeline()
+            for user_id in expired:
+                pipe.zrem(self.SESSION_INDEX_KEY, user_id)
+            yield pipe.execute()
+
+        if len(index) < max_results:
+            returnValue((sessions, None))
+        # Continue from the last score we saw, skipping the sessions at that
+        # score that are still in the index.
+        last_score = index[-1][1]
+        if last_score != float(min_score):
+            offset = 0
+        active = set(user_id for user_id, _session in sessions)
+        for user_id, score in index:
+            if score == last_score and user_id in active:
+                offset += 1
+        returnValue((sessions, "%r:%d" % (last_score, offset)))
+
+    @inlineCallbacks
+    def stream_active_sessions(self, callback, page_size=100):
+        """Fetch all active sessions, a page at a time.
+
+        ``callback`` is called with each page, a list of ``(user_id,
+        session)`` pairs. If it returns a deferred, the next page isn't
+        fetched until it fires.
+        """
+        continuation = None
+        while True:
+            sessions, continuation = yield self.active_sessions_page(
+                page_size, continuation)
+            if sessions:
+                yield callback(sessions)
+            if continuation is None:
+                break
+
+    @inlineCallbacks
+    def clear_expired_sessions(self, batch_size=100):
+        """Remove expired sessions from the session index and return how
+        many were removed.
+
+        Redis expires the sessions themselves. Only index entries for
+        sessions last saved more than ``max_session_length`` ago are
+        checked, ``batch_size`` at a time.
+        """
+        if not self.max_session_length:
+            returnValue(0)
+        max_score = time.time() - self.max_session_length
+        removed = 0
+        offset = 0
+        while True:
+            user_ids = yield self.redis.zrangebyscore(
+                self.SESSION_INDEX_KEY, '-inf', max_score, start=offset,
+                num=batch_size)
+            if not user_ids:
+                break
+            pipe = self.redis.pipeline()
+            for user_id in user_ids:
+                pipe.exists(self.session_key(user_id))
+            exists = yield pipe.execute()
+
+            expired = [user_id for user_id, session_exists
+                       in zip(user_ids, exists) if not session_exists]
+            if expired:
+                pipe = self.redis.pipeline()
+                for user_id in expired:
+                    pipe.zrem(self.SESSION_INDEX_KEY, user_id)
+                yield pipe.execute()
+            removed += len(expired)
+            # Skip the sessions that still exist because their expiry has
+            # been extended.
+            offset += len(user_ids) - len(expired)
+            if len(user_ids) < batch_size:
+                break
+        returnValue(removed)
+
+    def _maybe_clear_expired_sessions(self):
+        """Start clearing expired sessions if it's time to.
+
+        This doesn't wait for them to be cleared, so creating or saving a
+        session never waits on a large index being cleaned up.
+        """
+        if not self.max_session_length or self._gc_d is not None:
+            return
+        now = self.clock.seconds()
+        if self._next_gc is not None and now < self._next_gc:
+            return
+        self._next_gc = now + self.gc_period
+        self._gc_d = d = self.clear_expired_sessions()
+        d.addErrback(log.err, "Error clearing expired sessions")
+        d.addBoth(self._gc_done)
+
+    def _gc_done(self, _):
+        self._gc_d = None
+
+    @inlineCallbacks
     def load_session(self, user_id):
         """
-        Load session data from Redis
+        Load session data from the cache or Redis
         """
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.hgetall(ukey)
+        if self.cache is None:
+            returnValue((yield self.redis.hgetall(self.session_key(user_id))))
+        _held, session = yield self._load_leased(user_id)
+        returnValue(session)
 
+    def load_sessions(self, user_ids):
+        """
+        Load the sessions for several users from Redis in one round trip.
+        """
+        pipe = self.redis.pipeline()
+        for user_id in user_ids:
+            pipe.hgetall(self.session_key(user_id))
+        return pipe.execute()
+
+    @inlineCallbacks
     def schedule_session_expiry(self, user_id, timeout):
         """
         Schedule a session to timeout
@@ -75,28 +608,57 @@ class SessionManager(object):
         timeout : int
             The number of seconds after which this session should expire
         """
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.expire(ukey, timeout)
+        if user_id in self._unflushed:
+            # The session may not be in Redis yet.
+            yield self.flush()
+        returnValue((yield self.redis.expire(
+            self.session_key(user_id), timeout)))
 
     @inlineCallbacks
     def create_session(self, user_id, **kwargs):
         """
         Create a new session using the given user_id
         """
-        yield self.clear_session(user_id)
+        ukey = self.session_key(user_id)
         defaults = {
             'created_at': time.time()
         }
         defaults.update(kwargs)
-        yield self.save_session(user_id, defaults)
+        self._maybe_clear_expired_sessions()
+        if self.cache is not None:
+            yield self._hold_lease(user_id)
+            session = encode_session(defaults)
+            self.cache.put(
+                user_id, session, self.clock.seconds() + self.lease_ttl)
+            self._cache_changed(user_id, session, created=True)
+            returnValue(session)
+        pipe = self.redis.pipeline()
+        pipe.delete(ukey)
+        self._save_session(pipe, user_id, defaults)
         if self.max_session_length:
-            yield self.schedule_session_expiry(user_id,
-                                               int(self.max_session_length))
-        returnValue((yield self.load_session(user_id)))
+            pipe.expire(ukey, int(self.max_session_length))
+        pipe.hgetall(ukey)
+        results = yield pipe.execute()
+        returnValue(results[-1])
 
+    @inlineCallbacks
     def clear_session(self, user_id):
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.delete(ukey)
+        if self.cache is not None:
+            yield self._hold_lease(user_id)
+            self.cache.invalidate(user_id)
+            self._unflushed.pop(user_id, None)
+        pipe = self.redis.pipeline()
+        pipe.delete(self.session_key(user_id))
+        pipe.zrem(self.SESSION_INDEX_KEY, user_id)
+        deleted, _ = yield pipe.execute()
+        if self.cache is not None:
+            yield self._release_leases([user_id])
+        returnValue(deleted)
+
+    def _save_session(self, pipe, user_id, session):
+        if session:
+            pipe.hmset(self.session_key(user_id), session)
+        pipe.zadd(self.SESSION_INDEX_KEY, **{user_id: time.time()})
 
     @inlineCallbacks
     def save_session(self, user_id, session):
@@ -111,8 +673,16 @@ class SessionManager(object):
             The session info, nested dictionaries are not supported. Any
             values that are dictionaries are converted to strings by Redis.
 
+        Raises :class:`SessionLeaseHeld` if sessions are cached and another
+        process holds the lease on this one.
         """
-        ukey = "%s:%s" % ('session', user_id)
-        for s_key, s_value in session.items():
-            yield self.redis.hset(ukey, s_key, s_value)
+        self._maybe_clear_expired_sessions()
+        if self.cache is not None:
+            cached = yield self._hold_lease(user_id)
+            cached.update(encode_session(session))
+            self._cache_changed(user_id, cached)
+            returnValue(session)
+        pipe = self.redis.pipeline()
+        self._save_session(pipe, user_id, session)
+        yield pipe.execute()
         returnValue(session)
@@ -9,13 +9,217 @@ import time
 from twisted.internet.defer import returnValue
 
 from vumi.errors import VumiError
-from vumi.persist.redis_base import Manager
+from vumi.persist.redis_base import Manager, RedisScript
 
 
 class TagpoolError(VumiError):
     """An error occurred during an operation on a tag pool."""
 
 
+# Each free tag has exactly one entry in its pool's free list. Acquiring a
+# specific tag leaves that entry where it is (removing it would mean scanning
+# the list) and records the tag in the pool's stale set instead. Whoever pops
+# a stale entry discards it, and releasing a tag whose entry is still in the
+# list just clears the stale marker rather than pushing a second entry.
+
+# Owner tag set members are written exactly as ``json.dumps([pool, tag])``
+# writes them, so that they can be removed again by value. cjson escapes
+# differently (it leaves non-ASCII characters as UTF-8 and escapes "/"), so
+# the Lua side escapes the UTF-8 encoded tag the way Python's json module
+# does.
+OWNER_MEMBER_LUA = r"""
+local json_escapes = {
+    [8] = '\\b', [9] = '\\t', [10] = '\\n', [12] = '\\f', [13] = '\\r',
+    [34] = '\\"', [92] = '\\\\',
+}
+
+local function json_string(text)
+    local out = {}
+    local i = 1
+    while i <= #text do
+        local c = string.byte(text, i)
+        local code, len = c, 1
+        if c >= 0xF0 then
+            code, len = c % 0x08, 4
+        elseif c >= 0xE0 then
+            code, len = c % 0x10, 3
+        elseif c >= 0xC0 then
+            code, len = c % 0x20, 2
+        end
+        for j = i + 1, i + len - 1 do
+            code = code * 0x40 + string.byte(text, j) % 0x40
+        end
+        i = i + len
+        if json_escapes[code] then
+            out[#out + 1] = json_escapes[code]
+        elseif code >= 0x20 and code < 0x7F then
+            out[#out + 1] = string.char(code)
+        elseif code < 0x10000 then
+            out[#out + 1] = string.format('\\u%04x', code)
+        else
+            code = code - 0x10000
+            out[#out + 1] = string.format(
+                '\\u%04x\\u%04x', 0xD800 + math.floor(code / 0x400),
+                0xDC00 + code % 0x400)
+        end
+    end
+    return '"' .. table.concat(out) .. '"'
+end
+
+local function owner_member(pool_json, tag)
+    return '[' .. pool_json .. ', ' .. json_string(tag) .. ']'
+end
+"""
+
+
+def _owner_member(pool_json, tag):
+    return "[%s, %s]" % (pool_json, json.dumps(tag.decode("utf-8")))
+
+
+def _acquire_tags(redis, keys, args):
+    free_list, free_set, inuse_set, stale_set, reason_hash, owner_key = keys
+    count, reason_json, pool_json = args
+    acquired = []
+    while len(acquired) < int(count):
+        tag = redis.lpop(free_list)
+        if tag is None:
+            break
+        if redis.srem(stale_set, tag):
+            continue
+        if not redis.smove(free_set, inuse_set, tag):
+            continue
+        redis.hset(reason_hash, tag, reason_json)
+        redis.sadd(owner_key, _owner_member(pool_json, tag))
+        acquired.append(tag)
+    return acquired
+
+
+ACQUIRE_TAGS_SCRIPT = RedisScript('tagpool.acquire_tags', OWNER_MEMBER_LUA + """
+local free_list, free_set, inuse_set = KEYS[1], KEYS[2], KEYS[3]
+local stale_set, reason_hash, owner_key = KEYS[4], KEYS[5], KEYS[6]
+local count = tonumber(ARGV[1])
+local acquired = {}
+while #acquired < count do
+    local tag = redis.call('LPOP', free_list)
+    if not tag then
+        break
+    end
+    if redis.call('SREM', stale_set, tag) == 0 and
+            redis.call('SMOVE', free_set, inuse_set, tag) == 1 then
+        redis.call('HSET', reason_hash, tag, ARGV[2])
+        redis.call('SADD', owner_key, owner_member(ARGV[3], tag))
+        acquired[#acquired + 1] = tag
+    end
+end
+return acquired
+""", _acquire_tags)
+
+
+def _acquire_specific_tag(redis, keys, args):
+    free_set, inuse_set, stale_set, reason_hash, owner_key = keys
+    tag, reason_json, pool_json = args
+    if not redis.smove(free_set, inuse_set, tag):
+        return 0
+    redis.sadd(stale_set, tag)
+    redis.hset(reason_hash, tag, reason_json)
+    redis.sadd(owner_key, _owner_member(pool_json, tag))
+    return 1
+
+
+ACQUIRE_SPECIFIC_TAG_SCRIPT = RedisScript(
+    'tagpool.acquire_specific_tag', OWNER_MEMBER_LUA + """
+local free_set, inuse_set, stale_set = KEYS[1], KEYS[2], KEYS[3]
+local reason_hash, owner_key = KEYS[4], KEYS[5]
+local tag = ARGV[1]
+if redis.call('SMOVE', free_set, inuse_set, tag) == 0 then
+    return 0
+end
+redis.call('SADD', stale_set, tag)
+redis.call('HSET', reason_hash, tag, ARGV[2])
+redis.call('SADD', owner_key, owner_member(ARGV[3], tag))
+return 1
+""", _acquire_specific_tag)
+
+
+def _release_tag(redis, keys, args):
+    (free_list, free_set, inuse_set, stale_set, reason_hash, unowned_key,
+     owners_prefix) = keys
+    tag, pool_json = args
+    if not redis.smove(inuse_set, free_set, tag):
+        return 0
+    if not redis.srem(stale_set, tag):
+        redis.rpush(free_list, tag)
+    reason_json = redis.hget(reason_hash, tag)
+    redis.hdel(reason_hash, tag)
+    owner_key = unowned_key
+    if reason_json is not None:
+        owner = json.loads(reason_json).get('owner')
+        if owner is not None:
+            owner_key = "%s%s:tags" % (
+                owners_prefix, unicode(owner).encode('utf-8'))
+    redis.srem(owner_key, _owner_member(pool_json, tag))
+    return 1
+
+
+# The owner tag set key depends on who acquired the tag, so it's built from
+# the owner in the tag's reason.
+RELEASE_TAG_SCRIPT = RedisScript('tagpool.release_tag', OWNER_MEMBER_LUA + """
+local free_list, free_set, inuse_set = KEYS[1], KEYS[2], KEYS[3]
+local stale_set, reason_hash = KEYS[4], KEYS[5]
+local unowned_key, owners_prefix = KEYS[6], KEYS[7]
+local tag = ARGV[1]
+if redis.call('SMOVE', inuse_set, free_set, tag) == 0 then
+    return 0
+end
+if redis.call('SREM', stale_set, tag) == 0 then
+    redis.call('RPUSH', free_list, tag)
+end
+local reason_json = redis.call('HGET', reason_hash, tag)
+redis.call('HDEL', reason_hash, tag)
+local owner_key = unowned_key
+if reason_json then
+    local owner = cjson.decode(reason_json)['owner']
+    if owner ~= nil and owner ~= cjson.null then
+        owner_key = owners_prefix .. owner .. ':tags'
+    end
+end
+redis.call('SREM', owner_key, owner_member(ARGV[2], tag))
+return 1
+""", _release_tag)
+
+
+def _declare_tags(redis, keys, args):
+    pool_list, free_list, free_set, inuse_set = keys
+    pool, tags = args[0], args[1:]
+    redis.sadd(pool_list, pool)
+    declared = 0
+    for tag in tags:
+        if redis.sismember(free_set, tag) or redis.sismember(inuse_set, tag):
+            continue
+        redis.sadd(free_set, tag)
+        redis.rpush(free_list, tag)
+        declared += 1
+    return declared
+
+
+DECLARE_TAGS_SCRIPT = RedisScript('tagpool.declare_tags', """
+local pool_list, free_list, free_set, inuse_set = KEYS[1], KEYS[2], KEYS[3],
+    KEYS[4]
+redis.call('SADD', pool_list, ARGV[1])
+local declared = 0
+for i = 2, #ARGV do
+    local tag = ARGV[i]
+    if redis.call('SISMEMBER', free_set, tag) == 0 and
+            redis.call('SISMEMBER', inuse_set, tag) == 0 then
+        redis.call('SADD', free_set, tag)
+        redis.call('RPUSH', free_list, tag)
+        declared = declared + 1
+    end
+end
+return declared
+""", _declare_tags)
+
+
 class TagpoolManager(object):
     """Manage a set of tag pools.
 
@@ -25,6 +229,9 @@ class TagpoolManager(object):
 
     encoding = "UTF-8"
 
+    # The most tags declare_tags() sends to Redis in one script call.
+    DECLARE_BATCH_SIZE = 1000
+
     def __init__(self, redis):
         self.redis = redis
         self.manager = redis  # TODO: This is a bit of a hack to make the
@@ -38,8 +245,18 @@ class TagpoolManager(object):
 
     @Manager.calls_manager
     def acquire_tag(self, pool, owner=None, reason=None):
-        local_tag = yield self._acquire_tag(pool, owner, reason)
-        returnValue((pool, local_tag) if local_tag is not None else None)
+        local_tags = yield self._acquire_tags(pool, 1, owner, reason)
+        returnValue((pool, local_tags[0]) if local_tags else None)
+
+    @Manager.calls_manager
+    def acquire_tags(self, pool, n, owner=None, reason=None):
+        """Acquire up to ``n`` tags from ``pool`` in one atomic operation.
+
+        Returns a list of the acquired tags, which is shorter than ``n`` if
+        the pool doesn't have enough free tags.
+        """
+        local_tags = yield self._acquire_tags(pool, n, owner, reason)
+        returnValue([(pool, local_tag) for local_tag in local_tags])
 
     @Manager.calls_manager
     def acquire_specific_tag(self, tag, owner=None, reason=None):
@@ -61,7 +278,6 @@ class TagpoolManager(object):
         for pool, local_tag in tags:
             pools.setdefault(pool, []).append(local_tag)
         for pool, local_tags in pools.items():
-            yield self._register_pool(pool)
             yield self._declare_tags(pool, local_tags)
 
     @Manager.calls_manager
@@ -93,6 +309,7 @@ class TagpoolManager(object):
             yield self.redis.delete(free_set_key)
             yield self.redis.delete(free_list_key)
             yield self.redis.delete(inuse_set_key)
+            yield self.redis.delete(self._tag_pool_stale_key(pool))
             yield self.redis.delete(metadata_key)
             yield self._unregister_pool(pool)
 
@@ -161,43 +378,48 @@ class TagpoolManager(object):
         pool = self._encode(pool)
         return ":".join(["tagpools", pool, "metadata"])
 
+    def _tag_pool_stale_key(self, pool):
+        pool = self._encode(pool)
+        return ":".join(["tagpools", pool, "free:list:stale"])
+
     @Manager.calls_manager
-    def _acquire_tag(self, pool, owner, reason):
+    def _acquire_tags(self, pool, count, owner, reason):
         free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        tag = yield self.redis.lpop(free_list_key)
-        if tag is not None:
-            yield self.redis.smove(free_set_key, inuse_set_key, tag)
-            yield self._store_reason(pool, tag, owner, reason)
-        returnValue(self._decode(tag) if tag is not None else None)
+        local_tags = yield self.redis.run_script(ACQUIRE_TAGS_SCRIPT, [
+            free_list_key, free_set_key, inuse_set_key,
+            self._tag_pool_stale_key(pool), self._tag_pool_reason_key(pool),
+            self._owner_tag_list_key(owner),
+        ], [count, self._reason_json(owner, reason), json.dumps(pool)])
+        returnValue([self._decode(local_tag) for local_tag in local_tags])
 
     @Manager.calls_manager
     def _acquire_specific_tag(self, pool, local_tag, owner, reason):
-        local_tag = self._encode(local_tag)
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        moved = yield self.redis.lrem(free_list_key, local_tag, num=1)
-        if moved:
-            yield self.redis.smove(free_set_key, inuse_set_key, local_tag)
-            yield self._store_reason(pool, local_tag, owner, reason)
-        returnValue(moved)
+        _free_list, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
+        acquired = yield self.redis.run_script(ACQUIRE_SPECIFIC_TAG_SCRIPT, [
+            free_set_key, inuse_set_key, self._tag_pool_stale_key(pool),
+            self._tag_pool_reason_key(pool), self._owner_tag_list_key(owner),
+        ], [self._encode(local_tag), self._reason_json(owner, reason),
+            json.dumps(pool)])
+        returnValue(acquired)
 
-    @Manager.calls_manager
     def _release_tag(self, pool, local_tag):
-        local_tag = self._encode(local_tag)
         free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        count = yield self.redis.smove(inuse_set_key, free_set_key, local_tag)
-        if count == 1:
-            yield self.redis.rpush(free_list_key, local_tag)
-            yield self._remove_reason(pool, local_tag)
+        return self.redis.run_script(RELEASE_TAG_SCRIPT, [
+            free_list_key, free_set_key, inuse_set_key,
+            self._tag_pool_stale_key(pool), self._tag_pool_reason_key(pool),
+            self._owner_tag_list_key(None), self._owner_tag_list_prefix(),
+        ], [self._encode(local_tag), json.dumps(pool)])
 
     @Manager.calls_manager
     def _declare_tags(self, pool, local_tags):
         free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        new_tags = set(self._encode(tag) for tag in local_tags)
-        old_tags = yield self.redis.sunion(free_set_key, inuse_set_key)
-        old_tags = set(old_tags)
-        for tag in sorted(new_tags - old_tags):
-            yield self.redis.sadd(free_set_key, tag)
-            yield self.redis.rpush(free_list_key, tag)
+        keys = [self._pool_list_key(), free_list_key, free_set_key,
+                inuse_set_key]
+        new_tags = sorted(set(self._encode(tag) for tag in local_tags))
+        for i in range(0, len(new_tags), self.DECLARE_BATCH_SIZE):
+            batch = new_tags[i:i + self.DECLARE_BATCH_SIZE]
+            yield self.redis.run_script(
+                DECLARE_TAGS_SCRIPT, keys, [self._encode(pool)] + batch)
 
     def _tag_pool_reason_key(self, pool):
         pool = self._encode(pool)
@@ -209,25 +431,12 @@ class TagpoolManager(object):
         owner = self._encode(owner)
         return ":".join(["tagpools", "owners", owner, "tags"])
 
-    @Manager.calls_manager
-    def _store_reason(self, pool, local_tag, owner, reason):
-        if reason is None:
-            reason = {}
+    def _owner_tag_list_prefix(self):
+        """The part of an owner's tag list key before the owner."""
+        return ":".join(["tagpools", "owners", ""])
+
+    def _reason_json(self, owner, reason):
+        reason = dict(reason or {})
         reason['timestamp'] = time.time()
         reason['owner'] = owner
-        reason_hash_key = self._tag_pool_reason_key(pool)
-        yield self.redis.hset(reason_hash_key, local_tag, json.dumps(reason))
-        owner_tag_list_key = self._owner_tag_list_key(owner)
-        yield self.redis.sadd(owner_tag_list_key,
-                              json.dumps([pool, self._decode(local_tag)]))
-
-    @Manager.calls_manager
-    def _remove_reason(self, pool, local_tag):
-        reason_hash_key = self._tag_pool_reason_key(pool)
-        reason = yield self.redis.hget(reason_hash_key, local_tag)
-        if reason is not None:
-            reason = json.loads(reason)
-            owner = reason.get('owner')
-            owner_tag_list_key = self._owner_tag_list_key(owner)
-            self.redis.srem(owner_tag_list_key,
-                            json.dumps([pool, self._decode(local_tag)]))
+        return json.dumps(reason)
@@ -189,6 +189,27 @@ class TestMessageStore(TestMessageStoreBase):
         self.assertEqual((yield self.store.batch_outbound_keys(batch_id_2)),
                          [msg_id])
 
+    @inlineCallbacks
+    def test_add_outbound_messages(self):
+        batch_id = yield self.store.batch_start()
+        old_msg_id, old_msg, _ = yield self._create_outbound(tag=None)
+        old_msg['helper_metadata']['foo'] = {'bar': 'baz'}
+        msgs = [old_msg] + [
+            self.msg_helper.make_outbound("outbound") for i in range(2)]
+        failures = yield self.store.add_outbound_messages(
+            msgs, batch_id=batch_id)
+
+        self.assertEqual(failures, [])
+        for msg in msgs:
+            stored_msg = yield self.store.get_outbound_message(
+                msg['message_id'])
+            self.assertEqual(stored_msg, msg)
+        outbound_keys = yield self.store.batch_outbound_keys(batch_id)
+        self.assertEqual(
+            sorted(outbound_keys), sorted(m['message_id'] for m in msgs))
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status, self._batch_status(sent=3))
+
     @inlineCallbacks
     def test_get_events_for_message(self):
         msg_id, msg, batch_id = yield self._create_outbound()
@@ -315,6 +336,23 @@ class TestMessageStore(TestMessageStoreBase):
         stored_msg = yield self.store.get_inbound_message(msg_id)
         self.assertEqual(stored_msg, msg)
 
+    @inlineCallbacks
+    def test_add_inbound_messages(self):
+        tag = ("pool", "tag")
+        batch_id = yield self.store.batch_start([tag])
+        msgs = [self.msg_helper.make_inbound("inbound") for _ in range(3)]
+        failures = yield self.store.add_inbound_messages(msgs, tag=tag)
+
+        self.assertEqual(failures, [])
+        for msg in msgs:
+            stored_msg = yield self.store.get_inbound_message(
+                msg['message_id'])
+            self.assertEqual(stored_msg, msg)
+        inbound_keys = yield self.store.batch_inbound_keys(batch_id)
+        self.assertEqual(
+            sorted(inbound_keys), sorted(m['message_id'] for m in msgs))
+        self.assertEqual((yield self.store.batch_inbound_count(batch_id)), 3)
+
     @inlineCallbacks
     def test_add_inbound_message_again(self):
         msg_id, msg, _batch_id = yield self._create_inbound(tag=None)
@@ -348,6 +386,20 @@ class TestMessageStore(TestMessageStoreBase):
         self.assertEqual(stored_msg, msg)
         self.assertEqual(inbound_keys, [msg_id])
 
+    @inlineCallbacks
+    def test_batch_inbound_keys_page(self):
+        msg_id, msg, batch_id = yield self._create_inbound(by_batch=True)
+        msg2 = self.msg_helper.make_inbound("inbound bar")
+        yield self.store.add_inbound_message(msg2, batch_id=batch_id)
+
+        keys1, continuation = yield self.store.batch_inbound_keys_page(
+            batch_id, max_results=1)
+        keys2, continuation = yield self.store.batch_inbound_keys_page(
+            batch_id, max_results=1, continuation=continuation)
+        self.assertEqual(continuation, None)
+        self.assertEqual(
+            sorted(keys1 + keys2), sorted([msg_id, msg2['message_id']]))
+
     @inlineCallbacks
     def test_add_inbound_message_to_multiple_batches(self):
         msg_id, msg, batch_id_1 = yield self._create_inbound()
@@ -56,6 +56,29 @@ class TestMessageStoreCache(MessageStoreCacheTestCase):
         [msg_key] = yield self.cache.get_outbound_message_keys(self.batch_id)
         self.assertEqual(msg_key, msg['message_id'])
 
+    @inlineCallbacks
+    def test_add_outbound_messages(self):
+        now = datetime.now()
+        msgs = []
+        for i in range(3):
+            msg = self.msg_helper.make_outbound(
+                "outbound", to_addr='to-%s' % (i,))
+            msg['timestamp'] = now - timedelta(seconds=i)
+            msgs.append(msg)
+        yield self.cache.add_outbound_messages(self.batch_id, msgs)
+        yield self.cache.add_outbound_messages(self.batch_id, msgs[:1])
+        keys = yield self.cache.get_outbound_message_keys(self.batch_id)
+        self.assertEqual(keys, [m['message_id'] for m in msgs])
+        self.assertEqual(
+            (yield self.cache.get_to_addrs(self.batch_id)),
+            ['to-0', 'to-1', 'to-2'])
+        status = yield self.cache.get_event_status(self.batch_id)
+        self.assertEqual(status['sent'], 3)
+        # The counter counts every message added, as with
+        # add_outbound_message().
+        self.assertEqual(
+            (yield self.cache.count_outbound_message_keys(self.batch_id)), 4)
+
     @inlineCallbacks
     def test_get_outbound_message_keys(self):
         messages = yield self.add_messages(
@@ -101,6 +124,33 @@ class TestMessageStoreCache(MessageStoreCacheTestCase):
         [msg_key] = yield self.cache.get_inbound_message_keys(self.batch_id)
         self.assertEqual(msg_key, msg['message_id'])
 
+    @inlineCallbacks
+    def test_add_inbound_messages(self):
+        now = datetime.now()
+        msgs = []
+        for i in range(3):
+            msg = self.msg_helper.make_inbound(
+                "inbound", from_addr='from-%s' % (i,))
+            msg['timestamp'] = now - timedelta(seconds=i)
+            msgs.append(msg)
+        yield self.cache.add_inbound_messages(self.batch_id, msgs)
+        keys = yield self.cache.get_inbound_message_keys(self.batch_id)
+        self.assertEqual(keys, [m['message_id'] for m in msgs])
+        self.assertEqual(
+            (yield self.cache.get_from_addrs(self.batch_id)),
+            ['from-0', 'from-1', 'from-2'])
+        self.assertEqual(
+            (yield self.cache.count_inbound_message_keys(self.batch_id)), 3)
+
+    @inlineCallbacks
+    def test_add_no_messages(self):
+        yield self.cache.add_inbound_messages(self.batch_id, [])
+        yield self.cache.add_outbound_messages(self.batch_id, [])
+        self.assertEqual(
+            (yield self.cache.count_inbound_message_keys(self.batch_id)), 0)
+        self.assertEqual(
+            (yield self.cache.count_outbound_message_keys(self.batch_id)), 0)
+
     @inlineCallbacks
     def test_get_inbound_message_keys(self):
         messages = yield self.add_messages(
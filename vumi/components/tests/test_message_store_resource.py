@@ -2,7 +2,7 @@
 
 import json
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, fail
 
 from vumi.utils import http_request_full
 
@@ -92,3 +92,32 @@ class TestMessageStoreResource(VumiTestCase):
         self.assertEqual(
             set([msg['message_id'] for msg in messages]),
             set([msg1['message_id'], msg2['message_id']]))
+
+    @inlineCallbacks
+    def test_get_outbound_without_index_pages(self):
+        def index_keys_page(*args, **kw):
+            self.fail("Index pages aren't supported.")
+
+        self.patch(self.store.manager, 'supports_index_pages', lambda: False)
+        self.patch(self.store.manager, 'index_keys_page', index_keys_page)
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        msg1 = yield self.make_outbound(batch_id, 'føø')
+        msg2 = yield self.make_outbound(batch_id, 'føø')
+        resp = yield self.make_request('GET', batch_id, 'outbound.json')
+        messages = map(
+            json.loads, filter(None, resp.delivered_body.split('\n')))
+        self.assertEqual(
+            set([msg['message_id'] for msg in messages]),
+            set([msg1['message_id'], msg2['message_id']]))
+
+    @inlineCallbacks
+    def test_get_outbound_error(self):
+        self.patch(
+            self.store.manager, 'index_keys_page',
+            lambda *args, **kw: fail(Exception("Riak went away")))
+        batch_id = yield self.make_batch(('foo', 'bar'))
+        yield self.make_outbound(batch_id, 'føø')
+        resp = yield self.make_request('GET', batch_id, 'outbound.json')
+        self.assertEqual(resp.delivered_body, '')
+        [err] = self.flushLoggedErrors(Exception)
+        self.assertEqual(err.getErrorMessage(), "Riak went away")
@@ -2,9 +2,10 @@
 
 import time
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, succeed, fail, Deferred
+from twisted.internet.task import Clock
 
-from vumi.components.session import SessionManager
+from vumi.components.session import SessionManager, SessionLeaseHeld
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper
 
 
@@ -70,3 +71,348 @@ class TestSessionManager(VumiTestCase):
         # Redis saves & returns all session values as strings
         self.assertEqual(session, dict([map(str, kvs) for kvs
                                         in test_session.items()]))
+
+    @inlineCallbacks
+    def test_save_session_indexes_session(self):
+        yield self.sm.save_session("u1", {"foo": "bar"})
+        self.assertEqual(
+            (yield self.manager.zrange(self.sm.SESSION_INDEX_KEY, 0, -1)),
+            ["u1"])
+        self.assertEqual((yield self.sm.active_sessions()),
+                         [("u1", {"foo": "bar"})])
+
+    @inlineCallbacks
+    def test_clear_session(self):
+        yield self.sm.create_session("u1")
+        yield self.sm.clear_session("u1")
+        self.assertEqual((yield self.sm.load_session("u1")), {})
+        self.assertEqual(
+            (yield self.manager.zrange(self.sm.SESSION_INDEX_KEY, 0, -1)),
+            [])
+
+    @inlineCallbacks
+    def test_load_sessions(self):
+        yield self.sm.save_session("u1", {"foo": "1"})
+        yield self.sm.save_session("u2", {"foo": "2"})
+        self.assertEqual(
+            (yield self.sm.load_sessions(["u2", "missing", "u1"])),
+            [{"foo": "2"}, {}, {"foo": "1"}])
+
+    @inlineCallbacks
+    def set_index_scores(self, scores):
+        for user_id, score in scores.items():
+            yield self.manager.zadd(
+                self.sm.SESSION_INDEX_KEY, **{user_id: score})
+
+    @inlineCallbacks
+    def test_active_sessions_page(self):
+        for i in range(5):
+            yield self.sm.save_session("u%d" % i, {"i": str(i)})
+        # Sessions saved at the same time are paged through by offset.
+        yield self.set_index_scores({
+            "u0": 1, "u1": 2, "u2": 2, "u3": 2, "u4": 3})
+
+        sessions, continuation = yield self.sm.active_sessions_page(2)
+        self.assertEqual([user_id for user_id, _ in sessions], ["u0", "u1"])
+        self.assertEqual(sessions[0][1], {"i": "0"})
+        sessions, continuation = yield self.sm.active_sessions_page(
+            2, continuation)
+        self.assertEqual([user_id for user_id, _ in sessions], ["u2", "u3"])
+        sessions, continuation = yield self.sm.active_sessions_page(
+            2, continuation)
+        self.assertEqual([user_id for user_id, _ in sessions], ["u4"])
+        self.assertEqual(continuation, None)
+
+    @inlineCallbacks
+    def test_active_sessions_page_removes_expired_sessions(self):
+        for i in range(4):
+            yield self.sm.save_session("u%d" % i, {"i": str(i)})
+        yield self.set_index_scores({"u0": 1, "u1": 2, "u2": 3, "u3": 4})
+        # Expire a session without removing it from the index.
+        yield self.manager.delete(self.sm.session_key("u1"))
+
+        sessions, continuation = yield self.sm.active_sessions_page(2)
+        self.assertEqual([user_id for user_id, _ in sessions], ["u0"])
+        sessions, continuation = yield self.sm.active_sessions_page(
+            2, continuation)
+        self.assertEqual([user_id for user_id, _ in sessions], ["u2", "u3"])
+        self.assertEqual(
+            (yield self.manager.zrange(self.sm.SESSION_INDEX_KEY, 0, -1)),
+            ["u0", "u2", "u3"])
+
+    @inlineCallbacks
+    def test_stream_active_sessions(self):
+        for i in range(5):
+            yield self.sm.save_session("u%d" % i, {"i": str(i)})
+        pages = []
+        yield self.sm.stream_active_sessions(pages.append, page_size=2)
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual(
+            sorted(user_id for page in pages for user_id, _ in page),
+            ["u0", "u1", "u2", "u3", "u4"])
+
+    @inlineCallbacks
+    def test_clear_expired_sessions(self):
+        self.sm.max_session_length = 60
+        for i in range(5):
+            yield self.sm.create_session("u%d" % i)
+        old = time.time() - 120
+        yield self.set_index_scores(
+            {"u0": old, "u1": old, "u2": old, "u3": old})
+        # u0 and u1 have expired, u2's expiry has been extended and u3 and
+        # u4 have been saved recently.
+        yield self.manager.delete(self.sm.session_key("u0"))
+        yield self.manager.delete(self.sm.session_key("u1"))
+        yield self.set_index_scores({"u3": time.time()})
+
+        self.assertEqual((yield self.sm.clear_expired_sessions(1)), 2)
+        self.assertEqual(
+            sorted((yield self.manager.zrange(
+                self.sm.SESSION_INDEX_KEY, 0, -1))),
+            ["u2", "u3", "u4"])
+        self.assertEqual((yield self.sm.clear_expired_sessions()), 0)
+
+    @inlineCallbacks
+    def test_save_session_clears_expired_sessions(self):
+        self.sm.max_session_length = 60
+        self.sm.gc_period = 0
+        yield self.sm.create_session("u0")
+        yield self.set_index_scores({"u0": time.time() - 120})
+        yield self.manager.delete(self.sm.session_key("u0"))
+
+        yield self.sm.save_session("u1", {"foo": "bar"})
+        yield self.sm._gc_d
+        self.assertEqual(
+            (yield self.manager.zrange(self.sm.SESSION_INDEX_KEY, 0, -1)),
+            ["u1"])
+
+    @inlineCallbacks
+    def test_save_session_does_not_wait_for_expired_sessions(self):
+        self.sm.max_session_length = 60
+        gc_d = Deferred()
+        self.sm.clear_expired_sessions = lambda: gc_d
+
+        yield self.sm.save_session("u1", {"foo": "bar"})
+        yield self.sm.save_session("u2", {"foo": "bar"})
+        self.assertEqual(self.sm._gc_d, gc_d)
+        self.assertEqual(
+            sorted((yield self.manager.zrange(
+                self.sm.SESSION_INDEX_KEY, 0, -1))),
+            ["u1", "u2"])
+        gc_d.callback(0)
+        self.assertEqual(self.sm._gc_d, None)
+
+    @inlineCallbacks
+    def test_save_session_clears_expired_sessions_once_per_gc_period(self):
+        self.sm.max_session_length = 60
+        yield self.sm.create_session("u0")
+        yield self.set_index_scores({"u0": time.time() - 120})
+        yield self.manager.delete(self.sm.session_key("u0"))
+
+        yield self.sm.save_session("u1", {"foo": "bar"})
+        self.assertEqual(
+            sorted((yield self.manager.zrange(
+                self.sm.SESSION_INDEX_KEY, 0, -1))),
+            ["u0", "u1"])
+
+    @inlineCallbacks
+    def test_clear_expired_sessions_without_max_session_length(self):
+        yield self.sm.create_session("u1")
+        yield self.manager.delete(self.sm.session_key("u1"))
+        self.assertEqual((yield self.sm.clear_expired_sessions()), 0)
+
+
+class TestSessionManagerCache(VumiTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.manager = yield self.persistence_helper.get_redis_manager()
+        yield self.manager._purge_all()  # Just in case
+        self.clock = Clock()
+        self.patch(SessionManager, 'get_clock', lambda _: self.clock)
+        self.sm = self.mk_session_manager()
+
+    def mk_session_manager(self, **kw):
+        kw.setdefault('cache_size', 10)
+        kw.setdefault('cache_ttl', 30)
+        sm = SessionManager(self.manager, **kw)
+        self.add_cleanup(sm.stop, stop_redis=False)
+        return sm
+
+    def redis_session(self, user_id):
+        return self.manager.hgetall(self.sm.session_key(user_id))
+
+    @inlineCallbacks
+    def test_create_session_is_written_behind(self):
+        self.sm.max_session_length = 60
+        session = yield self.sm.create_session("u1", foo="bar")
+        self.assertEqual(sorted(session.keys()), ['created_at', 'foo'])
+        self.assertEqual((yield self.redis_session("u1")), {})
+        self.assertEqual((yield self.sm.load_session("u1")), session)
+
+        yield self.sm.flush()
+        self.assertEqual((yield self.redis_session("u1")), session)
+        self.assertTrue(
+            0 < (yield self.manager.ttl(self.sm.session_key("u1"))) <= 60)
+        self.assertEqual(
+            (yield self.manager.get(self.sm.lease_key("u1"))),
+            self.sm.lease_owner)
+
+    @inlineCallbacks
+    def test_load_session_is_cached(self):
+        yield self.manager.hmset(self.sm.session_key("u1"), {"foo": "bar"})
+        self.assertEqual((yield self.sm.load_session("u1")), {"foo": "bar"})
+        self.assertEqual(self.sm.cache.misses, 1)
+        # Changes made directly in Redis aren't seen while we hold the lease.
+        yield self.manager.hset(self.sm.session_key("u1"), "foo", "baz")
+        session = yield self.sm.load_session("u1")
+        self.assertEqual(session, {"foo": "bar"})
+        self.assertEqual(self.sm.cache.hits, 1)
+        # Loads return copies.
+        session["foo"] = "changed"
+        self.assertEqual((yield self.sm.load_session("u1")), {"foo": "bar"})
+
+    @inlineCallbacks
+    def test_save_session_is_written_behind(self):
+        yield self.sm.create_session("u1")
+        yield self.sm.flush()
+        yield self.sm.save_session("u1", {"foo": 5})
+        self.assertEqual(
+            (yield self.redis_session("u1")).get("foo"), None)
+        self.assertEqual((yield self.sm.load_session("u1"))["foo"], "5")
+
+        yield self.sm.flush()
+        self.assertEqual((yield self.redis_session("u1"))["foo"], "5")
+
+    @inlineCallbacks
+    def test_flush_is_scheduled(self):
+        self.sm.flush_delay = 0.5
+        flushes = []
+        self.patch(self.sm, 'flush', lambda: flushes.append(1) or succeed(0))
+        yield self.sm.create_session("u1")
+        yield self.sm.save_session("u1", {"foo": "bar"})
+        self.clock.advance(0.4)
+        self.assertEqual(flushes, [])
+        self.clock.advance(0.1)
+        self.assertEqual(flushes, [1])
+
+    @inlineCallbacks
+    def test_save_uncached_session_takes_lease(self):
+        yield self.manager.hmset(self.sm.session_key("u1"), {"foo": "bar"})
+        yield self.sm.save_session("u1", {"baz": "quux"})
+        self.assertEqual(
+            (yield self.manager.get(self.sm.lease_key("u1"))),
+            self.sm.lease_owner)
+        self.assertEqual(
+            (yield self.sm.load_session("u1")), {"foo": "bar", "baz": "quux"})
+        yield self.sm.flush()
+        self.assertEqual(
+            (yield self.redis_session("u1")), {"foo": "bar", "baz": "quux"})
+
+    @inlineCallbacks
+    def test_lease_held_by_another_process(self):
+        other_sm = self.mk_session_manager()
+        yield other_sm.create_session("u1", foo="bar")
+        yield other_sm.flush()
+
+        self.assertEqual((yield self.sm.load_session("u1"))["foo"], "bar")
+        self.assertEqual(len(self.sm.cache), 0)
+        yield self.assertFailure(
+            self.sm.save_session("u1", {"foo": "baz"}), SessionLeaseHeld)
+        yield self.assertFailure(
+            self.sm.create_session("u1"), SessionLeaseHeld)
+        yield self.assertFailure(self.sm.clear_session("u1"), SessionLeaseHeld)
+        self.assertEqual((yield self.redis_session("u1"))["foo"], "bar")
+        self.assertEqual(
+            (yield self.manager.get(self.sm.lease_key("u1"))),
+            other_sm.lease_owner)
+
+    @inlineCallbacks
+    def test_flush_after_lease_lost(self):
+        other_sm = self.mk_session_manager()
+        yield self.sm.create_session("u1", foo="bar")
+        yield self.sm.flush()
+        yield self.sm.save_session("u1", {"foo": "mine"})
+        # Our lease runs out and another process takes over the session.
+        yield self.manager.delete(self.sm.lease_key("u1"))
+        yield other_sm.save_session("u1", {"foo": "theirs"})
+        yield other_sm.flush()
+
+        yield self.sm.flush()
+        self.assertEqual((yield self.redis_session("u1"))["foo"], "theirs")
+        self.assertEqual(
+            (yield self.manager.get(self.sm.lease_key("u1"))),
+            other_sm.lease_owner)
+        self.assertEqual(len(self.sm.cache), 0)
+        self.assertEqual((yield self.sm.load_session("u1"))["foo"], "theirs")
+
+    @inlineCallbacks
+    def test_evicted_session_after_lease_lost(self):
+        other_sm = self.mk_session_manager()
+        self.sm.cache.max_size = 1
+        yield self.sm.create_session("u1", foo="bar")
+        yield self.sm.create_session("u2", foo="baz")
+        yield self.manager.delete(self.sm.lease_key("u1"))
+        yield other_sm.create_session("u1", foo="theirs")
+        yield other_sm.flush()
+
+        self.assertEqual((yield self.sm.load_session("u1"))["foo"], "theirs")
+        self.assertEqual(self.sm.cache.user_ids(), ["u2"])
+        self.assertEqual((yield self.redis_session("u1"))["foo"], "theirs")
+
+    @inlineCallbacks
+    def test_stop_flushes_and_releases_leases(self):
+        yield self.sm.create_session("u1", foo="bar")
+        yield self.sm.stop(stop_redis=False)
+        self.assertEqual((yield self.redis_session("u1"))["foo"], "bar")
+        self.assertEqual(
+            (yield self.manager.get(self.sm.lease_key("u1"))), None)
+
+        other_sm = self.mk_session_manager()
+        yield other_sm.load_session("u1")
+        self.assertEqual(len(other_sm.cache), 1)
+
+    @inlineCallbacks
+    def test_clear_session_releases_lease(self):
+        yield self.sm.create_session("u1")
+        yield self.sm.flush()
+        yield self.sm.clear_session("u1")
+        self.assertEqual((yield self.redis_session("u1")), {})
+        self.assertEqual(
+            (yield self.manager.get(self.sm.lease_key("u1"))), None)
+        self.assertEqual(len(self.sm.cache), 0)
+        yield self.sm.flush()
+        self.assertEqual((yield self.redis_session("u1")), {})
+
+    @inlineCallbacks
+    def test_cache_expires_with_lease(self):
+        yield self.manager.hmset(self.sm.session_key("u1"), {"foo": "bar"})
+        yield self.sm.load_session("u1")
+        yield self.manager.hset(self.sm.session_key("u1"), "foo", "baz")
+        self.clock.advance(30)
+        self.assertEqual((yield self.sm.load_session("u1")), {"foo": "baz"})
+
+    @inlineCallbacks
+    def test_evicted_sessions_are_flushed(self):
+        self.sm.cache.max_size = 1
+        yield self.sm.create_session("u1", foo="1")
+        yield self.sm.create_session("u2", foo="2")
+        self.assertEqual(len(self.sm.cache), 1)
+        self.assertEqual((yield self.sm.load_session("u1"))["foo"], "1")
+        yield self.sm.flush()
+        self.assertEqual((yield self.redis_session("u1"))["foo"], "1")
+        self.assertEqual((yield self.redis_session("u2"))["foo"], "2")
+
+    @inlineCallbacks
+    def test_failed_flush_is_retried(self):
+        yield self.sm.create_session("u1", foo="bar")
+        orig_run_script = self.manager.run_script
+        self.patch(
+            self.manager, 'run_script',
+            lambda *a: fail(Exception("Redis went away")))
+        yield self.assertFailure(self.sm.flush(), Exception)
+        yield self.sm.save_session("u1", {"baz": "quux"})
+        self.patch(self.manager, 'run_script', orig_run_script)
+        yield self.sm.flush()
+        session = yield self.redis_session("u1")
+        self.assertEqual((session["foo"], session["baz"]), ("bar", "quux"))
@@ -111,16 +111,70 @@ class TestTxTagpoolManager(VumiTestCase):
         yield self.tpm.declare_tags(tags)
         self.assertEqual((yield self.tpm.acquire_specific_tag(tag5)), tag5)
         self.assertEqual((yield self.tpm.acquire_specific_tag(tag5)), None)
-        free_local_tags = [t[1] for t in tags]
-        free_local_tags.remove("tag5")
+        local_tags = [t[1] for t in tags]
+        free_local_tags = [t for t in local_tags if t != "tag5"]
         redis = self.redis
+        # The free list entry for tag5 is left in place and marked stale.
         self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)),
-                         free_local_tags)
+                         local_tags)
+        self.assertEqual((yield redis.smembers(tkey("free:list:stale"))),
+                         set(["tag5"]))
         self.assertEqual((yield redis.smembers(tkey("free:set"))),
                          set(free_local_tags))
         self.assertEqual((yield redis.smembers(tkey("inuse:set"))),
                          set(["tag5"]))
 
+    @inlineCallbacks
+    def test_acquire_tag_skips_specifically_acquired_tags(self):
+        tkey = self.pool_key_generator("poolA")
+        tag1, tag2, tag3 = [("poolA", "tag%d" % i) for i in (1, 2, 3)]
+        yield self.tpm.declare_tags([tag1, tag2, tag3])
+        yield self.tpm.acquire_specific_tag(tag1)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag2)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag3)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), None)
+        redis = self.redis
+        self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)), [])
+        self.assertEqual((yield redis.smembers(tkey("free:list:stale"))),
+                         set())
+        yield self.tpm.release_tag(tag1)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag1)
+
+    @inlineCallbacks
+    def test_acquire_tags(self):
+        tkey = self.pool_key_generator("poolA")
+        tags = [("poolA", "tag%d" % i) for i in range(5)]
+        yield self.tpm.declare_tags(tags)
+        yield self.tpm.acquire_specific_tag(tags[1])
+        self.assertEqual((yield self.tpm.acquire_tags("poolA", 3, "me")),
+                         [tags[0], tags[2], tags[3]])
+        self.assertEqual((yield self.tpm.acquire_tags("poolA", 3)),
+                         [tags[4]])
+        self.assertEqual((yield self.tpm.acquire_tags("poolA", 3)), [])
+        self.assertEqual((yield self.tpm.acquire_tags("poolB", 3)), [])
+        self.assertEqual(
+            sorted((yield self.tpm.owned_tags("me"))),
+            [list(tags[0]), list(tags[2]), list(tags[3])])
+        self.assertEqual((yield self.redis.smembers(tkey("free:set"))),
+                         set())
+
+    @inlineCallbacks
+    def test_release_specific_tag(self):
+        tkey = self.pool_key_generator("poolA")
+        tag1, tag2 = ("poolA", "tag1"), ("poolA", "tag2")
+        yield self.tpm.declare_tags([tag1, tag2])
+        for _ in range(3):
+            yield self.tpm.acquire_specific_tag(tag1)
+            yield self.tpm.release_tag(tag1)
+        redis = self.redis
+        # Releasing a tag whose stale entry is still in the free list
+        # doesn't add a second entry.
+        self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)),
+                         ["tag1", "tag2"])
+        self.assertEqual((yield redis.smembers(tkey("free:list:stale"))),
+                         set())
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag1)
+
     @inlineCallbacks
     def test_acquire_specific_unicode_tag(self):
         tag = (u"poöl", u"tág")
@@ -152,6 +206,66 @@ class TestTxTagpoolManager(VumiTestCase):
         yield self.tpm.release_tag(tag)
         self.assertEqual((yield self.tpm.acquire_tag(tag[0])), tag)
 
+    @inlineCallbacks
+    def test_release_tag_removes_reason(self):
+        tag = ("pool", "tag")
+        yield self.tpm.declare_tags([tag])
+        yield self.tpm.acquire_tag("pool", "me", {"foo": "bar"})
+        yield self.tpm.release_tag(tag)
+        self.assertEqual((yield self.tpm.acquired_by(tag)), (None, None))
+        self.assertEqual((yield self.tpm.owned_tags("me")), [])
+
+    @inlineCallbacks
+    def test_release_tag_removes_legacy_owner_entry(self):
+        tag = (u"poöl", u"tág")
+        yield self.tpm.declare_tags([tag])
+        yield self.tpm.acquire_tag(tag[0], "me")
+        owner_key = "tagpools:owners:me:tags"
+        yield self.redis.sadd(owner_key, json.dumps(list(tag)))
+        yield self.tpm.release_tag(tag)
+        self.assertEqual((yield self.tpm.owned_tags("me")), [])
+
+    @inlineCallbacks
+    def test_owner_tag_list_members(self):
+        # Members are written and removed by the scripts, so they must match
+        # json.dumps() exactly however the tag is escaped.
+        tags = [(u"poöl", u"tág"), (u"poöl", u"a/b"), (u"poöl", u'q"\\'),
+                (u"poöl", u"\U0001d11e\t")]
+        yield self.tpm.declare_tags(tags)
+        acquired = yield self.tpm.acquire_tag(u"poöl", u"mé")
+        for tag in tags:
+            if tag != acquired:
+                yield self.tpm.acquire_specific_tag(tag, u"mé")
+        owner_key = u"tagpools:owners:mé:tags".encode("utf-8")
+        self.assertEqual(
+            (yield self.redis.smembers(owner_key)),
+            set(json.dumps(list(tag)) for tag in tags))
+        for tag in tags:
+            yield self.tpm.release_tag(tag)
+        self.assertEqual((yield self.redis.smembers(owner_key)), set())
+
+    @inlineCallbacks
+    def test_release_tag_owner_from_reason(self):
+        tag = ("pool", "tag")
+        yield self.tpm.declare_tags([tag])
+        yield self.tpm.acquire_tag("pool", "me")
+
+        def acquired_by(tag):
+            self.fail("Release shouldn't look up the owner separately.")
+
+        self.patch(self.tpm, 'acquired_by', acquired_by)
+        yield self.tpm.release_tag(tag)
+        self.assertEqual((yield self.tpm.owned_tags("me")), [])
+
+    @inlineCallbacks
+    def test_declare_many_tags(self):
+        self.patch(TagpoolManager, "DECLARE_BATCH_SIZE", 3)
+        tags = [("poolA", "tag%02d" % i) for i in range(10)]
+        yield self.tpm.declare_tags(reversed(tags))
+        yield self.tpm.declare_tags(tags)
+        self.assertEqual((yield self.tpm.acquire_tags("poolA", 20)), tags)
+        self.assertEqual((yield self.tpm.list_pools()), set(["poolA"]))
+
     @inlineCallbacks
     def test_metadata(self):
         mkey = self.pool_key_generator("poolA")("metadata")
@@ -1,4 +1,4 @@
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred
 from twisted.internet.task import Clock
 
 from vumi.components.window_manager import WindowManager, WindowException
@@ -80,6 +80,94 @@ class TestWindowManager(VumiTestCase):
         next_flight_key = yield self.wm.get_next_key(self.window_id)
         self.assertTrue(next_flight_key)
 
+    @inlineCallbacks
+    def test_get_next_keys(self):
+        keys = []
+        for i in range(12):
+            keys.append((yield self.wm.add(self.window_id, i)))
+
+        self.assertEqual((yield self.wm.get_next_keys(self.window_id)),
+                         keys[:10])
+        self.assertEqual((yield self.wm.get_next_keys(self.window_id)), [])
+        yield self.assert_in_flight(self.window_id, 10)
+        self.assertEqual(
+            len((yield self.wm.get_expired_flight_keys(self.window_id))), 0)
+
+        yield self.wm.remove_key(self.window_id, keys[0])
+        yield self.wm.remove_key(self.window_id, keys[1])
+        self.assertEqual((yield self.wm.get_next_keys(self.window_id)),
+                         keys[10:])
+        self.assertEqual((yield self.wm.get_next_keys(self.window_id)), [])
+
+    @inlineCallbacks
+    def test_add_many(self):
+        self.patch(WindowManager, 'BULK_BATCH_SIZE', 5)
+        keys = yield self.wm.add_many(self.window_id, range(12))
+        self.assertEqual(len(set(keys)), 12)
+        yield self.assert_count_waiting(self.window_id, 12)
+        self.assertEqual((yield self.wm.get_next_keys(self.window_id)),
+                         keys[:10])
+        for i, key in enumerate(keys):
+            self.assertEqual((yield self.wm.get_data(self.window_id, key)), i)
+
+    @inlineCallbacks
+    def test_add_many_empty(self):
+        self.assertEqual((yield self.wm.add_many(self.window_id, [])), [])
+        yield self.assert_count_waiting(self.window_id, 0)
+
+    @inlineCallbacks
+    def test_remove_keys(self):
+        self.patch(WindowManager, 'BULK_BATCH_SIZE', 3)
+        keys = yield self.wm.add_many(self.window_id, range(10))
+        yield self.wm.get_next_keys(self.window_id)
+        yield self.wm.set_external_id(self.window_id, keys[0], "ext-0")
+        yield self.wm.set_external_id(self.window_id, keys[5], "ext-5")
+
+        yield self.wm.remove_keys(self.window_id, keys[:8])
+        yield self.assert_in_flight(self.window_id, 2)
+        self.assertEqual(
+            (yield self.redis.lrange(self.wm.flight_key(self.window_id),
+                                     0, -1)),
+            [keys[9], keys[8]])
+        self.assertEqual(
+            (yield self.redis.zrange(self.wm.stats_key(self.window_id),
+                                     0, -1)),
+            sorted(keys[8:]))
+        for key in keys[:8]:
+            self.assertEqual(
+                (yield self.redis.get(self.wm.window_key(self.window_id,
+                                                         key))),
+                None)
+        for key, external_id in [(keys[0], "ext-0"), (keys[5], "ext-5")]:
+            self.assertEqual(
+                (yield self.wm.get_external_id(self.window_id, key)), None)
+            self.assertEqual(
+                (yield self.wm.get_internal_id(self.window_id, external_id)),
+                None)
+
+    @inlineCallbacks
+    def test_clear_expired_window_flight_keys(self):
+        self.patch(WindowManager, 'get_clocktime', lambda wm: wm._clocktime)
+        self.wm._clocktime = 0
+        yield self.wm.add_many(self.window_id, range(15))
+        yield self.wm.get_next_keys(self.window_id)
+        yield self.assert_in_flight(self.window_id, 10)
+
+        self.wm._clocktime = 5
+        self.assertEqual(
+            (yield self.wm.clear_expired_window_flight_keys(self.window_id)),
+            0)
+        yield self.assert_in_flight(self.window_id, 10)
+
+        self.wm._clocktime = 10
+        self.assertEqual(
+            (yield self.wm.clear_expired_window_flight_keys(self.window_id)),
+            10)
+        yield self.assert_in_flight(self.window_id, 0)
+        yield self.assert_expired_keys(self.window_id, 10)
+        self.assertEqual(
+            len((yield self.wm.get_next_keys(self.window_id))), 5)
+
     @inlineCallbacks
     def test_set_and_external_id(self):
         yield self.wm.set_external_id(self.window_id, "flight_key",
@@ -210,6 +298,69 @@ class TestWindowManager(VumiTestCase):
         self.assertEqual((yield self.wm.get_windows()), [])
         self.assertEqual(set(cleanup_callbacks), set(window_ids))
 
+    def collect_keys(self, count):
+        """Return a key callback and a Deferred that fires with the keys
+        it has been called with once there are ``count`` of them."""
+        keys = []
+        done = Deferred()
+
+        def callback(window_id, key):
+            self.assertEqual(window_id, self.window_id)
+            keys.append(key)
+            if len(keys) == count:
+                done.callback(keys)
+
+        return callback, done
+
+    @inlineCallbacks
+    def test_monitor_push_on_add(self):
+        callback, done = self.collect_keys(10)
+        self.wm.monitor(callback, push=True)
+        self.clock.advance(0)
+
+        keys = []
+        for i in range(12):
+            keys.append((yield self.wm.add(self.window_id, i)))
+        self.clock.advance(0)
+        self.assertEqual((yield done), keys[:10])
+        yield self.assert_count_waiting(self.window_id, 2)
+
+    @inlineCallbacks
+    def test_monitor_push_on_remove(self):
+        callback, done = self.collect_keys(12)
+        self.wm.monitor(callback, push=True)
+        self.clock.advance(0)
+
+        keys = []
+        for i in range(12):
+            keys.append((yield self.wm.add(self.window_id, i)))
+        self.clock.advance(0)
+        yield self.wm.remove_key(self.window_id, keys[0])
+        yield self.wm.remove_key(self.window_id, keys[1])
+        self.clock.advance(0)
+        self.assertEqual((yield done), keys)
+
+    @inlineCallbacks
+    def test_monitor_without_push(self):
+        callback, done = self.collect_keys(1)
+        self.wm.monitor(callback)
+        yield self.wm.add(self.window_id, 1)
+        self.assertEqual(self.wm._push_call, None)
+        self.clock.advance(10)
+        self.assertEqual(len((yield done)), 1)
+
+    @inlineCallbacks
+    def test_stop_cancels_push(self):
+        callback, done = self.collect_keys(1)
+        self.wm.monitor(callback, push=True)
+        yield self.wm.add(self.window_id, 1)
+        push_call = self.wm._push_call
+        self.assertTrue(push_call.active())
+        self.wm.stop()
+        self.assertFalse(push_call.active())
+        yield self.wm.add(self.window_id, 2)
+        self.assertEqual(self.wm._push_call, None)
+
 
 class TestConcurrentWindowManager(VumiTestCase):
 
@@ -7,12 +7,127 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.task import LoopingCall
 
 from vumi import log
+from vumi.persist.redis_base import RedisScript
 
 
 class WindowException(Exception):
     pass
 
 
+def _get_next_key(redis, keys, args):
+    window_key, inflight_key, stats_key = keys
+    window_size, timestamp = args
+    if redis.llen(window_key) == 0:
+        return None
+    if redis.llen(inflight_key) >= int(window_size):
+        return None
+    next_key = redis.rpoplpush(window_key, inflight_key)
+    if next_key:
+        redis.zadd(stats_key, **{next_key: float(timestamp)})
+    return next_key
+
+
+GET_NEXT_KEY_SCRIPT = RedisScript('window_manager.get_next_key', """
+local window_key, inflight_key, stats_key = KEYS[1], KEYS[2], KEYS[3]
+if redis.call('LLEN', window_key) == 0 then
+    return nil
+end
+if redis.call('LLEN', inflight_key) >= tonumber(ARGV[1]) then
+    return nil
+end
+local next_key = redis.call('RPOPLPUSH', window_key, inflight_key)
+if next_key then
+    redis.call('ZADD', stats_key, ARGV[2], next_key)
+end
+return next_key
+""", _get_next_key)
+
+
+def _get_next_keys(redis, keys, args):
+    window_key, inflight_key, stats_key = keys
+    window_size, timestamp = args
+    next_keys = []
+    free_slots = int(window_size) - redis.llen(inflight_key)
+    for _ in range(free_slots):
+        next_key = redis.rpoplpush(window_key, inflight_key)
+        if not next_key:
+            break
+        redis.zadd(stats_key, **{next_key: float(timestamp)})
+        next_keys.append(next_key)
+    return next_keys
+
+
+GET_NEXT_KEYS_SCRIPT = RedisScript('window_manager.get_next_keys', """
+local window_key, inflight_key, stats_key = KEYS[1], KEYS[2], KEYS[3]
+local next_keys = {}
+local free_slots = tonumber(ARGV[1]) - redis.call('LLEN', inflight_key)
+for i = 1, free_slots do
+    local next_key = redis.call('RPOPLPUSH', window_key, inflight_key)
+    if not next_key then
+        break
+    end
+    redis.call('ZADD', stats_key, ARGV[2], next_key)
+    next_keys[#next_keys + 1] = next_key
+end
+return next_keys
+""", _get_next_keys)
+
+
+def _clear_expired_flight_keys(redis, keys, args):
+    inflight_key, stats_key = keys
+    [max_timestamp] = args
+    removed = 0
+    for key in redis.zrangebyscore(stats_key, '-inf', float(max_timestamp)):
+        removed += redis.lrem(inflight_key, key, 1)
+    return removed
+
+
+CLEAR_EXPIRED_FLIGHT_KEYS_SCRIPT = RedisScript(
+    'window_manager.clear_expired_flight_keys', """
+local inflight_key, stats_key = KEYS[1], KEYS[2]
+local removed = 0
+local expired = redis.call('ZRANGEBYSCORE', stats_key, '-inf', ARGV[1])
+for _, key in ipairs(expired) do
+    removed = removed + redis.call('LREM', inflight_key, 1, key)
+end
+return removed
+""", _clear_expired_flight_keys)
+
+
+def _remove_keys(redis, keys, args):
+    (inflight_key, stats_key, data_prefix, external_prefix,
+     internal_prefix) = keys
+    for key in args:
+        redis.lrem(inflight_key, key, 1)
+        redis.delete(data_prefix + key)
+        external_id = redis.get(external_prefix + key)
+        if external_id:
+            redis.delete(external_prefix + key)
+            redis.delete(internal_prefix + external_id)
+        redis.zrem(stats_key, key)
+    return len(args)
+
+
+# The data and id map keys depend on the flight keys (and on the external ids
+# stored in redis), so we pass their prefixes and build the keys in the
+# script.
+REMOVE_KEYS_SCRIPT = RedisScript('window_manager.remove_keys', """
+local inflight_key, stats_key = KEYS[1], KEYS[2]
+local data_prefix, external_prefix, internal_prefix = KEYS[3], KEYS[4], KEYS[5]
+for _, key in ipairs(ARGV) do
+    redis.call('LREM', inflight_key, 1, key)
+    redis.call('DEL', data_prefix .. key)
+    local external_id = redis.call('GET', external_prefix .. key)
+    if external_id then
+        redis.call('DEL', external_prefix .. key)
+        redis.call('DEL', internal_prefix .. external_id)
+    end
+    redis.call('ZREM', stats_key, key)
+end
+return #ARGV
+""", _remove_keys)
+
+
 class WindowManager(object):
 
     WINDOW_KEY = 'windows'
@@ -20,6 +135,9 @@ class WindowManager(object):
     FLIGHT_STATS_KEY = 'flightstats'
     MAP_KEY = 'keymap'
 
+    # The most keys add_many() and remove_keys() put in one pipeline.
+    BULK_BATCH_SIZE = 1000
+
     def __init__(self, redis, window_size=100, flight_lifetime=None,
                 gc_interval=10):
         self.window_size = window_size
@@ -30,6 +148,10 @@ class WindowManager(object):
         self.gc.clock = self.clock
         self.gc.start(gc_interval)
         self._monitor = None
+        self._push_callback = None
+        self._push_call = None
+        self._pushing = False
+        self._pending_windows = set()
 
     def noop(self, *args, **kwargs):
         pass
@@ -38,6 +160,12 @@ class WindowManager(object):
         if self._monitor and self._monitor.running:
             self._monitor.stop()
 
+        self._push_callback = None
+        self._pending_windows.clear()
+        if self._push_call is not None and self._push_call.active():
+            self._push_call.cancel()
+        self._push_call = None
+
         if self.gc.running:
             self.gc.stop()
 
@@ -95,28 +223,61 @@ class WindowManager(object):
         yield self.redis.set(self.window_key(window_id, key),
                              json.dumps(data))
         yield self.redis.lpush(self.window_key(window_id), key)
+        self._notify(window_id)
         returnValue(key)
 
     @inlineCallbacks
-    def get_next_key(self, window_id):
-
-        window_key = self.window_key(window_id)
-        inflight_key = self.flight_key(window_id)
-
-        waiting_list = yield self.count_waiting(window_id)
-        if waiting_list == 0:
-            return
+    def add_many(self, window_id, items):
+        """Add each of ``items`` to a window and return their keys.
+
+        This is equivalent to calling :meth:`add` for each item in order,
+        but the items are written in pipelined batches of up to
+        ``BULK_BATCH_SIZE``.
+        """
+        keys = []
+        items = list(items)
+        for start in range(0, len(items), self.BULK_BATCH_SIZE):
+            batch_keys = []
+            pipe = self.redis.pipeline()
+            for data in items[start:start + self.BULK_BATCH_SIZE]:
+                key = uuid.uuid4().get_hex()
+                pipe.set(self.window_key(window_id, key), json.dumps(data))
+                batch_keys.append(key)
+            # As in add(), the data is set before its key is pushed. Redis
+            # runs pipelined commands in order.
+            for key in batch_keys:
+                pipe.lpush(self.window_key(window_id), key)
+            yield pipe.execute()
+            keys.extend(batch_keys)
+        if keys:
+            self._notify(window_id)
+        returnValue(keys)
 
-        flight_size = yield self.count_in_flight(window_id)
-        room_available = self.window_size - flight_size
-
-        if room_available > 0:
-            log.debug('Window %s has space for %s' % (window_key,
-                                                        room_available))
-            next_key = yield self.redis.rpoplpush(window_key, inflight_key)
-            if next_key:
-                yield self._set_timestamp(window_id, next_key)
-                returnValue(next_key)
+    def get_next_key(self, window_id):
+        """Move the next waiting key into flight and return it.
+
+        Returns ``None`` if there are no waiting keys or the window is full.
+        This is done in a single script so that several window managers can
+        safely share a window.
+        """
+        return self.redis.run_script(GET_NEXT_KEY_SCRIPT, [
+            self.window_key(window_id),
+            self.flight_key(window_id),
+            self.stats_key(window_id),
+        ], [self.window_size, self.get_clocktime()])
+
+    def get_next_keys(self, window_id):
+        """Move as many waiting keys into flight as the window has room for
+        and return them.
+
+        Returns an empty list if there are no waiting keys or the window is
+        full. Like :meth:`get_next_key`, this is atomic.
+        """
+        return self.redis.run_script(GET_NEXT_KEYS_SCRIPT, [
+            self.window_key(window_id),
+            self.flight_key(window_id),
+            self.stats_key(window_id),
+        ], [self.window_size, self.get_clocktime()])
 
     def _set_timestamp(self, window_id, flight_key):
         return self.redis.zadd(self.stats_key(window_id), **{
@@ -138,26 +299,55 @@ class WindowManager(object):
         return self.redis.zrangebyscore(self.stats_key(window_id),
             '-inf', self.get_clocktime() - self.flight_lifetime)
 
+    @inlineCallbacks
+    def clear_expired_window_flight_keys(self, window_id):
+        """Take expired keys out of flight in a window, freeing their slots,
+        and return how many were removed.
+
+        The expired keys stay in the window's flight stats until they are
+        removed with :meth:`remove_key`.
+        """
+        removed = yield self.redis.run_script(
+            CLEAR_EXPIRED_FLIGHT_KEYS_SCRIPT, [
+                self.flight_key(window_id),
+                self.stats_key(window_id),
+            ], [self.get_clocktime() - self.flight_lifetime])
+        if removed:
+            self._notify(window_id)
+        returnValue(removed)
+
     @inlineCallbacks
     def clear_expired_flight_keys(self):
         windows = yield self.get_windows()
         for window_id in windows:
-            expired_keys = yield self.get_expired_flight_keys(window_id)
-            for key in expired_keys:
-                yield self.redis.lrem(self.flight_key(window_id), key, 1)
+            yield self.clear_expired_window_flight_keys(window_id)
 
     @inlineCallbacks
     def get_data(self, window_id, key):
         json_data = yield self.redis.get(self.window_key(window_id, key))
         returnValue(json.loads(json_data))
 
-    @inlineCallbacks
     def remove_key(self, window_id, key):
-        yield self.redis.lrem(self.flight_key(window_id), key, 1)
-        yield self.redis.delete(self.window_key(window_id, key))
-        yield self.redis.delete(self.stats_key(window_id, key))
-        yield self.clear_external_id(window_id, key)
-        yield self._clear_timestamp(window_id, key)
+        return self.remove_keys(window_id, [key])
+
+    @inlineCallbacks
+    def remove_keys(self, window_id, keys):
+        """Remove keys from flight, along with their data and external ids.
+
+        Keys are removed in batches of up to ``BULK_BATCH_SIZE``. Each batch
+        is removed atomically by a single script.
+        """
+        keys = list(keys)
+        for start in range(0, len(keys), self.BULK_BATCH_SIZE):
+            yield self.redis.run_script(REMOVE_KEYS_SCRIPT, [
+                self.flight_key(window_id),
+                self.stats_key(window_id),
+                self.window_key(window_id, ''),
+                self.map_key(window_id, 'external', ''),
+                self.map_key(window_id, 'internal', ''),
+            ], keys[start:start + self.BULK_BATCH_SIZE])
+        if keys:
+            self._notify(window_id)
 
     @inlineCallbacks
     def set_external_id(self, window_id, flight_key, external_id):
@@ -182,25 +372,78 @@ class WindowManager(object):
                                                  external_id))
 
     def monitor(self, key_callback, interval=10, cleanup=True,
-                cleanup_callback=None):
-
+                cleanup_callback=None, push=False):
+        """Call ``key_callback(window_id, key)`` for each key that is moved
+        into flight.
+
+        Every ``interval`` seconds all windows are checked for keys that can
+        be moved into flight and, if ``cleanup`` is set, empty windows are
+        removed.
+
+        If ``push`` is set, windows are also checked as soon as this window
+        manager adds a key to them, removes a key from them or expires
+        flights in them, so keys don't wait for the next interval. Changes
+        made by other window managers are still only noticed every
+        ``interval`` seconds.
+        """
         if self._monitor is not None:
             raise WindowException('Monitor already started')
 
+        if push:
+            self._push_callback = key_callback
         self._monitor = LoopingCall(lambda: self._monitor_windows(
             key_callback, cleanup, cleanup_callback))
         self._monitor.clock = self.get_clock()
         self._monitor.start(interval)
 
+    def _notify(self, window_id):
+        """Schedule a check of ``window_id`` if we're monitoring in push
+        mode.
+
+        Checks are run one at a time, on a later reactor iteration, and
+        notifications for a window that is already waiting to be checked are
+        coalesced.
+        """
+        if self._push_callback is None:
+            return
+        self._pending_windows.add(window_id)
+        if not self._pushing and self._push_call is None:
+            self._push_call = self.clock.callLater(0, self._push_windows)
+
+    @inlineCallbacks
+    def _push_windows(self):
+        self._push_call = None
+        self._pushing = True
+        try:
+            while self._pending_windows and self._push_callback is not None:
+                window_id = self._pending_windows.pop()
+                try:
+                    yield self._monitor_window(
+                        window_id, self._push_callback)
+                except Exception:
+                    log.err(None, "Error sending keys from window %r" % (
+                        window_id,))
+        finally:
+            self._pushing = False
+
+    @inlineCallbacks
+    def _monitor_window(self, window_id, key_callback):
+        """Fill the free slots in a window, calling ``key_callback`` for each
+        key moved into flight, until it is full or there are no more keys
+        waiting.
+        """
+        keys = yield self.get_next_keys(window_id)
+        while keys:
+            for key in keys:
+                yield key_callback(window_id, key)
+            keys = yield self.get_next_keys(window_id)
+
     @inlineCallbacks
     def _monitor_windows(self, key_callback, cleanup=True,
                          cleanup_callback=None):
         windows = yield self.get_windows()
         for window_id in windows:
-            key = (yield self.get_next_key(window_id))
-            while key:
-                yield key_callback(window_id, key)
-                key = (yield self.get_next_key(window_id))
+            yield self._monitor_window(window_id, key_callback)
 
             # Remove empty windows if required
             if cleanup and not ((yield self.count_waiting(window_id)) or
@@ -1,5 +1,7 @@
 # -*- test-case-name: vumi.tests.test_config -*-
 
+from collections import OrderedDict
+
 from confmodel.fields import ConfigField
 from confmodel.fallbacks import FieldFallback
 
@@ -94,6 +96,52 @@ class ConfigContext(object):
             setattr(self, k, v)
 
 
+class ConfigCache(object):
+    """Cache for config objects built for messages.
+
+    Building a config object validates every field, so workers that build
+    one per message should keep the ones they've built here, keyed by
+    whatever the config depends on (``None`` for config that doesn't depend
+    on the message at all). The least recently used entries are discarded
+    once there are more than `max_size` of them.
+
+    Config objects read values from the data they were built from, so if
+    that data changes the relevant entries must be removed with
+    :meth:`invalidate`.
+
+    :param int max_size:
+        The maximum number of config objects to keep.
+    """
+
+    def __init__(self, max_size=100):
+        self.max_size = max_size
+        self._configs = OrderedDict()
+
+    def __len__(self):
+        return len(self._configs)
+
+    def __contains__(self, key):
+        return key in self._configs
+
+    def get(self, key, build):
+        """Return the config for `key`, calling `build()` if we have none."""
+        config = self._configs.pop(key, None)
+        if config is None:
+            config = build()
+        self._configs[key] = config
+        if len(self._configs) > self.max_size:
+            self._configs.popitem(last=False)
+        return config
+
+    def invalidate(self, key=None, all_keys=False):
+        """Discard the config for `key`, or all configs if `all_keys` is set.
+        """
+        if all_keys:
+            self._configs.clear()
+        else:
+            self._configs.pop(key, None)
+
+
 # Re-export these for compatibility.
 from confmodel import Config
 from confmodel.errors import ConfigError
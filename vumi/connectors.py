@@ -1,7 +1,14 @@
-from twisted.internet.defer import gatherResults, inlineCallbacks, returnValue
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    gatherResults, inlineCallbacks, returnValue, succeed)
+from twisted.internet.task import LoopingCall
 
 from vumi import log
-from vumi.message import TransportMessage, TransportEvent, TransportUserMessage
+from vumi.blinkenlights.metrics import Gauge, MAX
+from vumi.config import Config, ConfigInt, ConfigFloat
+from vumi.message import (
+    TransportMessage, TransportEvent, TransportUserMessage, get_message_codec,
+    COMPACT_MESSAGE_CLASSES)
 from vumi.middleware import MiddlewareStack
 
 
@@ -9,6 +16,170 @@ class IgnoreMessage(Exception):
     pass
 
 
+class AdaptivePrefetchConfig(Config):
+    """Config for :class:`AdaptivePrefetchController`.
+
+    Unknown keys are rejected so that a misspelt option isn't silently
+    ignored.
+    """
+
+    target_concurrency = ConfigInt(
+        "How many messages we'd like to be handling at once. Defaults to the"
+        " consumer's concurrency limit, or the initial prefetch limit if the"
+        " consumer doesn't have one.",
+        required=False, static=True)
+    min_prefetch = ConfigInt(
+        "The smallest prefetch limit to set.", default=1, static=True)
+    max_prefetch = ConfigInt(
+        "The largest prefetch limit to set.", default=500, static=True)
+    max_delay = ConfigFloat(
+        "The longest (in seconds) a prefetched message should wait to be"
+        " handled.", default=1.0, static=True)
+    interval = ConfigFloat(
+        "How often (in seconds) to adjust the prefetch limit.",
+        default=5.0, static=True)
+    smoothing = ConfigFloat(
+        "Weight given to the newest measurements, between 0 and 1.",
+        default=0.5, static=True)
+
+    def post_validate(self):
+        unknown = set(self._config_data) - set(self._field_names)
+        if unknown:
+            self.raise_config_error(
+                "Unknown adaptive prefetch options: %s" % (
+                    ", ".join(sorted(unknown)),))
+        if not 1 <= self.min_prefetch <= self.max_prefetch:
+            self.raise_config_error(
+                "min_prefetch must be at least 1 and at most max_prefetch.")
+        if not 0 < self.smoothing <= 1:
+            self.raise_config_error("smoothing must be between 0 and 1.")
+        if self.interval <= 0:
+            self.raise_config_error("interval must be positive.")
+
+
+class AdaptivePrefetchController(object):
+    """Adjusts a consumer's prefetch limit to keep a target concurrency.
+
+    Between a handler acking a message and the next message arriving from
+    the broker, nothing is being handled unless there are prefetched messages
+    waiting, so fast handlers need more prefetched messages than slow ones to
+    stay busy. Every `interval` seconds we measure the mean handler latency
+    and the mean number of messages being handled at once (from the
+    consumer's counters) and scale the prefetch limit by how far the latter
+    is from `target_concurrency`, at most doubling or halving it each time.
+
+    Prefetched messages sit unacknowledged until they are handled and are
+    redelivered if the worker goes away, so the limit is also capped to keep
+    the wait for a prefetched message under about `max_delay` seconds at the
+    measured latency, and clamped to `min_prefetch` and `max_prefetch`.
+
+    If a handler has been running for the whole interval without finishing
+    we treat the interval as a lower bound on the latency.
+
+    :param consumer: The :class:`vumi.service.Consumer` to manage.
+    :param int initial_prefetch: The limit to start with.
+    :param int target_concurrency:
+        How many messages we'd like to be handling at once. Defaults to the
+        consumer's concurrency limit, or `initial_prefetch` if it has none.
+    :param int min_prefetch: The smallest limit we'll set.
+    :param int max_prefetch: The largest limit we'll set.
+    :param float max_delay:
+        The longest (in seconds) a prefetched message should wait to be
+        handled.
+    :param float interval: How often (in seconds) to adjust the limit.
+    :param float smoothing:
+        Weight given to the newest measurements, between 0 and 1.
+    """
+
+    def __init__(self, consumer, initial_prefetch=20, target_concurrency=None,
+                 min_prefetch=1, max_prefetch=500, max_delay=1.0,
+                 interval=5.0, smoothing=0.5, clock=reactor):
+        self.consumer = consumer
+        self.min_prefetch = min_prefetch
+        self.max_prefetch = max_prefetch
+        self.prefetch_count = self._clamp(initial_prefetch or max_prefetch)
+        if target_concurrency is None:
+            target_concurrency = (
+                getattr(consumer, 'concurrency', None) or self.prefetch_count)
+        self.target_concurrency = target_concurrency
+        self.max_delay = max_delay
+        self.interval = interval
+        self.smoothing = smoothing
+        self.clock = clock
+        self.latency = None
+        self.in_flight = None
+        self._last_count = consumer.processed_count
+        self._last_time = consumer.processing_time
+        self._task = None
+
+    @classmethod
+    def from_config(cls, consumer, initial_prefetch, config, **kw):
+        """Build a controller from an :class:`AdaptivePrefetchConfig`."""
+        return cls(
+            consumer, initial_prefetch=initial_prefetch,
+            target_concurrency=config.target_concurrency,
+            min_prefetch=config.min_prefetch,
+            max_prefetch=config.max_prefetch, max_delay=config.max_delay,
+            interval=config.interval, smoothing=config.smoothing, **kw)
+
+    def _clamp(self, prefetch_count):
+        return max(self.min_prefetch, min(self.max_prefetch, prefetch_count))
+
+    def _smooth(self, average, sample):
+        if average is None:
+            return sample
+        return self.smoothing * sample + (1 - self.smoothing) * average
+
+    def start(self):
+        self._task = LoopingCall(self.update)
+        self._task.clock = self.clock
+        self._task.start(self.interval, now=False)
+        return self.consumer.set_channel_prefetch_count(self.prefetch_count)
+
+    def stop(self):
+        if self._task is not None and self._task.running:
+            self._task.stop()
+        self._task = None
+
+    def _sample(self):
+        """Return the latency and concurrency since the last sample, or
+        `None` if nothing was handled.
+        """
+        count = self.consumer.processed_count - self._last_count
+        elapsed = self.consumer.processing_time - self._last_time
+        self._last_count = self.consumer.processed_count
+        self._last_time = self.consumer.processing_time
+        if count > 0:
+            return elapsed / count, elapsed / self.interval
+        if self.consumer.in_progress > 0:
+            return (max(self.interval, self.latency or 0),
+                    float(self.consumer.in_progress))
+        return None
+
+    def update(self):
+        """Sample the consumer's latency and concurrency and adjust the limit
+        if needed.
+        """
+        sample = self._sample()
+        if sample is None:
+            return succeed(None)
+        latency, in_flight = sample
+        self.latency = self._smooth(self.latency, latency)
+        self.in_flight = self._smooth(self.in_flight, in_flight)
+        scale = self.target_concurrency / max(self.in_flight, 1e-6)
+        prefetch_count = self.prefetch_count * max(0.5, min(2.0, scale))
+        max_waiting = (
+            self.target_concurrency * self.max_delay / max(self.latency, 1e-6))
+        prefetch_count = self._clamp(int(round(
+            min(prefetch_count, self.target_concurrency + max_waiting))))
+        if prefetch_count == self.prefetch_count:
+            return succeed(None)
+        log.debug("Changing prefetch limit for %r from %s to %s." % (
+            self.consumer.queue_name, self.prefetch_count, prefetch_count))
+        self.prefetch_count = prefetch_count
+        return self.consumer.set_channel_prefetch_count(prefetch_count)
+
+
 class BaseConnector(object):
     """Base class for 'connector' objects.
 
@@ -17,7 +188,10 @@ class BaseConnector(object):
     individually all over the place.
     """
     def __init__(self, worker, connector_name, prefetch_count=None,
-                 middlewares=None):
+                 middlewares=None, message_codec=None,
+                 compact_messages=False, publisher_options=None,
+                 adaptive_prefetch=None, concurrency=1,
+                 metric_manager=None, amqp_connections=None):
         self.name = connector_name
         self.worker = worker
         self._consumers = {}
@@ -25,6 +199,17 @@ class BaseConnector(object):
         self._endpoint_handlers = {}
         self._default_handlers = {}
         self._prefetch_count = prefetch_count
+        self._message_codec = get_message_codec(message_codec)
+        self._compact_messages = compact_messages
+        self._publisher_options = publisher_options or {}
+        if adaptive_prefetch is not None:
+            adaptive_prefetch = AdaptivePrefetchConfig(
+                adaptive_prefetch, static=True)
+        self._adaptive_prefetch = adaptive_prefetch
+        self._prefetch_controllers = {}
+        self._concurrency = concurrency
+        self._metric_manager = metric_manager
+        self._amqp_connections = amqp_connections or {}
         self._middlewares = MiddlewareStack(middlewares
                                             if middlewares is not None else [])
 
@@ -35,6 +220,8 @@ class BaseConnector(object):
         raise NotImplementedError()
 
     def teardown(self):
+        for controller in self._prefetch_controllers.values():
+            controller.stop()
         d = gatherResults([c.stop() for c in self._consumers.values()])
         d.addCallback(lambda r: self._middlewares.teardown())
         return d
@@ -55,7 +242,10 @@ class BaseConnector(object):
 
     @inlineCallbacks
     def _setup_publisher(self, mtype):
-        publisher = yield self.worker.publish_to(self._rkey(mtype))
+        publisher = yield self.worker.publish_to(
+            self._rkey(mtype), message_codec=self._message_codec,
+            amqp_connection=self._amqp_connections.get('publish'),
+            **self._publisher_options)
         self._publishers[mtype] = publisher
         returnValue(publisher)
 
@@ -64,13 +254,51 @@ class BaseConnector(object):
         def handler(msg):
             return self._consume_message(mtype, msg)
 
+        if self._compact_messages:
+            msg_class = COMPACT_MESSAGE_CLASSES.get(msg_class, msg_class)
+
+        # With adaptive prefetch, the controller manages the channel's limit
+        # instead, because a per-consumer limit can't be changed later.
+        prefetch_count = self._prefetch_count
+        if self._adaptive_prefetch is not None:
+            prefetch_count = None
+
         consumer = yield self.worker.consume(
             self._rkey(mtype), handler, message_class=msg_class, paused=True,
-            prefetch_count=self._prefetch_count)
+            prefetch_count=prefetch_count,
+            message_codec=self._message_codec,
+            concurrency=self._concurrency,
+            amqp_connection=self._amqp_connections.get('consume'))
         self._consumers[mtype] = consumer
+        if self._metric_manager is not None:
+            self._register_consumer_metrics(mtype, consumer)
+        if self._adaptive_prefetch is not None:
+            controller = AdaptivePrefetchController.from_config(
+                consumer, self._prefetch_count, self._adaptive_prefetch)
+            self._prefetch_controllers[mtype] = controller
+            yield controller.start()
         self._set_default_endpoint_handler(mtype, default_handler)
         returnValue(consumer)
 
+    def _register_consumer_metrics(self, mtype, consumer):
+        prefix = '%s.in_flight' % (self._rkey(mtype),)
+        self._register_gauge(prefix, lambda: consumer.in_progress)
+        self._register_gauge(
+            prefix + '_peak', consumer.reset_peak_in_progress,
+            aggregators=[MAX])
+
+    def _register_gauge(self, name, func, aggregators=None):
+        """Register a gauge, or point an existing one at `func`.
+
+        A connector may be set up again, or replaced by a new one with the
+        same name, and the metric manager doesn't allow duplicate names.
+        """
+        if name in self._metric_manager:
+            self._metric_manager[name].set_func(func)
+        else:
+            self._metric_manager.register(
+                Gauge(name, func, aggregators=aggregators))
+
     def _set_endpoint_handler(self, mtype, handler, endpoint_name):
         if endpoint_name is None:
             endpoint_name = TransportMessage.DEFAULT_ENDPOINT_NAME
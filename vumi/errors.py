@@ -18,6 +18,10 @@ class InvalidMessageField(InvalidMessage):
     pass
 
 
+class MessageCodecError(VumiError):
+    """Raised when a message codec is unknown or unavailable."""
+
+
 class DuplicateConnectorError(VumiError):
     pass
 
@@ -4,7 +4,18 @@ import json
 from uuid import uuid4
 from datetime import datetime
 
-from errors import MissingMessageField, InvalidMessageField
+try:
+    import simplejson as fast_json
+except ImportError:
+    fast_json = json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from errors import (
+    MissingMessageField, InvalidMessageField, MessageCodecError)
 
 from vumi.utils import to_kwargs
 
@@ -41,6 +52,190 @@ def to_json(obj):
     return json.dumps(obj, cls=JSONMessageEncoder)
 
 
+# Top-level payload fields that hold datetimes. Codecs that don't run
+# `date_time_decoder` over everything only decode these.
+DATETIME_FIELDS = frozenset(['timestamp'])
+
+
+def _copy_payload_value(value):
+    """Copy the mutable containers in a JSON-like value.
+
+    Strings, numbers, datetimes and other leaf values are shared.
+    """
+    if isinstance(value, dict):
+        return dict((k, _copy_payload_value(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [_copy_payload_value(v) for v in value]
+    return value
+
+
+def _encode_datetime(obj):
+    if isinstance(obj, datetime):
+        return obj.strftime(VUMI_DATE_FORMAT)
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+
+def _decode_datetime_fields(payload, datetime_fields):
+    for field in datetime_fields:
+        value = payload.get(field)
+        if isinstance(value, basestring):
+            try:
+                payload[field] = datetime.strptime(value, VUMI_DATE_FORMAT)
+            except ValueError:
+                pass
+    return payload
+
+
+class MessageCodec(object):
+    """Base class for message payload codecs.
+
+    A codec turns a message payload dict into a string for the wire and back
+    again. Codecs are looked up by `name` in worker config and by
+    `content_type` when a message arrives over AMQP. A `content_type` of
+    `None` means the message is published without a content type, which is
+    how the original JSON format has always been sent.
+    """
+
+    name = None
+    content_type = None
+
+    def encode(self, payload):
+        raise NotImplementedError()
+
+    def decode(self, data):
+        raise NotImplementedError()
+
+
+class JSONMessageCodec(MessageCodec):
+    """The original vumi JSON format.
+
+    Every string value anywhere in the payload that looks like a datetime is
+    decoded into a datetime.
+    """
+
+    name = 'json'
+
+    def encode(self, payload):
+        return to_json(payload)
+
+    def decode(self, data):
+        return from_json(data)
+
+
+class FastJSONMessageCodec(MessageCodec):
+    """A faster codec for the original vumi JSON format.
+
+    This uses `simplejson` if it is installed and only decodes datetimes in
+    known top-level fields (see :data:`DATETIME_FIELDS`) instead of trying to
+    parse every string in the payload. The encoded form is identical to that
+    of :class:`JSONMessageCodec`, so the two can be mixed freely.
+
+    NOTE: `simplejson` may decode ASCII strings as `str` rather than
+          `unicode`.
+    """
+
+    name = 'fast_json'
+
+    def __init__(self, datetime_fields=DATETIME_FIELDS):
+        self.datetime_fields = datetime_fields
+
+    def encode(self, payload):
+        return fast_json.dumps(payload, default=_encode_datetime)
+
+    def decode(self, data):
+        return _decode_datetime_fields(
+            fast_json.loads(data), self.datetime_fields)
+
+
+class MsgpackMessageCodec(MessageCodec):
+    """A compact binary codec using `msgpack`.
+
+    Datetimes are stored as msgpack extension values so they survive the round
+    trip wherever they are in the payload. This requires the `msgpack`
+    package to be installed.
+    """
+
+    name = 'msgpack'
+    content_type = 'application/x-msgpack'
+    DATETIME_EXT_TYPE = 1
+
+    def __init__(self):
+        if msgpack is None:
+            raise MessageCodecError("The msgpack codec requires 'msgpack'.")
+
+    def _default(self, obj):
+        if isinstance(obj, datetime):
+            return msgpack.ExtType(
+                self.DATETIME_EXT_TYPE, obj.strftime(VUMI_DATE_FORMAT))
+        raise TypeError("%r is not msgpack serializable" % (obj,))
+
+    def _ext_hook(self, code, data):
+        if code == self.DATETIME_EXT_TYPE:
+            return datetime.strptime(data, VUMI_DATE_FORMAT)
+        return msgpack.ExtType(code, data)
+
+    def encode(self, payload):
+        return msgpack.packb(
+            payload, default=self._default, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, ext_hook=self._ext_hook, raw=False)
+
+
+MESSAGE_CODECS = {}
+_CODEC_INSTANCES = {}
+DEFAULT_MESSAGE_CODEC = JSONMessageCodec.name
+
+
+def register_message_codec(codec_class):
+    """Make a :class:`MessageCodec` subclass available by name."""
+    MESSAGE_CODECS[codec_class.name] = codec_class
+    return codec_class
+
+
+def get_message_codec(codec=None):
+    """Return a codec instance.
+
+    :param codec:
+        A codec name, a :class:`MessageCodec` instance (which is returned
+        unchanged) or `None` for the default codec.
+    """
+    if isinstance(codec, MessageCodec):
+        return codec
+    if codec is None:
+        codec = DEFAULT_MESSAGE_CODEC
+    if codec not in _CODEC_INSTANCES:
+        if codec not in MESSAGE_CODECS:
+            raise MessageCodecError("Unknown message codec: %r" % (codec,))
+        _CODEC_INSTANCES[codec] = MESSAGE_CODECS[codec]()
+    return _CODEC_INSTANCES[codec]
+
+
+def get_message_codec_for_content_type(content_type, default=None):
+    """Return the codec to decode a message with the given content type.
+
+    If `default` is given and handles `content_type`, it is used. Otherwise
+    the first registered codec for `content_type` is used. Messages with no
+    content type use the default JSON codec.
+    """
+    if default is not None:
+        default = get_message_codec(default)
+        if default.content_type == content_type:
+            return default
+    if content_type is None:
+        return get_message_codec(DEFAULT_MESSAGE_CODEC)
+    for name, codec_class in sorted(MESSAGE_CODECS.items()):
+        if codec_class.content_type == content_type:
+            return get_message_codec(name)
+    raise MessageCodecError(
+        "No message codec for content type: %r" % (content_type,))
+
+
+register_message_codec(JSONMessageCodec)
+register_message_codec(FastJSONMessageCodec)
+register_message_codec(MsgpackMessageCodec)
+
+
 class Message(object):
     """
     Start of a somewhat unified message object to be
@@ -51,12 +246,76 @@ class Message(object):
 
     """
 
+    # The payload may contain containers (such as `helper_metadata`) that are
+    # shared with copies of this message. These are tracked in `_shared` and
+    # copied the first time they are handed out by `__getitem__` or `get`,
+    # since we can't tell whether the caller is going to modify them.
+    # Accessing `payload` directly unshares everything.
+    #
+    # Containers that have already been handed out (or were passed in by the
+    # caller) are tracked in `_exposed`, which is `True` once the whole
+    # payload dict has been handed out. Someone else may still hold a
+    # reference to these, so `copy` copies them straight away instead of
+    # sharing them.
+    #
+    # The message classes in this module declare `__slots__` all the way
+    # down so that the compact subclasses don't get an instance `__dict__`.
+    # Subclasses elsewhere that don't declare `__slots__` get one as usual.
+    __slots__ = ('_payload', '_shared', '_exposed', '__weakref__')
+
     def __init__(self, _process_fields=True, **kwargs):
         if _process_fields:
             kwargs = self.process_fields(kwargs)
         self.payload = kwargs
         self.validate_fields()
 
+    @property
+    def payload(self):
+        if self._shared:
+            for key in list(self._shared):
+                self._unshare(key)
+        self._exposed = True
+        return self._payload
+
+    @payload.setter
+    def payload(self, payload):
+        self._payload = payload
+        self._shared = None
+        self._exposed = True
+
+    def _unshare(self, key):
+        self._shared.discard(key)
+        if key in self._payload:
+            self._payload[key] = _copy_payload_value(self._payload[key])
+
+    def _expose(self, key, value):
+        """Note that a container in the payload has been handed out."""
+        if self._exposed is True or not isinstance(value, (dict, list)):
+            return
+        if self._exposed is None:
+            self._exposed = set()
+        self._exposed.add(key)
+
+    def _copy_fields(self, fields):
+        """Copy `fields` for a copy of this message.
+
+        Returns the new fields and the set of keys whose containers are
+        shared with this message.
+        """
+        fields = dict(fields)
+        shared = set()
+        for key, value in fields.items():
+            if not isinstance(value, (dict, list)):
+                continue
+            if self._exposed is True or (
+                    self._exposed and key in self._exposed):
+                fields[key] = _copy_payload_value(value)
+            else:
+                shared.add(key)
+        if shared:
+            self._shared = shared.union(self._shared or ())
+        return fields, shared
+
     def process_fields(self, fields):
         return fields
 
@@ -73,46 +332,98 @@ class Message(object):
         if self.payload[field] not in values:
             raise InvalidMessageField(field)
 
+    def _get_fields(self):
+        """Return the payload for reading without unsharing anything."""
+        return self._payload
+
     def to_json(self):
-        return to_json(self.payload)
+        return to_json(self._get_fields())
 
     @classmethod
     def from_json(cls, json_string):
-        return cls(_process_fields=False, **to_kwargs(from_json(json_string)))
+        msg = cls(_process_fields=False, **to_kwargs(from_json(json_string)))
+        # Nobody else has seen the freshly decoded payload.
+        msg._exposed = None
+        return msg
+
+    def encode(self, codec=None):
+        """Serialize this message using the given codec.
+
+        See :func:`get_message_codec` for valid values of `codec`.
+        """
+        return get_message_codec(codec).encode(self._get_fields())
+
+    @classmethod
+    def decode(cls, data, codec=None):
+        """Build a message from data serialized with the given codec.
+
+        See :func:`get_message_codec` for valid values of `codec`.
+        """
+        payload = get_message_codec(codec).decode(data)
+        msg = cls(_process_fields=False, **to_kwargs(payload))
+        # Nobody else has seen the freshly decoded payload.
+        msg._exposed = None
+        return msg
 
     def __str__(self):
-        return u"<Message payload=\"%s\">" % repr(self.payload)
+        return u"<Message payload=\"%s\">" % repr(self._get_fields())
 
     def __repr__(self):
         return str(self)
 
     def __eq__(self, other):
         if isinstance(other, Message):
-            return self.payload == other.payload
+            return self._get_fields() == other._get_fields()
         return False
 
     def __contains__(self, key):
-        return key in self.payload
+        return key in self._payload
 
     def __getitem__(self, key):
-        return self.payload[key]
+        if self._shared and key in self._shared:
+            self._unshare(key)
+        value = self._payload[key]
+        self._expose(key, value)
+        return value
 
     def __setitem__(self, key, value):
-        self.payload[key] = value
+        if self._shared:
+            self._shared.discard(key)
+        self._expose(key, value)
+        self._payload[key] = value
 
     def get(self, key, default=None):
-        return self.payload.get(key, default)
+        if self._shared and key in self._shared:
+            self._unshare(key)
+        value = self._payload.get(key, default)
+        self._expose(key, value)
+        return value
 
     def items(self):
         return self.payload.items()
 
     def copy(self):
-        return self.from_json(self.to_json())
+        """Return a copy of this message.
+
+        Leaf values are shared between the two messages and mutable
+        containers in the payload are only copied when one of the messages
+        hands them out, so copying a message that is then only modified at
+        the top level is cheap. Containers this message has already handed
+        out are copied immediately.
+        """
+        msg = self.__class__.__new__(self.__class__)
+        if hasattr(self, '__dict__'):
+            msg.__dict__.update(self.__dict__)
+        msg._payload, msg._shared = self._copy_fields(self._payload)
+        msg._exposed = None
+        return msg
 
 
 class TransportMessage(Message):
     """Common base class for messages sent to or from a transport."""
 
+    __slots__ = ()
+
     # sub-classes should set the message type
     MESSAGE_TYPE = None
     MESSAGE_VERSION = '20110921'
@@ -152,7 +463,9 @@ class TransportMessage(Message):
 
     @property
     def routing_metadata(self):
-        return self.payload.setdefault('routing_metadata', {})
+        if 'routing_metadata' not in self:
+            self['routing_metadata'] = {}
+        return self['routing_metadata']
 
     @classmethod
     def check_routing_endpoint(cls, endpoint_name):
@@ -178,6 +491,8 @@ class TransportUserMessage(TransportMessage):
                       by transports or message workers).
     """
 
+    __slots__ = ()
+
     MESSAGE_TYPE = 'user_message'
 
     # session event constants
@@ -336,6 +651,9 @@ class TransportUserMessage(TransportMessage):
 class TransportEvent(TransportMessage):
     """Message about a TransportUserMessage.
     """
+
+    __slots__ = ()
+
     MESSAGE_TYPE = 'event'
 
     # list of valid delivery statuses
@@ -371,3 +689,222 @@ class TransportEvent(TransportMessage):
             self.assert_field_present(extra_field)
             if not check(self[extra_field]):
                 raise InvalidMessageField(extra_field)
+
+
+_MISSING = object()
+
+
+class CompactMessageMixin(object):
+    """Mixin for messages that keep well-known fields in slots.
+
+    Fields listed in `COMPACT_FIELDS` are stored in slots and anything else
+    goes into an `_extras` dict that is only allocated if it's needed. The
+    usual dict-like API works without building a payload dict. Accessing
+    :attr:`payload` directly converts the message into an ordinary
+    dict-backed message, since the caller may modify the dict it gets back.
+
+    Messages decoded with :meth:`decode` or :meth:`from_json` are assumed to
+    come from a trusted source (such as another vumi worker) and are not
+    validated.
+
+    Concrete classes must set `_SLOTS` using :func:`compact_slot_names` and
+    declare `__slots__` to match.
+    """
+
+    __slots__ = ()
+
+    COMPACT_FIELDS = frozenset()
+    _SLOTS = {}
+
+    def __init__(self, _process_fields=True, **kwargs):
+        super(CompactMessageMixin, self).__init__(
+            _process_fields=_process_fields, **kwargs)
+        payload, self._payload, self._extras = self._payload, None, None
+        self._set_fields(payload)
+
+    @classmethod
+    def _from_fields(cls, fields):
+        msg = cls.__new__(cls)
+        msg._payload = None
+        msg._shared = None
+        msg._exposed = None
+        msg._extras = None
+        msg._set_fields(fields)
+        return msg
+
+    @classmethod
+    def fill_legacy_fields(cls, fields):
+        """Add defaults for fields that older message versions may lack.
+
+        This is what :meth:`validate_fields` does as a side effect and is the
+        only part of validation that trusted decodes still need.
+        """
+        return fields
+
+    @classmethod
+    def from_trusted_payload(cls, payload):
+        """Build a message from a decoded payload without validating it."""
+        return cls._from_fields(to_kwargs(cls.fill_legacy_fields(payload)))
+
+    @classmethod
+    def from_json(cls, json_string):
+        return cls.from_trusted_payload(from_json(json_string))
+
+    @classmethod
+    def decode(cls, data, codec=None):
+        return cls.from_trusted_payload(get_message_codec(codec).decode(data))
+
+    def _set_fields(self, fields):
+        for key, value in fields.iteritems():
+            self._set_field(key, value)
+
+    def _set_field(self, key, value):
+        slot = self._SLOTS.get(key)
+        if slot is not None:
+            setattr(self, slot, value)
+        else:
+            if self._extras is None:
+                self._extras = {}
+            self._extras[key] = value
+
+    def _get_field(self, key, default):
+        slot = self._SLOTS.get(key)
+        if slot is not None:
+            return getattr(self, slot, default)
+        if self._extras is None:
+            return default
+        return self._extras.get(key, default)
+
+    def _get_fields(self):
+        if self._payload is not None:
+            return self._payload
+        fields = {}
+        for key, slot in self._SLOTS.iteritems():
+            value = getattr(self, slot, _MISSING)
+            if value is not _MISSING:
+                fields[key] = value
+        if self._extras:
+            fields.update(self._extras)
+        return fields
+
+    @property
+    def payload(self):
+        if self._payload is None:
+            if self._shared:
+                for key in list(self._shared):
+                    self._unshare(key)
+            fields = self._get_fields()
+            for slot in self._SLOTS.itervalues():
+                if hasattr(self, slot):
+                    delattr(self, slot)
+            self._extras = None
+            self._payload = fields
+        return super(CompactMessageMixin, self).payload
+
+    @payload.setter
+    def payload(self, payload):
+        self._payload = payload
+        self._shared = None
+        self._exposed = True
+
+    def _unshare(self, key):
+        if self._payload is not None:
+            return super(CompactMessageMixin, self)._unshare(key)
+        self._shared.discard(key)
+        value = self._get_field(key, _MISSING)
+        if value is not _MISSING:
+            self._set_field(key, _copy_payload_value(value))
+
+    def __contains__(self, key):
+        if self._payload is not None:
+            return key in self._payload
+        return self._get_field(key, _MISSING) is not _MISSING
+
+    def __getitem__(self, key):
+        if self._payload is not None:
+            return super(CompactMessageMixin, self).__getitem__(key)
+        if self._shared and key in self._shared:
+            self._unshare(key)
+        value = self._get_field(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        self._expose(key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        if self._payload is not None:
+            return super(CompactMessageMixin, self).__setitem__(key, value)
+        if self._shared:
+            self._shared.discard(key)
+        self._expose(key, value)
+        self._set_field(key, value)
+
+    def get(self, key, default=None):
+        if self._payload is not None:
+            return super(CompactMessageMixin, self).get(key, default)
+        if self._shared and key in self._shared:
+            self._unshare(key)
+        value = self._get_field(key, default)
+        self._expose(key, value)
+        return value
+
+    def items(self):
+        if self._shared:
+            for key in list(self._shared):
+                self._unshare(key)
+        self._exposed = True
+        return self._get_fields().items()
+
+    def copy(self):
+        fields, shared = self._copy_fields(self._get_fields())
+        msg = self._from_fields(fields)
+        msg._shared = shared
+        return msg
+
+
+def compact_slot_names(fields):
+    """Map field names to slot names for a :class:`CompactMessageMixin`."""
+    return dict((field, '_f_' + field) for field in fields)
+
+
+class CompactTransportUserMessage(CompactMessageMixin, TransportUserMessage):
+    """A :class:`TransportUserMessage` that stores its fields in slots."""
+
+    COMPACT_FIELDS = frozenset([
+        'message_version', 'message_type', 'timestamp', 'routing_metadata',
+        'helper_metadata', 'message_id', 'to_addr', 'from_addr',
+        'in_reply_to', 'session_event', 'content', 'transport_name',
+        'transport_type', 'transport_metadata', 'group',
+    ])
+    _SLOTS = compact_slot_names(COMPACT_FIELDS)
+    __slots__ = ('_extras',) + tuple(_SLOTS.values())
+
+    @classmethod
+    def fill_legacy_fields(cls, fields):
+        fields.setdefault('helper_metadata', {})
+        fields.setdefault('group', None)
+        return fields
+
+
+class CompactTransportEvent(CompactMessageMixin, TransportEvent):
+    """A :class:`TransportEvent` that stores its fields in slots."""
+
+    COMPACT_FIELDS = frozenset([
+        'message_version', 'message_type', 'timestamp', 'routing_metadata',
+        'helper_metadata', 'event_id', 'event_type', 'user_message_id',
+        'sent_message_id', 'nack_reason', 'delivery_status',
+        'transport_name', 'transport_metadata',
+    ])
+    _SLOTS = compact_slot_names(COMPACT_FIELDS)
+    __slots__ = ('_extras',) + tuple(_SLOTS.values())
+
+    @classmethod
+    def fill_legacy_fields(cls, fields):
+        fields.setdefault('helper_metadata', {})
+        return fields
+
+
+COMPACT_MESSAGE_CLASSES = {
+    TransportUserMessage: CompactTransportUserMessage,
+    TransportEvent: CompactTransportEvent,
+}
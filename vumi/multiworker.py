@@ -2,7 +2,7 @@
 
 from copy import deepcopy
 
-from vumi.service import Worker, WorkerCreator
+from vumi.service import Worker, WorkerCreator, LocalMessageBus
 
 
 class MultiWorker(Worker):
@@ -16,6 +16,12 @@ class MultiWorker(Worker):
     :type defaults: dict
     :param defaults:
         Default configuration for child workers.
+    :type local_routing: bool
+    :param local_routing:
+        If true, messages published by one child worker to a routing key
+        consumed by another child worker are handed over directly instead of
+        going through the AMQP broker. See
+        :class:`vumi.service.LocalMessageBus`. Defaults to false.
 
     Each entry in the ``workers`` config dict defines a child worker to start.
     A child worker's configuration should be provided in a config dict keyed by
@@ -39,6 +45,7 @@ class MultiWorker(Worker):
         """
         config = self.construct_worker_config(worker_name)
         worker = self.worker_creator.create_worker(worker_class, config)
+        worker.local_bus = self.local_bus
         worker.setName(worker_name)
         worker.setServiceParent(self)
         return worker
@@ -46,6 +53,9 @@ class MultiWorker(Worker):
     def startService(self):
         super(MultiWorker, self).startService()
         self.workers = []
+        self.local_bus = None
+        if self.config.get('local_routing', False):
+            self.local_bus = LocalMessageBus()
         self.worker_creator = self.WORKER_CREATOR(self.options)
         for wname, wclass in self.config.get('workers', {}).items():
             worker = self.create_worker(wname, wclass)
@@ -1,7 +1,8 @@
 # -*- test-case-name: vumi.persist.tests.test_fake_redis -*-
 
 import fnmatch
-from functools import wraps
+from functools import wraps, partial
+from hashlib import sha1
 from itertools import takewhile, dropwhile
 import os
 from zlib import crc32
@@ -26,6 +27,71 @@ def call_to_deferred(deferred, func, *args, **kw):
     execute(func, *args, **kw).chainDeferred(deferred)
 
 
+def run_pipeline_calls(redis, calls):
+    return [func(redis, *args, **kw) for func, args, kw in calls]
+
+
+def lua_result(value):
+    """Convert a Python value to what redis would return for its Lua
+    equivalent.
+
+    Numbers are truncated to integers, ``True`` becomes ``1`` and ``False``
+    becomes ``None``.
+    """
+    if value is True:
+        return 1
+    if value is False or value is None:
+        return None
+    if isinstance(value, (int, long, float)):
+        return int(value)
+    if isinstance(value, (list, tuple)):
+        return [lua_result(v) for v in value]
+    return value
+
+
+class NoScriptError(Exception):
+    """Raised when asked to run a script that hasn't been loaded."""
+
+
+class FakeRedisScriptCalls(object):
+    """Gives script emulations synchronous access to a :class:`FakeRedis`.
+
+    A real Lua script runs atomically and can't wait on anything, so neither
+    can its emulation, even in async mode.
+    """
+
+    def __init__(self, redis):
+        self._redis = redis
+
+    def __getattr__(self, name):
+        return partial(getattr(self._redis, name).sync, self._redis)
+
+
+class FakeRedisPipeline(object):
+    """Queues calls to a :class:`FakeRedis` and runs them all at once.
+
+    As with redis-py's pipelines, queueing a call returns the pipeline and
+    :meth:`execute` returns a list of results. In async mode all the calls
+    are made after a single delay.
+    """
+
+    def __init__(self, redis):
+        self._redis = redis
+        self._calls = []
+
+    def __getattr__(self, name):
+        func = getattr(self._redis, name).sync
+
+        def queue_call(*args, **kw):
+            self._calls.append((func, args, kw))
+            return self
+        return queue_call
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return self._redis._delay_operation(run_pipeline_calls, [calls], {})
+
+
 class FakeRedis(object):
     """In process and memory implementation of redis-like data store.
 
@@ -40,6 +106,7 @@ class FakeRedis(object):
 
     def __init__(self, charset='utf-8', errors='strict', async=False):
         self._data = {}
+        self._scripts = set()
         self._known_key_existence = {}
         self._expiries = {}
         self._is_async = async
@@ -110,6 +177,27 @@ class FakeRedis(object):
         """
         return sorted(keys, key=crc32)
 
+    def pipeline(self, transaction=True, shard_hint=None):
+        """Return a pipeline for queueing calls and running them together.
+
+        The queued calls are always run without interruption, whether or not
+        a transaction is asked for.
+        """
+        return FakeRedisPipeline(self)
+
+    def _get_script(self, sha):
+        """Return the :class:`~vumi.persist.redis_base.RedisScript` with the
+        given SHA1, or ``None``.
+
+        FakeRedis can't run Lua, so :meth:`eval` and :meth:`evalsha` call the
+        script's ``emulation(redis, keys, args)`` instead. ``redis`` provides
+        the usual operations, always synchronously, and the return value is
+        converted with :func:`lua_result`.
+        """
+        # This is imported here because redis_base imports this module.
+        from vumi.persist.redis_base import RedisScript
+        return RedisScript.get_script(sha)
+
     # Global operations
 
     @maybe_async
@@ -469,6 +557,37 @@ class FakeRedis(object):
             del lval[stop + 1:]
         del lval[:start]
 
+    # Scripting operations
+
+    @maybe_async
+    def script_load(self, script):
+        sha = sha1(script).hexdigest()
+        if self._get_script(sha) is None:
+            raise ValueError("No emulation registered for script %r" % (
+                script,))
+        self._scripts.add(sha)
+        return sha
+
+    @maybe_async
+    def script_flush(self):
+        self._scripts.clear()
+        return True
+
+    @maybe_async
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        if sha not in self._scripts:
+            raise NoScriptError("No matching script. Please use EVAL.")
+        keys_and_args = [self._encode(v) for v in keys_and_args]
+        emulation = self._get_script(sha).emulation
+        return lua_result(emulation(
+            FakeRedisScriptCalls(self), keys_and_args[:numkeys],
+            keys_and_args[numkeys:]))
+
+    @maybe_async
+    def eval(self, script, numkeys, *keys_and_args):
+        sha = self.script_load.sync(self, script)
+        return self.evalsha.sync(self, sha, numkeys, *keys_and_args)
+
     # Expiry operations
 
     @maybe_async
@@ -0,0 +1,144 @@
+# -*- test-case-name: vumi.persist.tests.test_fake_riak -*-
+
+"""An in-memory stand-in for a Riak server, for riakasaurus clients."""
+
+import urllib
+from uuid import uuid4
+
+from riakasaurus.metadata import MD_CTYPE, MD_INDEX, MD_USERMETA
+from riakasaurus.riak import RiakClient
+from riakasaurus.riak_index_entry import RiakIndexEntry
+from twisted.internet.defer import succeed, fail
+
+from vumi.persist.txriak_manager import TxRiakManager
+
+
+def fake_riak_manager(bucket_prefix, **kw):
+    """Return a :class:`TxRiakManager` backed by a
+    :class:`FakeRiakTransport`.
+
+    Keyword arguments are passed on to the manager.
+    """
+    return TxRiakManager(
+        RiakClient(transport=FakeRiakTransport), bucket_prefix, **kw)
+
+
+class FakeRiakTransport(object):
+    """A riakasaurus transport that keeps objects in memory.
+
+    Objects are kept per transport (and so per client), so managers that
+    need to see the same data must share a client. Fetching, storing and
+    deleting objects, listing keys and buckets and secondary index queries
+    are supported. MapReduce, search and paging through index results are
+    not.
+
+    This is a stand-in for benchmarks and tests that don't have a Riak
+    server to talk to. It doesn't emulate siblings, vector clocks or
+    tombstones.
+    """
+
+    VCLOCK = 'fake-vclock'
+
+    def __init__(self, client):
+        self._client = client
+        self._buckets = {}
+        self._bucket_props = {}
+
+    def _bucket_objects(self, bucket_name):
+        return self._buckets.setdefault(bucket_name, {})
+
+    def _result(self, stored):
+        """Build the result riakasaurus expects from a fetch."""
+        if stored is None:
+            return None
+        content_type, usermeta, indexes, data = stored
+        metadata = {
+            MD_CTYPE: content_type,
+            MD_USERMETA: dict(usermeta),
+            MD_INDEX: [RiakIndexEntry(field, value)
+                       for field, value in indexes],
+        }
+        return (self.VCLOCK, [(metadata, data)])
+
+    def get(self, robj, r=None, pr=None, vtag=None):
+        objects = self._buckets.get(robj.get_bucket().get_name(), {})
+        return succeed(self._result(objects.get(robj.get_key())))
+
+    head = get
+
+    def put(self, robj, w=None, dw=None, pw=None, return_body=True,
+            if_none_match=False):
+        stored = self._put(robj, robj.get_key(), if_none_match)
+        return succeed(self._result(stored) if return_body else None)
+
+    def put_new(self, robj, w=None, dw=None, pw=None, return_body=True,
+                if_none_match=False):
+        key = uuid4().hex
+        _vclock, [(metadata, _data)] = self._result(
+            self._put(robj, key, if_none_match))
+        return succeed((key, self.VCLOCK, metadata))
+
+    def _put(self, robj, key, if_none_match):
+        objects = self._bucket_objects(robj.get_bucket().get_name())
+        if if_none_match and key in objects:
+            raise ValueError("Object %r already exists." % (key,))
+        objects[key] = (
+            robj.get_content_type(), dict(robj.get_usermeta()),
+            [(entry.get_field(), entry.get_value())
+             for entry in robj.get_indexes()],
+            robj.get_encoded_data())
+        return objects[key]
+
+    def delete(self, robj, rw=None, r=None, w=None, dw=None, pr=None,
+               pw=None):
+        objects = self._buckets.get(robj.get_bucket().get_name(), {})
+        objects.pop(robj.get_key(), None)
+        return succeed(self)
+
+    def get_keys(self, bucket):
+        return succeed(list(self._buckets.get(bucket.get_name(), {})))
+
+    def get_buckets(self):
+        return succeed(
+            [name for name, objects in self._buckets.iteritems() if objects])
+
+    def get_bucket_props(self, bucket):
+        return succeed(dict(self._bucket_props.get(bucket.get_name(), {})))
+
+    def set_bucket_props(self, bucket, props):
+        self._bucket_props.setdefault(bucket.get_name(), {}).update(props)
+        return succeed(None)
+
+    def ping(self):
+        return succeed(True)
+
+    def _index_value(self, index, value):
+        if index.endswith('_int'):
+            return int(value)
+        return value
+
+    def get_index(self, bucket, index, startkey, endkey=None):
+        # Managers quote index values for the HTTP API.
+        startkey = urllib.unquote(str(startkey))
+        if endkey is not None:
+            endkey = urllib.unquote(str(endkey))
+        objects = self._buckets.get(bucket, {})
+        if index == '$bucket':
+            return succeed(sorted(objects))
+        start = self._index_value(index, startkey)
+        end = start if endkey is None else self._index_value(index, endkey)
+        if index == '$key':
+            return succeed(sorted(
+                key for key in objects if start <= key <= end))
+        matches = []
+        for key, (_, _, indexes, _) in objects.iteritems():
+            for field, value in indexes:
+                if field == index and (
+                        start <= self._index_value(index, value) <= end):
+                    matches.append(key)
+                    break
+        return succeed(sorted(matches))
+
+    def mapred(self, inputs, query, timeout=None):
+        return fail(NotImplementedError(
+            "MapReduce isn't supported by the in-memory Riak transport."))
@@ -16,6 +16,12 @@ class ValidationError(Exception):
 class FieldDescriptor(object):
     """Property for getting and setting fields."""
 
+    # Descriptors that are expensive to decode can set this to keep decoded
+    # values on the model object until the field is next set or the model's
+    # data is replaced. Cached values are written back before the model is
+    # stored, so changes made to them in place are saved.
+    cache_values = False
+
     def __init__(self, key, field):
         self.key = key
         self.field = field
@@ -66,6 +72,11 @@ class FieldDescriptor(object):
         raw_value = modelobj._riak_object._data.get(self.key)
         return self.field.from_riak(raw_value)
 
+    def get_raw_value(self, modelobj):
+        """Get the value associated with this descriptor as stored in Riak,
+        without decoding it."""
+        return modelobj._riak_object._data.get(self.key)
+
     def clean(self, modelobj):
         """Do any cleanup of the model data for this descriptor after loading
         the data from Riak."""
@@ -75,14 +86,31 @@ class FieldDescriptor(object):
         return "<%s key=%s field=%r>" % (self.__class__.__name__, self.key,
                                          self.field)
 
+    def store_cached_value(self, modelobj):
+        """Write the cached value for this descriptor (if any) back to the
+        model's data."""
+        cached = modelobj._decoded_values.get(self.key)
+        if cached is not None and cached[0] is modelobj._riak_object._data:
+            self.set_value(modelobj, cached[1])
+
     def __get__(self, instance, owner):
         if instance is None:
             return self.field
-        return self.get_value(instance)
+        if not self.cache_values:
+            return self.get_value(instance)
+        # We remember which data dict the value was decoded from, so we don't
+        # return it once the model's data has been replaced.
+        data = instance._riak_object._data
+        cached = instance._decoded_values.get(self.key)
+        if cached is None or cached[0] is not data:
+            cached = (data, self.get_value(instance))
+            instance._decoded_values[self.key] = cached
+        return cached[1]
 
     def __set__(self, instance, value):
         # instance can never be None here
         self.validate(value)
+        instance._decoded_values.pop(self.key, None)
         self.set_value(instance, value)
 
 
@@ -260,7 +288,15 @@ class Json(Field):
 
 
 class VumiMessageDescriptor(FieldDescriptor):
-    """Property for getting and setting fields."""
+    """Property for getting and setting fields.
+
+    Building a message is expensive, so the message is only built the first
+    time the field is read and the same message object is returned until the
+    field is set again. Changes made to that message are stored when the
+    model is saved.
+    """
+
+    cache_values = True
 
     def setup(self, model_cls):
         super(VumiMessageDescriptor, self).setup(model_cls)
@@ -292,18 +328,29 @@ class VumiMessageDescriptor(FieldDescriptor):
             full_key = "%s%s" % (self.prefix, key)
             modelobj._riak_object._data[full_key] = value
 
+    def get_raw_value(self, modelobj):
+        """Get the message payload as stored in Riak, without building a
+        message.
+
+        Timestamps are left in their JSON form, so the payload can be
+        serialised as it is.
+        """
+        prefix_len = len(self.prefix)
+        payload = dict(
+            (key[prefix_len:], value)
+            for key, value in modelobj._riak_object._data.iteritems()
+            if key.startswith(self.prefix))
+        return payload or None
+
     def get_value(self, modelobj):
         """Get the value associated with this descriptor."""
-        payload = {}
-        for key, value in modelobj._riak_object._data.iteritems():
-            if key.startswith(self.prefix):
-                key = key[len(self.prefix):]
-                # TODO: timestamp as datetime in payload must die.
-                if key == "timestamp":
-                    value = self._timestamp_from_json(value)
-                payload[key] = value
-        if not payload:
+        payload = self.get_raw_value(modelobj)
+        if payload is None:
             return None
+        # TODO: timestamp as datetime in payload must die.
+        if "timestamp" in payload:
+            payload["timestamp"] = self._timestamp_from_json(
+                payload["timestamp"])
         return self.field.message_class(**to_kwargs(payload))
 
 
@@ -2,9 +2,14 @@
 
 """Base classes for Vumi persistence models."""
 
+from collections import OrderedDict
+import copy
 from functools import wraps
+import time
 import urllib
 
+from twisted.internet.defer import returnValue
+
 from vumi.errors import VumiError
 from vumi.persist.fields import Field, FieldDescriptor, ValidationError
 
@@ -13,6 +18,11 @@ class ModelMigrationError(VumiError):
     pass
 
 
+class IndexPaginationNotSupported(VumiError):
+    """Raised when asked for a page of index results over a Riak transport
+    that can't page through them."""
+
+
 class ModelMetaClass(type):
     def __new__(mcs, name, bases, dict):
         # set default bucket suffix
@@ -33,6 +43,12 @@ class ModelMetaClass(type):
                     dict[key] = descriptors[key]
                     fields[key] = possible_field
         dict["field_descriptors"] = descriptors
+        # Most descriptors have nothing to clean, so we only visit the ones
+        # that do when loading objects.
+        dict["_cleaned_descriptors"] = [
+            descriptor for descriptor in descriptors.itervalues()
+            if type(descriptor).clean.im_func is not
+            FieldDescriptor.clean.im_func]
 
         # add backlinks object
         dict["backlinks"] = BackLinks()
@@ -198,6 +214,7 @@ class Model(object):
     def __init__(self, manager, key, _riak_object=None, **field_values):
         self.manager = manager
         self.key = key
+        self._decoded_values = {}
         if _riak_object is not None:
             self._riak_object = _riak_object
         else:
@@ -223,7 +240,7 @@ class Model(object):
         return "<%s %s>" % (self.__class__.__name__, " ".join(str_items))
 
     def clean(self):
-        for field_name, descriptor in self.field_descriptors.iteritems():
+        for descriptor in self._cleaned_descriptors:
             descriptor.clean(self)
 
     def get_data(self):
@@ -234,12 +251,29 @@ class Model(object):
         :returns:
             A dict of all values, including the key.
         """
+        self._store_cached_values()
         data = self._riak_object.get_data()
         data.update({
             'key': self.key,
             })
         return data
 
+    def _store_cached_values(self):
+        """Write field values cached on this object back to its Riak data.
+
+        Managers call this before storing the object.
+        """
+        for field_name in self._decoded_values.keys():
+            self.field_descriptors[field_name].store_cached_value(self)
+
+    def get_raw_value(self, field_name):
+        """Return the value of a field as it is stored in Riak.
+
+        This skips decoding the value, which is useful when the value is only
+        going to be serialised again (when exporting data, for example).
+        """
+        return self.field_descriptors[field_name].get_raw_value(self)
+
     def save(self):
         """Save the object to Riak.
 
@@ -276,6 +310,17 @@ class Model(object):
         """
         return manager.load_all_bunches(cls, keys)
 
+    @classmethod
+    def load_all(cls, manager, keys, callback):
+        """Load the objects for the given keys, calling `callback` with each
+        one as it is loaded.
+
+        :returns:
+            A deferred that fires once all the objects have been loaded and
+            handled (or None if using a synchronous manager).
+        """
+        return manager.load_all(cls, keys, callback)
+
     @classmethod
     def all_keys(cls, manager):
         """Return all keys in this model's bucket.
@@ -299,6 +344,35 @@ class Model(object):
             cls, field_name, value, None)
         return manager.index_keys(cls, index_name, start_value, end_value)
 
+    @classmethod
+    def all_keys_page(cls, manager, max_results=None, continuation=None):
+        """Return a page of keys from this model's bucket.
+
+        See :meth:`all_keys` and :meth:`Manager.index_keys_page`.
+
+        :returns:
+            A ``(keys, continuation)`` tuple.
+        """
+        return manager.index_keys_page(
+            cls, '$bucket', manager.bucket_name(cls), None,
+            max_results=max_results, continuation=continuation)
+
+    @classmethod
+    def index_keys_page(cls, manager, field_name, value, max_results=None,
+                        continuation=None):
+        """Find a page of objects by index.
+
+        See :meth:`Manager.index_keys_page`.
+
+        :returns:
+            A ``(keys, continuation)`` tuple.
+        """
+        index_name, start_value, end_value = index_vals_for_field(
+            cls, field_name, value, None)
+        return manager.index_keys_page(
+            cls, index_name, start_value, end_value,
+            max_results=max_results, continuation=continuation)
+
     @classmethod
     def index_lookup(cls, manager, field_name, value):
         """Find objects by index.
@@ -329,18 +403,17 @@ class Model(object):
 
     @classmethod
     def search(cls, manager, **kw):
-        """Search for instances of this model matching keys/values.
+        """Search for instances of this model matching field values.
 
-        :returns: :class:`VumiMapReduce` instance based on the search params.
+        Each keyword argument is a field name and either a value to match
+        or a ``(start, end)`` tuple to match an inclusive range of values.
+        Secondary indexes are used for indexed fields and everything else is
+        matched by a MapReduce job over the objects the indexes found. See
+        :class:`ModelQuery`.
+
+        :returns: :class:`ModelQuery` instance based on the search params.
         """
-        # TODO: build the queries more intelligently
-        for k, value in kw.iteritems():
-            value = unicode(value)
-            value = value.replace('\\', '\\\\')
-            value = value.replace("'", "\\'")
-            kw[k] = value
-        query = " AND ".join("%s:'%s'" % (k, v) for k, v in kw.iteritems())
-        return cls.raw_search(manager, query)
+        return ModelQuery(manager, cls, kw)
 
     @classmethod
     def raw_search(cls, manager, query):
@@ -512,22 +585,147 @@ class VumiMapReduce(object):
             self._riak_mapreduce_obj, self._results_to_keys)
 
 
+class ModelCache(object):
+    """Read-through cache for objects loaded by a :class:`Manager`.
+
+    We keep a private copy of each loaded object's Riak data, keyed by bucket
+    name and object key, and give every load a fresh copy of it so that
+    changes to one model object don't leak into another. The least recently
+    used entries are discarded once there are more than `max_size` of them
+    and entries older than `ttl` seconds are ignored.
+
+    Only changes made through the manager that owns the cache invalidate its
+    entries, so the TTL should be short if other processes modify the same
+    objects.
+
+    A load that was started before a key was invalidated may return data
+    from before the change. To keep that data out of the cache, loads note
+    :attr:`generation` before they start and pass it to :meth:`put`, which
+    ignores objects for keys that have been invalidated since then.
+
+    :param int max_size:
+        The maximum number of objects to keep.
+    :param float ttl:
+        The number of seconds to keep an object for, or ``None`` to keep
+        objects until they're evicted.
+    :param clock:
+        A function returning the current time in seconds. Defaults to
+        :func:`time.time`.
+    """
+
+    def __init__(self, max_size, ttl=None, clock=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock if clock is not None else time.time
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # This goes up with each invalidation. We remember when the most
+        # recently invalidated keys were invalidated, and when the newest of
+        # the ones we've forgotten was.
+        self.generation = 0
+        self._invalidated = OrderedDict()
+        self._forgotten_generation = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _copy_riak_object(self, riak_object):
+        copied = copy.copy(riak_object)
+        copied.set_data(copy.deepcopy(riak_object.get_data()))
+        copied.set_metadata(copy.deepcopy(riak_object.get_metadata()))
+        return copied
+
+    def get(self, modelcls, bucket_name, key):
+        """Return a copy of the cached Riak object for a key, or ``None``.
+        """
+        entry = self._entries.pop((bucket_name, key), None)
+        if entry is not None:
+            cached_modelcls, riak_object, expires_at = entry
+            if cached_modelcls is modelcls and (
+                    expires_at is None or expires_at > self.clock()):
+                self._entries[(bucket_name, key)] = entry
+                self.hits += 1
+                return self._copy_riak_object(riak_object)
+        self.misses += 1
+        return None
+
+    def _invalidated_since(self, bucket_name, key, generation):
+        if generation < self._forgotten_generation:
+            # We don't know, so we assume the worst.
+            return True
+        return self._invalidated.get((bucket_name, key), 0) > generation
+
+    def put(self, modelcls, bucket_name, key, riak_object, generation=None):
+        """Cache a copy of the Riak object for a key.
+
+        If `generation` is given, the object isn't cached if the key has been
+        invalidated since :attr:`generation` had that value.
+        """
+        if generation is not None and self._invalidated_since(
+                bucket_name, key, generation):
+            return
+        expires_at = None
+        if self.ttl is not None:
+            expires_at = self.clock() + self.ttl
+        self._entries.pop((bucket_name, key), None)
+        self._entries[(bucket_name, key)] = (
+            modelcls, self._copy_riak_object(riak_object), expires_at)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, bucket_name, key):
+        """Discard the cached object for a key, if there is one."""
+        self._entries.pop((bucket_name, key), None)
+        self.generation += 1
+        self._invalidated.pop((bucket_name, key), None)
+        self._invalidated[(bucket_name, key)] = self.generation
+        if len(self._invalidated) > self.max_size:
+            _, self._forgotten_generation = self._invalidated.popitem(
+                last=False)
+
+    def clear(self):
+        """Discard all cached objects."""
+        self._entries.clear()
+        self.generation += 1
+        self._invalidated.clear()
+        self._forgotten_generation = self.generation
+
+
 class Manager(object):
     """A wrapper around a Riak client."""
 
     DEFAULT_LOAD_BUNCH_SIZE = 100
     DEFAULT_MAPREDUCE_TIMEOUT = 4 * 60 * 1000  # in milliseconds
+    DEFAULT_LOAD_CONCURRENCY = 20
+    DEFAULT_LOAD_RETRIES = 2
+    DEFAULT_STORE_CONCURRENCY = 20
+    # Loads that fail with one of these (transport errors, such as a lost
+    # connection) are retried by load_all(). Other errors aren't retried.
+    LOAD_RETRY_ERRORS = ()
     # This is a temporary measure to give us an easy way to switch back to the
     # old mechanism if the new one causes problems.
     USE_MAPREDUCE_BUNCH_LOADING = False
 
     def __init__(self, client, bucket_prefix, load_bunch_size=None,
-                 mapreduce_timeout=None):
+                 mapreduce_timeout=None, load_concurrency=None,
+                 load_retries=None, cache_size=None, cache_ttl=None,
+                 store_concurrency=None):
         self.client = client
         self.bucket_prefix = bucket_prefix
         self.load_bunch_size = load_bunch_size or self.DEFAULT_LOAD_BUNCH_SIZE
         self.mapreduce_timeout = (mapreduce_timeout or
                                   self.DEFAULT_MAPREDUCE_TIMEOUT)
+        self.load_concurrency = (load_concurrency or
+                                 self.DEFAULT_LOAD_CONCURRENCY)
+        if load_retries is None:
+            load_retries = self.DEFAULT_LOAD_RETRIES
+        self.load_retries = load_retries
+        self.store_concurrency = (store_concurrency or
+                                  self.DEFAULT_STORE_CONCURRENCY)
+        self.cache = None
+        if cache_size:
+            self.cache = ModelCache(cache_size, cache_ttl)
         self._bucket_cache = {}
 
     def proxy(self, modelcls):
@@ -579,6 +777,37 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " .from_config(...)")
 
+    def _get_cached(self, modelcls, key):
+        """Return a model object built from the cache, or ``None``."""
+        if self.cache is None:
+            return None
+        riak_object = self.cache.get(modelcls, self.bucket_name(modelcls), key)
+        if riak_object is None:
+            return None
+        return modelcls(self, key, _riak_object=riak_object)
+
+    def _cache_generation(self):
+        """Return the cache generation to pass to :meth:`_cache_loaded` for
+        a load that is about to start.
+        """
+        if self.cache is not None:
+            return self.cache.generation
+
+    def _cache_loaded(self, modelobj, generation):
+        """Add a freshly loaded model object to the cache.
+
+        Migrated objects aren't cached, because callers may check
+        `was_migrated` to decide whether to save them. Neither are objects
+        whose keys were invalidated while they were being loaded.
+        """
+        if self.cache is not None and not modelobj.was_migrated:
+            self.cache.put(type(modelobj), self.bucket_name(modelobj),
+                           modelobj.key, modelobj._riak_object, generation)
+
+    def _uncache(self, modelobj):
+        if self.cache is not None:
+            self.cache.invalidate(self.bucket_name(modelobj), modelobj.key)
+
     def riak_object(self, cls, key):
         """Construct an empty RiakObject for the given model class and key."""
         raise NotImplementedError("Sub-classes of Manager should implement"
@@ -589,6 +818,20 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " .store(...)")
 
+    def store_many(self, modelobjs):
+        """Store several model objects in Riak.
+
+        At most `store_concurrency` stores are in progress at once. A failed
+        store doesn't stop the others.
+
+        :returns:
+            A list of `(modelobj, failure)` pairs for the objects that
+            couldn't be stored, which is empty if everything was stored (via
+            a deferred if using an asynchronous manager).
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " .store_many(...)")
+
     def delete(self, modelobj):
         """Delete the modelobj from Riak."""
         raise NotImplementedError("Sub-classes of Manager should implement"
@@ -655,6 +898,31 @@ class Manager(object):
             keys = keys[self.load_bunch_size:]
             yield self._load_bunch(model, batch_keys)
 
+    def load_all(self, model, keys, callback):
+        """Load model instances for an iterable of keys from Riak, calling
+        `callback` with each instance as it is loaded.
+
+        At most `load_concurrency` loads are in progress at once, and the next
+        key isn't taken from `keys` until there's room for it, so `keys` may
+        be a generator over a very large number of keys. If `callback` returns
+        a deferred, the load that produced the object waits for it. Keys that
+        don't exist are skipped. Loads that fail with a transport error (see
+        `LOAD_RETRY_ERRORS`) are retried up to `load_retries` times.
+
+        If a load (or `callback`) fails, no more keys are taken from `keys`
+        and `callback` isn't called again. Loads already in progress are
+        left to finish.
+
+        Objects aren't necessarily passed to `callback` in the same order as
+        their keys.
+
+        :returns:
+            A deferred that fires once all the objects have been loaded and
+            handled (or None if using a synchronous manager).
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " .load_all(...)")
+
     def riak_map_reduce(self):
         """Construct a RiakMapReduce object for this client."""
         raise NotImplementedError("Sub-classes of Manager should implement"
@@ -670,14 +938,104 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " .should_quote_index_values()")
 
+    def supports_index_pages(self):
+        """Return ``True`` if :meth:`index_keys_page` can be used.
+
+        Only the HTTP API can page through index results.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " .supports_index_pages()")
+
     def index_keys(self, model, index_name, start_value, end_value=None):
         bucket = self.bucket_for_modelcls(model)
+        start_value, end_value = self._quote_index_values(
+            start_value, end_value)
+        return bucket.get_index(index_name, start_value, end_value)
+
+    def _quote_index_values(self, start_value, end_value):
         if self.should_quote_index_values():
             if start_value is not None:
                 start_value = urllib.quote(start_value)
             if end_value is not None:
                 end_value = urllib.quote(end_value)
-        return bucket.get_index(index_name, start_value, end_value)
+        return start_value, end_value
+
+    def _index_page_request(self, model, index_name, start_value, end_value,
+                            max_results, continuation):
+        """Build the URI and query parameters for a page of an HTTP index
+        query."""
+        start_value, end_value = self._quote_index_values(
+            start_value, end_value)
+        segments = ["buckets", self.bucket_name(model), "index", index_name,
+                    str(start_value)]
+        if end_value:
+            segments.append(str(end_value))
+        params = {
+            'max_results': max_results,
+            'continuation': continuation,
+        }
+        return '/%s' % ('/'.join(segments),), params
+
+    def _index_page_from_response(self, data):
+        return (data[u'keys'][:], data.get(u'continuation'))
+
+    def index_keys_page(self, model, index_name, start_value, end_value=None,
+                        max_results=None, continuation=None):
+        """Fetch a page of keys from a secondary index.
+
+        :param int max_results:
+            The maximum number of keys to return, or ``None`` for all of them.
+        :param str continuation:
+            The continuation returned with the previous page, or ``None``
+            for the first page.
+
+        :returns:
+            A ``(keys, continuation)`` tuple (possibly via a deferred). The
+            continuation is ``None`` on the last page.
+
+        :raises IndexPaginationNotSupported:
+            If the manager doesn't use the HTTP transport. Check
+            :meth:`supports_index_pages` first, or use
+            :meth:`stream_index_keys`, which works on any transport.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " .index_keys_page(...)")
+
+    def stream_index_keys(self, model, callback, index_name, start_value,
+                          end_value=None, page_size=None):
+        """Fetch all the keys from a secondary index, a page at a time.
+
+        `callback` is called with each page of keys. If it returns a deferred,
+        the next page isn't fetched until it fires, so at most one page of
+        keys is held in memory at a time. Transports that can't page through
+        index results (see :meth:`supports_index_pages`) fetch all the keys
+        at once and pass them to `callback` a page at a time.
+
+        :returns:
+            A deferred that fires once the last page has been handled (or
+            None if using a synchronous manager).
+        """
+        return self.call_decorator(self._stream_index_keys)(
+            model, callback, index_name, start_value, end_value,
+            page_size or self.load_bunch_size)
+
+    def _stream_index_keys(self, model, callback, index_name, start_value,
+                           end_value, page_size):
+        if not self.supports_index_pages():
+            keys = yield self.index_keys(
+                model, index_name, start_value, end_value)
+            for start in range(0, len(keys), page_size):
+                yield callback(keys[start:start + page_size])
+            return
+        continuation = None
+        while True:
+            keys, continuation = yield self.index_keys_page(
+                model, index_name, start_value, end_value,
+                max_results=page_size, continuation=continuation)
+            if keys:
+                yield callback(keys)
+            if continuation is None:
+                break
 
     def mr_from_field(self, model, field_name, start_value, end_value=None):
         return VumiMapReduce.from_field(
@@ -733,13 +1091,29 @@ class ModelProxy(object):
     def load_all_bunches(self, *args, **kw):
         return self._modelcls.load_all_bunches(self._manager, *args, **kw)
 
+    def store_many(self, modelobjs):
+        return self._manager.store_many(modelobjs)
+
+    def load_all(self, *args, **kw):
+        return self._modelcls.load_all(self._manager, *args, **kw)
+
     def all_keys(self):
         return self._modelcls.all_keys(self._manager)
 
+    def all_keys_page(self, max_results=None, continuation=None):
+        return self._modelcls.all_keys_page(
+            self._manager, max_results=max_results, continuation=continuation)
+
     def index_keys(self, field_name, value):
         return self._modelcls.index_keys(
             self._manager, field_name, value)
 
+    def index_keys_page(self, field_name, value, max_results=None,
+                        continuation=None):
+        return self._modelcls.index_keys_page(
+            self._manager, field_name, value, max_results=max_results,
+            continuation=continuation)
+
     def index_lookup(self, field_name, value):
         return self._modelcls.index_lookup(self._manager, field_name, value)
 
@@ -755,3 +1129,192 @@ class ModelProxy(object):
 
     def enable_search(self):
         return self._modelcls.enable_search(self._manager)
+
+
+class ModelQuery(object):
+    """A query for the objects of a model that match some field values.
+
+    The query is planned when it's built:
+
+    * Predicates on indexed fields become secondary index lookups. Exact
+      matches are assumed to be more selective than ranges, so the plan
+      starts with the first exact match (or the first range if there aren't
+      any) and the keys found by the other index lookups are intersected with
+      its keys client-side. We stop early if the intersection is empty.
+
+    * Predicates on unindexed fields (the residual predicates) are checked
+      by a MapReduce job over the keys the index lookups found, or over the
+      whole bucket if there are no indexed predicates. This is the only case
+      where a MapReduce job is run. Ranges over numeric fields are residual
+      predicates too, even if the field is indexed, because index values are
+      compared as strings.
+
+    Use :meth:`explain` to see the plan. Like :class:`VumiMapReduce`, the
+    query has :meth:`get_keys` and :meth:`get_count` methods, but it can be
+    run more than once.
+
+    :param Manager manager:
+        The manager to query with.
+    :param model:
+        The model class to query.
+    :param dict predicates:
+        A mapping of field names to either a value or a ``(start, end)``
+        tuple for an inclusive range of values.
+    """
+
+    def __init__(self, manager, model, predicates):
+        self.manager = manager
+        self.model = model
+        self.index_predicates = []
+        self.residual_predicates = []
+        for field_name, value in sorted(predicates.iteritems()):
+            self._add_predicate(field_name, value)
+        # Exact matches first, then ranges. sort() is stable, so predicates
+        # of the same kind stay in field name order.
+        self.index_predicates.sort(key=lambda pred: pred[3] is not None)
+
+    def _add_predicate(self, field_name, value):
+        descriptor = self.model.field_descriptors.get(field_name)
+        if descriptor is None:
+            raise ValueError("%s has no field %r" % (
+                self.model.__name__, field_name))
+        start_value, end_value = value, None
+        if isinstance(value, tuple):
+            start_value, end_value = value
+
+        if descriptor.index_name is not None and not (
+                end_value is not None and
+                self._is_numeric(descriptor.field, start_value, end_value)):
+            self.index_predicates.append((field_name,) + index_vals_for_field(
+                self.model, field_name, start_value, end_value))
+            return
+
+        start_value = descriptor.field.to_riak(start_value)
+        if end_value is not None:
+            end_value = descriptor.field.to_riak(end_value)
+        for raw_value in (start_value, end_value):
+            if not isinstance(raw_value, (basestring, int, long, float,
+                                          bool, type(None))):
+                raise ValueError(
+                    "%s.%s is not indexed and can only be matched against"
+                    " simple values" % (self.model.__name__, field_name))
+        self.residual_predicates.append(
+            (field_name, descriptor.key, start_value, end_value))
+
+    def _is_numeric(self, field, *values):
+        # Index values are stored as strings, which don't sort like the
+        # numbers they represent ('10' < '2').
+        return any(
+            isinstance(field.to_riak(value), (int, long, float))
+            for value in values)
+
+    def explain(self):
+        """Describe the query plan.
+
+        :returns: A string with one line per step of the plan.
+        """
+        lines = ["Query plan for %s:" % (self.model.__name__,)]
+        for i, (_, index_name, start, end) in enumerate(
+                self.index_predicates):
+            step = "index lookup" if i == 0 else "intersect index lookup"
+            if end is None:
+                lines.append("  %s: %s = %r" % (step, index_name, start))
+            else:
+                lines.append("  %s: %s in [%r, %r]" % (
+                    step, index_name, start, end))
+        if not self.index_predicates:
+            lines.append("  bucket scan: %s" % (
+                self.manager.bucket_name(self.model),))
+        for field_name, _, start, end in self.residual_predicates:
+            if end is None:
+                lines.append("  mapreduce filter: %s == %r" % (
+                    field_name, start))
+            else:
+                lines.append("  mapreduce filter: %r <= %s <= %r" % (
+                    start, field_name, end))
+        return "\n".join(lines)
+
+    @Manager.calls_manager
+    def _index_keys(self):
+        """Return the set of keys matching all the index predicates, or
+        ``None`` if there aren't any."""
+        keys = None
+        for _, index_name, start, end in self.index_predicates:
+            index_keys = yield self.manager.index_keys(
+                self.model, index_name, start, end)
+            if keys is None:
+                keys = set(index_keys)
+            else:
+                keys.intersection_update(index_keys)
+            if not keys:
+                break
+        returnValue(keys)
+
+    def _residual_mapreduce(self, keys):
+        if keys is None:
+            mr = VumiMapReduce.from_index(
+                self.manager, self.model, '$bucket',
+                self.manager.bucket_name(self.model))
+        else:
+            mr = VumiMapReduce.from_keys(self.manager, self.model, keys)
+        predicates = []
+        for _, key, start, end in self.residual_predicates:
+            if end is None:
+                predicates.append({"key": key, "value": start})
+            else:
+                predicates.append({"key": key, "start": start, "end": end})
+        mr._riak_mapreduce_obj.map(
+            """
+            function(value, keyData, arg) {
+                /*
+                    skip deleted values, might show up during a test
+                */
+                var values = value.values.filter(function(val) {
+                    return !val.metadata['X-Riak-Deleted'];
+                });
+                if (!values.length) {
+                    return [];
+                }
+                var data = JSON.parse(values[0].data);
+                for (var i = 0; i < arg.length; i++) {
+                    var pred = arg[i];
+                    var content = data[pred.key];
+                    if ('value' in pred) {
+                        if (content !== pred.value) {
+                            return [];
+                        }
+                    } else if (content === undefined || content === null ||
+                               content < pred.start || content > pred.end) {
+                        return [];
+                    }
+                }
+                return [value.key];
+            }
+            """, {
+                'arg': predicates,  # Client lib turns this to JSON for us.
+            })
+        return mr
+
+    @Manager.calls_manager
+    def get_keys(self):
+        """Run the query.
+
+        :returns: A list of the keys of the matching objects.
+        """
+        keys = yield self._index_keys()
+        if keys is not None and not keys:
+            returnValue([])
+        if self.residual_predicates:
+            keys = yield self._residual_mapreduce(keys).get_keys()
+        elif keys is None:
+            keys = yield self.model.all_keys(self.manager)
+        returnValue(list(keys))
+
+    @Manager.calls_manager
+    def get_count(self):
+        """Run the query.
+
+        :returns: The number of matching objects.
+        """
+        keys = yield self.get_keys()
+        returnValue(len(keys))
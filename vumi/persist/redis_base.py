@@ -1,7 +1,9 @@
 # -*- test-case-name: vumi.persist.tests.test_redis_base -*-
 
+import copy
 import os
 from functools import wraps
+from hashlib import sha1
 
 from vumi.persist.ast_magic import make_function
 from vumi.persist.fake_redis import FakeRedis
@@ -20,11 +22,16 @@ def make_callfunc(name, redis_call):
         aa = [_f(k, v) for k, v in zip(arg_names, a)]
         kk = dict((k, _f(k, v)) for k, v in kw.items())
 
-        result = self._make_redis_call(name, *aa, **kk)
         f_func = redis_call.filter_func
+        if f_func and isinstance(f_func, basestring):
+            f_func = getattr(self, f_func)
+
+        if self._pipeline_calls is not None:
+            self._pipeline_calls.append((name, aa, kk, f_func))
+            return None
+
+        result = self._make_redis_call(name, *aa, **kk)
         if f_func:
-            if isinstance(f_func, basestring):
-                f_func = getattr(self, f_func)
             result = self._filter_redis_results(f_func, result)
         return result
 
@@ -55,10 +62,58 @@ class CallMakerMetaclass(type):
         return type.__new__(meta, classname, bases, new_class_dict)
 
 
+class RedisPipelineError(Exception):
+    pass
+
+
+class RedisScript(object):
+    """A Lua script that can be run with :meth:`Manager.run_script`.
+
+    Scripts are normally declared once at module level. Redis caches each
+    script the first time it is run, after which only its SHA1 is sent.
+
+    :param str name:
+        A name for the script, for use in error messages and debugging.
+    :param str source:
+        The Lua source. Every key the script touches must be passed to it in
+        ``KEYS`` so that the manager's key prefix can be applied.
+    :param emulation:
+        A Python function, ``emulation(redis, keys, args)``, that does the
+        same thing as the script. This is used by
+        :class:`~vumi.persist.fake_redis.FakeRedis`, which can't run Lua.
+    """
+
+    # Every script declared so far, keyed by SHA1. See .get_script().
+    _scripts = {}
+
+    def __init__(self, name, source, emulation):
+        self.name = name
+        self.source = source
+        self.sha = sha1(source).hexdigest()
+        self.emulation = emulation
+        self._scripts[self.sha] = self
+
+    def __repr__(self):
+        return "<RedisScript %s>" % (self.name,)
+
+    @classmethod
+    def get_script(cls, sha):
+        """Return the script with the given SHA1, or ``None``."""
+        return cls._scripts.get(sha)
+
+    @classmethod
+    def all_scripts(cls):
+        """Return every script declared so far."""
+        return cls._scripts.values()
+
+
 class Manager(object):
 
     __metaclass__ = CallMakerMetaclass
 
+    # Calls waiting to be sent, if this is a pipeline. See .pipeline().
+    _pipeline_calls = None
+
     def __init__(self, client, config, key_prefix, key_separator=None):
         if key_separator is None:
             key_separator = ':'
@@ -82,6 +137,59 @@ class Manager(object):
             sub_man._close = self._client.teardown
         return sub_man
 
+    def pipeline(self):
+        """Return a pipeline for sending several calls in one round trip.
+
+        Pipelines are not atomic. They save round trips but don't use
+        MULTI/EXEC, so commands from other clients may run between the
+        pipelined calls and a failed call doesn't undo the calls before it.
+        Use a :class:`RedisScript` for updates that must be atomic.
+
+        The pipeline has the same redis call methods (and key prefix) as this
+        manager, but calls made on it are queued instead of being sent and
+        return ``None``. :meth:`execute` sends all the queued calls together
+        and returns a list of their results (via a Deferred for asynchronous
+        managers)::
+
+            pipe = manager.pipeline()
+            pipe.incr('count')
+            pipe.expire('count', 60)
+            count, _ = yield pipe.execute()
+
+        Transactions aren't offered because asynchronous managers share one
+        connection, so other calls could end up inside a MULTI block, and
+        txredis can't parse the replies to queued commands.
+        """
+        pipe = copy.copy(self)
+        pipe._pipeline_calls = []
+        return pipe
+
+    def execute(self):
+        """Send the calls queued on this pipeline and return their results.
+
+        The calls are sent in order but not atomically. See :meth:`pipeline`.
+        """
+        if self._pipeline_calls is None:
+            raise RedisPipelineError("Only pipelines can be executed.")
+        calls, self._pipeline_calls = self._pipeline_calls, []
+        return self._execute_pipeline(calls)
+
+    def run_script(self, script, keys=(), args=()):
+        """Run a :class:`RedisScript` atomically and return its result.
+
+        The manager's key prefix is added to each of ``keys``. The script is
+        called by its SHA1 and only sent to redis if redis doesn't have it
+        cached yet.
+        """
+        if self._pipeline_calls is not None:
+            raise RedisPipelineError("Scripts can't be run in a pipeline.")
+        keys = [self._key(key) for key in keys]
+        return self._run_script(script, keys, list(args))
+
+    def _apply_pipeline_filters(self, calls, results):
+        return [f_func(result) if f_func else result
+                for (_, _, _, f_func), result in zip(calls, results)]
+
     @staticmethod
     def calls_manager(manager_attr):
         """Decorate a method that calls a manager.
@@ -182,6 +290,19 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " ._filter_redis_results()")
 
+    def _execute_pipeline(self, calls):
+        """Send a list of `(call, args, kw, filter_func)` calls together.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " ._execute_pipeline()")
+
+    def _run_script(self, script, keys, args):
+        """Run a script with EVALSHA, falling back to EVAL if redis doesn't
+        have it cached.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " ._run_script()")
+
     def _key(self, key):
         """
         Generate a key using this manager's key prefix
@@ -3,7 +3,7 @@
 import redis
 
 from vumi.persist.redis_base import Manager
-from vumi.persist.fake_redis import FakeRedis
+from vumi.persist.fake_redis import FakeRedis, NoScriptError
 from vumi.utils import flatten_generator
 
 
@@ -86,3 +86,20 @@ class RedisManager(Manager):
         """Filter results of a redis call.
         """
         return func(results)
+
+    def _execute_pipeline(self, calls):
+        """Send a list of calls in one round trip.
+        """
+        pipe = self._client.pipeline(transaction=False)
+        for call, args, kw, _ in calls:
+            getattr(pipe, call)(*args, **kw)
+        return self._apply_pipeline_filters(calls, pipe.execute())
+
+    def _run_script(self, script, keys, args):
+        """Run a script with EVALSHA, falling back to EVAL if redis doesn't
+        have it cached.
+        """
+        try:
+            return self._client.evalsha(script.sha, len(keys), *(keys + args))
+        except (redis.exceptions.NoScriptError, NoScriptError):
+            return self._client.eval(script.source, len(keys), *(keys + args))
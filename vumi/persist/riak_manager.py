@@ -2,13 +2,16 @@
 
 """A manager implementation on top of the riak Python package."""
 
+import httplib
 import json
+import socket
 
 from riak import (
     RiakClient, RiakObject, RiakMapReduce, RiakHttpTransport, RiakPbcTransport)
 from twisted.internet.defer import gatherResults
+from twisted.python.failure import Failure
 
-from vumi.persist.model import Manager
+from vumi.persist.model import Manager, IndexPaginationNotSupported
 from vumi.utils import flatten_generator
 
 
@@ -17,6 +20,8 @@ class RiakManager(Manager):
 
     call_decorator = staticmethod(flatten_generator)
 
+    LOAD_RETRY_ERRORS = (socket.error, httplib.HTTPException)
+
     @classmethod
     def from_config(cls, config):
         config = config.copy()
@@ -25,6 +30,13 @@ class RiakManager(Manager):
                                      cls.DEFAULT_LOAD_BUNCH_SIZE)
         mapreduce_timeout = config.pop('mapreduce_timeout',
                                        cls.DEFAULT_MAPREDUCE_TIMEOUT)
+        load_concurrency = config.pop('load_concurrency',
+                                      cls.DEFAULT_LOAD_CONCURRENCY)
+        load_retries = config.pop('load_retries', cls.DEFAULT_LOAD_RETRIES)
+        cache_size = config.pop('cache_size', None)
+        cache_ttl = config.pop('cache_ttl', None)
+        store_concurrency = config.pop('store_concurrency',
+                                       cls.DEFAULT_STORE_CONCURRENCY)
         transport_type = config.pop('transport_type', 'http')
         transport_class = {
             'http': RiakHttpTransport,
@@ -54,7 +66,10 @@ class RiakManager(Manager):
         client.set_decoder('application/json', json.loads)
         client.set_decoder('text/json', json.loads)
         return cls(client, bucket_prefix, load_bunch_size=load_bunch_size,
-                   mapreduce_timeout=mapreduce_timeout)
+                   mapreduce_timeout=mapreduce_timeout,
+                   load_concurrency=load_concurrency,
+                   load_retries=load_retries, cache_size=cache_size,
+                   cache_ttl=cache_ttl, store_concurrency=store_concurrency)
 
     def riak_object(self, modelcls, key, result=None):
         bucket = self.bucket_for_modelcls(modelcls)
@@ -78,13 +93,31 @@ class RiakManager(Manager):
         return riak_object
 
     def store(self, modelobj):
+        self._uncache(modelobj)
+        modelobj._store_cached_values()
         modelobj._riak_object.store()
         return modelobj
 
+    def store_many(self, modelobjs):
+        # We only have one connection, so we store one object at a time.
+        failures = []
+        for modelobj in modelobjs:
+            try:
+                self.store(modelobj)
+            except Exception:
+                failures.append((modelobj, Failure()))
+        return failures
+
     def delete(self, modelobj):
+        self._uncache(modelobj)
         modelobj._riak_object.delete()
 
     def load(self, modelcls, key, result=None):
+        if result is None:
+            cached = self._get_cached(modelcls, key)
+            if cached is not None:
+                return cached
+        generation = self._cache_generation()
         riak_object = self.riak_object(modelcls, key, result)
         if not result:
             riak_object.reload()
@@ -96,12 +129,29 @@ class RiakManager(Manager):
             if data_version == modelcls.VERSION:
                 obj = modelcls(self, key, _riak_object=riak_object)
                 obj.was_migrated = was_migrated
+                if not result:
+                    self._cache_loaded(obj, generation)
                 return obj
             migrator = modelcls.MIGRATOR(modelcls, self, data_version)
             riak_object = migrator(riak_object).get_riak_object()
             was_migrated = True
         return None
 
+    def _load_with_retries(self, modelcls, key, retries):
+        for _ in range(retries):
+            try:
+                return self.load(modelcls, key)
+            except self.LOAD_RETRY_ERRORS:
+                pass
+        return self.load(modelcls, key)
+
+    def load_all(self, modelcls, keys, callback):
+        # We only have one connection, so we load one object at a time.
+        for key in keys:
+            obj = self._load_with_retries(modelcls, key, self.load_retries)
+            if obj is not None:
+                callback(obj)
+
     def _load_multiple(self, modelcls, keys):
         objs = (self.load(modelcls, key) for key in keys)
         return [obj for obj in objs if obj is not None]
@@ -117,6 +167,20 @@ class RiakManager(Manager):
             results = reducer_func(self, results)
         return results
 
+    def index_keys_page(self, model, index_name, start_value, end_value=None,
+                        max_results=None, continuation=None):
+        if not self.supports_index_pages():
+            raise IndexPaginationNotSupported(
+                "Only the HTTP transport can page through index results."
+                " Use index_keys() or stream_index_keys() instead.")
+        transport = self.client.get_transport()
+        uri, params = self._index_page_request(
+            model, index_name, start_value, end_value, max_results,
+            continuation)
+        response = transport.get_request(uri, params)
+        transport.check_http_code(response, [200])
+        return self._index_page_from_response(json.loads(response[1]))
+
     def riak_enable_search(self, modelcls):
         bucket_name = self.bucket_name(modelcls)
         bucket = self.client.bucket(bucket_name)
@@ -125,6 +189,9 @@ class RiakManager(Manager):
     def should_quote_index_values(self):
         return not isinstance(self.client, RiakPbcTransport)
 
+    def supports_index_pages(self):
+        return isinstance(self.client.get_transport(), RiakHttpTransport)
+
     def purge_all(self):
         buckets = self.client.get_buckets()
         for bucket_name in buckets:
@@ -1,10 +1,20 @@
 # -*- coding: utf-8 -*-
 from twisted.internet.defer import inlineCallbacks
 
-from vumi.persist.fake_redis import FakeRedis
+from vumi.persist.fake_redis import FakeRedis, lua_result
+from vumi.persist.redis_base import RedisScript
 from vumi.tests.helpers import VumiTestCase
 
 
+def incrby_emulation(redis, keys, args):
+    return redis.incr(keys[0], int(args[0]))
+
+
+INCRBY_SCRIPT = RedisScript(
+    'incrby', "return redis.call('INCRBY', KEYS[1], ARGV[1])",
+    incrby_emulation).source
+
+
 class TestFakeRedis(VumiTestCase):
 
     def setUp(self):
@@ -407,6 +417,41 @@ class TestFakeRedis(VumiTestCase):
             (yield self.redis.scan('31')),
             (None, result_keys[15:]))
 
+    @inlineCallbacks
+    def test_eval(self):
+        yield self.assert_redis_op(3, 'eval', INCRBY_SCRIPT, 1, 'foo', 3)
+        sha = yield self.redis.script_load(INCRBY_SCRIPT)
+        yield self.assert_redis_op(5, 'evalsha', sha, 1, 'foo', 2)
+        yield self.assert_redis_op('5', 'get', 'foo')
+
+    @inlineCallbacks
+    def test_evalsha_not_loaded(self):
+        sha = yield self.redis.script_load(INCRBY_SCRIPT)
+        yield self.redis.script_flush()
+        yield self.assert_error(self.redis.evalsha, sha, 1, 'foo', 1)
+
+    @inlineCallbacks
+    def test_eval_no_emulation(self):
+        yield self.assert_error(
+            self.redis.eval, "return redis.call('GET', KEYS[1])", 1, 'foo')
+
+    def test_lua_result(self):
+        self.assertEqual(lua_result(True), 1)
+        self.assertEqual(lua_result(False), None)
+        self.assertEqual(lua_result(2.7), 2)
+        self.assertEqual(lua_result(['a', 1.5, None]), ['a', 1, None])
+
+    @inlineCallbacks
+    def test_pipeline(self):
+        yield self.redis.set('foo', '1')
+        pipe = self.redis.pipeline()
+        self.assertIdentical(pipe.incr('foo'), pipe)
+        pipe.get('foo').sadd('bar', 'a', 'b')
+        self.assertEqual((yield self.redis.get('foo')), '1')
+        self.assertEqual((yield pipe.execute()), [2, '2', 2])
+        self.assertEqual((yield self.redis.get('foo')), '2')
+        self.assertEqual((yield pipe.execute()), [])
+
     @inlineCallbacks
     def test_scan_no_keys(self):
         self.assertEqual(
@@ -0,0 +1,106 @@
+"""Tests for vumi.persist.fake_riak."""
+
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.persist.model import Model
+from vumi.persist.fields import Integer, Unicode
+from vumi.tests.helpers import VumiTestCase, import_skip
+
+
+class FakeRiakModel(Model):
+    a = Integer(index=True)
+    b = Unicode(null=True)
+
+
+class TestFakeRiakTransport(VumiTestCase):
+
+    def setUp(self):
+        try:
+            from vumi.persist.fake_riak import (
+                FakeRiakTransport, fake_riak_manager)
+        except ImportError, e:
+            import_skip(e, 'riakasaurus', 'riakasaurus.riak')
+        self.manager = fake_riak_manager('test.')
+        self.assertEqual(
+            type(self.manager.client.transport), FakeRiakTransport)
+        self.model = self.manager.proxy(FakeRiakModel)
+
+    @inlineCallbacks
+    def mk_models(self, n):
+        for i in range(n):
+            yield self.model(u"key-%d" % i, a=i, b=u"value-%d" % i).save()
+
+    @inlineCallbacks
+    def test_store_and_load(self):
+        yield self.model(u"foo", a=1, b=u"bar").save()
+        obj = yield self.model.load(u"foo")
+        self.assertEqual((obj.key, obj.a, obj.b), (u"foo", 1, u"bar"))
+
+    @inlineCallbacks
+    def test_load_missing(self):
+        self.assertEqual((yield self.model.load(u"missing")), None)
+
+    @inlineCallbacks
+    def test_loaded_objects_are_independent(self):
+        yield self.model(u"foo", a=1).save()
+        obj1 = yield self.model.load(u"foo")
+        obj1.a = 2
+        obj2 = yield self.model.load(u"foo")
+        self.assertEqual(obj2.a, 1)
+
+    @inlineCallbacks
+    def test_delete(self):
+        yield self.model(u"foo", a=1).save()
+        obj = yield self.model.load(u"foo")
+        yield obj.delete()
+        self.assertEqual((yield self.model.load(u"foo")), None)
+        self.assertEqual((yield self.model.all_keys()), [])
+
+    @inlineCallbacks
+    def test_index_keys(self):
+        yield self.mk_models(3)
+        self.assertEqual(
+            (yield self.model.index_keys('a', 1)), [u"key-1"])
+        self.assertEqual((yield self.model.index_keys('a', 5)), [])
+        self.assertEqual(
+            (yield self.manager.index_keys(FakeRiakModel, 'a_bin', '1', '2')),
+            [u"key-1", u"key-2"])
+
+    @inlineCallbacks
+    def test_index_keys_updated_on_save(self):
+        yield self.model(u"foo", a=1).save()
+        obj = yield self.model.load(u"foo")
+        obj.a = 2
+        yield obj.save()
+        self.assertEqual((yield self.model.index_keys('a', 1)), [])
+        self.assertEqual((yield self.model.index_keys('a', 2)), [u"foo"])
+
+    @inlineCallbacks
+    def test_index_keys_page_unsupported(self):
+        from vumi.persist.model import IndexPaginationNotSupported
+        yield self.mk_models(3)
+        self.assertFalse(self.manager.supports_index_pages())
+        yield self.assertFailure(
+            self.model.all_keys_page(max_results=2),
+            IndexPaginationNotSupported)
+
+    @inlineCallbacks
+    def test_stream_index_keys(self):
+        yield self.mk_models(3)
+        pages = []
+        yield self.manager.stream_index_keys(
+            FakeRiakModel, pages.append, '$bucket',
+            self.manager.bucket_name(FakeRiakModel), page_size=2)
+        self.assertEqual(pages, [[u"key-0", u"key-1"], [u"key-2"]])
+
+    @inlineCallbacks
+    def test_purge_all(self):
+        yield self.mk_models(2)
+        yield self.manager.purge_all()
+        self.assertEqual((yield self.model.all_keys()), [])
+
+    @inlineCallbacks
+    def test_mapreduce_unsupported(self):
+        yield self.mk_models(1)
+        mr = self.model.index_lookup('a', 0)
+        yield self.assertFailure(mr.get_keys(), NotImplementedError)
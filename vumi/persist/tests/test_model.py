@@ -3,11 +3,14 @@
 """Tests for vumi.persist.model."""
 
 from datetime import datetime
+import json
 
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import Clock
 
 from vumi.persist.model import (
-    Model, Manager, ModelMigrator, ModelMigrationError)
+    Model, Manager, ModelMigrator, ModelMigrationError, ModelCache,
+    ModelQuery)
 from vumi.persist.fields import (
     ValidationError, Integer, Unicode, VumiMessage, Dynamic, ListOf,
     ForeignKey, ManyToMany, Timestamp)
@@ -25,6 +28,11 @@ class IndexedModel(Model):
     b = Unicode(index=True, null=True)
 
 
+class PartlyIndexedModel(Model):
+    a = Integer(index=True)
+    b = Unicode()
+
+
 class VumiMessageModel(Model):
     msg = VumiMessage(TransportUserMessage)
 
@@ -339,6 +347,51 @@ class TestModelOnTxRiak(VumiTestCase):
             ["one", "two"], search, 'b:abc OR b:def')
         yield self.assert_mapreduce_results(["three", "two"], search, 'a:2')
 
+    @Manager.calls_manager
+    def test_indexed_search(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        yield indexed_model("one", a=1, b=u'abc').save()
+        yield indexed_model("two", a=2, b=u'def').save()
+        yield indexed_model("three", a=2, b=u'ghi').save()
+        yield indexed_model("four", a=3, b=u'def').save()
+
+        search = indexed_model.search
+        yield self.assert_mapreduce_results(["one"], search, a=1)
+        yield self.assert_mapreduce_results(["two"], search, a=2, b=u'def')
+        yield self.assert_mapreduce_results([], search, a=1, b=u'def')
+        yield self.assert_mapreduce_results(
+            ["four", "three", "two"], search, a=(2, 3))
+        yield self.assert_mapreduce_results(
+            ["four", "two"], search, a=(2, 3), b=u'def')
+
+    @Manager.calls_manager
+    def test_indexed_search_multi_digit_range(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        yield indexed_model("k2", a=2, b=u'abc').save()
+        yield indexed_model("k5", a=5, b=u'abc').save()
+        yield indexed_model("k10", a=10, b=u'def').save()
+
+        search = indexed_model.search
+        yield self.assert_mapreduce_results(
+            ["k10", "k2", "k5"], search, a=(2, 10))
+        yield self.assert_mapreduce_results(["k5"], search, a=(3, 9))
+        yield self.assert_mapreduce_results(
+            ["k10"], search, a=(3, 100), b=u'def')
+
+    @Manager.calls_manager
+    def test_search_with_residual_predicates(self):
+        model = self.manager.proxy(PartlyIndexedModel)
+        yield model("one", a=1, b=u'abc').save()
+        yield model("two", a=2, b=u'def').save()
+        yield model("three", a=2, b=u'ghi').save()
+
+        search = model.search
+        yield self.assert_mapreduce_results(["three", "two"], search, a=2)
+        yield self.assert_mapreduce_results(["two"], search, a=2, b=u'def')
+        yield self.assert_mapreduce_results(
+            ["one", "two"], search, b=(u'abc', u'def'))
+        yield self.assert_mapreduce_results([], search, a=3, b=u'abc')
+
     @Manager.calls_manager
     def test_load_all_bunches(self):
         self.assertFalse(self.manager.USE_MAPREDUCE_BUNCH_LOADING)
@@ -368,6 +421,61 @@ class TestModelOnTxRiak(VumiTestCase):
             objs.extend((yield obj_bunch))
         self.assertEqual(["one", "two"], sorted(obj.key for obj in objs))
 
+    @Manager.calls_manager
+    def test_load_all(self):
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("one", a=1, b=u'abc').save()
+        yield simple_model("two", a=2, b=u'def').save()
+        yield simple_model("three", a=2, b=u'ghi').save()
+
+        objs = []
+        yield simple_model.load_all(['one', 'two', 'bad'], objs.append)
+        self.assertEqual(["one", "two"], sorted(obj.key for obj in objs))
+
+    @Manager.calls_manager
+    def test_store_many(self):
+        simple_model = self.manager.proxy(SimpleModel)
+        failures = yield simple_model.store_many([
+            simple_model("one", a=1, b=u'abc'),
+            simple_model("two", a=2, b=u'def'),
+        ])
+        self.assertEqual(failures, [])
+        s1 = yield simple_model.load("one")
+        s2 = yield simple_model.load("two")
+        self.assertEqual((s1.a, s2.a), (1, 2))
+
+    @Manager.calls_manager
+    def test_load_cached(self):
+        self.manager.cache = ModelCache(10)
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("one", a=1, b=u'abc').save()
+
+        s1 = yield simple_model.load("one")
+        s2 = yield simple_model.load("one")
+        self.assertEqual(
+            (self.manager.cache.hits, self.manager.cache.misses), (1, 1))
+        self.assertEqual(s2.a, 1)
+        self.assertFalse(s2.was_migrated)
+        # Each load gets its own copy of the data.
+        s2.a = 2
+        s3 = yield simple_model.load("one")
+        self.assertEqual(s1.a, 1)
+        self.assertEqual(s3.a, 1)
+
+    @Manager.calls_manager
+    def test_load_cached_invalidated(self):
+        self.manager.cache = ModelCache(10)
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("one", a=1, b=u'abc').save()
+
+        s1 = yield simple_model.load("one")
+        s1.a = 2
+        yield s1.save()
+        self.assertEqual((yield simple_model.load("one")).a, 2)
+        yield s1.delete()
+        self.assertEqual((yield simple_model.load("one")), None)
+        self.assertEqual(self.manager.cache.hits, 0)
+
     @Manager.calls_manager
     def test_load_all_bunches_mapreduce(self):
         self.manager.USE_MAPREDUCE_BUNCH_LOADING = True
@@ -499,6 +607,46 @@ class TestModelOnTxRiak(VumiTestCase):
         keys = yield indexed_model.index_keys('b', None)
         self.assertEqual(keys, ["foo3"])
 
+    @Manager.calls_manager
+    def test_index_keys_page(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        yield indexed_model("foo1", a=1, b=u"one").save()
+        yield indexed_model("foo2", a=2, b=u"one").save()
+        yield indexed_model("foo3", a=2, b=u"one").save()
+
+        keys1, continuation = yield indexed_model.index_keys_page(
+            'b', u"one", max_results=2)
+        self.assertEqual(len(keys1), 2)
+        self.assertNotEqual(continuation, None)
+
+        keys2, continuation = yield indexed_model.index_keys_page(
+            'b', u"one", max_results=2, continuation=continuation)
+        self.assertEqual(continuation, None)
+        self.assertEqual(sorted(keys1 + keys2), ["foo1", "foo2", "foo3"])
+
+    @Manager.calls_manager
+    def test_all_keys_page(self):
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("foo-1", a=5, b=u'1').save()
+        yield simple_model("foo-2", a=5, b=u'2').save()
+
+        keys, continuation = yield simple_model.all_keys_page(max_results=5)
+        self.assertEqual(continuation, None)
+        self.assertEqual(sorted(keys), [u"foo-1", u"foo-2"])
+
+    @Manager.calls_manager
+    def test_stream_index_keys(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        for i in range(5):
+            yield indexed_model("foo%d" % i, a=1, b=u"one").save()
+
+        pages = []
+        yield self.manager.stream_index_keys(
+            IndexedModel, pages.append, 'a_bin', '1', page_size=2)
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual(
+            sorted(sum(pages, [])), ["foo%d" % i for i in range(5)])
+
     @Manager.calls_manager
     def test_index_keys_quoting(self):
         indexed_model = self.manager.proxy(IndexedModel)
@@ -569,6 +717,51 @@ class TestModelOnTxRiak(VumiTestCase):
         m1.msg = msg2
         self.assertTrue("extra" not in m1.msg)
 
+    @Manager.calls_manager
+    def test_vumimessage_field_decoded_once(self):
+        msg_model = self.manager.proxy(VumiMessageModel)
+        yield msg_model("foo", msg=self.mkmsg(extra="bar")).save()
+
+        m1 = yield msg_model.load("foo")
+        self.assertIdentical(m1.msg, m1.msg)
+        msg2 = self.mkmsg()
+        m1.msg = msg2
+        self.assertEqual(m1.msg, msg2)
+        self.assertTrue("extra" not in m1.msg)
+
+    @Manager.calls_manager
+    def test_vumimessage_field_changed_in_place(self):
+        msg_model = self.manager.proxy(VumiMessageModel)
+        yield msg_model("foo", msg=self.mkmsg(extra="bar")).save()
+
+        m1 = yield msg_model.load("foo")
+        m1.msg["extra"] = "baz"
+        yield m1.save()
+        m2 = yield msg_model.load("foo")
+        self.assertEqual(m2.msg["extra"], "baz")
+
+    @Manager.calls_manager
+    def test_vumimessage_field_data_replaced(self):
+        msg_model = self.manager.proxy(VumiMessageModel)
+        yield msg_model("foo", msg=self.mkmsg(extra="bar")).save()
+
+        m1 = yield msg_model.load("foo")
+        self.assertEqual(m1.msg["extra"], "bar")
+        m2 = yield msg_model.load("foo")
+        m2.msg = self.mkmsg(extra="baz")
+        m1._riak_object.set_data(m2._riak_object.get_data())
+        self.assertEqual(m1.msg["extra"], "baz")
+
+    @Manager.calls_manager
+    def test_vumimessage_field_raw_value(self):
+        msg_model = self.manager.proxy(VumiMessageModel)
+        msg = self.mkmsg(extra="bar")
+        yield msg_model("foo", msg=msg).save()
+
+        m1 = yield msg_model.load("foo")
+        self.assertEqual(m1.get_raw_value("msg"), json.loads(msg.to_json()))
+        self.assertEqual(msg_model("bar").get_raw_value("msg"), None)
+
     def _create_dynamic_instance(self, dynamic_model):
         d1 = dynamic_model("foo", a=u"ab")
         d1.contact_info['cellphone'] = u"+27123"
@@ -1043,3 +1236,189 @@ class TestModelOnRiak(TestModelOnTxRiak):
 
         self.manager = RiakManager.from_config({'bucket_prefix': 'test.'})
         self.manager.purge_all()
+
+
+class FakeRiakObject(object):
+    def __init__(self, data, metadata=None):
+        self._data = data
+        self._metadata = metadata or {'index': []}
+
+    def get_data(self):
+        return self._data
+
+    def set_data(self, data):
+        self._data = data
+
+    def get_metadata(self):
+        return self._metadata
+
+    def set_metadata(self, metadata):
+        self._metadata = metadata
+
+
+class TestModelCache(VumiTestCase):
+
+    def test_get_missing(self):
+        cache = ModelCache(2)
+        self.assertEqual(cache.get(SimpleModel, 'bucket', 'foo'), None)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def test_put_get(self):
+        cache = ModelCache(2)
+        riak_object = FakeRiakObject({'a': [1]})
+        cache.put(SimpleModel, 'bucket', 'foo', riak_object)
+        cached = cache.get(SimpleModel, 'bucket', 'foo')
+        self.assertEqual(cached.get_data(), {'a': [1]})
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        # We get copies, so changes don't affect the cache.
+        riak_object.get_data()['a'].append(2)
+        cached.get_data()['a'].append(3)
+        self.assertEqual(
+            cache.get(SimpleModel, 'bucket', 'foo').get_data(), {'a': [1]})
+
+    def test_get_other_model(self):
+        cache = ModelCache(2)
+        cache.put(SimpleModel, 'bucket', 'foo', FakeRiakObject({}))
+        self.assertEqual(cache.get(IndexedModel, 'bucket', 'foo'), None)
+        self.assertEqual(cache.get(SimpleModel, 'other', 'foo'), None)
+
+    def test_lru_eviction(self):
+        cache = ModelCache(2)
+        for key in ['foo', 'bar']:
+            cache.put(SimpleModel, 'bucket', key, FakeRiakObject({}))
+        cache.get(SimpleModel, 'bucket', 'foo')
+        cache.put(SimpleModel, 'bucket', 'baz', FakeRiakObject({}))
+        self.assertEqual(len(cache), 2)
+        self.assertNotEqual(cache.get(SimpleModel, 'bucket', 'foo'), None)
+        self.assertEqual(cache.get(SimpleModel, 'bucket', 'bar'), None)
+
+    def test_ttl(self):
+        clock = Clock()
+        cache = ModelCache(2, ttl=10, clock=clock.seconds)
+        cache.put(SimpleModel, 'bucket', 'foo', FakeRiakObject({}))
+        clock.advance(9)
+        self.assertNotEqual(cache.get(SimpleModel, 'bucket', 'foo'), None)
+        clock.advance(1)
+        self.assertEqual(cache.get(SimpleModel, 'bucket', 'foo'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate(self):
+        cache = ModelCache(2)
+        cache.put(SimpleModel, 'bucket', 'foo', FakeRiakObject({}))
+        cache.put(SimpleModel, 'bucket', 'bar', FakeRiakObject({}))
+        cache.invalidate('bucket', 'foo')
+        self.assertEqual(cache.get(SimpleModel, 'bucket', 'foo'), None)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_put_after_invalidate(self):
+        cache = ModelCache(2)
+        generation = cache.generation
+        cache.invalidate('bucket', 'foo')
+        # A load that started before the invalidation may have stale data.
+        cache.put(SimpleModel, 'bucket', 'foo', FakeRiakObject({}),
+                  generation)
+        self.assertEqual(cache.get(SimpleModel, 'bucket', 'foo'), None)
+        # Other keys aren't affected.
+        cache.put(SimpleModel, 'bucket', 'bar', FakeRiakObject({}),
+                  generation)
+        self.assertNotEqual(cache.get(SimpleModel, 'bucket', 'bar'), None)
+        # Loads that started afterwards are fine.
+        cache.put(SimpleModel, 'bucket', 'foo', FakeRiakObject({}),
+                  cache.generation)
+        self.assertNotEqual(cache.get(SimpleModel, 'bucket', 'foo'), None)
+
+    def test_put_after_invalidation_forgotten(self):
+        cache = ModelCache(2)
+        generation = cache.generation
+        for key in ['foo', 'bar', 'baz']:
+            cache.invalidate('bucket', key)
+        # We no longer know when 'foo' was invalidated, so we don't trust
+        # anything loaded before then.
+        for key in ['foo', 'quux']:
+            cache.put(SimpleModel, 'bucket', key, FakeRiakObject({}),
+                      generation)
+        self.assertEqual(len(cache), 0)
+
+    def test_put_after_clear(self):
+        cache = ModelCache(2)
+        generation = cache.generation
+        cache.clear()
+        cache.put(SimpleModel, 'bucket', 'foo', FakeRiakObject({}),
+                  generation)
+        self.assertEqual(len(cache), 0)
+
+
+class TestModelQuery(VumiTestCase):
+
+    def setUp(self):
+        self.manager = Manager(None, 'test.')
+
+    def test_unknown_field(self):
+        self.assertRaises(
+            ValueError, ModelQuery, self.manager, IndexedModel, {'c': 1})
+
+    def test_residual_predicate_must_be_simple(self):
+        self.assertRaises(
+            ValueError, ModelQuery, self.manager, ListOfModel,
+            {'items': [1, 2]})
+
+    def test_plan_index_lookup(self):
+        query = ModelQuery(self.manager, IndexedModel, {'a': 1})
+        self.assertEqual(query.index_predicates, [('a', 'a_bin', '1', None)])
+        self.assertEqual(query.residual_predicates, [])
+        self.assertEqual(query.explain(), "\n".join([
+            "Query plan for IndexedModel:",
+            "  index lookup: a_bin = '1'",
+        ]))
+
+    def test_plan_exact_match_before_range(self):
+        query = ModelQuery(
+            self.manager, IndexedModel, {'a': 1, 'b': (u'bar', u'foo')})
+        self.assertEqual(query.index_predicates, [
+            ('a', 'a_bin', '1', None),
+            ('b', 'b_bin', 'bar', 'foo'),
+        ])
+        self.assertEqual(query.explain(), "\n".join([
+            "Query plan for IndexedModel:",
+            "  index lookup: a_bin = '1'",
+            "  intersect index lookup: b_bin in ['bar', 'foo']",
+        ]))
+
+    def test_plan_numeric_range(self):
+        query = ModelQuery(
+            self.manager, IndexedModel, {'a': (2, 10), 'b': u'foo'})
+        self.assertEqual(query.index_predicates, [
+            ('b', 'b_bin', 'foo', None),
+        ])
+        self.assertEqual(query.residual_predicates, [
+            ('a', 'a', 2, 10),
+        ])
+        self.assertEqual(query.explain(), "\n".join([
+            "Query plan for IndexedModel:",
+            "  index lookup: b_bin = 'foo'",
+            "  mapreduce filter: 2 <= a <= 10",
+        ]))
+
+    def test_plan_bucket_scan(self):
+        query = ModelQuery(self.manager, SimpleModel, {'a': 1, 'b': u'x'})
+        self.assertEqual(query.index_predicates, [])
+        self.assertEqual(query.residual_predicates, [
+            ('a', 'a', 1, None),
+            ('b', 'b', u'x', None),
+        ])
+        self.assertEqual(query.explain(), "\n".join([
+            "Query plan for SimpleModel:",
+            "  bucket scan: test.simplemodel",
+            "  mapreduce filter: a == 1",
+            "  mapreduce filter: b == u'x'",
+        ]))
+
+    def test_plan_index_lookup_with_residual(self):
+        query = ModelQuery(
+            self.manager, PartlyIndexedModel, {'a': 1, 'b': (u'x', u'y')})
+        self.assertEqual(query.explain(), "\n".join([
+            "Query plan for PartlyIndexedModel:",
+            "  index lookup: a_bin = '1'",
+            "  mapreduce filter: u'x' <= b <= u'y'",
+        ]))
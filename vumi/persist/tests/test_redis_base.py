@@ -1,9 +1,24 @@
 """Tests for vumi.persist.redis_base."""
 
-from vumi.persist.redis_base import Manager
+import os
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial.unittest import SkipTest
+
+from vumi.persist.redis_base import Manager, RedisScript
 from vumi.tests.helpers import VumiTestCase
 
 
+# Modules that declare RedisScripts. They're imported by TestRedisScripts so
+# that every script is checked.
+SCRIPT_MODULES = [
+    'vumi.components.session',
+    'vumi.components.tagpool',
+    'vumi.components.window_manager',
+    'vumi.transports.smpp.sequence',
+]
+
+
 class TestBaseRedisManager(VumiTestCase):
     def mk_manager(self, key_prefix='test', client=None, config=None):
         if client is None:
@@ -33,3 +48,31 @@ class TestBaseRedisManager(VumiTestCase):
         self.assertEqual(sub_manager._key_prefix, "foo")
         self.assertEqual(sub_manager._client, manager._client)
         self.assertEqual(sub_manager._key_separator, manager._key_separator)
+
+
+class TestRedisScripts(VumiTestCase):
+    """Load every script we have into a real redis server.
+
+    This only runs if ``VUMITEST_REDIS_DB`` is set, since FakeRedis runs
+    Python emulations of scripts instead of the Lua source.
+    """
+
+    @inlineCallbacks
+    def setUp(self):
+        if 'VUMITEST_REDIS_DB' not in os.environ:
+            raise SkipTest("VUMITEST_REDIS_DB isn't set.")
+        from vumi.persist.txredis_manager import TxRedisManager
+        for module in SCRIPT_MODULES:
+            __import__(module)
+        self.manager = yield TxRedisManager.from_config({
+            'key_prefix': 'redisscripttest',
+        })
+        self.add_cleanup(self.manager._close)
+
+    @inlineCallbacks
+    def test_scripts_compile(self):
+        scripts = RedisScript.all_scripts()
+        self.assertNotEqual(scripts, [])
+        for script in scripts:
+            sha = yield self.manager._client.script_load(script.source)
+            self.assertEqual(sha, script.sha, script)
@@ -98,6 +98,18 @@ class TestRiakManager(CommonRiakManagerTests, VumiTestCase):
         from riak import RiakHttpTransport
         self.assertEqual(type(manager.client._transport), RiakHttpTransport)
 
+    def test_index_keys_page_protocol_buffer(self):
+        from vumi.persist.model import IndexPaginationNotSupported
+        manager_class = type(self.manager)
+        manager = manager_class.from_config({
+            'transport_type': 'protocol_buffer',
+            'bucket_prefix': 'test.',
+            })
+        self.assertFalse(manager.supports_index_pages())
+        self.assertRaises(
+            IndexPaginationNotSupported, manager.index_keys_page,
+            DummyModel, 'test_index_bin', 'foo', None, max_results=2)
+
     def test_transport_class_default(self):
         manager_class = type(self.manager)
         manager = manager_class.from_config({
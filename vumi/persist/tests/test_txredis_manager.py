@@ -2,10 +2,20 @@
 
 from twisted.internet.defer import inlineCallbacks
 
+from vumi.persist.redis_base import RedisPipelineError, RedisScript
 from vumi.persist.txredis_manager import TxRedisManager
 from vumi.tests.helpers import VumiTestCase
 
 
+def incrby_emulation(redis, keys, args):
+    return redis.incr(keys[0], int(args[0]))
+
+
+INCRBY_SCRIPT = RedisScript(
+    'incrby', "return redis.call('INCRBY', KEYS[1], ARGV[1])",
+    incrby_emulation)
+
+
 class TestTxRedisManager(VumiTestCase):
     @inlineCallbacks
     def setUp(self):
@@ -62,3 +72,43 @@ class TestTxRedisManager(VumiTestCase):
         self.assertEqual(cursor, None)
         self.assertEqual(all_keys, set(
             'key%d' % i for i in range(10)))
+
+    @inlineCallbacks
+    def test_pipeline(self):
+        pipe = self.manager.pipeline()
+        self.assertEqual(pipe.set('foo', 'bar'), None)
+        pipe.incr('count')
+        pipe.get('foo')
+        pipe.keys()
+        self.assertEqual((yield self.manager.get('foo')), None)
+        results = (yield pipe.execute())
+        self.assertEqual(results[1:3], [1, 'bar'])
+        self.assertEqual(sorted(results[3]), ['count', 'foo'])
+        self.assertEqual((yield self.manager.get('foo')), 'bar')
+        self.assertEqual((yield pipe.execute()), [])
+
+    def test_execute_not_pipeline(self):
+        self.assertRaises(RedisPipelineError, self.manager.execute)
+
+    @inlineCallbacks
+    def test_run_script(self):
+        self.assertEqual(
+            (yield self.manager.run_script(INCRBY_SCRIPT, ['foo'], [3])), 3)
+        self.assertEqual((yield self.manager.get('foo')), '3')
+        self.assertEqual(
+            (yield self.manager._client.get('redistest:foo')), '3')
+        # The script is cached now, so we only send its SHA1.
+        self.assertEqual(
+            (yield self.manager.run_script(INCRBY_SCRIPT, ['foo'], [2])), 5)
+
+    @inlineCallbacks
+    def test_run_script_not_cached(self):
+        yield self.manager.run_script(INCRBY_SCRIPT, ['foo'], [1])
+        yield self.manager._client.script_flush()
+        self.assertEqual(
+            (yield self.manager.run_script(INCRBY_SCRIPT, ['foo'], [1])), 2)
+
+    def test_run_script_in_pipeline(self):
+        pipe = self.manager.pipeline()
+        self.assertRaises(
+            RedisPipelineError, pipe.run_script, INCRBY_SCRIPT, ['foo'], [1])
@@ -57,6 +57,9 @@ class CommonRiakManagerTests(object):
                          manager.DEFAULT_LOAD_BUNCH_SIZE)
         self.assertEqual(manager.mapreduce_timeout,
                          manager.DEFAULT_MAPREDUCE_TIMEOUT)
+        self.assertEqual(manager.load_concurrency,
+                         manager.DEFAULT_LOAD_CONCURRENCY)
+        self.assertEqual(manager.load_retries, manager.DEFAULT_LOAD_RETRIES)
 
     def test_from_config_with_bunch_size(self):
         manager_cls = self.manager.__class__
@@ -146,6 +149,107 @@ class CommonRiakManagerTests(object):
         result_data.sort(key=lambda d: d["a"])
         self.assertEqual(result_data, [{"a": 0}, {"a": 1}, {"a": 2}])
 
+    @Manager.calls_manager
+    def test_load_all(self):
+        yield self.manager.store(self.mkdummy("foo", {"a": 0}))
+        yield self.manager.store(self.mkdummy("bar", {"a": 1}))
+        yield self.manager.store(self.mkdummy("baz", {"a": 2}))
+        self.manager.load_concurrency = 2
+
+        keys = iter(["foo", "unknown", "bar", "baz"])
+        results = []
+        yield self.manager.load_all(DummyModel, keys, results.append)
+        result_data = sorted(
+            (result.get_data() for result in results), key=lambda d: d["a"])
+        self.assertEqual(result_data, [{"a": 0}, {"a": 1}, {"a": 2}])
+
+    @Manager.calls_manager
+    def test_load_all_retries(self):
+        yield self.manager.store(self.mkdummy("foo", {"a": 0}))
+        failures = ["foo", "foo"]
+        load = self.manager.load
+
+        def flaky_load(modelcls, key, result=None):
+            if key in failures:
+                failures.remove(key)
+                raise ValueError("Failed to load %s" % (key,))
+            return load(modelcls, key, result)
+
+        self.patch(self.manager, 'load', flaky_load)
+        self.patch(self.manager, 'LOAD_RETRY_ERRORS', (ValueError,))
+        results = []
+        yield self.manager.load_all(DummyModel, ["foo"], results.append)
+        self.assertEqual([r.get_data() for r in results], [{"a": 0}])
+        self.assertEqual(failures, [])
+
+    @Manager.calls_manager
+    def test_load_all_stops_after_failure(self):
+        for i in range(4):
+            yield self.manager.store(self.mkdummy("key%s" % i, {"a": i}))
+        self.manager.load_concurrency = 2
+        load = self.manager.load
+        loads = []
+
+        def failing_load(modelcls, key, result=None):
+            loads.append(key)
+            if key == "key0":
+                raise ValueError("Failed to load key0")
+            return load(modelcls, key, result)
+
+        self.patch(self.manager, 'load', failing_load)
+        taken = []
+
+        def keys():
+            for i in range(4):
+                taken.append(i)
+                yield "key%s" % i
+
+        results = []
+        try:
+            yield self.manager.load_all(DummyModel, keys(), results.append)
+        except ValueError:
+            pass
+        else:
+            self.fail("Expected ValueError.")
+        # The failure isn't a transport error, so it isn't retried, and no
+        # more keys are taken.
+        self.assertEqual(loads, ["key0"])
+        self.assertEqual(taken, [0])
+        self.assertEqual(results, [])
+
+    @Manager.calls_manager
+    def test_store_many(self):
+        self.manager.store_concurrency = 2
+        dummies = [self.mkdummy(key, {"a": i})
+                   for i, key in enumerate(["foo", "bar", "baz"])]
+        failures = yield self.manager.store_many(iter(dummies))
+        self.assertEqual(failures, [])
+        results = []
+        yield self.manager.load_all(
+            DummyModel, ["foo", "bar", "baz"], results.append)
+        result_data = sorted(
+            (result.get_data() for result in results), key=lambda d: d["a"])
+        self.assertEqual(result_data, [{"a": 0}, {"a": 1}, {"a": 2}])
+
+    @Manager.calls_manager
+    def test_store_many_failures(self):
+        store = self.manager.store
+
+        def flaky_store(modelobj):
+            if modelobj.key == "bar":
+                raise ValueError("Failed to store bar")
+            return store(modelobj)
+
+        self.patch(self.manager, 'store', flaky_store)
+        foo, bar = self.mkdummy("foo", {"a": 0}), self.mkdummy("bar", {"a": 1})
+        failures = yield self.manager.store_many([foo, bar])
+        [(failed_obj, failure)] = failures
+        self.assertEqual(failed_obj, bar)
+        self.assertTrue(failure.check(ValueError))
+        self.assertEqual(
+            (yield self.manager.load(DummyModel, "foo")).get_data(), {"a": 0})
+        self.assertEqual((yield self.manager.load(DummyModel, "bar")), None)
+
     @Manager.calls_manager
     def test_run_riak_map_reduce(self):
         dummies = [self.mkdummy(str(i), {"a": i}) for i in range(4)]
@@ -247,3 +351,18 @@ class TestTxRiakManager(CommonRiakManagerTests, VumiTestCase):
             })
         self.assertEqual(type(manager.client.transport),
                          self.http_transport)
+
+    @inlineCallbacks
+    def test_index_keys_page_protocol_buffer(self):
+        from vumi.persist.model import IndexPaginationNotSupported
+        manager_class = type(self.manager)
+        manager = manager_class.from_config({
+            'transport_type': 'protocol_buffer',
+            'bucket_prefix': 'test.',
+            })
+        self.add_cleanup(manager.client.transport.quit)
+        self.assertFalse(manager.supports_index_pages())
+        yield self.assertFailure(
+            manager.index_keys_page(DummyModel, 'test_index_bin', 'foo', None,
+                                    max_results=2),
+            IndexPaginationNotSupported)
@@ -11,12 +11,19 @@ except ImportError:
     import txredis.protocol as txrp
     txr = txrp
 
+try:
+    from txredis.exceptions import NoScript
+except ImportError:
+    # Older versions report NOSCRIPT errors as plain ResponseErrors.
+    NoScript = txr.ResponseError
+
 from twisted.internet import reactor
 from twisted.internet.defer import (
-    inlineCallbacks, DeferredList, succeed, Deferred)
+    inlineCallbacks, DeferredList, succeed, Deferred, gatherResults,
+    FirstError)
 
 from vumi.persist.redis_base import Manager
-from vumi.persist.fake_redis import FakeRedis
+from vumi.persist.fake_redis import FakeRedis, NoScriptError
 
 
 class VumiRedis(txr.Redis):
@@ -120,6 +127,17 @@ class VumiRedis(txr.Redis):
             d.addCallback(lambda r: [(v, score_cast_func(s)) for v, s in r])
         return d
 
+    # txredis takes lists of keys and args for scripts, but we want to match
+    # the other redis client.
+
+    def eval(self, script, numkeys, *keys_and_args):
+        self._send('EVAL', script, numkeys, *keys_and_args)
+        return self.getResponse()
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        self._send('EVALSHA', sha, numkeys, *keys_and_args)
+        return self.getResponse()
+
     def scan(self, cursor, match=None, count=None):
         """
         Scan through all the keys in the database returning those that
@@ -247,3 +265,35 @@ class TxRedisManager(Manager):
         """Filter results of a redis call.
         """
         return results.addCallback(func)
+
+    def _execute_pipeline(self, calls):
+        """Send a list of calls in one round trip.
+
+        Redis handles commands in order and txredis matches replies to
+        commands in order, so we can send every command before waiting for
+        any replies.
+        """
+        if isinstance(self._client, FakeRedis):
+            pipe = self._client.pipeline(transaction=False)
+            for call, args, kw, _ in calls:
+                getattr(pipe, call)(*args, **kw)
+            d = pipe.execute()
+        else:
+            d = gatherResults([
+                getattr(self._client, call)(*args, **kw)
+                for call, args, kw, _ in calls], consumeErrors=True)
+            d.addErrback(lambda f: f.trap(FirstError) and f.value.subFailure)
+        return d.addCallback(
+            lambda results: self._apply_pipeline_filters(calls, results))
+
+    def _run_script(self, script, keys, args):
+        """Run a script with EVALSHA, falling back to EVAL if redis doesn't
+        have it cached.
+        """
+        def eval_on_noscript(f):
+            f.trap(NoScript, NoScriptError)
+            return self._client.eval(
+                script.source, len(keys), *(keys + args))
+
+        d = self._client.evalsha(script.sha, len(keys), *(keys + args))
+        return d.addErrback(eval_on_noscript)
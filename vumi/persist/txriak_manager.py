@@ -4,10 +4,14 @@
 
 from riakasaurus.riak import RiakClient, RiakObject, RiakMapReduce
 from riakasaurus import transport
+from riakasaurus.exceptions import RequestTimeout, ConnectTimeout
 from twisted.internet.defer import (
-    inlineCallbacks, gatherResults, maybeDeferred, succeed)
+    inlineCallbacks, gatherResults, maybeDeferred, succeed, fail, FirstError)
+from twisted.internet.error import ConnectError, ConnectionClosed, TimeoutError
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseFailed, ResponseNeverReceived
 
-from vumi.persist.model import Manager
+from vumi.persist.model import Manager, IndexPaginationNotSupported
 
 
 class TxRiakManager(Manager):
@@ -15,6 +19,10 @@ class TxRiakManager(Manager):
 
     call_decorator = staticmethod(inlineCallbacks)
 
+    LOAD_RETRY_ERRORS = (
+        ConnectError, ConnectionClosed, TimeoutError, ResponseFailed,
+        ResponseNeverReceived, RequestTimeout, ConnectTimeout)
+
     @classmethod
     def from_config(cls, config):
         config = config.copy()
@@ -23,6 +31,13 @@ class TxRiakManager(Manager):
                                      cls.DEFAULT_LOAD_BUNCH_SIZE)
         mapreduce_timeout = config.pop('mapreduce_timeout',
                                        cls.DEFAULT_MAPREDUCE_TIMEOUT)
+        load_concurrency = config.pop('load_concurrency',
+                                      cls.DEFAULT_LOAD_CONCURRENCY)
+        load_retries = config.pop('load_retries', cls.DEFAULT_LOAD_RETRIES)
+        cache_size = config.pop('cache_size', None)
+        cache_ttl = config.pop('cache_ttl', None)
+        store_concurrency = config.pop('store_concurrency',
+                                       cls.DEFAULT_STORE_CONCURRENCY)
         transport_type = config.pop('transport_type', 'http')
         transport_class = {
             'http': transport.HTTPTransport,
@@ -41,7 +56,10 @@ class TxRiakManager(Manager):
             mapred_prefix=mapred_prefix, client_id=client_id,
             transport=transport_class)
         return cls(client, bucket_prefix, load_bunch_size=load_bunch_size,
-                   mapreduce_timeout=mapreduce_timeout)
+                   mapreduce_timeout=mapreduce_timeout,
+                   load_concurrency=load_concurrency,
+                   load_retries=load_retries, cache_size=cache_size,
+                   cache_ttl=cache_ttl, store_concurrency=store_concurrency)
 
     def _encode_indexes(self, iterable, encoding='utf-8'):
         """
@@ -93,14 +111,43 @@ class TxRiakManager(Manager):
         return riak_object
 
     def store(self, modelobj):
+        self._uncache(modelobj)
+        modelobj._store_cached_values()
         d = modelobj._riak_object.store()
+        d.addCallback(lambda result: self._uncache(modelobj))
         d.addCallback(lambda result: modelobj)
         return d
 
+    def store_many(self, modelobjs):
+        modelobjs = iter(modelobjs)
+        failures = []
+
+        @inlineCallbacks
+        def store_objs():
+            # Each of these shares the same iterator, so we have at most
+            # store_concurrency stores in progress.
+            for modelobj in modelobjs:
+                try:
+                    yield self.store(modelobj)
+                except Exception:
+                    failures.append((modelobj, Failure()))
+
+        d = gatherResults([
+            store_objs() for _ in range(self.store_concurrency)])
+        return d.addCallback(lambda _: failures)
+
     def delete(self, modelobj):
-        return modelobj._riak_object.delete()
+        self._uncache(modelobj)
+        d = modelobj._riak_object.delete()
+        d.addCallback(lambda result: self._uncache(modelobj) or result)
+        return d
 
     def load(self, modelcls, key, result=None):
+        if result is None:
+            cached = self._get_cached(modelcls, key)
+            if cached is not None:
+                return succeed(cached)
+        generation = self._cache_generation()
         riak_object = self.riak_object(modelcls, key, result)
         d = succeed(riak_object) if result else riak_object.reload()
 
@@ -119,16 +166,86 @@ class TxRiakManager(Manager):
             md.addCallback(lambda mdata: mdata.get_riak_object())
             return md.addCallback(build_model_object, was_migrated=True)
 
-        return d.addCallback(build_model_object, was_migrated=False)
+        d.addCallback(build_model_object, was_migrated=False)
+        if result is None:
+            d.addCallback(self._cache_loaded_result, generation)
+        return d
+
+    def _cache_loaded_result(self, obj, generation):
+        if obj is not None:
+            self._cache_loaded(obj, generation)
+        return obj
+
+    def _load_with_retries(self, modelcls, key, retries):
+        d = maybeDeferred(self.load, modelcls, key)
+        if retries > 0:
+            def retry(f):
+                f.trap(*self.LOAD_RETRY_ERRORS)
+                return self._load_with_retries(modelcls, key, retries - 1)
+            d.addErrback(retry)
+        return d
+
+    def load_all(self, modelcls, keys, callback):
+        keys = iter(keys)
+        failed = []
+
+        def remaining_keys():
+            # We check this before taking each key, so nothing more is taken
+            # from `keys` once a load has failed.
+            while not failed:
+                yield next(keys)
+
+        remaining = remaining_keys()
+
+        @inlineCallbacks
+        def load_keys():
+            # Each of these shares the same key iterator, so we have at most
+            # load_concurrency loads in progress.
+            try:
+                for key in remaining:
+                    obj = yield self._load_with_retries(
+                        modelcls, key, self.load_retries)
+                    if obj is not None and not failed:
+                        yield callback(obj)
+            except Exception:
+                failed.append(True)
+                raise
+
+        d = gatherResults([
+            load_keys() for _ in range(self.load_concurrency)],
+            consumeErrors=True)
+        d.addErrback(lambda f: f.trap(FirstError) and f.value.subFailure)
+        return d.addCallback(lambda _: None)
 
     def _load_multiple(self, modelcls, keys):
-        d = gatherResults([self.load(modelcls, key) for key in keys])
-        d.addCallback(lambda objs: [obj for obj in objs if obj is not None])
+        objs = {}
+        d = self.load_all(
+            modelcls, keys, lambda obj: objs.__setitem__(obj.key, obj))
+        d.addCallback(lambda _: [objs[key] for key in keys if key in objs])
         return d
 
     def riak_map_reduce(self):
         return RiakMapReduce(self.client)
 
+    def index_keys_page(self, model, index_name, start_value, end_value=None,
+                        max_results=None, continuation=None):
+        if not self.supports_index_pages():
+            return fail(IndexPaginationNotSupported(
+                "Only the HTTP transport can page through index results."
+                " Use index_keys() or stream_index_keys() instead."))
+        riak_transport = self.client.get_transport()
+        uri, params = self._index_page_request(
+            model, index_name, start_value, end_value, max_results,
+            continuation)
+        d = riak_transport.get_request(uri, params)
+
+        def parse_response(response):
+            riak_transport.check_http_code(response, [200])
+            return self._index_page_from_response(
+                riak_transport.decodeJson(response[1]))
+
+        return d.addCallback(parse_response)
+
     def riak_enable_search(self, modelcls):
         bucket_name = self.bucket_name(modelcls)
         bucket = self.client.bucket(bucket_name)
@@ -151,6 +268,10 @@ class TxRiakManager(Manager):
     def should_quote_index_values(self):
         return not isinstance(self.client, transport.PBCTransport)
 
+    def supports_index_pages(self):
+        return isinstance(
+            self.client.get_transport(), transport.HTTPTransport)
+
     @inlineCallbacks
     def purge_all(self):
         buckets = yield self.client.list_buckets()
@@ -1,110 +1,578 @@
 # -*- test-case-name: vumi.scripts.tests.test_benchmark_persist -*-
+"""Benchmark vumi's Riak and Redis backed persistence.
+
+Each scenario performs ``--messages`` operations (``--concurrent-messages``
+at a time) and reports throughput and the median and 99th percentile
+latency of the calls it made. By default Riak is replaced by an in-memory
+stand-in and Redis by FakeRedis, which measures our own overhead. Pass
+``--riak-config`` and ``--redis-config`` to measure against real servers.
+"""
+
+import json
 import sys
 import time
+
 from twisted.python import usage
 from twisted.internet import reactor
-from twisted.internet.defer import maybeDeferred, inlineCallbacks, DeferredList
+from twisted.internet.defer import (
+    maybeDeferred, inlineCallbacks, returnValue, gatherResults, Deferred)
 
 from vumi.message import TransportUserMessage
+from vumi.persist.fake_riak import fake_riak_manager
 from vumi.persist.model import Model
 from vumi.persist.txriak_manager import TxRiakManager
-from vumi.persist.fields import VumiMessage
+from vumi.persist.txredis_manager import TxRedisManager
+from vumi.persist.fields import VumiMessage, Unicode
+
+
+SCENARIOS = []
+
+# Everything under these prefixes is purged before and after a run, so
+# they're never taken from the user's config.
+RIAK_BUCKET_PREFIX = 'test.bench.'
+REDIS_KEY_PREFIX = 'bench'
+
+
+class ScenarioUnsupported(Exception):
+    """Raised by a scenario that can't run against the configured
+    backends."""
+
+
+def scenario(func):
+    """Register a benchmark scenario.
+
+    A scenario is called with the :class:`PersistenceBenchmark` and returns a
+    Deferred that fires with a function that runs the benchmark. That
+    function returns a Deferred that fires once it's done. Anything done
+    before the function is returned isn't timed. A scenario that can't run
+    against the configured backends raises :class:`ScenarioUnsupported`.
+    """
+    SCENARIOS.append(func)
+    return func
 
 
 class Options(usage.Options):
     optParameters = [
-        ["messages", "m", "1000",
-         "Total number of messages to write and read back."],
-        ["concurrent-messages", "c", "100",
-         "Number of messages to read and write concurrently"],
+        ["messages", "m", 1000,
+         "Number of operations per scenario.", int],
+        ["concurrent-messages", "c", 100,
+         "Number of operations to run concurrently.", int],
+        ["riak-config", None, None,
+         "Riak manager config (as JSON) for a real Riak server. Defaults to"
+         " an in-memory stand-in. Buckets are always prefixed with %r."
+         % (RIAK_BUCKET_PREFIX,)],
+        ["redis-config", None, None,
+         "Redis manager config (as JSON) for a real Redis server. Defaults"
+         " to FakeRedis. Keys are always prefixed with %r."
+         % (REDIS_KEY_PREFIX,)],
+        ["json", None, None,
+         "Write the results to this file as JSON."],
     ]
 
-    longdesc = """Benchmarks vumi.persist.model.Model"""
+    longdesc = """Benchmarks vumi.persist models and the Redis and Riak
+                  backed components built on them."""
+
+    def __init__(self):
+        usage.Options.__init__(self)
+        self['scenarios'] = []
+
+    def opt_scenario(self, name):
+        """Run this scenario (may be repeated). Defaults to all of them.
+        """
+        names = [s.__name__ for s in SCENARIOS]
+        if name not in names:
+            raise usage.UsageError(
+                "Unknown scenario %r. Choose from: %s" % (
+                    name, ", ".join(names)))
+        self['scenarios'].append(name)
+
+    opt_s = opt_scenario
+
+    def postOptions(self):
+        for name, prefix_key in [('riak-config', 'bucket_prefix'),
+                                 ('redis-config', 'key_prefix')]:
+            if self[name] is not None:
+                try:
+                    self[name] = json.loads(self[name])
+                except ValueError, e:
+                    raise usage.UsageError("Invalid %s: %s" % (name, e))
+                if prefix_key in self[name]:
+                    raise usage.UsageError(
+                        "The %s may not set %r. The benchmark purges"
+                        " everything under its own prefix." % (
+                            name, prefix_key))
 
 
 class MessageModel(Model):
     msg = VumiMessage(TransportUserMessage)
 
 
-class WriteReadBenchmark(object):
+class IndexedMessageModel(Model):
+    msg = VumiMessage(TransportUserMessage)
+    batch = Unicode(index=True)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class PersistenceBenchmark(object):
     """
-    Writes messages to Riak and then reads them back.
+    Runs benchmark scenarios against a Riak manager and a Redis manager.
     """
 
     def __init__(self, options):
-        self.messages = int(options['messages'])
-        self.concurrent = int(options['concurrent-messages'])
-
-    def make_batches(self):
-        num_batches, rem = divmod(self.messages, self.concurrent)
-        batches = [self.make_batch(i, self.concurrent)
-                   for i in range(num_batches)]
-        if rem:
-            batches.append(self.make_batch(num_batches, rem))
-        return batches
-
-    def make_batch(self, batch_no, num_msgs):
-        return [TransportUserMessage(to_addr="1234", from_addr="5678",
+        self.messages = options['messages']
+        self.concurrent = options['concurrent-messages']
+        self.riak_config = options['riak-config']
+        self.redis_config = options['redis-config']
+        self.scenario_names = options['scenarios']
+        self.latencies = []
+        self.cleanups = []
+
+    def emit(self, s):
+        print s
+
+    def emit_error(self, s):
+        print >> sys.stderr, s
+
+    def require_mapreduce(self):
+        if self.riak_config is None:
+            raise ScenarioUnsupported(
+                "The in-memory Riak stand-in doesn't do MapReduce.")
+
+    @inlineCallbacks
+    def setup(self):
+        if self.riak_config is None:
+            self.riak = fake_riak_manager(
+                RIAK_BUCKET_PREFIX, store_concurrency=self.concurrent)
+        else:
+            riak_config = {'store_concurrency': self.concurrent}
+            riak_config.update(self.riak_config)
+            riak_config['bucket_prefix'] = RIAK_BUCKET_PREFIX
+            self.riak = TxRiakManager.from_config(riak_config)
+        redis_config = {'FAKE_REDIS': 'yes'}
+        if self.redis_config is not None:
+            redis_config = dict(self.redis_config)
+        redis_config['key_prefix'] = REDIS_KEY_PREFIX
+        self.redis = yield TxRedisManager.from_config(redis_config)
+        yield self.purge()
+
+    @inlineCallbacks
+    def teardown(self):
+        yield self.purge()
+        yield self.redis._close()
+
+    @inlineCallbacks
+    def purge(self):
+        yield self.riak.purge_all()
+        yield self.redis._purge_all()
+
+    def make_messages(self, count=None):
+        if count is None:
+            count = self.messages
+        return [TransportUserMessage(
+                    to_addr="1234", from_addr="5678",
                     transport_name="bench", transport_type="sms",
-                    content="Batch: %d. Msg: %d" % (batch_no, i))
-                for i in range(num_msgs)]
-
-    def write_batch(self, model, msgs):
-        print "  Writing %d messages." % len(msgs)
-        deferreds = []
-        for msg in msgs:
-            msg_obj = model(key=msg['message_id'], msg=msg)
-            deferreds.append(msg_obj.save())
-        return DeferredList(deferreds)
-
-    def read_batch(self, model, msgs):
-        print "  Reading %d messages." % len(msgs)
-        deferreds = []
-        for msg in msgs:
-            deferreds.append(model.load(msg['message_id']))
-        return DeferredList(deferreds)
+                    content="Msg: %d" % (i,))
+                for i in range(count)]
+
+    def chunks(self, items):
+        return [items[i:i + self.concurrent]
+                for i in range(0, len(items), self.concurrent)]
+
+    def run_concurrently(self, func, items):
+        """Call `func` with each of `items`, `concurrent-messages` at a time,
+        and record the latency of each call."""
+        items = iter(items)
+
+        @inlineCallbacks
+        def worker():
+            for item in items:
+                started = time.time()
+                yield func(item)
+                self.latencies.append(time.time() - started)
+
+        return gatherResults(
+            [worker() for _ in range(self.concurrent)], consumeErrors=True)
+
+    @inlineCallbacks
+    def run_scenario(self, setup):
+        """Run a scenario and return a dict of measurements."""
+        self.latencies = []
+        self.cleanups = []
+        try:
+            run = yield maybeDeferred(setup, self)
+            self.latencies = []
+            start = time.time()
+            yield maybeDeferred(run)
+            elapsed = time.time() - start
+        finally:
+            for cleanup in reversed(self.cleanups):
+                yield cleanup()
+            yield self.purge()
+
+        latencies = sorted(self.latencies)
+        returnValue({
+            'ops': self.messages,
+            'seconds': elapsed,
+            'ops_per_sec': self.messages / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+        })
 
     @inlineCallbacks
     def run(self):
-        manager = TxRiakManager.from_config({'bucket_prefix': 'test.bench.'})
-        model = manager.proxy(MessageModel)
-        yield manager.purge_all()
+        yield self.setup()
+        results = []
+        try:
+            for setup in SCENARIOS:
+                name = setup.__name__
+                if self.scenario_names and name not in self.scenario_names:
+                    continue
+                try:
+                    result = yield self.run_scenario(setup)
+                except ScenarioUnsupported as e:
+                    self.emit_error("Scenario %s skipped: %s" % (name, e))
+                    result = None
+                except Exception as e:
+                    self.emit_error("Scenario %s failed: %r" % (name, e))
+                    result = {'error': repr(e)}
+                results.append((name, result))
+        finally:
+            yield self.teardown()
+        returnValue(results)
+
+    def print_results(self, results):
+        self.emit("%-24s%10s%12s%10s%10s" % (
+            "scenario", "seconds", "ops/s", "p50 ms", "p99 ms"))
+        for name, result in results:
+            if result is None:
+                self.emit("%-24s skipped" % (name,))
+                continue
+            if 'error' in result:
+                self.emit("%-24s FAILED" % (name,))
+                continue
+            self.emit("%-24s%10.2f%12.1f%10.2f%10.2f" % (
+                name, result['seconds'], result['ops_per_sec'],
+                result['p50_ms'], result['p99_ms']))
+
+    def results_json(self, results):
+        return json.dumps({
+            'riak': 'memory' if self.riak_config is None else 'riak',
+            'redis': 'fake' if self.redis_config is None else 'redis',
+            'messages': self.messages,
+            'concurrency': self.concurrent,
+            'results': dict(results),
+        })
+
+
+@inlineCallbacks
+def store_messages(bench, modelcls=MessageModel, **fields):
+    model = bench.riak.proxy(modelcls)
+    msgs = bench.make_messages()
+    failures = yield model.store_many([
+        model(msg['message_id'], msg=msg, **fields) for msg in msgs])
+    if failures:
+        raise RuntimeError("Failed to store %d messages." % (len(failures),))
+    returnValue((model, msgs))
+
+
+@scenario
+def model_save(bench):
+    model = bench.riak.proxy(MessageModel)
+    msgs = bench.make_messages()
+
+    def run():
+        return bench.run_concurrently(
+            lambda msg: model(msg['message_id'], msg=msg).save(), msgs)
+
+    return run
+
+
+@scenario
+def model_store_many(bench):
+    model = bench.riak.proxy(MessageModel)
+    msgs = bench.make_messages()
+
+    def run():
+        return bench.run_concurrently(
+            lambda chunk: model.store_many([
+                model(msg['message_id'], msg=msg) for msg in chunk]),
+            bench.chunks(msgs))
+
+    return run
+
+
+@scenario
+@inlineCallbacks
+def model_load(bench):
+    model, msgs = yield store_messages(bench)
+
+    @inlineCallbacks
+    def load(msg):
+        stored = yield model.load(msg['message_id'])
+        if stored is None or not (stored.msg == msg):
+            raise RuntimeError(
+                "Failed to retrieve message (%s)" % (msg['content'],))
+
+    returnValue(lambda: bench.run_concurrently(load, msgs))
 
-        msg_batches = self.make_batches()
 
-        start = time.time()
+def load_bunches(bench, use_mapreduce):
+    @inlineCallbacks
+    def setup():
+        if use_mapreduce:
+            bench.require_mapreduce()
+        model, msgs = yield store_messages(bench)
+        keys = [msg['message_id'] for msg in msgs]
+        bench.riak.USE_MAPREDUCE_BUNCH_LOADING = use_mapreduce
+        bench.cleanups.append(
+            lambda: delattr(bench.riak, 'USE_MAPREDUCE_BUNCH_LOADING'))
+
+        @inlineCallbacks
+        def run():
+            loaded = 0
+            for bunch in model.load_all_bunches(keys):
+                started = time.time()
+                loaded += len((yield bunch))
+                bench.latencies.append(time.time() - started)
+            if loaded != len(keys):
+                raise RuntimeError("Loaded %d of %d messages." % (
+                    loaded, len(keys)))
+
+        returnValue(run)
+
+    return setup()
+
+
+@scenario
+def load_bunches_multiget(bench):
+    return load_bunches(bench, False)
+
+
+@scenario
+def load_bunches_mapreduce(bench):
+    return load_bunches(bench, True)
+
+
+@scenario
+@inlineCallbacks
+def index_keys(bench):
+    model = bench.riak.proxy(IndexedMessageModel)
+    msgs = bench.make_messages()
+    yield model.store_many([
+        model(msg['message_id'], msg=msg, batch=u"batch-%d" % (i % 10,))
+        for i, msg in enumerate(msgs)])
+
+    def run():
+        return bench.run_concurrently(
+            lambda i: model.index_keys('batch', u"batch-%d" % (i % 10,)),
+            range(bench.messages))
+
+    returnValue(run)
+
+
+@scenario
+@inlineCallbacks
+def index_keys_page(bench):
+    if not bench.riak.supports_index_pages():
+        raise ScenarioUnsupported(
+            "The Riak transport can't page through index results.")
+    model = bench.riak.proxy(IndexedMessageModel)
+    msgs = bench.make_messages()
+    yield model.store_many([
+        model(msg['message_id'], msg=msg, batch=u"batch")
+        for msg in msgs])
 
-        for batch in msg_batches:
-            yield self.write_batch(model, batch)
+    @inlineCallbacks
+    def run():
+        continuation = None
+        while True:
+            started = time.time()
+            keys, continuation = yield model.index_keys_page(
+                'batch', u"batch", max_results=bench.concurrent,
+                continuation=continuation)
+            bench.latencies.append(time.time() - started)
+            if continuation is None:
+                break
+
+    returnValue(run)
+
+
+@inlineCallbacks
+def message_store(bench):
+    from vumi.components.message_store import MessageStore
+    store = MessageStore(bench.riak, bench.redis)
+    batch_id = yield store.batch_start()
+    returnValue((store, batch_id))
+
+
+@scenario
+@inlineCallbacks
+def message_store_add(bench):
+    store, batch_id = yield message_store(bench)
+    msgs = bench.make_messages()
+
+    returnValue(lambda: bench.run_concurrently(
+        lambda msg: store.add_outbound_message(msg, batch_id=batch_id),
+        msgs))
 
-        write_done = time.time()
-        write_time = write_done - start
-        print "Write took %.2f seconds (%.2f msgs/s)" % (
-                write_time, self.messages / write_time)
 
-        result_batches = []
-        for batch in msg_batches:
-            r = yield self.read_batch(model, batch)
-            result_batches.append(r)
+@scenario
+@inlineCallbacks
+def message_store_add_many(bench):
+    store, batch_id = yield message_store(bench)
+    msgs = bench.make_messages()
 
-        read_done = time.time()
-        read_time = read_done - write_done
-        print "Read took %.2f seconds (%.2f msgs/s)" % (
-                read_time, self.messages / read_time)
+    returnValue(lambda: bench.run_concurrently(
+        lambda chunk: store.add_outbound_messages(chunk, batch_id=batch_id),
+        bench.chunks(msgs)))
 
-        for batch, result_batch in zip(msg_batches, result_batches):
-            for msg, (good, stored_msg) in zip(batch, result_batch):
-                if not good or stored_msg is None:
-                    raise RuntimeError("Failed to retrieve message (%s)"
-                                       % msg['content'])
-                if not(msg == stored_msg.msg):  # TODO: fix message !=
-                    raise RuntimeError("Message %r does not equal stored"
-                                       " message %r" % (msg, stored_msg.msg))
 
-        print "Messages retrieved successfully."
+@scenario
+@inlineCallbacks
+def window_manager(bench):
+    from vumi.components.window_manager import WindowManager
+    wm = WindowManager(bench.redis, window_size=bench.concurrent)
+    bench.cleanups.append(wm.stop)
+    yield wm.create_window('bench')
+    msgs = bench.make_messages()
+
+    @inlineCallbacks
+    def run():
+        yield bench.run_concurrently(
+            lambda msg: wm.add('bench', msg.to_json()), msgs)
+        while True:
+            key = yield wm.get_next_key('bench')
+            if key is None:
+                break
+            started = time.time()
+            yield wm.get_data('bench', key)
+            yield wm.remove_key('bench', key)
+            bench.latencies.append(time.time() - started)
+
+    returnValue(run)
+
+
+@scenario
+@inlineCallbacks
+def window_manager_bulk(bench):
+    from vumi.components.window_manager import WindowManager
+    wm = WindowManager(bench.redis, window_size=bench.concurrent)
+    bench.cleanups.append(wm.stop)
+    yield wm.create_window('bench')
+    msgs = bench.make_messages()
+
+    @inlineCallbacks
+    def run():
+        yield bench.run_concurrently(
+            lambda chunk: wm.add_many(
+                'bench', [msg.to_json() for msg in chunk]),
+            bench.chunks(msgs))
+        while True:
+            started = time.time()
+            keys = yield wm.get_next_keys('bench')
+            if not keys:
+                break
+            yield wm.remove_keys('bench', keys)
+            bench.latencies.append(time.time() - started)
+
+    returnValue(run)
+
+
+@scenario
+@inlineCallbacks
+def window_manager_push(bench):
+    from vumi.components.window_manager import WindowManager
+    wm = WindowManager(bench.redis, window_size=bench.concurrent)
+    bench.cleanups.append(wm.stop)
+    yield wm.create_window('bench')
+    waiting = {}
+
+    def key_callback(window_id, key):
+        # Acknowledge the message as a transport would, without holding up
+        # the rest of the window.
+        d = wm.remove_key(window_id, key)
+        d.addCallback(lambda _: waiting.pop(key).callback(None))
+
+    wm.monitor(key_callback, cleanup=False, push=True)
+
+    def send(msg):
+        # Time from adding the message to the window until it's been sent.
+        key = msg['message_id']
+        d = waiting[key] = Deferred()
+        wm.add('bench', msg.to_json(), key=key)
+        return d
+
+    msgs = bench.make_messages()
+    returnValue(lambda: bench.run_concurrently(send, msgs))
+
+
+@scenario
+@inlineCallbacks
+def tagpool_manager(bench):
+    from vumi.components.tagpool import TagpoolManager
+    tagpool = TagpoolManager(bench.redis)
+    yield tagpool.declare_tags([
+        ("bench", u"tag-%d" % (i,)) for i in range(bench.concurrent)])
+
+    @inlineCallbacks
+    def acquire_and_release(_):
+        tag = yield tagpool.acquire_tag("bench")
+        yield tagpool.release_tag(tag)
+
+    returnValue(lambda: bench.run_concurrently(
+        acquire_and_release, range(bench.messages)))
+
+
+@scenario
+@inlineCallbacks
+def tagpool_manager_specific(bench):
+    from vumi.components.tagpool import TagpoolManager
+    tagpool = TagpoolManager(bench.redis)
+    tags = [("bench", u"tag-%d" % (i,)) for i in range(bench.messages)]
+    yield tagpool.declare_tags(tags)
+
+    @inlineCallbacks
+    def acquire_and_release(tag):
+        yield tagpool.acquire_specific_tag(tag)
+        yield tagpool.release_tag(tag)
+
+    returnValue(lambda: bench.run_concurrently(acquire_and_release, tags))
+
+
+def session_scenario(bench, **kw):
+    from vumi.components.session import SessionManager
+    sessions = SessionManager(bench.redis, max_session_length=60, **kw)
+    bench.cleanups.append(lambda: sessions.stop(stop_redis=False))
+
+    @inlineCallbacks
+    def session_cycle(i):
+        user_id = "user-%d" % (i,)
+        session = yield sessions.create_session(user_id, state="start")
+        for step in range(3):
+            session = yield sessions.load_session(user_id)
+            session["state"] = "step-%d" % (step,)
+            yield sessions.save_session(user_id, session)
+        yield sessions.clear_session(user_id)
+
+    return lambda: bench.run_concurrently(
+        session_cycle, range(bench.messages))
+
+
+@scenario
+def session_manager(bench):
+    return session_scenario(bench)
+
+
+@scenario
+def session_manager_cached(bench):
+    return session_scenario(bench, cache_size=bench.concurrent)
 
-        yield manager.purge_all()
-        print "Messages purged."
 
 if __name__ == '__main__':
     try:
@@ -115,13 +583,20 @@ if __name__ == '__main__':
         print '%s: Try --help for usage details.' % (sys.argv[0])
         sys.exit(1)
 
-    bench = WriteReadBenchmark(options)
+    bench = PersistenceBenchmark(options)
 
     def _eb(f):
         f.printTraceback()
 
+    def _report(results):
+        bench.print_results(results)
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                f.write(bench.results_json(results))
+
     def _main():
         d = maybeDeferred(bench.run)
+        d.addCallback(_report)
         d.addErrback(_eb)
         d.addBoth(lambda _: reactor.stop())
 
@@ -1,10 +1,15 @@
 # -*- test-case-name: vumi.scripts.tests.test_model_migrator -*-
+import os
 import sys
 
 from twisted.python import usage
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, maybeDeferred, gatherResults, succeed)
+from twisted.internet.task import deferLater
 
 from vumi.utils import load_class_by_string
-from vumi.persist.riak_manager import RiakManager
+from vumi.persist.txriak_manager import TxRiakManager
 
 
 class Options(usage.Options):
@@ -17,6 +22,18 @@ class Options(usage.Options):
         ["keys", None, None,
          "Migrate these specific keys rather than the whole bucket."
          " E.g. --keys 'foo,bar,baz'"],
+        ["index-page-size", None, 1000,
+         "Fetch keys from Riak in pages of this size.", int],
+        ["concurrency", "c", 10,
+         "Maximum number of objects to migrate at the same time.", int],
+        ["rate-limit", None, None,
+         "Migrate at most this many objects per second.", float],
+        ["checkpoint-file", None, None,
+         "Record progress through the bucket in this file after each page"
+         " of keys. If the file exists when the migrator starts, the"
+         " migration resumes from the recorded position. The file is"
+         " removed once the migration completes. Not written during a"
+         " dry run."],
     ]
 
     optFlags = [
@@ -33,29 +50,24 @@ class Options(usage.Options):
             raise usage.UsageError("Please specify a model class.")
         if self['bucket-prefix'] is None:
             raise usage.UsageError("Please specify a bucket prefix.")
+        if self['index-page-size'] < 1:
+            raise usage.UsageError("The index page size must be positive.")
+        if self['concurrency'] < 1:
+            raise usage.UsageError("The concurrency must be positive.")
+        if self['rate-limit'] is not None and self['rate-limit'] <= 0:
+            raise usage.UsageError("The rate limit must be positive.")
 
 
-class ProgressEmitter(object):
-    """Report progress as a percentage to an emitter."""
-
-    def __init__(self, total, emit):
-        self.emit = emit
-        self.total = total
-        self.percentage = 0
-
-    def _calculate_percentage(self, value):
-        if value == 0:
-            return 0
-        return int(value * 100.0 / self.total)
+class ModelMigrator(object):
+    """Load and re-save every object in a bucket.
 
-    def update(self, value):
-        old_percentage = self.percentage
-        self.percentage = self._calculate_percentage(value)
-        if self.percentage != old_percentage:
-            self.emit(self.percentage)
+    Keys are fetched a page at a time (the next page is fetched while the
+    current one is being migrated) and up to ``concurrency`` objects from
+    each page are migrated at once.
+    """
 
+    clock = reactor
 
-class ModelMigrator(object):
     def __init__(self, options):
         self.options = options
         model_cls = load_class_by_string(options['model'])
@@ -64,41 +76,121 @@ class ModelMigrator(object):
         }
         manager = self.get_riak_manager(riak_config)
         self.model = manager.proxy(model_cls)
+        self.dry_run = options['dry-run']
+        self.concurrency = options['concurrency']
+        self.rate_limit = options['rate-limit']
+        self.checkpoint_file = options['checkpoint-file']
+        self.processed = 0
+        self._next_slot = None
 
     def get_riak_manager(self, riak_config):
-        return RiakManager.from_config(riak_config)
+        return TxRiakManager.from_config(riak_config)
 
     def emit(self, s):
         print s
 
+    @inlineCallbacks
     def run(self):
-        dry_run = self.options["dry-run"]
+        self.start_time = self.clock.seconds()
         if self.options["keys"] is not None:
             keys = self.options["keys"].split(",")
             self.emit("Migrating %d specified keys ..." % len(keys))
+            yield self.migrate_keys(keys)
+            self.emit_progress()
         else:
-            keys = self.model.all_keys()
-            self.emit("%d keys found. Migrating ..." % len(keys))
+            yield self.migrate_pages(self.options["index-page-size"])
+        self.emit("Done.")
+
+    def decode_keys(self, keys):
         # Depending on our Riak client, Python version, and JSON library we may
         # get bytes or unicode here.
-        keys = [k.decode('utf-8') if isinstance(k, str) else k for k in keys]
-        progress = ProgressEmitter(
-            len(keys),
-            lambda p: self.emit("%s%% complete." % (p,))
-        )
-        for i, key in enumerate(keys):
-            try:
-                obj = self.model.load(key)
-                if obj is not None:
-                    if not dry_run:
-                        obj.save()
-                else:
-                    self.emit("Skipping tombstone key %r." % (key,))
-            except Exception, e:
-                self.emit("Failed to migrate key %r:" % (key,))
-                self.emit("  %s: %s" % (type(e).__name__, e))
-            progress.update(i)
-        self.emit("Done.")
+        return [k.decode('utf-8') if isinstance(k, str) else k for k in keys]
+
+    def emit_progress(self):
+        elapsed = self.clock.seconds() - self.start_time
+        rate = self.processed / elapsed if elapsed > 0 else 0.0
+        self.emit("%d keys processed (%.1f objects/s)." % (
+            self.processed, rate))
+
+    def read_checkpoint(self):
+        if self.checkpoint_file is None:
+            return None
+        if not os.path.exists(self.checkpoint_file):
+            return None
+        with open(self.checkpoint_file) as f:
+            return f.read().strip() or None
+
+    def write_checkpoint(self, continuation):
+        if self.checkpoint_file is None or self.dry_run:
+            return
+        if continuation is None:
+            if os.path.exists(self.checkpoint_file):
+                os.remove(self.checkpoint_file)
+            return
+        # Write to a temporary file and rename it so that an interrupted
+        # write can't leave a truncated token behind.
+        tmp_file = self.checkpoint_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            f.write(continuation)
+        os.rename(tmp_file, self.checkpoint_file)
+
+    def wait_for_slot(self):
+        """Return a Deferred that fires when the rate limit allows another
+        object to be migrated.
+        """
+        if self.rate_limit is None:
+            return succeed(None)
+        now = self.clock.seconds()
+        slot = now if self._next_slot is None else max(now, self._next_slot)
+        self._next_slot = slot + 1.0 / self.rate_limit
+        return deferLater(self.clock, slot - now, lambda: None)
+
+    @inlineCallbacks
+    def migrate_key(self, key):
+        try:
+            obj = yield self.model.load(key)
+            if obj is not None:
+                if not self.dry_run:
+                    yield obj.save()
+            else:
+                self.emit("Skipping tombstone key %r." % (key,))
+        except Exception, e:
+            self.emit("Failed to migrate key %r:" % (key,))
+            self.emit("  %s: %s" % (type(e).__name__, e))
+        self.processed += 1
+
+    def migrate_keys(self, keys):
+        """Migrate ``keys`` with at most ``concurrency`` objects in flight.
+        """
+        key_iter = iter(self.decode_keys(keys))
+
+        @inlineCallbacks
+        def worker():
+            for key in key_iter:
+                yield self.wait_for_slot()
+                yield self.migrate_key(key)
+
+        return gatherResults([
+            worker() for _ in range(min(self.concurrency, len(keys)))])
+
+    @inlineCallbacks
+    def migrate_pages(self, page_size):
+        continuation = self.read_checkpoint()
+        if continuation is not None:
+            self.emit("Resuming from checkpoint ...")
+        self.emit("Migrating keys in pages of %d ..." % (page_size,))
+        page_d = self.model.all_keys_page(
+            max_results=page_size, continuation=continuation)
+        while True:
+            keys, continuation = yield page_d
+            if continuation is not None:
+                page_d = self.model.all_keys_page(
+                    max_results=page_size, continuation=continuation)
+            yield self.migrate_keys(keys)
+            self.write_checkpoint(continuation)
+            self.emit_progress()
+            if continuation is None:
+                break
 
 
 if __name__ == '__main__':
@@ -111,4 +203,14 @@ if __name__ == '__main__':
         sys.exit(1)
 
     cfg = ModelMigrator(options)
-    cfg.run()
+
+    def _eb(f):
+        f.printTraceback()
+
+    def _main():
+        d = maybeDeferred(cfg.run)
+        d.addErrback(_eb)
+        d.addBoth(lambda _: reactor.stop())
+
+    reactor.callLater(0, _main)
+    reactor.run()
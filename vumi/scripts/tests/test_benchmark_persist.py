@@ -0,0 +1,139 @@
+"""Tests for vumi.scripts.benchmark_persist."""
+
+import json
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.python import usage
+
+from vumi.tests.helpers import VumiTestCase, import_skip
+
+
+class TestPersistenceBenchmark(VumiTestCase):
+
+    def setUp(self):
+        try:
+            from vumi.scripts import benchmark_persist
+        except ImportError, e:
+            import_skip(e, 'riakasaurus', 'riakasaurus.riak')
+        self.bp = benchmark_persist
+
+    def make_bench(self, args=()):
+        options = self.bp.Options()
+        options.parseOptions(["-m", "10", "-c", "3"] + list(args))
+        bench = self.bp.PersistenceBenchmark(options)
+        bench.output = []
+        bench.emit = bench.output.append
+        bench.errors = []
+        bench.emit_error = bench.errors.append
+        return bench
+
+    def test_options_defaults(self):
+        options = self.bp.Options()
+        options.parseOptions([])
+        self.assertEqual(options['messages'], 1000)
+        self.assertEqual(options['concurrent-messages'], 100)
+        self.assertEqual(options['riak-config'], None)
+        self.assertEqual(options['redis-config'], None)
+        self.assertEqual(options['scenarios'], [])
+
+    def test_options_scenarios(self):
+        options = self.bp.Options()
+        options.parseOptions(["-s", "model_save", "-s", "model_load"])
+        self.assertEqual(options['scenarios'], ["model_save", "model_load"])
+
+    def test_options_unknown_scenario(self):
+        options = self.bp.Options()
+        self.assertRaises(
+            usage.UsageError, options.parseOptions, ["-s", "bogus"])
+
+    def test_options_json_config(self):
+        options = self.bp.Options()
+        options.parseOptions(["--redis-config", '{"db": 1}'])
+        self.assertEqual(options['redis-config'], {"db": 1})
+        options = self.bp.Options()
+        self.assertRaises(
+            usage.UsageError, options.parseOptions, ["--riak-config", "{"])
+
+    def test_options_refuse_prefix_config(self):
+        options = self.bp.Options()
+        self.assertRaises(
+            usage.UsageError, options.parseOptions,
+            ["--redis-config", '{"key_prefix": "app"}'])
+        options = self.bp.Options()
+        self.assertRaises(
+            usage.UsageError, options.parseOptions,
+            ["--riak-config", '{"bucket_prefix": "app."}'])
+
+    @inlineCallbacks
+    def test_setup_keeps_bench_prefix(self):
+        bench = self.make_bench(["--redis-config", '{"FAKE_REDIS": "yes"}'])
+        # Set after option parsing, as a caller building its own options
+        # might.
+        bench.redis_config['key_prefix'] = 'app'
+        yield bench.setup()
+        self.addCleanup(bench.teardown)
+        self.assertEqual(
+            bench.redis.get_key_prefix(), self.bp.REDIS_KEY_PREFIX)
+
+    @inlineCallbacks
+    def test_run_all_scenarios(self):
+        bench = self.make_bench()
+        results = yield bench.run()
+        self.assertEqual(
+            [name for name, _ in results],
+            [s.__name__ for s in self.bp.SCENARIOS])
+        results = dict(results)
+        # The in-memory Riak stand-in doesn't do MapReduce or paging.
+        self.assertEqual(results.pop('load_bunches_mapreduce'), None)
+        self.assertEqual(results.pop('index_keys_page'), None)
+        self.assertEqual(len(bench.errors), 2)
+        self.assertTrue(all(" skipped: " in e for e in bench.errors))
+        for name, result in results.items():
+            self.assertEqual(result['ops'], 10, name)
+            self.assertTrue(result['p99_ms'] >= result['p50_ms'], name)
+
+    @inlineCallbacks
+    def test_run_selected_scenarios(self):
+        bench = self.make_bench(["-s", "model_load", "-s", "session_manager"])
+        results = yield bench.run()
+        self.assertEqual(
+            [name for name, _ in results], ["model_load", "session_manager"])
+
+    @inlineCallbacks
+    def test_failed_scenario(self):
+        def broken_scenario(bench):
+            raise RuntimeError("Broken.")
+
+        self.patch(self.bp, 'SCENARIOS', [broken_scenario])
+        bench = self.make_bench()
+        results = yield bench.run()
+        self.assertEqual(results, [
+            ("broken_scenario", {'error': "RuntimeError('Broken.',)"})])
+        self.assertEqual(bench.errors, [
+            "Scenario broken_scenario failed: RuntimeError('Broken.',)"])
+        bench.print_results(results)
+        self.assertEqual(bench.output[1], "broken_scenario          FAILED")
+
+    @inlineCallbacks
+    def test_scenarios_start_empty(self):
+        bench = self.make_bench(["-s", "model_load"])
+        yield bench.run()
+        yield bench.setup()
+        self.assertEqual((yield bench.redis.keys()), [])
+        self.assertEqual((yield bench.riak.client.list_buckets()), [])
+        yield bench.teardown()
+
+    @inlineCallbacks
+    def test_results_output(self):
+        bench = self.make_bench(["-s", "model_save"])
+        results = yield bench.run()
+        bench.print_results(results + [("skipped_scenario", None)])
+        self.assertEqual(len(bench.output), 3)
+        self.assertTrue(bench.output[1].startswith("model_save"))
+        self.assertEqual(bench.output[2], "skipped_scenario         skipped")
+        data = json.loads(bench.results_json(results))
+        self.assertEqual(data['riak'], 'memory')
+        self.assertEqual(data['redis'], 'fake')
+        self.assertEqual(data['messages'], 10)
+        self.assertEqual(data['concurrency'], 3)
+        self.assertEqual(data['results'].keys(), ['model_save'])
@@ -1,5 +1,9 @@
 """Tests for vumi.scripts.model_migrator."""
 
+import os
+
+from twisted.internet.defer import inlineCallbacks, Deferred, succeed
+from twisted.internet.task import Clock
 from twisted.python import usage
 
 from vumi.persist.model import Model
@@ -16,6 +20,7 @@ class StubbedModelMigrator(ModelMigrator):
     def __init__(self, testcase, *args, **kwargs):
         self.testcase = testcase
         self.output = []
+        self.clock = Clock()
         super(StubbedModelMigrator, self).__init__(*args, **kwargs)
 
     def emit(self, s):
@@ -29,7 +34,7 @@ class TestModelMigrator(VumiTestCase):
 
     def setUp(self):
         self.persistence_helper = self.add_helper(
-            PersistenceHelper(use_riak=True, is_sync=True))
+            PersistenceHelper(use_riak=True, is_sync=False))
         self.riak_manager = self.persistence_helper.get_riak_manager()
         self.model = self.riak_manager.proxy(SimpleModel)
         self.model_cls_path = ".".join([
@@ -52,10 +57,11 @@ class TestModelMigrator(VumiTestCase):
                          self.expected_bucket_prefix)
         return self.riak_manager
 
+    @inlineCallbacks
     def mk_simple_models(self, n):
         for i in range(n):
             obj = self.model(u"key-%d" % i, a=u"value-%d" % i)
-            obj.save()
+            yield obj.save()
 
     def record_load_and_store(self):
         loads, stores = [], []
@@ -69,6 +75,7 @@ class TestModelMigrator(VumiTestCase):
 
         def record_store(obj):
             stores.append(obj.key)
+            return succeed(obj)
 
         self.patch(self.riak_manager, 'store', record_store)
         return loads, stores
@@ -83,42 +90,55 @@ class TestModelMigrator(VumiTestCase):
             "-m", self.model_cls_path,
         ])
 
+    def test_concurrency_must_be_positive(self):
+        self.assertRaises(
+            usage.UsageError, self.make_migrator,
+            self.default_args + ["--concurrency", "0"])
+
+    def test_rate_limit_must_be_positive(self):
+        self.assertRaises(
+            usage.UsageError, self.make_migrator,
+            self.default_args + ["--rate-limit", "0"])
+
+    @inlineCallbacks
     def test_successful_migration(self):
-        self.mk_simple_models(3)
+        yield self.mk_simple_models(3)
         loads, stores = self.record_load_and_store()
         cfg = self.make_migrator()
-        cfg.run()
+        yield cfg.run()
         self.assertEqual(cfg.output, [
-            "3 keys found. Migrating ...",
-            "33% complete.", "66% complete.",
+            "Migrating keys in pages of 1000 ...",
+            "3 keys processed (0.0 objects/s).",
             "Done.",
         ])
         self.assertEqual(sorted(loads), [u"key-%d" % i for i in range(3)])
         self.assertEqual(sorted(stores), [u"key-%d" % i for i in range(3)])
 
+    @inlineCallbacks
     def test_migration_with_tombstones(self):
-        self.mk_simple_models(3)
+        yield self.mk_simple_models(3)
 
         def tombstone_load(modelcls, key, result=None):
-            return None
+            return succeed(None)
 
         self.patch(self.riak_manager, 'load', tombstone_load)
 
         cfg = self.make_migrator()
-        cfg.run()
+        yield cfg.run()
         for i in range(3):
             self.assertTrue(("Skipping tombstone key u'key-%d'." % i)
                             in cfg.output)
         self.assertEqual(cfg.output[:1], [
-            "3 keys found. Migrating ...",
+            "Migrating keys in pages of 1000 ...",
         ])
         self.assertEqual(cfg.output[-2:], [
-            "66% complete.",
+            "3 keys processed (0.0 objects/s).",
             "Done.",
         ])
 
+    @inlineCallbacks
     def test_migration_with_failures(self):
-        self.mk_simple_models(3)
+        yield self.mk_simple_models(3)
 
         def error_load(modelcls, key, result=None):
             raise ValueError("Failed to load.")
@@ -126,43 +146,140 @@ class TestModelMigrator(VumiTestCase):
         self.patch(self.riak_manager, 'load', error_load)
 
         cfg = self.make_migrator()
-        cfg.run()
+        yield cfg.run()
         line_pairs = zip(cfg.output, cfg.output[1:])
         for i in range(3):
             self.assertTrue((
-                "Failed to migrate key u'key-0':",
+                "Failed to migrate key u'key-%d':" % i,
                 "  ValueError: Failed to load.",
             ) in line_pairs)
         self.assertEqual(cfg.output[:1], [
-            "3 keys found. Migrating ...",
+            "Migrating keys in pages of 1000 ...",
         ])
         self.assertEqual(cfg.output[-2:], [
-            "66% complete.",
+            "3 keys processed (0.0 objects/s).",
             "Done.",
         ])
 
+    @inlineCallbacks
     def test_migrating_specific_keys(self):
-        self.mk_simple_models(3)
+        yield self.mk_simple_models(3)
         loads, stores = self.record_load_and_store()
         cfg = self.make_migrator(self.default_args + ["--keys", "key-1,key-2"])
-        cfg.run()
+        yield cfg.run()
         self.assertEqual(cfg.output, [
             "Migrating 2 specified keys ...",
-            "50% complete.",
+            "2 keys processed (0.0 objects/s).",
             "Done.",
         ])
         self.assertEqual(sorted(loads), [u"key-1", u"key-2"])
         self.assertEqual(sorted(stores), [u"key-1", u"key-2"])
 
+    @inlineCallbacks
+    def test_migration_in_pages(self):
+        yield self.mk_simple_models(3)
+        loads, stores = self.record_load_and_store()
+        cfg = self.make_migrator(
+            self.default_args + ["--index-page-size", "2"])
+        yield cfg.run()
+        self.assertEqual(cfg.output, [
+            "Migrating keys in pages of 2 ...",
+            "2 keys processed (0.0 objects/s).",
+            "3 keys processed (0.0 objects/s).",
+            "Done.",
+        ])
+        self.assertEqual(sorted(loads), [u"key-%d" % i for i in range(3)])
+        self.assertEqual(sorted(stores), [u"key-%d" % i for i in range(3)])
+
+    @inlineCallbacks
     def test_dry_run(self):
-        self.mk_simple_models(3)
+        yield self.mk_simple_models(3)
         loads, stores = self.record_load_and_store()
         cfg = self.make_migrator(self.default_args + ["--dry-run"])
-        cfg.run()
+        yield cfg.run()
         self.assertEqual(cfg.output, [
-            "3 keys found. Migrating ...",
-            "33% complete.", "66% complete.",
+            "Migrating keys in pages of 1000 ...",
+            "3 keys processed (0.0 objects/s).",
             "Done.",
         ])
         self.assertEqual(sorted(loads), [u"key-%d" % i for i in range(3)])
         self.assertEqual(sorted(stores), [])
+
+    def test_concurrency(self):
+        pending = []
+
+        def pending_load(modelcls, key, result=None):
+            d = Deferred()
+            pending.append((key, d))
+            return d
+
+        self.patch(self.riak_manager, 'load', pending_load)
+        cfg = self.make_migrator(self.default_args + [
+            "--keys", "key-0,key-1,key-2,key-3", "--concurrency", "2"])
+        d = cfg.run()
+        self.assertEqual([k for k, _ in pending], [u"key-0", u"key-1"])
+        pending[0][1].callback(None)
+        self.assertEqual(
+            [k for k, _ in pending], [u"key-0", u"key-1", u"key-2"])
+        for _, load_d in pending[1:]:
+            load_d.callback(None)
+        pending[3][1].callback(None)
+        self.assertEqual(len(pending), 4)
+        self.assertTrue(d.called)
+        self.assertEqual(cfg.processed, 4)
+
+    def test_rate_limit(self):
+        cfg = self.make_migrator(self.default_args + ["--rate-limit", "2"])
+        slots = [cfg.wait_for_slot() for _ in range(3)]
+        self.assertEqual([d.called for d in slots], [False, False, False])
+        cfg.clock.advance(0)
+        self.assertEqual([d.called for d in slots], [True, False, False])
+        cfg.clock.advance(0.5)
+        self.assertEqual([d.called for d in slots], [True, True, False])
+        cfg.clock.advance(0.5)
+        self.assertEqual([d.called for d in slots], [True, True, True])
+
+    def test_no_rate_limit(self):
+        cfg = self.make_migrator()
+        self.assertTrue(cfg.wait_for_slot().called)
+
+    @inlineCallbacks
+    def test_checkpoint_removed_on_completion(self):
+        yield self.mk_simple_models(3)
+        checkpoint_file = self.mktemp()
+        cfg = self.make_migrator(self.default_args + [
+            "--index-page-size", "2", "--checkpoint-file", checkpoint_file])
+        written = []
+        orig_write_checkpoint = cfg.write_checkpoint
+
+        def record_write_checkpoint(continuation):
+            orig_write_checkpoint(continuation)
+            written.append(os.path.exists(checkpoint_file))
+
+        cfg.write_checkpoint = record_write_checkpoint
+        yield cfg.run()
+        self.assertEqual(written, [True, False])
+
+    @inlineCallbacks
+    def test_resume_from_checkpoint(self):
+        yield self.mk_simple_models(3)
+        first_page, continuation = yield self.model.all_keys_page(
+            max_results=2)
+        checkpoint_file = self.mktemp()
+        with open(checkpoint_file, "w") as f:
+            f.write(continuation)
+        loads, stores = self.record_load_and_store()
+        cfg = self.make_migrator(self.default_args + [
+            "--index-page-size", "2", "--checkpoint-file", checkpoint_file])
+        yield cfg.run()
+        self.assertEqual(cfg.output, [
+            "Resuming from checkpoint ...",
+            "Migrating keys in pages of 2 ...",
+            "1 keys processed (0.0 objects/s).",
+            "Done.",
+        ])
+        remaining = sorted(
+            set(u"key-%d" % i for i in range(3)) - set(first_page))
+        self.assertEqual(sorted(loads), remaining)
+        self.assertEqual(sorted(stores), remaining)
+        self.assertFalse(os.path.exists(checkpoint_file))
@@ -2,11 +2,15 @@
 
 import json
 from copy import deepcopy
+from collections import deque
 
 from twisted.python import log
+from twisted.python.failure import Failure
 from twisted.application.service import MultiService
 from twisted.application.internet import TCPClient
-from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, maybeDeferred, gatherResults,
+    FirstError, DeferredSemaphore, DeferredQueue)
 from twisted.internet import protocol, reactor
 import txamqp
 from txamqp.client import TwistedDelegate
@@ -14,7 +18,8 @@ from txamqp.content import Content
 from txamqp.protocol import AMQClient
 
 from vumi.errors import VumiError
-from vumi.message import Message
+from vumi.message import (
+    Message, get_message_codec, get_message_codec_for_content_type)
 from vumi.utils import load_class_by_string, vumi_resource_path, build_web_site
 
 
@@ -36,12 +41,13 @@ def get_spec(specfile):
 
 class AmqpFactory(protocol.ReconnectingClientFactory):
 
-    def __init__(self, worker):
+    def __init__(self, worker, connection_index=0):
         self.options = worker.options
         self.config = worker.config
         self.spec = get_spec(vumi_resource_path(worker.options['specfile']))
         self.delegate = TwistedDelegate()
         self.worker = worker
+        self.connection_index = connection_index
         self.amqp_client = None
 
     def buildProtocol(self, addr):
@@ -50,13 +56,20 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
             self.spec, self.options.get('heartbeat', 0))
         self.amqp_client.factory = self
         self.amqp_client.vumi_options = self.options
-        self.amqp_client.connected_callback = self.worker._amqp_connected
+        self.amqp_client.connected_callback = self._amqp_connected
         self.resetDelay()
         return self.amqp_client
 
+    def _amqp_connected(self, amqp_client):
+        if self.connection_index == 0:
+            return self.worker._amqp_connected(amqp_client)
+        return self.worker._amqp_connected(
+            amqp_client, connection_index=self.connection_index)
+
     def clientConnectionFailed(self, connector, reason):
         log.err("Connection failed: %r" % (reason,))
         self.worker._amqp_connection_failed()
+        self.worker._amqp_connection_dropped(self.connection_index)
         self.amqp_client = None
         protocol.ReconnectingClientFactory.clientConnectionFailed(
             self, connector, reason)
@@ -67,6 +80,7 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
             return
         log.err("Client connection lost: %r" % (reason,))
         self.worker._amqp_connection_failed()
+        self.worker._amqp_connection_dropped(self.connection_index)
         self.amqp_client = None
         protocol.ReconnectingClientFactory.clientConnectionLost(
             self, connector, reason)
@@ -155,8 +169,19 @@ class Worker(MultiService, object):
     """
     The Worker is responsible for starting consumers & publishers
     as needed.
+
+    If the ``amqp_connections`` config option is greater than 1, the worker
+    opens that many AMQP connections and only starts once they're all up.
+    Consumers and publishers are started on the first connection unless an
+    ``amqp_connection`` index is given, so busy publishers and consumers
+    can be kept on separate sockets.
     """
 
+    # If set, consumers and publishers started by this worker use this
+    # LocalMessageBus to skip AMQP for messages between workers in the same
+    # process.
+    local_bus = None
+
     def __init__(self, options, config=None):
         super(Worker, self).__init__()
         self.options = options
@@ -164,11 +189,62 @@ class Worker(MultiService, object):
             config = {}
         self.config = config
         self._amqp_client = None
-
-    def _amqp_connected(self, amqp_client):
-        self._amqp_client = amqp_client
+        # Connection index -> client, for all connections in the pool.
+        self._amqp_clients = {}
+        # Set once every connection in the pool is up, cleared when any
+        # of them drops.
+        self._amqp_pool_complete = False
+
+    @property
+    def amqp_connection_count(self):
+        """The number of AMQP connections this worker should open."""
+        return max(1, int(self.config.get('amqp_connections', 1)))
+
+    def _amqp_connected(self, amqp_client, connection_index=0):
+        self._amqp_clients[connection_index] = amqp_client
+        if connection_index == 0:
+            self._amqp_client = amqp_client
+        if len(self._amqp_clients) < self.amqp_connection_count:
+            log.msg("Waiting for %s more AMQP connection(s)." % (
+                self.amqp_connection_count - len(self._amqp_clients),))
+            return
+        if self._amqp_pool_complete:
+            return
+        self._amqp_pool_complete = True
         return self.startWorker()
 
+    def _amqp_connection_dropped(self, connection_index=0):
+        """Forget the client for a connection that has gone away.
+
+        Connectors are spread across every connection in the pool, so we
+        can't restart just the ones on the lost connection. Instead, we
+        close the rest of the pool and start the worker again once all
+        the connections are back.
+        """
+        self._amqp_clients.pop(connection_index, None)
+        if not self._amqp_pool_complete:
+            return
+        self._amqp_pool_complete = False
+        if not self._amqp_clients:
+            return
+        log.msg("Closing %s remaining AMQP connection(s) to restart the"
+                " pool." % (len(self._amqp_clients),))
+        for index in sorted(self._amqp_clients):
+            client = self._amqp_clients.pop(index)
+            client.transport.loseConnection()
+
+    def get_amqp_client(self, amqp_connection=None):
+        """Return the AMQP client for the given connection index.
+
+        Indexes wrap around the size of the pool. If there is no such
+        connection (which is the case in most tests), the first connection
+        is used.
+        """
+        if amqp_connection is None:
+            return self._amqp_client
+        index = amqp_connection % self.amqp_connection_count
+        return self._amqp_clients.get(index, self._amqp_client)
+
     def _amqp_connection_failed(self):
         pass
 
@@ -195,7 +271,8 @@ class Worker(MultiService, object):
 
     def consume(self, routing_key, callback, queue_name=None,
                 exchange_name='vumi', exchange_type='direct', durable=True,
-                message_class=None, paused=False, prefetch_count=None):
+                message_class=None, paused=False, prefetch_count=None,
+                message_codec=None, concurrency=1, amqp_connection=None):
 
         # use the routing key to generate the name for the class
         # amq.routing.key -> AmqRoutingKey
@@ -209,19 +286,28 @@ class Worker(MultiService, object):
             'durable': durable,
             'start_paused': paused,
             'prefetch_count': prefetch_count,
+            'message_codec': message_codec,
+            'concurrency': concurrency,
         }
         log.msg('Starting %s with %s' % (class_name, kwargs))
         klass = type(class_name, (DynamicConsumer,), kwargs)
         if message_class is not None:
             klass.message_class = message_class
-        return self.start_consumer(klass, callback)
+        return self.start_consumer(
+            klass, callback, amqp_connection=amqp_connection)
 
     def start_consumer(self, consumer_class, *args, **kw):
-        return self._amqp_client.start_consumer(consumer_class, *args, **kw)
+        client = self.get_amqp_client(kw.pop('amqp_connection', None))
+        d = client.start_consumer(consumer_class, *args, **kw)
+        if self.local_bus is not None:
+            d.addCallback(self.local_bus.register_consumer)
+        return d
 
     def publish_to(self, routing_key,
                    exchange_name='vumi', exchange_type='direct', durable=True,
-                   delivery_mode=2):
+                   delivery_mode=2, message_codec=None, batch_publishes=False,
+                   confirm_publishes=False, max_unconfirmed=None,
+                   amqp_connection=None):
         class_name = self.routing_key_to_class_name(routing_key)
         publisher_class = type("%sDynamicPublisher" % class_name, (Publisher,),
             {
@@ -230,11 +316,24 @@ class Worker(MultiService, object):
                 "exchange_type": exchange_type,
                 "durable": durable,
                 "delivery_mode": delivery_mode,
+                "message_codec": message_codec,
+                "batch_publishes": batch_publishes,
+                "confirm_publishes": confirm_publishes,
+                "max_unconfirmed": max_unconfirmed,
             })
-        return self.start_publisher(publisher_class)
+        return self.start_publisher(
+            publisher_class, amqp_connection=amqp_connection)
 
     def start_publisher(self, publisher_class, *args, **kw):
-        return self._amqp_client.start_publisher(publisher_class, *args, **kw)
+        client = self.get_amqp_client(kw.pop('amqp_connection', None))
+        d = client.start_publisher(publisher_class, *args, **kw)
+        if self.local_bus is not None:
+            d.addCallback(self._set_local_bus)
+        return d
+
+    def _set_local_bus(self, publisher):
+        publisher.local_bus = self.local_bus
+        return publisher
 
     def start_web_resources(self, resources, port, site_class=None):
         resources = dict((path, resource) for resource, path in resources)
@@ -256,8 +355,22 @@ class Consumer(object):
     routing_key = "routing_key"
 
     message_class = Message
+    # Messages that arrive without a content type (or with the content type
+    # this codec handles) are decoded with this codec. Anything else is
+    # decoded by whichever codec is registered for its content type.
+    message_codec = None
     start_paused = False
     prefetch_count = None
+    # The maximum number of messages handled at once. While this many
+    # handlers are running, no more messages are taken from the channel.
+    # `None` means no limit.
+    concurrency = 1
+    # The maximum number of local messages (see :class:`LocalMessageBus`)
+    # accepted but not yet handled. `None` means `prefetch_count`, or
+    # `concurrency` if there's no prefetch limit.
+    local_capacity = None
+
+    clock = reactor
 
     def __init__(self, channel):
         self.channel = channel
@@ -265,14 +378,25 @@ class Consumer(object):
         self.keep_consuming = False
         self._testing = hasattr(self.channel, 'message_processed')
         self.queue = None
+        self._local_queue = None
+        self._local_unhandled = set()
+        self._local_waiting = set()
         self._consumer_tag = None
+        self._in_progress = 0
+        self._slots = None
+        if self.concurrency is not None:
+            self._slots = DeferredSemaphore(self.concurrency)
+        # These are read by things like the adaptive prefetch controller and
+        # consumer metrics.
+        self.peak_in_progress = 0
+        self.processed_count = 0
+        self.processing_time = 0.0
 
     @inlineCallbacks
     def start(self):
-        self._in_progress = 0
         self.keep_consuming = True
         self.paused = self.start_paused
-        self._unpause_d = None
+        self._unpause_d = Deferred() if self.paused else None
         if self.prefetch_count is not None:
             yield self.channel.basic_qos(0, self.prefetch_count, False)
         if not self.paused:
@@ -286,12 +410,83 @@ class Consumer(object):
                 message = yield self.queue.get()
                 if isinstance(message, QueueCloseMarker):
                     break
-                if self.paused:
-                    yield self._unpause_d
-                yield self.consume(message)
+                yield self._start_consuming(self.consume, message)
         except txamqp.queue.Closed as e:
             log.err("Queue has closed", e)
 
+    @inlineCallbacks
+    def _read_local_messages(self):
+        while self.keep_consuming:
+            item = yield self._local_queue.get()
+            if isinstance(item, QueueCloseMarker):
+                break
+            yield self._start_consuming(self.consume_local, item)
+
+    @inlineCallbacks
+    def _start_consuming(self, consume, message):
+        """
+        Wait until we're allowed to handle another message and start handling
+        this one. We don't wait for the handler to finish.
+        """
+        if self._slots is not None:
+            yield self._slots.acquire()
+        if self.paused:
+            yield self._unpause_d
+        d = consume(message)
+        d.addErrback(log.err, "Error consuming message")
+        if self._slots is not None:
+            d.addBoth(lambda _: self._slots.release())
+
+    def get_local_capacity(self):
+        if self.local_capacity is not None:
+            return self.local_capacity
+        if self.prefetch_count is not None:
+            return self.prefetch_count
+        return self.concurrency
+
+    def accepts_local(self):
+        """True if :meth:`deliver_local` may be called.
+
+        We don't take local messages while we're stopped or paused, or while
+        we already have as many unhandled local messages as we're allowed.
+        """
+        if not self.keep_consuming or self.paused:
+            return False
+        capacity = self.get_local_capacity()
+        return capacity is None or len(self._local_unhandled) < capacity
+
+    def deliver_local(self, message):
+        """Hand a message to this consumer without going through AMQP.
+
+        The message is copied (or converted to our message class if it isn't
+        already an instance of it) and handled like any other message,
+        subject to pausing and the concurrency limit.
+
+        Returns a deferred that fires once the message has been handled. It
+        fails with :class:`LocalDeliveryFailed` if the handler fails or
+        returns `False` (where an AMQP message wouldn't be acked) or if we're
+        stopped before handling it. The message should then be sent through
+        AMQP instead.
+        """
+        if isinstance(message, self.message_class):
+            message = message.copy()
+        else:
+            message = self.message_class.from_json(message.to_json())
+        if self._local_queue is None:
+            self._local_queue = DeferredQueue()
+            self._read_local_messages()
+        d = Deferred()
+        self._local_unhandled.add(d)
+        self._local_waiting.add(d)
+        d.addBoth(self._local_handled, d)
+        self._local_queue.put((message, d))
+        return d
+
+    def _local_handled(self, result, d):
+        self._local_unhandled.discard(d)
+        self._local_waiting.discard(d)
+        return result
+
     @inlineCallbacks
     def _channel_consume(self):
         if self._consumer_tag is not None:
@@ -328,20 +523,88 @@ class Consumer(object):
             while self._notify_paused_and_quiet:
                 self._notify_paused_and_quiet.pop(0).callback(None)
 
+    @property
+    def in_progress(self):
+        """The number of messages currently being handled."""
+        return self._in_progress
+
+    @property
+    def saturated(self):
+        """True if we're handling as many messages as we're allowed to."""
+        return (self.concurrency is not None and
+                self._in_progress >= self.concurrency)
+
+    def reset_peak_in_progress(self):
+        """Return the peak number of messages handled at once and reset it."""
+        peak, self.peak_in_progress = self.peak_in_progress, self._in_progress
+        return peak
+
+    def set_channel_prefetch_count(self, prefetch_count):
+        """Change the prefetch limit for this consumer's channel.
+
+        Unlike :attr:`prefetch_count`, which applies to the consumer when it
+        is registered, this takes effect immediately. Each consumer has its
+        own channel, so the limit only affects this consumer.
+        """
+        return self.channel.basic_qos(0, prefetch_count, True)
+
     @inlineCallbacks
-    def consume(self, message):
+    def _handle_message(self, message):
         self._in_progress += 1
-        result = yield self.consume_message(self.message_class.from_json(
-                                            message.content.body))
-        self._in_progress -= 1
-        if self._testing:
-            self.channel.message_processed()
-        if result is not False:
-            yield self.channel.basic_ack(message.delivery_tag, False)
+        self.peak_in_progress = max(self.peak_in_progress, self._in_progress)
+        started = self.clock.seconds()
+        try:
+            result = yield self.consume_message(message)
+        finally:
+            self._in_progress -= 1
+            self.processed_count += 1
+            self.processing_time += self.clock.seconds() - started
+        returnValue(result)
+
+    @inlineCallbacks
+    def consume(self, message):
+        try:
+            try:
+                result = yield self._handle_message(
+                    self.decode_message(message.content))
+            finally:
+                if self._testing:
+                    self.channel.message_processed()
+            if result is not False:
+                yield self.channel.basic_ack(message.delivery_tag, False)
+            else:
+                log.msg('Received %s as a return value consume_message. '
+                        'Not acknowledging AMQ message' % result)
+        finally:
+            self._check_notify()
+
+    @inlineCallbacks
+    def consume_local(self, item):
+        message, d = item
+        if d.called:
+            # We were stopped while this message was waiting.
+            return
+        self._local_waiting.discard(d)
+        try:
+            result = yield self._handle_message(message)
+        except Exception:
+            log.err(None, "Error consuming local message")
+            d.errback(LocalDeliveryFailed("Error consuming local message."))
         else:
-            log.msg('Received %s as a return value consume_message. '
-                    'Not acknowledging AMQ message' % result)
-        self._check_notify()
+            if result is not False:
+                d.callback(None)
+            else:
+                log.msg('Received %s as a return value consume_message for'
+                        ' a local message. Not acknowledging it.' % result)
+                d.errback(LocalDeliveryFailed("Local message not acked."))
+        finally:
+            self._check_notify()
+
+    def decode_message(self, content):
+        properties = getattr(content, 'properties', None) or {}
+        codec = get_message_codec_for_content_type(
+            properties.get('content type'), default=self.message_codec)
+        return self.message_class.decode(content.body, codec)
 
     def consume_message(self, message):
         """helper method, override in implementation"""
@@ -351,6 +614,10 @@ class Consumer(object):
     def stop(self):
         log.msg("Consumer stopping...")
         self.keep_consuming = False
+        for d in list(self._local_waiting):
+            d.errback(LocalDeliveryFailed("Consumer stopped."))
+        if self._local_queue is not None:
+            self._local_queue.put(QueueCloseMarker())
         yield self.pause()
         # This actually closes the channel on the server
         yield self.channel.channel_close()
@@ -368,6 +635,10 @@ class DynamicConsumer(Consumer):
         return self.callback(message)
 
 
+class LocalDeliveryFailed(VumiError):
+    """A local message wasn't handled and should be sent through AMQP."""
+
+
 class RoutingKeyError(Exception):
     def __init__(self, value):
         self.value = value
@@ -383,16 +654,42 @@ class Publisher(object):
     durable = False
     auto_delete = False
     delivery_mode = 2  # save to disk
+    message_codec = None
+
+    # If `batch_publishes` is set, messages are queued and sent together once
+    # per reactor tick instead of one at a time. Each message's deferred
+    # fires (or fails) when that message has been written to the channel.
+    batch_publishes = False
+    # If `confirm_publishes` is set, messages are batched and each batch is
+    # sent in an AMQP transaction. The deferred returned by `publish` only
+    # fires once the broker has committed the transaction containing the
+    # message, and fails if the commit fails.
+    confirm_publishes = False
+    # The maximum number of messages sent to the broker but not yet
+    # confirmed. Further messages are held back (and their deferreds don't
+    # fire) until earlier ones are confirmed. Without `confirm_publishes` this
+    # is the most messages that are queued before they're sent without
+    # waiting for the next tick. `None` means no limit.
+    max_unconfirmed = None
+    # Set by the worker if it is sharing a LocalMessageBus with other
+    # workers. See :class:`LocalMessageBus`.
+    local_bus = None
 
     def start(self, channel):
         log.msg("Started the publisher")
         self.channel = channel
         self.bound_routing_keys = {}
+        self._pending = deque()
+        self._unconfirmed = 0
+        self._flush_call = None
 
         # There's probably a better way to do this.
         if not hasattr(self, 'vumi_options'):
             self.vumi_options = {}
 
+        if self.confirm_publishes:
+            return maybeDeferred(self.channel.tx_select)
+
     def check_routing_key(self, routing_key):
         if(routing_key != routing_key.lower()):
             raise RoutingKeyError("The routing_key: %s is not all lower case!"
@@ -403,12 +700,105 @@ class Publisher(object):
         exchange_name = kwargs.get('exchange_name') or self.exchange_name
         routing_key = kwargs.get('routing_key') or self.routing_key
         self.check_routing_key(routing_key)
-        yield self.channel.basic_publish(exchange=exchange_name,
-                                         content=message,
-                                         routing_key=routing_key)
+        if self.batch_publishes or self.confirm_publishes:
+            d = Deferred()
+            self._pending.append((exchange_name, routing_key, message, d))
+            if (not self.confirm_publishes and
+                    self.max_unconfirmed is not None and
+                    len(self._pending) >= self.max_unconfirmed):
+                self._flush()
+            else:
+                self._schedule_flush()
+            yield d
+        else:
+            yield self.channel.basic_publish(exchange=exchange_name,
+                                             content=message,
+                                             routing_key=routing_key)
+
+    @property
+    def pending_count(self):
+        """The number of messages waiting to be sent to the broker."""
+        return len(self._pending)
+
+    @property
+    def unconfirmed_count(self):
+        """The number of messages sent but not yet confirmed."""
+        return self._unconfirmed
+
+    def _schedule_flush(self):
+        if self._flush_call is None:
+            self._flush_call = reactor.callLater(0, self._flush)
+
+    def _flush(self):
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        if not self.confirm_publishes:
+            # Nothing waits for confirmation, so send everything and let each
+            # message succeed or fail on its own.
+            batch, self._pending = self._pending, deque()
+            for exchange, routing_key, content, d in batch:
+                maybeDeferred(
+                    self.channel.basic_publish, exchange=exchange,
+                    content=content, routing_key=routing_key,
+                ).chainDeferred(d)
+            return
+        if self._unconfirmed:
+            # There's a commit in flight. We'll flush again when it's done.
+            return
+        batch = []
+        while self._pending and (self.max_unconfirmed is None or
+                                 len(batch) < self.max_unconfirmed):
+            batch.append(self._pending.popleft())
+        if not batch:
+            return
+
+        self._unconfirmed = len(batch)
+        ds = [maybeDeferred(self.channel.basic_publish, exchange=exchange,
+                            content=content, routing_key=routing_key)
+              for exchange, routing_key, content, _ in batch]
+        d = gatherResults(ds, consumeErrors=True)
+        d.addCallback(lambda _: self.channel.tx_commit())
+        d.addBoth(self._batch_done, batch)
+
+    def _batch_done(self, result, batch):
+        # The whole transaction fails or succeeds together.
+        self._unconfirmed = 0
+        if isinstance(result, Failure) and result.check(FirstError):
+            result = result.value.subFailure
+        for _, _, _, d in batch:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(None)
+        if self._pending:
+            self._schedule_flush()
+
+    def _get_local_consumer(self, kwargs):
+        if self.local_bus is None or self.exchange_type != 'direct':
+            return None
+        return self.local_bus.get_consumer(
+            kwargs.get('exchange_name') or self.exchange_name,
+            kwargs.get('routing_key') or self.routing_key)
 
     def publish_message(self, message, **kwargs):
-        d = self.publish_raw(message.to_json(), **kwargs)
+        consumer = self._get_local_consumer(kwargs)
+        if consumer is not None:
+            d = consumer.deliver_local(message)
+            d.addCallback(lambda _: message)
+            d.addErrback(self._local_delivery_failed, message, kwargs)
+            return d
+        return self._publish_message_amqp(message, **kwargs)
+
+    def _local_delivery_failed(self, failure, message, kwargs):
+        failure.trap(LocalDeliveryFailed)
+        return self._publish_message_amqp(message, **kwargs)
+
+    def _publish_message_amqp(self, message, **kwargs):
+        codec = get_message_codec(self.message_codec)
+        if codec.content_type is not None:
+            kwargs.setdefault('content_type', codec.content_type)
+        d = self.publish_raw(message.encode(codec), **kwargs)
         d.addCallback(lambda r: message)
         return d
 
@@ -420,9 +810,59 @@ class Publisher(object):
         amq_message = Content(data)
         amq_message['delivery mode'] = kwargs.pop('delivery_mode',
                 self.delivery_mode)
+        content_type = kwargs.pop('content_type', None)
+        if content_type is not None:
+            amq_message['content type'] = content_type
         return self.publish(amq_message, **kwargs)
 
 
+class LocalMessageBus(object):
+    """Routes messages between workers in the same process.
+
+    Consumers started by workers sharing a bus register themselves here.
+    When a publisher on a direct exchange publishes a message to a routing
+    key that has a running local consumer, the message is handed straight
+    to the consumer instead of being encoded and sent through the broker.
+    If there are several local consumers for a routing key they take turns.
+    Messages for routing keys without a local consumer go through AMQP as
+    usual, as do messages for consumers that are paused or already have as
+    many unhandled local messages as they accept.
+
+    Publishing a local message returns a deferred that fires once the
+    consumer has handled it, so publishers that wait for it are held back
+    by slow consumers. If the handler fails or doesn't ack the message, or
+    the consumer stops before handling it, the message is published
+    through AMQP instead so the broker can deliver it again. Messages that
+    are still unhandled when the process dies are lost.
+    """
+
+    def __init__(self):
+        # (exchange_name, routing_key) -> list of consumers
+        self._consumers = {}
+
+    def register_consumer(self, consumer):
+        if consumer.exchange_type == 'direct':
+            key = (consumer.exchange_name, consumer.routing_key)
+            self._consumers.setdefault(key, []).append(consumer)
+        return consumer
+
+    def get_consumer(self, exchange_name, routing_key):
+        """Return the next local consumer for a routing key, or `None`."""
+        key = (exchange_name, routing_key)
+        consumers = [c for c in self._consumers.get(key, [])
+                     if c.keep_consuming]
+        if not consumers:
+            self._consumers.pop(key, None)
+            return None
+        for i, consumer in enumerate(consumers):
+            if consumer.accepts_local():
+                consumers.append(consumers.pop(i))
+                self._consumers[key] = consumers
+                return consumer
+        self._consumers[key] = consumers
+        return None
+
+
 class WorkerCreator(object):
     """
     Creates workers
@@ -449,6 +889,8 @@ class WorkerCreator(object):
         return worker
 
     def _connect(self, worker, timeout, bindAddress):
-        service = TCPClient(self.options['hostname'], self.options['port'],
-                            AmqpFactory(worker), timeout, bindAddress)
-        service.setServiceParent(worker)
+        for index in range(worker.amqp_connection_count):
+            service = TCPClient(self.options['hostname'], self.options['port'],
+                                AmqpFactory(worker, connection_index=index),
+                                timeout, bindAddress)
+            service.setServiceParent(worker)
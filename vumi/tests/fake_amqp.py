@@ -9,7 +9,8 @@ from txamqp.client import TwistedDelegate
 from txamqp.content import Content
 
 from vumi.service import WorkerAMQClient
-from vumi.message import Message as VumiMessage
+from vumi.message import (
+    Message as VumiMessage, get_message_codec_for_content_type)
 
 
 def gen_id(prefix=''):
@@ -20,6 +21,15 @@ def gen_longlong():
     return uuid4().int & 0xffffffffffffffff
 
 
+def decode_content(message_class, content):
+    """
+    Decode an AMQP message body using the codec its content type names.
+    """
+    properties = getattr(content, 'properties', None) or {}
+    codec = get_message_codec_for_content_type(properties.get('content type'))
+    return message_class.decode(content.body, codec)
+
+
 class Thing(object):
     """
     A generic thing to reply with.
@@ -67,23 +77,23 @@ def mkContent(body, children=None, properties=None):
                  properties=properties)
 
 
-def mk_deliver(body, exchange, routing_key, ctag, dtag):
+def mk_deliver(body, exchange, routing_key, ctag, dtag, properties=None):
     return Message(mkMethod('deliver', 60), [
             ('consumer_tag', ctag),
             ('delivery_tag', dtag),
             ('redelivered', False),
             ('exchange', exchange),
             ('routing_key', routing_key),
-            ], mkContent(body))
+            ], mkContent(body, properties=properties))
 
 
-def mk_get_ok(body, exchange, routing_key, dtag):
+def mk_get_ok(body, exchange, routing_key, dtag, properties=None):
     return Message(mkMethod('get-ok', 71), [
             ('delivery_tag', dtag),
             ('redelivered', False),
             ('exchange', exchange),
             ('routing_key', routing_key),
-            ], mkContent(body))
+            ], mkContent(body, properties=properties))
 
 
 class FakeAMQPBroker(object):
@@ -185,7 +195,8 @@ class FakeAMQPBroker(object):
                 if dtag is None:
                     break
                 dmsg = mk_deliver(msg['content'], msg['exchange'],
-                                  msg['routing_key'], ctag, dtag)
+                                  msg['routing_key'], ctag, dtag,
+                                  msg['properties'])
                 self._delivering['count'] += 1
                 channel.deliver_message(dmsg, ctag)
                 delivered = True
@@ -259,7 +270,7 @@ class FakeAMQPBroker(object):
 
     def get_messages(self, exchange, rkey):
         contents = self.get_dispatched(exchange, rkey)
-        messages = [VumiMessage.from_json(content.body)
+        messages = [decode_content(VumiMessage, content)
                     for content in contents]
         return messages
 
@@ -281,15 +292,21 @@ class FakeAMQPBroker(object):
 
 
 class FakeAMQPChannel(object):
+    # Only tests that need channel-wide prefetch limits (such as those for
+    # adaptive prefetch) turn this on.
+    global_qos_supported = False
+
     def __init__(self, channel_id, client):
         self.channel_id = channel_id
         self.client = client
         self.broker = client.broker
         self.qos_prefetch_count = 0
+        self.qos_global_prefetch_count = 0
         self.consumers = {}
         self.delegate = client.delegate
         self.unacked = []
         self._consumer_prefetch = {}
+        self._tx_publishes = None
 
     def __repr__(self):
         return '<FakeAMQPChannel: id=%s>' % (self.channel_id,)
@@ -309,8 +326,15 @@ class FakeAMQPChannel(object):
 
     def basic_qos(self, _prefetch_size, prefetch_count, is_global):
         if is_global:
-            raise NotImplementedError("global prefetch limits not supported.")
-        self.qos_prefetch_count = prefetch_count
+            if not self.global_qos_supported:
+                raise NotImplementedError(
+                    "global prefetch limits not supported.")
+            # RabbitMQ (since 3.3.0) applies "global" limits to the whole
+            # channel immediately, rather than to consumers created later.
+            self.qos_global_prefetch_count = prefetch_count
+            self.broker.kick_delivery()
+        else:
+            self.qos_prefetch_count = prefetch_count
 
     def exchange_declare(self, exchange, type, durable=None):
         return self.broker.exchange_declare(exchange, type)
@@ -337,8 +361,28 @@ class FakeAMQPChannel(object):
         return Message(mkMethod("cancel-ok", 31))
 
     def basic_publish(self, exchange, routing_key, content):
+        if self._tx_publishes is not None:
+            self._tx_publishes.append((exchange, routing_key, content))
+            return None
         return self.broker.basic_publish(exchange, routing_key, content)
 
+    def tx_select(self):
+        if self._tx_publishes is None:
+            self._tx_publishes = []
+        return Message(mkMethod("select-ok", 11))
+
+    def tx_commit(self):
+        assert self._tx_publishes is not None, "tx_select() not called."
+        publishes, self._tx_publishes = self._tx_publishes, []
+        for exchange, routing_key, content in publishes:
+            self.broker.basic_publish(exchange, routing_key, content)
+        return Message(mkMethod("commit-ok", 21))
+
+    def tx_rollback(self):
+        assert self._tx_publishes is not None, "tx_select() not called."
+        self._tx_publishes = []
+        return Message(mkMethod("rollback-ok", 31))
+
     def basic_ack(self, delivery_tag, multiple):
         assert delivery_tag in [dtag for dtag, _ctag, _queue in self.unacked]
         for dtag, ctag, queue in self.unacked[:]:
@@ -356,10 +400,11 @@ class FakeAMQPChannel(object):
     def deliverable(self, consumer_tag):
         if consumer_tag not in self.consumers:
             return False
-        prefetch = self._get_consumer_prefetch(consumer_tag)
-        if prefetch < 1:
-            return True
-        return len(self.unacked) < prefetch
+        for prefetch in [self._get_consumer_prefetch(consumer_tag),
+                         self.qos_global_prefetch_count]:
+            if prefetch >= 1 and len(self.unacked) >= prefetch:
+                return False
+        return True
 
     def deliver_message(self, msg, consumer_tag):
         self.unacked.append(
@@ -371,7 +416,7 @@ class FakeAMQPChannel(object):
         if msg:
             self.unacked.append((dtag, None, queue))
             return mk_get_ok(msg['content'], msg['exchange'],
-                             msg['routing_key'], dtag)
+                             msg['routing_key'], dtag, msg['properties'])
         return Message(mkMethod("get-empty", 72))
 
     def message_processed(self):
@@ -457,6 +502,7 @@ class FakeAMQPQueue(object):
                 'exchange': exchange,
                 'routing_key': routing_key,
                 'content': content.body,
+                'properties': getattr(content, 'properties', None),
                 })
 
     def ack(self, delivery_tag):
@@ -15,7 +15,8 @@ from zope.interface import Interface, implements
 from vumi.message import TransportUserMessage, TransportEvent
 from vumi.service import get_spec
 from vumi.utils import vumi_resource_path, flatten_generator
-from vumi.tests.fake_amqp import FakeAMQPBroker, FakeAMQClient
+from vumi.tests.fake_amqp import (
+    FakeAMQPBroker, FakeAMQClient, decode_content)
 
 
 class _Default(object):
@@ -676,6 +677,10 @@ class WorkerHelper(object):
 
         worker = worker_class({}, config)
         worker._amqp_client = cls.get_fake_amqp_client(broker)
+        worker._amqp_clients[0] = worker._amqp_client
+        for index in range(1, worker.amqp_connection_count):
+            worker._amqp_clients[index] = cls.get_fake_amqp_client(
+                worker._amqp_client.broker)
         return worker
 
     @proxyable
@@ -724,7 +729,7 @@ class WorkerHelper(object):
         """
         msgs = self.broker.get_dispatched(
             'vumi', self._rkey(connector_name, name))
-        return [message_class.from_json(msg.body) for msg in msgs]
+        return [decode_content(message_class, msg) for msg in msgs]
 
     def _wait_for_dispatched(self, connector_name, name, amount):
         rkey = self._rkey(connector_name, name)
@@ -7,7 +7,7 @@ from zope.interface import Interface, implements
 
 from vumi.config import (
     ConfigClassName, ConfigServerEndpoint, ConfigClientEndpoint,
-    ServerEndpointFallback, ClientEndpointFallback)
+    ServerEndpointFallback, ClientEndpointFallback, ConfigCache)
 from vumi.tests.helpers import VumiTestCase
 
 
@@ -184,3 +184,41 @@ class ConfigFieldTest(VumiTestCase):
         self.assertRaises(ConfigError, MyConfig, {'myport': 'foo'})
         self.assertRaises(ConfigError, MyConfig, {'myhost': 'example.com'})
         self.assertRaises(ConfigError, MyConfig, {'myport': 80})
+
+
+class TestConfigCache(VumiTestCase):
+    def test_get(self):
+        cache = ConfigCache()
+        built = []
+
+        def build():
+            built.append(object())
+            return built[-1]
+
+        config = cache.get('foo', build)
+        self.assertEqual(built, [config])
+        self.assertIdentical(cache.get('foo', build), config)
+        self.assertEqual(len(built), 1)
+        self.assertNotIdentical(cache.get('bar', build), config)
+        self.assertEqual(len(built), 2)
+
+    def test_max_size(self):
+        cache = ConfigCache(max_size=2)
+        cache.get('a', object)
+        cache.get('b', object)
+        cache.get('a', object)
+        cache.get('c', object)
+        self.assertEqual(len(cache), 2)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+
+    def test_invalidate(self):
+        cache = ConfigCache()
+        cache.get('a', object)
+        cache.get('b', object)
+        cache.invalidate('a')
+        self.assertFalse('a' in cache)
+        self.assertTrue('b' in cache)
+        cache.invalidate(all_keys=True)
+        self.assertEqual(len(cache), 0)
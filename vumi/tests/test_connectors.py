@@ -1,8 +1,12 @@
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import Clock
 
 from vumi.connectors import (
     BaseConnector, ReceiveInboundConnector, ReceiveOutboundConnector,
-    IgnoreMessage)
+    IgnoreMessage, AdaptivePrefetchController)
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.config import ConfigError
+from vumi.tests.fake_amqp import FakeAMQPChannel
 from vumi.tests.utils import LogCatcher
 from vumi.worker import BaseWorker
 from vumi.message import TransportUserMessage
@@ -31,14 +35,15 @@ class BaseConnectorTestCase(VumiTestCase):
 
     @inlineCallbacks
     def mk_connector(self, worker=None, connector_name=None,
-                     prefetch_count=None, middlewares=None, setup=False):
+                     prefetch_count=None, middlewares=None, setup=False,
+                     **kw):
         if worker is None:
             worker = yield self.worker_helper.get_worker(DummyWorker, {})
         if connector_name is None:
             connector_name = "dummy_connector"
         connector = self.connector_class(worker, connector_name,
                                          prefetch_count=prefetch_count,
-                                         middlewares=middlewares)
+                                         middlewares=middlewares, **kw)
         if setup:
             yield connector.setup()
         returnValue(connector)
@@ -99,6 +104,67 @@ class TestBaseConnector(BaseConnectorTestCase):
         conn, consumer = yield self.mk_consumer(prefetch_count=10)
         self.assertEqual(consumer.channel.qos_prefetch_count, 10)
 
+    @inlineCallbacks
+    def test_adaptive_prefetch(self):
+        self.patch(FakeAMQPChannel, 'global_qos_supported', True)
+        conn, consumer = yield self.mk_consumer(
+            prefetch_count=10, adaptive_prefetch={'max_prefetch': 50})
+        self.assertEqual(consumer.channel.qos_prefetch_count, 0)
+        self.assertEqual(consumer.channel.qos_global_prefetch_count, 10)
+        controller = conn._prefetch_controllers['inbound']
+        self.assertEqual(controller.consumer, consumer)
+        self.assertEqual(controller.max_prefetch, 50)
+        self.assertEqual(controller.target_concurrency, 1)
+        yield conn.teardown()
+        self.assertEqual(controller._task, None)
+
+    @inlineCallbacks
+    def test_adaptive_prefetch_unknown_option(self):
+        err = yield self.assertFailure(
+            self.mk_connector(adaptive_prefetch={'max_prefech': 50}),
+            ConfigError)
+        self.assertTrue("max_prefech" in str(err))
+
+    @inlineCallbacks
+    def test_adaptive_prefetch_invalid_option(self):
+        yield self.assertFailure(
+            self.mk_connector(adaptive_prefetch={'max_prefetch': 'lots'}),
+            ConfigError)
+        yield self.assertFailure(
+            self.mk_connector(
+                adaptive_prefetch={'min_prefetch': 10, 'max_prefetch': 5}),
+            ConfigError)
+
+    @inlineCallbacks
+    def test_concurrency(self):
+        conn, consumer = yield self.mk_consumer(concurrency=5)
+        self.assertEqual(consumer.concurrency, 5)
+
+    @inlineCallbacks
+    def test_consumer_metrics(self):
+        mm = MetricManager('vumi.test.')
+        conn, consumer = yield self.mk_consumer(
+            connector_name='foo', metric_manager=mm)
+        in_flight = mm['foo.inbound.in_flight']
+        peak = mm['foo.inbound.in_flight_peak']
+        self.assertEqual(peak.aggs, ('max',))
+        consumer.peak_in_progress = 3
+        self.assertEqual([v for _, v in in_flight.poll()], [0])
+        self.assertEqual([v for _, v in peak.poll()], [3])
+        self.assertEqual([v for _, v in peak.poll()], [0])
+
+    @inlineCallbacks
+    def test_consumer_metrics_new_connector(self):
+        mm = MetricManager('vumi.test.')
+        conn, consumer = yield self.mk_consumer(
+            connector_name='foo', metric_manager=mm)
+        yield conn.teardown()
+        conn, consumer = yield self.mk_consumer(
+            connector_name='foo', metric_manager=mm)
+        consumer.peak_in_progress = 3
+        self.assertEqual(
+            [v for _, v in mm['foo.inbound.in_flight_peak'].poll()], [3])
+
     @inlineCallbacks
     def test_setup_raises(self):
         conn = yield self.mk_connector()
@@ -384,3 +450,116 @@ class TestReceiveOutboundConnector(BaseConnectorTestCase):
                 "Ignoring msg (with NACK) due to IgnoreMessage(): <Message"))
         [event] = self.worker_helper.get_dispatched_events('foo')
         self.assertEqual(event['event_type'], 'nack')
+
+
+class FakeConsumer(object):
+    queue_name = 'fake'
+
+    def __init__(self):
+        self.processed_count = 0
+        self.processing_time = 0.0
+        self.in_progress = 0
+        self.prefetch_counts = []
+
+    def handle(self, count, latency):
+        self.processed_count += count
+        self.processing_time += count * latency
+
+    def set_channel_prefetch_count(self, prefetch_count):
+        self.prefetch_counts.append(prefetch_count)
+
+
+class TestAdaptivePrefetchController(VumiTestCase):
+    def mk_controller(self, concurrency=1, **kw):
+        self.clock = Clock()
+        self.consumer = FakeConsumer()
+        self.consumer.concurrency = concurrency
+        controller = AdaptivePrefetchController(
+            self.consumer, clock=self.clock, **kw)
+        self.add_cleanup(controller.stop)
+        return controller
+
+    def test_start(self):
+        controller = self.mk_controller(initial_prefetch=10)
+        controller.start()
+        self.assertEqual(self.consumer.prefetch_counts, [10])
+
+    def test_start_no_initial_prefetch(self):
+        controller = self.mk_controller(
+            initial_prefetch=None, max_prefetch=100)
+        controller.start()
+        self.assertEqual(self.consumer.prefetch_counts, [100])
+
+    def test_target_concurrency_default(self):
+        controller = self.mk_controller(initial_prefetch=10, concurrency=4)
+        self.assertEqual(controller.target_concurrency, 4)
+        controller = self.mk_controller(initial_prefetch=10, concurrency=None)
+        self.assertEqual(controller.target_concurrency, 10)
+
+    def test_fast_handler(self):
+        controller = self.mk_controller(
+            initial_prefetch=10, max_prefetch=50, interval=5)
+        controller.start()
+        # The handler is only busy a fifth of the time, so we need more
+        # messages prefetched.
+        self.consumer.handle(100, 0.01)
+        self.clock.advance(5)
+        self.assertEqual(controller.latency, 0.01)
+        self.assertEqual(controller.in_flight, 0.2)
+        self.assertEqual(self.consumer.prefetch_counts, [10, 20])
+        self.consumer.handle(200, 0.01)
+        self.clock.advance(5)
+        self.assertEqual(self.consumer.prefetch_counts, [10, 20, 40])
+        self.consumer.handle(400, 0.01)
+        self.clock.advance(5)
+        self.assertEqual(self.consumer.prefetch_counts, [10, 20, 40, 50])
+
+    def test_slow_handler(self):
+        controller = self.mk_controller(
+            initial_prefetch=10, max_delay=1.0, interval=5)
+        controller.start()
+        self.consumer.handle(2, 2.0)
+        self.clock.advance(5)
+        self.assertEqual(self.consumer.prefetch_counts, [10, 2])
+
+    def test_stuck_handler(self):
+        controller = self.mk_controller(
+            initial_prefetch=10, max_delay=1.0, interval=5)
+        controller.start()
+        self.consumer.in_progress = 1
+        self.clock.advance(5)
+        self.assertEqual(controller.latency, 5)
+        self.assertEqual(self.consumer.prefetch_counts, [10, 1])
+
+    def test_concurrent_handler(self):
+        controller = self.mk_controller(
+            initial_prefetch=10, concurrency=4, interval=5)
+        controller.start()
+        self.consumer.handle(100, 0.1)
+        self.clock.advance(5)
+        self.assertEqual(controller.in_flight, 2.0)
+        self.assertEqual(self.consumer.prefetch_counts, [10, 20])
+
+    def test_above_target_concurrency(self):
+        controller = self.mk_controller(
+            initial_prefetch=10, target_concurrency=2, concurrency=None,
+            interval=5)
+        controller.start()
+        self.consumer.handle(50, 0.5)
+        self.clock.advance(5)
+        self.assertEqual(controller.in_flight, 5.0)
+        self.assertEqual(self.consumer.prefetch_counts, [10, 5])
+
+    def test_idle(self):
+        controller = self.mk_controller(initial_prefetch=10)
+        controller.start()
+        self.clock.advance(5)
+        self.assertEqual(controller.latency, None)
+        self.assertEqual(self.consumer.prefetch_counts, [10])
+
+    def test_no_change(self):
+        controller = self.mk_controller(initial_prefetch=10, interval=5)
+        controller.start()
+        self.consumer.handle(50, 0.1)
+        self.clock.advance(5)
+        self.assertEqual(self.consumer.prefetch_counts, [10])
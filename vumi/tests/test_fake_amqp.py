@@ -207,6 +207,25 @@ class TestFakeAMQP(VumiTestCase):
         channel = self.make_channel(0)
         self.assertRaises(NotImplementedError, channel.basic_qos, 0, 1, True)
 
+    def test_basic_qos_global(self):
+        """
+        basic_qos() with global=True applies to the whole channel immediately
+        if global limits are turned on.
+        """
+        self.patch(fake_amqp.FakeAMQPChannel, 'global_qos_supported', True)
+        channel = self.make_channel(0)
+        channel.queue_declare('q1')
+        channel.basic_consume('q1', 'tag1')
+        self.assertEqual(channel._get_consumer_prefetch('tag1'), 0)
+        self.assertTrue(channel.deliverable('tag1'))
+
+        channel.basic_qos(0, 1, True)
+        self.assertEqual(channel.qos_global_prefetch_count, 1)
+        self.assertEqual(channel._get_consumer_prefetch('tag1'), 0)
+        self.assertTrue(channel.deliverable('tag1'))
+        channel.unacked.append((0, 'tag1', 'q1'))
+        self.assertFalse(channel.deliverable('tag1'))
+
     def test_basic_qos_per_consumer(self):
         """
         basic_qos() only applies to consumers started after the call.
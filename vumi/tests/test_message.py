@@ -1,6 +1,16 @@
+import sys
+from datetime import datetime
+
+from twisted.trial.unittest import SkipTest
+
 from vumi.tests.utils import RegexMatcher, UTCNearNow
 from vumi.message import (Message, TransportMessage, TransportEvent,
-                          TransportUserMessage)
+                          TransportUserMessage, JSONMessageCodec,
+                          FastJSONMessageCodec, MsgpackMessageCodec,
+                          get_message_codec,
+                          get_message_codec_for_content_type, msgpack,
+                          CompactTransportUserMessage, CompactTransportEvent)
+from vumi.errors import MessageCodecError, InvalidMessageField
 from vumi.tests.helpers import VumiTestCase
 
 
@@ -16,6 +26,171 @@ class MessageTest(VumiTestCase):
         self.assertTrue('a' in Message(a=5))
         self.assertFalse('a' in Message(b=5))
 
+    def test_copy(self):
+        msg = Message(a=5, b={'c': [1, {'d': 2}]})
+        msg_copy = msg.copy()
+        self.assertEqual(msg_copy, msg)
+        self.assertTrue(type(msg_copy) is Message)
+
+    def test_copy_is_independent(self):
+        msg = Message(a=5, b={'c': [1, {'d': 2}]})
+        msg_copy = msg.copy()
+        msg_copy['a'] = 6
+        msg_copy['b']['c'][1]['d'] = 3
+        msg_copy.get('b')['e'] = 4
+        self.assertEqual(msg, Message(a=5, b={'c': [1, {'d': 2}]}))
+        self.assertEqual(msg_copy, Message(a=6, b={'c': [1, {'d': 3}],
+                                                   'e': 4}))
+
+    def test_copy_original_is_independent(self):
+        msg = Message(a=5, b={'c': [1, {'d': 2}]})
+        msg_copy = msg.copy()
+        msg['b']['c'].append(3)
+        msg.payload['a'] = 6
+        self.assertEqual(msg_copy, Message(a=5, b={'c': [1, {'d': 2}]}))
+
+    def test_copy_via_payload_is_independent(self):
+        msg = Message(a=5, b={'c': 1})
+        msg_copy = msg.copy()
+        msg_copy.payload['b']['c'] = 2
+        self.assertEqual(msg['b'], {'c': 1})
+        self.assertEqual(msg_copy['b'], {'c': 2})
+
+    def test_copy_shares_untouched_values(self):
+        msg = Message.decode(Message(a=u'foo', b={'c': 1}).encode())
+        msg_copy = msg.copy()
+        self.assertTrue(msg_copy._payload['a'] is msg._payload['a'])
+        self.assertTrue(msg_copy._payload['b'] is msg._payload['b'])
+        self.assertFalse(msg_copy['b'] is msg._payload['b'])
+
+    def test_copy_after_handing_out_container(self):
+        msg = Message.decode(Message(a=5, b={'c': 1}).encode())
+        b = msg['b']
+        msg_copy = msg.copy()
+        b['leak'] = 1
+        self.assertEqual(msg_copy['b'], {'c': 1})
+        self.assertEqual(msg['b'], {'c': 1, 'leak': 1})
+
+    def test_copy_after_handing_out_payload(self):
+        msg = Message.decode(Message(a=5, b={'c': 1}).encode())
+        payload = msg.payload
+        msg_copy = msg.copy()
+        payload['b']['leak'] = 1
+        self.assertEqual(msg_copy['b'], {'c': 1})
+
+    def test_copy_after_passing_in_container(self):
+        b = {'c': 1}
+        msg = Message(a=5, b=b)
+        msg_copy = msg.copy()
+        b['leak'] = 1
+        self.assertEqual(msg_copy['b'], {'c': 1})
+
+    def test_encode_decode_default_codec(self):
+        msg = Message(a=5, timestamp=datetime(2014, 1, 2, 3, 4, 5, 6))
+        data = msg.encode()
+        self.assertEqual(data, msg.to_json())
+        self.assertEqual(Message.decode(data), msg)
+
+    def test_encode_decode_named_codec(self):
+        msg = Message(a=5, timestamp=datetime(2014, 1, 2, 3, 4, 5, 6))
+        data = msg.encode('fast_json')
+        self.assertEqual(Message.decode(data, 'fast_json'), msg)
+
+
+class MessageCodecTestMixin(object):
+    codec_class = None
+
+    def mk_payload(self):
+        return {
+            'a': u'b',
+            'timestamp': datetime(2014, 1, 2, 3, 4, 5, 6),
+            'helper_metadata': {'nested': {'c': [1, 2, None]}},
+        }
+
+    def test_round_trip(self):
+        codec = self.codec_class()
+        payload = self.mk_payload()
+        self.assertEqual(codec.decode(codec.encode(payload)), payload)
+
+    def test_registered(self):
+        codec = get_message_codec(self.codec_class.name)
+        self.assertTrue(isinstance(codec, self.codec_class))
+        self.assertEqual(
+            get_message_codec_for_content_type(
+                self.codec_class.content_type, default=codec),
+            codec)
+
+
+class TestJSONMessageCodec(MessageCodecTestMixin, VumiTestCase):
+    codec_class = JSONMessageCodec
+
+    def test_decodes_nested_datetimes(self):
+        codec = self.codec_class()
+        data = codec.encode({'nested': {'t': datetime(2014, 1, 1)}})
+        self.assertEqual(codec.decode(data),
+                         {'nested': {'t': datetime(2014, 1, 1)}})
+
+
+class TestFastJSONMessageCodec(MessageCodecTestMixin, VumiTestCase):
+    codec_class = FastJSONMessageCodec
+
+    def test_compatible_with_json_codec(self):
+        codec = self.codec_class()
+        json_codec = JSONMessageCodec()
+        payload = self.mk_payload()
+        self.assertEqual(json_codec.decode(codec.encode(payload)), payload)
+        self.assertEqual(codec.decode(json_codec.encode(payload)), payload)
+
+    def test_only_decodes_known_datetime_fields(self):
+        codec = self.codec_class()
+        data = codec.encode({'nested': {'t': datetime(2014, 1, 1)}})
+        self.assertEqual(codec.decode(data),
+                         {'nested': {'t': '2014-01-01 00:00:00.000000'}})
+
+    def test_custom_datetime_fields(self):
+        codec = self.codec_class(datetime_fields=['t'])
+        data = codec.encode({'t': datetime(2014, 1, 1), 'timestamp': 'x'})
+        self.assertEqual(codec.decode(data),
+                         {'t': datetime(2014, 1, 1), 'timestamp': 'x'})
+
+
+class TestMsgpackMessageCodec(MessageCodecTestMixin, VumiTestCase):
+    codec_class = MsgpackMessageCodec
+
+    def setUp(self):
+        if msgpack is None:
+            raise SkipTest("msgpack not installed.")
+
+    def test_content_type(self):
+        self.assertEqual(
+            get_message_codec_for_content_type('application/x-msgpack'),
+            get_message_codec('msgpack'))
+
+
+class TestMessageCodecLookup(VumiTestCase):
+    def test_default_codec(self):
+        self.assertTrue(isinstance(get_message_codec(), JSONMessageCodec))
+
+    def test_codec_instance(self):
+        codec = FastJSONMessageCodec()
+        self.assertEqual(get_message_codec(codec), codec)
+
+    def test_unknown_codec(self):
+        self.assertRaises(MessageCodecError, get_message_codec, 'unknown')
+
+    def test_no_content_type(self):
+        self.assertEqual(get_message_codec_for_content_type(None),
+                         get_message_codec('json'))
+
+    def test_no_content_type_with_default(self):
+        self.assertEqual(
+            get_message_codec_for_content_type(None, default='fast_json'),
+            get_message_codec('fast_json'))
+
+    def test_unknown_content_type(self):
+        self.assertRaises(MessageCodecError,
+                          get_message_codec_for_content_type, 'text/plain')
+
 
 class TransportMessageTestMixin(object):
     def make_message(self, **fields):
@@ -36,6 +211,15 @@ class TransportMessageTestMixin(object):
         msg = self.make_message(routing_metadata={'foo': 'bar'})
         self.assertEqual({'foo': 'bar'}, msg.routing_metadata)
 
+    def test_copy_routing_metadata(self):
+        msg = self.make_message()
+        msg.set_routing_endpoint('foo')
+        msg_copy = msg.copy()
+        msg_copy.set_routing_endpoint('bar')
+        self.assertEqual('foo', msg.get_routing_endpoint())
+        self.assertEqual('bar', msg_copy.get_routing_endpoint())
+        self.assertEqual(type(msg), type(msg_copy))
+
     def test_check_routing_endpoint(self):
         msgcls = type(self.make_message())
         self.assertEqual('default', msgcls.check_routing_endpoint(None))
@@ -327,3 +511,123 @@ class TransportEventTest(TransportMessageTestMixin, VumiTestCase):
         # self.assertEqual('sphex', msg['transport_name'])
         self.assertEqual('delivered', msg['delivery_status'])
         self.assertEqual({}, msg['helper_metadata'])
+
+
+class CompactMessageTestMixin(TransportMessageTestMixin):
+    def test_fields_in_slots(self):
+        msg = self.make_message(foo='bar')
+        self.assertEqual(msg._payload, None)
+        self.assertEqual(msg._extras, {'foo': 'bar'})
+        self.assertEqual(msg._f_helper_metadata, {})
+        self.assertFalse(hasattr(msg, '__dict__'))
+
+    def test_no_extras(self):
+        msg = self.make_message()
+        self.assertEqual(msg._extras, None)
+
+    def test_smaller_than_uncompact_message(self):
+        msg = self.make_message()
+        uncompact = self.base_class.decode(msg.encode())
+        self.assertFalse(hasattr(msg, '__dict__'))
+        self.assertTrue(sys.getsizeof(msg) < (
+            sys.getsizeof(uncompact) + sys.getsizeof(uncompact._payload)))
+
+    def test_dict_api(self):
+        msg = self.make_message(foo='bar')
+        self.assertTrue('foo' in msg)
+        self.assertFalse('baz' in msg)
+        self.assertEqual(msg['foo'], 'bar')
+        self.assertEqual(msg.get('baz'), None)
+        self.assertEqual(msg.get('baz', 'quux'), 'quux')
+        self.assertRaises(KeyError, lambda: msg['baz'])
+        msg['baz'] = 'quux'
+        msg['message_version'] = 'foo'
+        self.assertEqual(msg['baz'], 'quux')
+        self.assertEqual(dict(msg.items())['message_version'], 'foo')
+
+    def test_equal_to_uncompact_message(self):
+        msg = self.make_message()
+        self.assertEqual(msg, self.base_class.from_json(msg.to_json()))
+        self.assertEqual(self.base_class.from_json(msg.to_json()), msg)
+
+    def test_payload_inflates(self):
+        msg = self.make_message(foo='bar')
+        fields = dict(msg.items())
+        payload = msg.payload
+        self.assertEqual(payload, fields)
+        payload['foo'] = 'baz'
+        self.assertEqual(msg['foo'], 'baz')
+        msg['foo'] = 'quux'
+        self.assertEqual(payload['foo'], 'quux')
+
+    def test_copy(self):
+        msg = self.make_message(foo='bar')
+        msg_copy = msg.copy()
+        self.assertEqual(msg, msg_copy)
+        self.assertEqual(type(msg), type(msg_copy))
+        msg_copy['helper_metadata']['foo'] = 'bar'
+        self.assertEqual(msg['helper_metadata'], {})
+
+    def test_copy_after_handing_out_container(self):
+        msg = type(self.make_message()).decode(self.make_message().encode())
+        helper_metadata = msg['helper_metadata']
+        msg_copy = msg.copy()
+        helper_metadata['leak'] = 1
+        self.assertEqual(msg_copy['helper_metadata'], {})
+        self.assertEqual(msg['helper_metadata'], {'leak': 1})
+
+    def test_copy_inflated(self):
+        msg = self.make_message(foo='bar')
+        msg.payload['helper_metadata']['foo'] = 'bar'
+        msg_copy = msg.copy()
+        self.assertEqual(msg, msg_copy)
+        msg_copy['helper_metadata']['foo'] = 'baz'
+        self.assertEqual(msg['helper_metadata'], {'foo': 'bar'})
+
+    def test_decode_is_trusted(self):
+        msg = self.make_message()
+        msg['message_version'] = 'foo'
+        decoded = type(msg).decode(msg.encode())
+        self.assertEqual(decoded['message_version'], 'foo')
+        self.assertRaises(InvalidMessageField, self.base_class.decode,
+                          msg.encode())
+
+    def test_decode_fills_legacy_fields(self):
+        msg = self.make_message()
+        del msg.payload['helper_metadata']
+        decoded = type(msg).from_json(msg.to_json())
+        self.assertEqual(decoded['helper_metadata'], {})
+
+
+class TestCompactTransportUserMessage(CompactMessageTestMixin, VumiTestCase):
+    base_class = TransportUserMessage
+
+    def make_message(self, **extra_fields):
+        fields = dict(
+            to_addr='+27831234567',
+            from_addr='12345',
+            transport_name='sphex',
+            transport_type='sms',
+        )
+        fields.update(extra_fields)
+        return CompactTransportUserMessage(**fields)
+
+    def test_reply(self):
+        msg = self.make_message()
+        reply = msg.reply('foo')
+        self.assertEqual(reply['in_reply_to'], msg['message_id'])
+        self.assertEqual(reply['to_addr'], msg['from_addr'])
+
+
+class TestCompactTransportEvent(CompactMessageTestMixin, VumiTestCase):
+    base_class = TransportEvent
+
+    def make_message(self, **extra_fields):
+        fields = dict(
+            event_id='def',
+            event_type='ack',
+            user_message_id='abc',
+            sent_message_id='ghi',
+        )
+        fields.update(extra_fields)
+        return CompactTransportEvent(**fields)
@@ -31,6 +31,17 @@ class ToyWorker(Worker):
             message.reply(''.join(reversed(message['content']))))
 
 
+class ChainedToyWorker(ToyWorker):
+    @inlineCallbacks
+    def startWorker(self):
+        self.events.append("START: %s" % self.name)
+        self.pub = yield self.publish_to(
+            self.config.get('publish_to', "%s.outbound" % self.name))
+        yield self.consume("%s.inbound" % self.name, self.process_message,
+                           message_class=TransportUserMessage)
+        self._d.callback(None)
+
+
 class StubbedMultiWorker(MultiWorker):
     def WORKER_CREATOR(self, options):
         worker_creator = StubbedWorkerCreator(options)
@@ -116,3 +127,29 @@ class TestMultiWorker(VumiTestCase):
         worker2 = worker.getServiceNamed("worker2")
         self.assertEqual({'foo': 'bar'}, worker1.config)
         self.assertEqual({'foo': 'baz'}, worker2.config)
+
+    @inlineCallbacks
+    def test_no_local_routing_by_default(self):
+        worker = yield self.get_multiworker(self.base_config)
+        self.assertEqual(worker.local_bus, None)
+        self.assertEqual(worker.getServiceNamed("worker1").local_bus, None)
+
+    @inlineCallbacks
+    def test_local_routing(self):
+        worker = yield self.get_multiworker({
+            'local_routing': True,
+            'workers': {
+                'worker1': "%s.ChainedToyWorker" % (__name__,),
+                'worker2': "%s.ChainedToyWorker" % (__name__,),
+            },
+            'worker1': {'publish_to': 'worker2.inbound'},
+        })
+        worker1 = worker.getServiceNamed("worker1")
+        self.assertEqual(worker1.local_bus, worker.local_bus)
+        self.assertEqual(worker1.pub.local_bus, worker.local_bus)
+        yield self.dispatch(self.msg_helper.make_inbound("foo"), "worker1")
+        yield self.worker_helper.wait_for_dispatched_outbound(1, "worker2")
+        self.assertEqual(['foo'], self.get_replies("worker2"))
+        # The message from worker1 to worker2 didn't go through the broker.
+        self.assertEqual(
+            [], self.worker_helper.get_dispatched_inbound("worker2"))
@@ -1,10 +1,15 @@
 import json
 from collections import namedtuple
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
+from twisted.test.proto_helpers import StringTransport
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, Deferred, fail)
+from twisted.trial.unittest import SkipTest
 
-from vumi.message import Message
-from vumi.service import Worker, WorkerCreator
+from vumi.message import Message, msgpack
+from vumi.service import Worker, WorkerCreator, LocalMessageBus
 from vumi.tests.helpers import VumiTestCase, WorkerHelper
 
 
@@ -69,6 +74,518 @@ class TestService(VumiTestCase):
         self.assertEquals(published_msg.body, '{"key": "value"}')
         self.assertEquals(published_msg.properties, {'delivery mode': 2})
 
+    @inlineCallbacks
+    def test_start_publisher_with_message_codec(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        publisher = yield worker.publish_to(
+            'test.routing.key', message_codec='fast_json')
+        publisher.publish_message(Message(key="value"))
+        [published_msg] = publisher.channel.broker.get_dispatched(
+            'vumi', 'test.routing.key')
+
+        self.assertEquals(published_msg.body, '{"key": "value"}')
+        self.assertEquals(published_msg.properties, {'delivery mode': 2})
+
+    @inlineCallbacks
+    def test_consume_with_content_type(self):
+        if msgpack is None:
+            raise SkipTest("msgpack not installed.")
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        log = []
+        yield worker.consume('test.routing.key', log.append)
+        publisher = yield worker.publish_to(
+            'test.routing.key', message_codec='msgpack')
+        yield publisher.publish_message(Message(key="value"))
+        [published_msg] = publisher.channel.broker.get_dispatched(
+            'vumi', 'test.routing.key')
+        self.assertEquals(published_msg.properties, {
+            'delivery mode': 2, 'content type': 'application/x-msgpack'})
+        yield self.worker_helper.broker.wait_delivery()
+        self.assertEquals(log, [Message(key="value")])
+
+
+class TestConsumerConcurrency(VumiTestCase):
+    def setUp(self):
+        self.worker_helper = self.add_helper(WorkerHelper())
+        self.handled = []
+
+    def handler(self, msg):
+        d = Deferred()
+        self.handled.append((msg['n'], d))
+        return d
+
+    @inlineCallbacks
+    def start_consumer(self, messages, **kw):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        consumer = yield worker.consume(
+            'test.routing.key', self.handler, **kw)
+        for n in range(messages):
+            self.worker_helper.broker.basic_publish(
+                'vumi', 'test.routing.key',
+                fake_amq_message({"n": n}).content)
+        yield self.settle()
+        returnValue(consumer)
+
+    @inlineCallbacks
+    def settle(self):
+        for _ in range(5):
+            yield deferLater(reactor, 0, lambda: None)
+
+    def handled_ns(self):
+        return [n for n, _ in self.handled]
+
+    @inlineCallbacks
+    def finish(self, n):
+        [d] = [d for m, d in self.handled if m == n]
+        d.callback(None)
+        yield self.settle()
+
+    @inlineCallbacks
+    def test_notify_paused_and_quiet_after_handler_error(self):
+        consumer = yield self.start_consumer(1)
+        pause_d = consumer.pause()
+        self.assertFalse(pause_d.called)
+        [(_, d)] = self.handled
+        d.errback(ValueError("oops"))
+        yield self.settle()
+        self.assertTrue(pause_d.called)
+        self.assertEqual(consumer.in_progress, 0)
+        self.assertEqual(consumer.processed_count, 1)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    @inlineCallbacks
+    def test_consume_serial_by_default(self):
+        consumer = yield self.start_consumer(3)
+        self.assertEqual(consumer.concurrency, 1)
+        self.assertEqual(self.handled_ns(), [0])
+        self.assertTrue(consumer.saturated)
+        yield self.finish(0)
+        self.assertEqual(self.handled_ns(), [0, 1])
+        yield self.finish(1)
+        yield self.finish(2)
+        self.assertEqual(self.handled_ns(), [0, 1, 2])
+        self.assertEqual(consumer.in_progress, 0)
+        self.assertFalse(consumer.saturated)
+
+    @inlineCallbacks
+    def test_consume_concurrently(self):
+        consumer = yield self.start_consumer(5, concurrency=3)
+        self.assertEqual(self.handled_ns(), [0, 1, 2])
+        self.assertEqual(consumer.in_progress, 3)
+        self.assertTrue(consumer.saturated)
+        yield self.finish(1)
+        self.assertEqual(self.handled_ns(), [0, 1, 2, 3])
+        yield self.finish(0)
+        yield self.finish(2)
+        self.assertEqual(self.handled_ns(), [0, 1, 2, 3, 4])
+        self.assertEqual(consumer.in_progress, 2)
+        self.assertFalse(consumer.saturated)
+        yield self.finish(3)
+        yield self.finish(4)
+        self.assertEqual(consumer.processed_count, 5)
+        self.assertEqual(consumer.in_progress, 0)
+
+    @inlineCallbacks
+    def test_consume_unlimited_concurrency(self):
+        consumer = yield self.start_consumer(5, concurrency=None)
+        self.assertEqual(self.handled_ns(), [0, 1, 2, 3, 4])
+        self.assertFalse(consumer.saturated)
+        for n in range(5):
+            yield self.finish(n)
+
+    @inlineCallbacks
+    def test_peak_in_progress(self):
+        consumer = yield self.start_consumer(3, concurrency=3)
+        yield self.finish(0)
+        yield self.finish(1)
+        self.assertEqual(consumer.peak_in_progress, 3)
+        self.assertEqual(consumer.reset_peak_in_progress(), 3)
+        self.assertEqual(consumer.peak_in_progress, 1)
+        yield self.finish(2)
+        self.assertEqual(consumer.reset_peak_in_progress(), 1)
+        self.assertEqual(consumer.reset_peak_in_progress(), 0)
+
+
+class TestPublisher(VumiTestCase):
+    def setUp(self):
+        self.worker_helper = self.add_helper(WorkerHelper())
+
+    def get_dispatched(self, publisher):
+        return publisher.channel.broker.get_dispatched(
+            'vumi', 'test.routing.key')
+
+    def get_publisher(self, **kw):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        return worker.publish_to('test.routing.key', **kw)
+
+    @inlineCallbacks
+    def test_publish_unbatched(self):
+        publisher = yield self.get_publisher()
+        d = publisher.publish_message(Message(key="value"))
+        self.assertEqual(len(self.get_dispatched(publisher)), 1)
+        msg = yield d
+        self.assertEqual(msg, Message(key="value"))
+
+    @inlineCallbacks
+    def test_publish_batched(self):
+        publisher = yield self.get_publisher(batch_publishes=True)
+        d1 = publisher.publish_message(Message(key="value1"))
+        d2 = publisher.publish_message(Message(key="value2"))
+        self.assertEqual(self.get_dispatched(publisher), [])
+        self.assertEqual(publisher.pending_count, 2)
+        msgs = yield gatherResults([d1, d2])
+        self.assertEqual(msgs, [Message(key="value1"), Message(key="value2")])
+        self.assertEqual(
+            [m.body for m in self.get_dispatched(publisher)],
+            ['{"key": "value1"}', '{"key": "value2"}'])
+        self.assertEqual(publisher.pending_count, 0)
+
+    @inlineCallbacks
+    def test_publish_batched_failure(self):
+        publisher = yield self.get_publisher(batch_publishes=True)
+        basic_publish = publisher.channel.basic_publish
+
+        def failing_basic_publish(exchange, content, routing_key):
+            if content.body == '{"key": "value2"}':
+                return fail(ValueError("oops"))
+            return basic_publish(
+                exchange=exchange, content=content, routing_key=routing_key)
+        publisher.channel.basic_publish = failing_basic_publish
+
+        d1 = publisher.publish_message(Message(key="value1"))
+        d2 = publisher.publish_message(Message(key="value2"))
+        d3 = publisher.publish_message(Message(key="value3"))
+        self.assertEqual((yield d1), Message(key="value1"))
+        yield self.assertFailure(d2, ValueError)
+        self.assertEqual((yield d3), Message(key="value3"))
+        self.assertEqual(
+            [m.body for m in self.get_dispatched(publisher)],
+            ['{"key": "value1"}', '{"key": "value3"}'])
+
+    @inlineCallbacks
+    def test_publish_batched_max_unconfirmed(self):
+        publisher = yield self.get_publisher(
+            batch_publishes=True, max_unconfirmed=2)
+        ds = [publisher.publish_message(Message(key=i)) for i in range(5)]
+        self.assertEqual(len(self.get_dispatched(publisher)), 4)
+        self.assertEqual(publisher.pending_count, 1)
+        yield gatherResults(ds)
+        self.assertEqual(len(self.get_dispatched(publisher)), 5)
+        self.assertEqual(publisher.pending_count, 0)
+
+    @inlineCallbacks
+    def test_publish_confirmed(self):
+        publisher = yield self.get_publisher(confirm_publishes=True)
+        self.assertEqual(publisher.channel._tx_publishes, [])
+        d1 = publisher.publish_message(Message(key="value1"))
+        d2 = publisher.publish_message(Message(key="value2"))
+        yield gatherResults([d1, d2])
+        self.assertEqual(len(self.get_dispatched(publisher)), 2)
+        self.assertEqual(publisher.channel._tx_publishes, [])
+        self.assertEqual(publisher.unconfirmed_count, 0)
+
+    @inlineCallbacks
+    def test_publish_confirmed_waits_for_commit(self):
+        publisher = yield self.get_publisher(confirm_publishes=True)
+        commit_d = Deferred()
+        publisher.channel.tx_commit = lambda: commit_d
+        d = publisher.publish_message(Message(key="value"))
+        yield self.wait_for_tick()
+        self.assertEqual(publisher.unconfirmed_count, 1)
+        self.assertFalse(d.called)
+        commit_d.callback(None)
+        self.assertTrue(d.called)
+        self.assertEqual(publisher.unconfirmed_count, 0)
+
+    @inlineCallbacks
+    def test_publish_confirmed_commit_failure(self):
+        publisher = yield self.get_publisher(confirm_publishes=True)
+        publisher.channel.tx_commit = lambda: fail(ValueError("oops"))
+        d1 = publisher.publish_message(Message(key="value1"))
+        d2 = publisher.publish_message(Message(key="value2"))
+        yield self.assertFailure(d1, ValueError)
+        yield self.assertFailure(d2, ValueError)
+
+    @inlineCallbacks
+    def test_publish_max_unconfirmed(self):
+        publisher = yield self.get_publisher(
+            confirm_publishes=True, max_unconfirmed=2)
+        commits = []
+
+        def tx_commit():
+            commits.append(Deferred())
+            return commits[-1]
+        publisher.channel.tx_commit = tx_commit
+
+        ds = [publisher.publish_message(Message(key=i)) for i in range(5)]
+        yield self.wait_for_tick()
+        self.assertEqual(publisher.unconfirmed_count, 2)
+        self.assertEqual(publisher.pending_count, 3)
+        self.assertEqual(len(commits), 1)
+
+        commits[0].callback(None)
+        self.assertEqual([d.called for d in ds],
+                         [True, True, False, False, False])
+        yield self.wait_for_tick()
+        self.assertEqual(publisher.unconfirmed_count, 2)
+        self.assertEqual(publisher.pending_count, 1)
+
+        commits[1].callback(None)
+        yield self.wait_for_tick()
+        commits[2].callback(None)
+        self.assertEqual([d.called for d in ds], [True] * 5)
+
+    def wait_for_tick(self):
+        return deferLater(reactor, 0, lambda: None)
+
+
+class RecordingWorker(Worker):
+    started = 0
+
+    def startWorker(self):
+        self.started += 1
+
+
+class TestWorkerConnectionPool(VumiTestCase):
+    def setUp(self):
+        self.worker_helper = self.add_helper(WorkerHelper())
+
+    def test_amqp_connection_count(self):
+        self.assertEqual(Worker({}, {}).amqp_connection_count, 1)
+        self.assertEqual(
+            Worker({}, {'amqp_connections': 3}).amqp_connection_count, 3)
+
+    def test_start_waits_for_all_connections(self):
+        worker = RecordingWorker({}, {'amqp_connections': 2})
+        client0 = WorkerHelper.get_fake_amqp_client(None)
+        client1 = WorkerHelper.get_fake_amqp_client(client0.broker)
+        worker._amqp_connected(client1, 1)
+        self.assertEqual(worker.started, 0)
+        self.assertEqual(worker._amqp_client, None)
+        worker._amqp_connected(client0)
+        self.assertEqual(worker.started, 1)
+        self.assertEqual(worker._amqp_client, client0)
+        self.assertEqual(worker._amqp_clients, {0: client0, 1: client1})
+
+    def test_reconnect_restarts_whole_pool(self):
+        worker = RecordingWorker({}, {'amqp_connections': 2})
+        client0 = WorkerHelper.get_fake_amqp_client(None)
+        client1 = WorkerHelper.get_fake_amqp_client(client0.broker)
+        client0.transport = StringTransport()
+        client1.transport = StringTransport()
+        worker._amqp_connected(client0)
+        worker._amqp_connected(client1, 1)
+        self.assertEqual(worker.started, 1)
+
+        # Losing one connection closes the rest of the pool.
+        worker._amqp_connection_dropped(1)
+        self.assertEqual(worker._amqp_clients, {})
+        self.assertTrue(client0.transport.disconnecting)
+        self.assertFalse(client1.transport.disconnecting)
+        # The closed connection reports its loss too.
+        worker._amqp_connection_dropped(0)
+
+        # A partial reconnect doesn't start the worker again.
+        new_client1 = WorkerHelper.get_fake_amqp_client(client0.broker)
+        worker._amqp_connected(new_client1, 1)
+        self.assertEqual(worker.started, 1)
+        new_client0 = WorkerHelper.get_fake_amqp_client(client0.broker)
+        worker._amqp_connected(new_client0)
+        self.assertEqual(worker.started, 2)
+        self.assertEqual(
+            worker._amqp_clients, {0: new_client0, 1: new_client1})
+
+    def test_get_amqp_client(self):
+        worker = WorkerHelper.get_worker_raw(Worker, {'amqp_connections': 2})
+        client0, client1 = worker._amqp_clients[0], worker._amqp_clients[1]
+        self.assertNotEqual(client0, client1)
+        self.assertEqual(worker.get_amqp_client(), client0)
+        self.assertEqual(worker.get_amqp_client(1), client1)
+        self.assertEqual(worker.get_amqp_client(2), client0)
+        del worker._amqp_clients[1]
+        self.assertEqual(worker.get_amqp_client(1), client0)
+
+    @inlineCallbacks
+    def test_consume_and_publish_on_connection(self):
+        worker = yield self.worker_helper.get_worker(
+            Worker, {'amqp_connections': 2}, start=False)
+        log = []
+        consumer = yield worker.consume(
+            'test.routing.key', log.append, amqp_connection=1)
+        publisher = yield worker.publish_to(
+            'test.routing.key', amqp_connection=0)
+        self.assertEqual(consumer.channel.client, worker._amqp_clients[1])
+        self.assertEqual(publisher.channel.client, worker._amqp_clients[0])
+        publisher.publish_message(Message(key="value"))
+        yield self.worker_helper.broker.wait_delivery()
+        self.assertEqual(log, [Message(key="value")])
+
+
+class TestLocalMessageBus(VumiTestCase):
+    def setUp(self):
+        self.worker_helper = self.add_helper(WorkerHelper())
+        self.bus = LocalMessageBus()
+
+    @inlineCallbacks
+    def get_worker(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        worker.local_bus = self.bus
+        returnValue(worker)
+
+    def get_dispatched(self):
+        return self.worker_helper.broker.get_dispatched(
+            'vumi', 'test.routing.key')
+
+    @inlineCallbacks
+    def test_publish_local(self):
+        worker = yield self.get_worker()
+        log = []
+        yield worker.consume('test.routing.key', log.append)
+        publisher = yield worker.publish_to('test.routing.key')
+        msg = Message(key="value", items=[1])
+        result = yield publisher.publish_message(msg)
+        self.assertEqual(result, msg)
+        self.assertEqual(self.get_dispatched(), [])
+        [received] = log
+        self.assertEqual(received, msg)
+        received['items'].append(2)
+        self.assertEqual(msg['items'], [1])
+
+    @inlineCallbacks
+    def test_publish_no_local_consumer(self):
+        worker = yield self.get_worker()
+        publisher = yield worker.publish_to('test.routing.key')
+        yield publisher.publish_message(Message(key="value"))
+        self.assertEqual(len(self.get_dispatched()), 1)
+
+    @inlineCallbacks
+    def test_publish_local_converts_message_class(self):
+        worker = yield self.get_worker()
+        log = []
+        yield worker.consume('test.routing.key', log.append,
+                             message_class=MessageSubclass)
+        publisher = yield worker.publish_to('test.routing.key')
+        yield publisher.publish_message(Message(key="value"))
+        [received] = log
+        self.assertEqual(type(received), MessageSubclass)
+        self.assertEqual(received['key'], "value")
+
+    @inlineCallbacks
+    def test_publish_local_paused(self):
+        worker = yield self.get_worker()
+        log = []
+        consumer = yield worker.consume(
+            'test.routing.key', log.append, paused=True)
+        publisher = yield worker.publish_to('test.routing.key')
+        yield publisher.publish_message(Message(key="value"))
+        self.assertEqual(log, [])
+        self.assertEqual(len(self.get_dispatched()), 1)
+        consumer.unpause()
+        yield self.worker_helper.broker.wait_delivery()
+        self.assertEqual(log, [Message(key="value")])
+
+    @inlineCallbacks
+    def test_publish_local_waits_for_handler(self):
+        worker = yield self.get_worker()
+        handler_ds = []
+
+        def handler(msg):
+            handler_ds.append(Deferred())
+            if msg['i'] == 0:
+                return handler_ds[-1]
+
+        yield worker.consume('test.routing.key', handler)
+        publisher = yield worker.publish_to('test.routing.key')
+        msg = Message(i=0)
+        d = publisher.publish_message(msg)
+        self.assertNoResult(d)
+        self.assertEqual(len(handler_ds), 1)
+        # The consumer is at capacity, so this one goes through AMQP.
+        yield publisher.publish_message(Message(i=1))
+        self.assertEqual(len(self.get_dispatched()), 1)
+        handler_ds[0].callback(None)
+        self.assertEqual(self.successResultOf(d), msg)
+
+    @inlineCallbacks
+    def test_publish_local_not_acked(self):
+        worker = yield self.get_worker()
+        yield worker.consume('test.routing.key', lambda msg: False)
+        publisher = yield worker.publish_to('test.routing.key')
+        yield publisher.publish_message(Message(key="value"))
+        [dispatched] = self.get_dispatched()
+        self.assertEqual(
+            Message.from_json(dispatched.body), Message(key="value"))
+
+    @inlineCallbacks
+    def test_publish_local_handler_error(self):
+        worker = yield self.get_worker()
+        log = []
+
+        def handler(msg):
+            log.append(msg)
+            if len(log) == 1:
+                raise ValueError("bad message")
+
+        yield worker.consume('test.routing.key', handler)
+        publisher = yield worker.publish_to('test.routing.key')
+        yield publisher.publish_message(Message(key="value"))
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(len(self.get_dispatched()), 1)
+        yield self.worker_helper.broker.wait_delivery()
+        self.assertEqual(log, [Message(key="value")] * 2)
+
+    @inlineCallbacks
+    def test_publish_local_consumer_stops_before_handling(self):
+        worker = yield self.get_worker()
+        handler_d = Deferred()
+        log = []
+
+        def handler(msg):
+            log.append(msg)
+            return handler_d
+
+        consumer = yield worker.consume('test.routing.key', handler)
+        consumer.local_capacity = 2
+        publisher = yield worker.publish_to('test.routing.key')
+        d1 = publisher.publish_message(Message(i=0))
+        d2 = publisher.publish_message(Message(i=1))
+        self.assertEqual([m['i'] for m in log], [0])
+        stop_d = consumer.stop()
+        yield d2
+        [dispatched] = self.get_dispatched()
+        self.assertEqual(Message.from_json(dispatched.body)['i'], 1)
+        handler_d.callback(None)
+        yield d1
+        yield stop_d
+        self.assertEqual([m['i'] for m in log], [0])
+
+    @inlineCallbacks
+    def test_publish_local_stopped_consumer(self):
+        worker = yield self.get_worker()
+        consumer = yield worker.consume('test.routing.key', lambda msg: None)
+        publisher = yield worker.publish_to('test.routing.key')
+        yield consumer.stop()
+        yield publisher.publish_message(Message(key="value"))
+        self.assertEqual(len(self.get_dispatched()), 1)
+        self.assertEqual(
+            self.bus.get_consumer('vumi', 'test.routing.key'), None)
+
+    @inlineCallbacks
+    def test_local_consumers_take_turns(self):
+        worker = yield self.get_worker()
+        log1, log2 = [], []
+        yield worker.consume('test.routing.key', log1.append)
+        yield worker.consume('test.routing.key', log2.append)
+        publisher = yield worker.publish_to('test.routing.key')
+        for i in range(4):
+            yield publisher.publish_message(Message(i=i))
+        self.assertEqual([m['i'] for m in log1], [0, 2])
+        self.assertEqual([m['i'] for m in log2], [1, 3])
+
+
+class MessageSubclass(Message):
+    pass
+
 
 class LoadableTestWorker(Worker):
     def poke(self):
@@ -103,3 +620,11 @@ class TestWorkerCreator(VumiTestCase):
                                   LoadableTestWorker.__name__)
         worker = creator.create_worker(worker_class, {})
         self.assertEquals("poke", worker.poke())
+
+    def test_create_worker_connection_pool(self):
+        creator = WorkerCreator(self.get_creator().options)
+        worker = creator.create_worker_by_class(
+            LoadableTestWorker, {'amqp_connections': 3})
+        factories = [service.args[2] for service in worker]
+        self.assertEqual([f.connection_index for f in factories], [0, 1, 2])
+        self.assertTrue(all(f.worker is worker for f in factories))
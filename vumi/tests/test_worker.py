@@ -2,6 +2,7 @@ from twisted.internet.defer import inlineCallbacks, succeed, Deferred
 
 from vumi.worker import BaseConfig, BaseWorker
 from vumi.connectors import ReceiveInboundConnector, ReceiveOutboundConnector
+from vumi.message import CompactTransportUserMessage, CompactTransportEvent
 from vumi.tests.utils import LogCatcher
 from vumi.middleware.base import BaseMiddleware
 from vumi.tests.helpers import VumiTestCase, MessageHelper, WorkerHelper
@@ -18,6 +19,10 @@ class DummyWorker(BaseWorker):
         pass
 
 
+class CachingDummyWorker(DummyWorker):
+    CONFIG_CACHE_SIZE = 10
+
+
 class DummyMiddleware(BaseMiddleware):
     setup_called = False
     teardown_called = False
@@ -50,6 +55,18 @@ class TestBaseConfig(VumiTestCase):
         config = BaseConfig({'amqp_prefetch_count': 10})
         self.assertEqual(config.amqp_prefetch_count, 10)
 
+    def test_no_amqp_message_codec(self):
+        config = BaseConfig({})
+        self.assertEqual(config.amqp_message_codec, 'json')
+
+    def test_amqp_message_codec(self):
+        config = BaseConfig({'amqp_message_codec': 'fast_json'})
+        self.assertEqual(config.amqp_message_codec, 'fast_json')
+
+    def test_no_amqp_consumer_concurrency(self):
+        config = BaseConfig({})
+        self.assertEqual(config.amqp_consumer_concurrency, 1)
+
 
 class TestBaseWorker(VumiTestCase):
 
@@ -152,6 +169,46 @@ class TestBaseWorker(VumiTestCase):
         cfg = yield self.worker.get_config(msg)
         self.assertEqual(cfg.amqp_prefetch_count, 20)
 
+    @inlineCallbacks
+    def test_get_config_not_cached_by_default(self):
+        cfg = yield self.worker.get_config(None)
+        self.assertNotIdentical((yield self.worker.get_config(None)), cfg)
+
+    @inlineCallbacks
+    def test_get_config_cached(self):
+        worker = yield self.worker_helper.get_worker(
+            DummyWorker, {'config_cache_size': 10}, False)
+        msg = self.msg_helper.make_inbound("inbound")
+        cfg = yield worker.get_config(msg)
+        self.assertIdentical((yield worker.get_config(msg)), cfg)
+        worker.invalidate_config_cache()
+        new_cfg = yield worker.get_config(msg)
+        self.assertNotIdentical(new_cfg, cfg)
+
+    @inlineCallbacks
+    def test_get_config_cache_opt_in(self):
+        worker = yield self.worker_helper.get_worker(
+            CachingDummyWorker, {}, False)
+        cfg = yield worker.get_config(None)
+        self.assertIdentical((yield worker.get_config(None)), cfg)
+
+    @inlineCallbacks
+    def test_get_config_cache_disabled(self):
+        worker = yield self.worker_helper.get_worker(
+            CachingDummyWorker, {'config_cache_size': 0}, False)
+        cfg = yield worker.get_config(None)
+        self.assertNotIdentical((yield worker.get_config(None)), cfg)
+
+    @inlineCallbacks
+    def test_get_config_cache_invalidated_on_new_config(self):
+        worker = yield self.worker_helper.get_worker(
+            CachingDummyWorker, {'amqp_prefetch_count': 5}, False)
+        cfg = yield worker.get_config(None)
+        self.assertEqual(cfg.amqp_prefetch_count, 5)
+        worker.config = {'amqp_prefetch_count': 7}
+        new_cfg = yield worker.get_config(None)
+        self.assertEqual(new_cfg.amqp_prefetch_count, 7)
+
     def test__validate_config(self):
         # should call .validate_config()
         self.worker.validate_config = CallRecorder(self.worker.validate_config)
@@ -173,6 +230,101 @@ class TestBaseWorker(VumiTestCase):
         # test setup happened
         self.assertTrue(connector._consumers['inbound'].keep_consuming)
 
+    @inlineCallbacks
+    def test_setup_connector_message_codec(self):
+        worker = yield self.worker_helper.get_worker(
+            DummyWorker, {'amqp_message_codec': 'fast_json'}, False)
+        connector = yield worker.setup_connector(ReceiveInboundConnector,
+                                                 'foo')
+        self.assertEqual(connector._message_codec.name, 'fast_json')
+        self.assertEqual(
+            connector._consumers['inbound'].message_codec.name, 'fast_json')
+        self.assertEqual(
+            connector._publishers['outbound'].message_codec.name, 'fast_json')
+
+    @inlineCallbacks
+    def test_setup_connector_compact_messages(self):
+        worker = yield self.worker_helper.get_worker(
+            DummyWorker, {'amqp_compact_messages': True}, False)
+        connector = yield worker.setup_connector(ReceiveInboundConnector,
+                                                 'foo')
+        self.assertEqual(connector._consumers['inbound'].message_class,
+                         CompactTransportUserMessage)
+        self.assertEqual(connector._consumers['event'].message_class,
+                         CompactTransportEvent)
+
+    @inlineCallbacks
+    def test_setup_connector_publisher_options(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'amqp_confirm_publishes': True,
+            'amqp_max_unconfirmed_publishes': 5,
+        }, False)
+        connector = yield worker.setup_connector(ReceiveInboundConnector,
+                                                 'foo')
+        publisher = connector._publishers['outbound']
+        self.assertEqual(publisher.batch_publishes, False)
+        self.assertEqual(publisher.confirm_publishes, True)
+        self.assertEqual(publisher.max_unconfirmed, 5)
+
+    @inlineCallbacks
+    def test_setup_connector_concurrency(self):
+        worker = yield self.worker_helper.get_worker(
+            DummyWorker, {'amqp_consumer_concurrency': 4}, False)
+        connector = yield worker.setup_connector(ReceiveInboundConnector,
+                                                 'foo')
+        self.assertEqual(connector._consumers['inbound'].concurrency, 4)
+
+    @inlineCallbacks
+    def test_setup_connector_metrics(self):
+        worker = yield self.worker_helper.get_worker(
+            DummyWorker, {'amqp_metrics_prefix': 'vumi.test.'})
+        connector = yield worker.setup_connector(ReceiveInboundConnector,
+                                                 'foo')
+        self.assertEqual(connector._metric_manager, worker._amqp_metrics)
+        self.assertEqual(worker._amqp_metrics.prefix, 'vumi.test.')
+        self.assertTrue('foo.inbound.in_flight' in worker._amqp_metrics)
+        yield worker.stopWorker()
+        self.assertEqual(worker._amqp_metrics, None)
+
+    @inlineCallbacks
+    def test_setup_connector_single_amqp_connection(self):
+        connector = yield self.worker.setup_connector(ReceiveInboundConnector,
+                                                      'foo')
+        self.assertEqual(connector._amqp_connections, {})
+
+    @inlineCallbacks
+    def test_setup_connector_amqp_connections(self):
+        worker = yield self.worker_helper.get_worker(
+            DummyWorker, {'amqp_connections': 2}, False)
+        connector = yield worker.setup_connector(ReceiveInboundConnector,
+                                                 'foo')
+        self.assertEqual(
+            connector._amqp_connections, {'consume': 0, 'publish': 1})
+        self.assertEqual(connector._consumers['inbound'].channel.client,
+                         worker._amqp_clients[0])
+        self.assertEqual(connector._publishers['outbound'].channel.client,
+                         worker._amqp_clients[1])
+        connector = yield worker.setup_connector(ReceiveInboundConnector,
+                                                 'bar')
+        self.assertEqual(
+            connector._amqp_connections, {'consume': 1, 'publish': 0})
+
+    @inlineCallbacks
+    def test_setup_connector_configured_amqp_connections(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'amqp_connections': 3,
+            'amqp_connector_connections': {
+                'foo': 2,
+                'bar': {'consume': 1},
+            },
+        }, False)
+        foo = yield worker.setup_connector(ReceiveInboundConnector, 'foo')
+        self.assertEqual(foo._amqp_connections, {'consume': 2, 'publish': 2})
+        bar = yield worker.setup_connector(ReceiveInboundConnector, 'bar')
+        self.assertEqual(bar._amqp_connections, {'consume': 1, 'publish': 0})
+        self.assertEqual(bar._consumers['inbound'].channel.client,
+                         worker._amqp_clients[1])
+
     @inlineCallbacks
     def test_teardown_connector(self):
         connector = yield self.worker.setup_connector(ReceiveInboundConnector,
@@ -60,9 +60,11 @@ class StubbedWorkerCreator(WorkerCreator):
     broker = None
 
     def _connect(self, worker, timeout, bindAddress):
-        amq_client = get_fake_amq_client(self.broker)
-        self.broker = amq_client.broker  # So we use the same broker for all.
-        reactor.callLater(0, worker._amqp_connected, amq_client)
+        for index in range(worker.amqp_connection_count):
+            amq_client = get_fake_amq_client(self.broker)
+            # So we use the same broker for all.
+            self.broker = amq_client.broker
+            reactor.callLater(0, worker._amqp_connected, amq_client, index)
 
 
 def get_stubbed_channel(broker=None, id=0):
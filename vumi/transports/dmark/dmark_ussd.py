@@ -20,6 +20,16 @@ class DmarkUssdTransportConfig(HttpRpcTransport.CONFIG_CLASS):
         " expires.",
         default=600, static=True)
 
+    session_cache_size = ConfigInt(
+        "Number of USSD sessions to cache in process. Cached sessions are"
+        " leased to this transport and written to Redis in the background."
+        " Default is 0 (no caching).",
+        default=0, static=True)
+
+    session_cache_ttl = ConfigInt(
+        "Number of seconds to cache a USSD session for.",
+        default=30, static=True)
+
     redis_manager = ConfigDict(
         "Redis client configuration.", default={}, static=True)
 
@@ -84,7 +94,9 @@ class DmarkUssdTransport(HttpRpcTransport):
         r_prefix = "vumi.transports.dmark_ussd:%s" % self.transport_name
         self.session_manager = yield SessionManager.from_redis_config(
             config.redis_manager, r_prefix,
-            max_session_length=config.ussd_session_timeout)
+            max_session_length=config.ussd_session_timeout,
+            cache_size=config.session_cache_size,
+            cache_ttl=config.session_cache_ttl)
 
     @inlineCallbacks
     def teardown_transport(self):
@@ -20,6 +20,12 @@ class MtechUssdTransport(HttpRpcTransport):
     :param int ussd_session_timeout:
         Number of seconds before USSD session information stored in
         Redis expires. Default is 600s.
+    :param int session_cache_size:
+        Number of USSD sessions to cache in process. Cached sessions are
+        leased to this transport and written to Redis in the background.
+        Default is 0 (no caching).
+    :param int session_cache_ttl:
+        Number of seconds to cache a USSD session for. Default is 30s.
     :param str web_path:
         The HTTP path to listen on.
     :param int web_port:
@@ -38,7 +44,9 @@ class MtechUssdTransport(HttpRpcTransport):
         r_prefix = "mtech_ussd:%s" % self.transport_name
         session_timeout = int(self.config.get("ussd_session_timeout", 600))
         self.session_manager = yield SessionManager.from_redis_config(
-                r_config, r_prefix, max_session_length=session_timeout)
+                r_config, r_prefix, max_session_length=session_timeout,
+                cache_size=int(self.config.get("session_cache_size", 0)),
+                cache_ttl=int(self.config.get("session_cache_ttl", 30)))
 
     @inlineCallbacks
     def teardown_transport(self):
@@ -47,6 +47,14 @@ class MtnNigeriaUssdTransportConfig(Transport.CONFIG_CLASS):
     session_timeout_period = ConfigInt(
         "Max length (in seconds) of a USSD session",
         default=600, static=True)
+    session_cache_size = ConfigInt(
+        "Number of USSD sessions to cache in process. Cached sessions are"
+        " leased to this transport and written to Redis in the background."
+        " Default is 0 (no caching).",
+        default=0, static=True)
+    session_cache_ttl = ConfigInt(
+        "Number of seconds to cache a USSD session for.",
+        default=30, static=True)
 
 
 class MtnNigeriaUssdTransport(Transport):
@@ -74,7 +82,9 @@ class MtnNigeriaUssdTransport(Transport):
         r_prefix = "vumi.transports.mtn_nigeria:%s" % self.transport_name
         self.session_manager = yield SessionManager.from_redis_config(
             config.redis_manager, r_prefix,
-            config.session_timeout_period)
+            config.session_timeout_period,
+            cache_size=config.session_cache_size,
+            cache_ttl=config.session_cache_ttl)
 
         self.factory = MtnNigeriaUssdClientFactory(
             vumi_transport=self,
@@ -36,6 +36,14 @@ class TruteqTransportConfig(Transport.CONFIG_CLASS):
     ussd_session_lifetime = ConfigInt(
         'Maximum number of seconds to retain USSD session information.',
         default=300, static=True)
+    session_cache_size = ConfigInt(
+        'Number of USSD sessions to cache in process. Cached sessions are'
+        ' leased to this transport and written to Redis in the background.'
+        ' Default is 0 (no caching).',
+        default=0, static=True)
+    session_cache_ttl = ConfigInt(
+        'Number of seconds to cache a USSD session for.',
+        default=30, static=True)
     debug = ConfigBool(
         'Print verbose log output.', default=False, static=True)
     redis_manager = ConfigDict(
@@ -125,7 +133,9 @@ class TruteqTransport(Transport):
 
         prefix = "%s:ussd_codes" % (config.transport_name,)
         self.session_manager = yield SessionManager.from_redis_config(
-            config.redis_manager, prefix, config.ussd_session_lifetime)
+            config.redis_manager, prefix, config.ussd_session_lifetime,
+            cache_size=config.session_cache_size,
+            cache_ttl=config.session_cache_ttl)
         self.client_service = self.get_service(
             config.twisted_endpoint, self.client_factory)
 
@@ -13,9 +13,11 @@ from twisted.python import log
 from vumi.service import Worker
 from vumi.middleware import setup_middlewares_from_config
 from vumi.connectors import ReceiveInboundConnector, ReceiveOutboundConnector
-from vumi.config import Config, ConfigInt
+from vumi.config import (
+    Config, ConfigInt, ConfigText, ConfigBool, ConfigDict, ConfigCache)
 from vumi.errors import DuplicateConnectorError
 from vumi.utils import generate_worker_id
+from vumi.blinkenlights.metrics import MetricManager
 from vumi.blinkenlights.heartbeat import (HeartBeatPublisher,
                                           HeartBeatMessage)
 
@@ -34,6 +36,74 @@ class BaseConfig(Config):
         "The number of messages fetched concurrently from each AMQP queue"
         " by each worker instance.",
         default=20, static=True)
+    amqp_message_codec = ConfigText(
+        "The codec used to encode messages published by this worker. One of"
+        " 'json' (the original format), 'fast_json' (the same format, decoded"
+        " faster) or 'msgpack' (requires the 'msgpack' package). Messages are"
+        " always decoded according to their AMQP content type, so workers"
+        " using different codecs can talk to each other as long as they all"
+        " understand the codecs in use.",
+        default='json', static=True)
+    amqp_compact_messages = ConfigBool(
+        "If true, user messages and events received over AMQP are decoded"
+        " into compact slot-based message objects without validation. They"
+        " behave like ordinary messages but use less memory and are cheaper"
+        " to decode.",
+        default=False, static=True)
+    amqp_batch_publishes = ConfigBool(
+        "If true, outgoing messages are sent to AMQP in batches once per"
+        " reactor tick rather than one at a time.",
+        default=False, static=True)
+    amqp_confirm_publishes = ConfigBool(
+        "If true, outgoing messages are batched and each batch is sent in an"
+        " AMQP transaction. Publishing a message only completes once the"
+        " broker has committed it.",
+        default=False, static=True)
+    amqp_max_unconfirmed_publishes = ConfigInt(
+        "The maximum number of outgoing messages on each routing key that"
+        " may be sent to AMQP without being confirmed. Further messages are"
+        " held back until earlier ones are confirmed. Only used when batching"
+        " or confirming publishes.",
+        required=False, static=True)
+    amqp_adaptive_prefetch = ConfigDict(
+        "If set, the prefetch limit for each AMQP queue is adjusted"
+        " automatically to keep a target number of messages being handled at"
+        " once, starting at `amqp_prefetch_count`. The (optional) keys are"
+        " `target_concurrency` (defaults to `amqp_consumer_concurrency`),"
+        " `min_prefetch`, `max_prefetch`, `max_delay` (the longest a"
+        " prefetched message should wait to be handled), `interval` (how"
+        " many seconds between adjustments) and `smoothing`. See"
+        " :class:`vumi.connectors.AdaptivePrefetchConfig`.",
+        required=False, static=True)
+    amqp_consumer_concurrency = ConfigInt(
+        "The maximum number of messages from each AMQP queue that may be"
+        " handled at once. No more messages are taken from a queue while"
+        " this many are being handled. The default of 1 handles messages"
+        " one at a time, in order.",
+        default=1, static=True)
+    amqp_connections = ConfigInt(
+        "The number of AMQP connections to open. Connectors are spread across"
+        " them so that a busy publisher doesn't hold up consumers (or other"
+        " connectors) sharing its socket.",
+        default=1, static=True)
+    amqp_connector_connections = ConfigDict(
+        "Which AMQP connection each connector uses, keyed by connector name."
+        " Values are either a connection index for all of the connector's"
+        " channels or a dict with `consume` and `publish` indexes. Connectors"
+        " not listed here consume and publish on different connections,"
+        " assigned round-robin. Only used if `amqp_connections` is greater"
+        " than 1.",
+        default={}, static=True)
+    config_cache_size = ConfigInt(
+        "The maximum number of message-specific config objects to cache."
+        " Set this to 0 to build a new config object for every message."
+        " Defaults to the worker's `CONFIG_CACHE_SIZE`, which is 0 unless"
+        " the worker opts in to caching.",
+        required=False, static=True)
+    amqp_metrics_prefix = ConfigText(
+        "If set, metrics for each AMQP queue (such as the number of messages"
+        " being handled at once) are published with this prefix.",
+        required=False, static=True)
 
 
 class BaseWorker(Worker):
@@ -45,20 +115,32 @@ class BaseWorker(Worker):
     """
 
     CONFIG_CLASS = BaseConfig
+    # Workers whose config objects are expensive to build and that don't
+    # change `self.config` in place can set this to cache them.
+    CONFIG_CACHE_SIZE = 0
+
+    config_cache = None
 
     def __init__(self, options, config=None):
         super(BaseWorker, self).__init__(options, config=config)
         self.connectors = {}
         self.middlewares = []
         self._static_config = self.CONFIG_CLASS(self.config, static=True)
+        cache_size = self._static_config.config_cache_size
+        if cache_size is None:
+            cache_size = self.CONFIG_CACHE_SIZE
+        self.config_cache = ConfigCache(cache_size)
         self._hb_pub = None
         self._worker_id = None
+        self._amqp_metrics = None
+        self._next_amqp_connection = 0
 
     def startWorker(self):
         log.msg('Starting a %s worker with config: %s'
                 % (self.__class__.__name__, self.config))
         d = maybeDeferred(self._validate_config)
         then_call(d, self.setup_heartbeat)
+        then_call(d, self.setup_amqp_metrics)
         then_call(d, self.setup_middleware)
         then_call(d, self.setup_connectors)
         then_call(d, self.setup_worker)
@@ -70,6 +152,7 @@ class BaseWorker(Worker):
         then_call(d, self.teardown_worker)
         then_call(d, self.teardown_connectors)
         then_call(d, self.teardown_middleware)
+        then_call(d, self.teardown_amqp_metrics)
         then_call(d, self.teardown_heartbeat)
         return d
 
@@ -98,6 +181,18 @@ class BaseWorker(Worker):
             self._hb_pub.stop()
             self._hb_pub = None
 
+    @inlineCallbacks
+    def setup_amqp_metrics(self):
+        prefix = self.get_static_config().amqp_metrics_prefix
+        if prefix is not None:
+            self._amqp_metrics = yield self.start_publisher(
+                MetricManager, prefix)
+
+    def teardown_amqp_metrics(self):
+        if self._amqp_metrics is not None:
+            self._amqp_metrics.stop()
+            self._amqp_metrics = None
+
     def _gen_heartbeat_attrs(self):
         # worker_name is guaranteed to be set here, otherwise this func would
         # not have been called
@@ -146,14 +241,38 @@ class BaseWorker(Worker):
         """Return static (message independent) configuration."""
         return self._static_config
 
+    @property
+    def config(self):
+        return self._config
+
+    @config.setter
+    def config(self, config):
+        self._config = config
+        if self.config_cache is not None:
+            self.invalidate_config_cache()
+
     def get_config(self, msg, ctxt=None):
         """This should return a message and context specific config object.
 
         It deliberately returns a deferred even when this isn't strictly
         necessary to ensure that workers will continue to work when per-message
         configuration needs to be fetched from elsewhere.
+
+        If the worker caches config objects, this one is built once and
+        kept in :attr:`config_cache`. The cache is cleared when
+        ``self.config`` is replaced, but :meth:`invalidate_config_cache`
+        must be called after changing it in place.
         """
-        return succeed(self.CONFIG_CLASS(self.config))
+        return succeed(self.config_cache.get(
+            None, lambda: self.CONFIG_CLASS(self.config)))
+
+    def invalidate_config_cache(self, key=None, all_keys=True):
+        """Discard cached config objects so they're rebuilt when next used.
+
+        By default everything is discarded. Pass ``all_keys=False`` to
+        discard only the config cached under `key`.
+        """
+        self.config_cache.invalidate(key, all_keys=all_keys)
 
     def _validate_config(self):
         """Once subclasses call `super().validate_config` properly,
@@ -177,18 +296,56 @@ class BaseWorker(Worker):
         if connector_name in self.connectors:
             raise DuplicateConnectorError("Attempt to add duplicate connector"
                                           " with name %r" % (connector_name,))
-        prefetch_count = self.get_static_config().amqp_prefetch_count
+        config = self.get_static_config()
         middlewares = self.middlewares if middleware else None
+        amqp_connections = self._assign_amqp_connections(connector_name)
+        publisher_options = {
+            'batch_publishes': config.amqp_batch_publishes,
+            'confirm_publishes': config.amqp_confirm_publishes,
+            'max_unconfirmed': config.amqp_max_unconfirmed_publishes,
+        }
 
-        connector = connector_cls(self, connector_name,
-                                  prefetch_count=prefetch_count,
-                                  middlewares=middlewares)
+        connector = connector_cls(
+            self, connector_name,
+            prefetch_count=config.amqp_prefetch_count,
+            middlewares=middlewares,
+            message_codec=config.amqp_message_codec,
+            compact_messages=config.amqp_compact_messages,
+            publisher_options=publisher_options,
+            adaptive_prefetch=config.amqp_adaptive_prefetch,
+            concurrency=config.amqp_consumer_concurrency,
+            metric_manager=self._amqp_metrics,
+            amqp_connections=amqp_connections)
         self.connectors[connector_name] = connector
 
         d = connector.setup()
         d.addCallback(lambda r: connector)
         return d
 
+    def _assign_amqp_connections(self, connector_name):
+        """Pick AMQP connections for a connector's consumers and publishers.
+
+        Returns a dict with `consume` and `publish` connection indexes, or
+        `None` if there's only one connection.
+        """
+        config = self.get_static_config()
+        if config.amqp_connections <= 1:
+            return None
+        assigned = config.amqp_connector_connections.get(connector_name)
+        if isinstance(assigned, dict):
+            return {
+                'consume': assigned.get('consume', 0),
+                'publish': assigned.get('publish', 0),
+            }
+        if assigned is not None:
+            return {'consume': assigned, 'publish': assigned}
+        index = self._next_amqp_connection
+        self._next_amqp_connection += 1
+        return {
+            'consume': index % config.amqp_connections,
+            'publish': (index + 1) % config.amqp_connections,
+        }
+
     def teardown_connector(self, connector_name):
         connector = self.connectors.pop(connector_name)
         d = connector.teardown()